@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Decomposition of an arbitrary model domain into sub-domains (clones) along river basin boundaries.
+#
+# Given the cloneMap, landmask and lddMap of an ini file, the domain is split into K sub-domains:
+# - every river basin (catchment of a pit in the lddMap) is assigned as a whole to one sub-domain,
+#   so that the routing in the sub-domains remains independent;
+# - basins are distributed using the longest-processing-time-first method (see clone_scheduler.py),
+#   so that the sub-domains have (as far as the basin sizes allow) the same number of cells.
+#
+# For every sub-domain, a clone map (the bounding box, extended to integer coordinates) and a landmask
+# map are written. A modified ini file that uses these maps for a parallel run is also written.
+#
+# Usage: python basin_decomposition.py <ini_file> <number_of_sub_domains> <output_folder>
+#
+# The generated ini file can be used with a parallel run, e.g.
+#   python deterministic_runner_with_arguments.py <generated_ini_file> parallel <clone_number> ...
+# with clone numbers 1 to K.
+
+import os
+import sys
+import re
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+import clone_scheduler
+
+import logging
+logger = logging.getLogger(__name__)
+
+# file name patterns of the sub-domain maps (consistent with the "M%07i" folders used in parallel runs)
+clone_map_file_name    = "clone_M%07i.map"
+landmask_map_file_name = "mask_M%07i.map"
+
+
+def assign_basins(basin_ids, number_of_sub_domains):
+    """
+    Return a numpy array (same shape as basin_ids, 0 = not in domain) with sub-domain numbers 1 to K.
+    K is limited to the number of basins.
+    """
+
+    valid = basin_ids > 0
+    ids, counts = np.unique(basin_ids[valid], return_counts = True)
+
+    if ids.size == 0:
+        msg = "There are no basins within the landmask."
+        raise Exception(msg)
+    if number_of_sub_domains > ids.size:
+        msg = "The number of sub-domains (" + str(number_of_sub_domains) + ") is larger than the number of basins (" + str(ids.size) + "). " + \
+              "The number of sub-domains is set to " + str(ids.size) + "."
+        logger.warning(msg)
+        number_of_sub_domains = ids.size
+
+    costs = dict(zip(ids.tolist(), counts.astype(np.float64).tolist()))
+    partitions = clone_scheduler.partition_clones(costs, number_of_sub_domains)
+
+    target = float(counts.sum()) / number_of_sub_domains
+    if counts.max() > target:
+        msg  = "The largest basin (" + str(int(counts.max())) + " cells) is larger than the target size of a sub-domain (" + "%.0f" %(target) + " cells). "
+        msg += "The sub-domains cannot be fully balanced."
+        logger.warning(msg)
+
+    # lookup table: basin id -> sub-domain number
+    lookup = np.zeros(int(ids.max()) + 1, dtype = np.int32)
+    for i_sub_domain, (basins, total_cost) in enumerate(partitions):
+        lookup[np.array(basins, dtype = np.int64)] = i_sub_domain + 1
+        logger.info("Sub-domain %i: %i basins, %.0f cells" %(i_sub_domain + 1, len(basins), total_cost))
+
+    sub_domains = np.zeros(basin_ids.shape, dtype = np.int32)
+    sub_domains[valid] = lookup[basin_ids[valid]]
+    return sub_domains
+
+
+def extend_to_integer_coordinate(index, origin, cellsize, direction, limit):
+    """
+    Move a row/column index (in the given direction, at most until limit) until its edge has an integer coordinate.
+    """
+
+    while index != limit:
+        coordinate = origin + index * cellsize
+        if abs(coordinate - round(coordinate)) < 1e-6: return index
+        index += direction
+    return index
+
+
+def write_sub_domain_maps(sub_domains, attributes, output_folder):
+    """
+    Write the clone and landmask maps of every sub-domain. Return the list of (xmin, ymin, xmax, ymax) of the clones.
+    """
+
+    cellsize = attributes['cellsize']
+    west     = attributes['xUL']
+    north    = attributes['yUL']
+    nr_rows, nr_cols = sub_domains.shape
+
+    extents = []
+    for i_sub_domain in range(1, int(sub_domains.max()) + 1):
+
+        rows, cols = np.nonzero(sub_domains == i_sub_domain)
+        if rows.size == 0:
+            extents.append(None)
+            continue
+
+        # bounding box (index of the first row/column and the edge after the last row/column), extended to integer coordinates
+        row_min = extend_to_integer_coordinate(int(rows.min())    , north, -cellsize, -1, 0)
+        row_max = extend_to_integer_coordinate(int(rows.max()) + 1, north, -cellsize,  1, nr_rows)
+        col_min = extend_to_integer_coordinate(int(cols.min())    , west ,  cellsize, -1, 0)
+        col_max = extend_to_integer_coordinate(int(cols.max()) + 1, west ,  cellsize,  1, nr_cols)
+
+        sub_west  = west  + col_min * cellsize
+        sub_north = north - row_min * cellsize
+
+        pcr.setclone(row_max - row_min, col_max - col_min, cellsize, sub_west, sub_north)
+
+        window   = sub_domains[row_min:row_max, col_min:col_max]
+        clone    = pcr.numpy2pcr(pcr.Boolean, np.ones(window.shape, dtype = np.int8), -1)
+        landmask = pcr.numpy2pcr(pcr.Boolean, np.where(window == i_sub_domain, 1, 0).astype(np.int8), 0)
+        landmask = pcr.ifthen(landmask, landmask)
+
+        pcr.report(clone   , os.path.join(output_folder, clone_map_file_name    %(i_sub_domain)))
+        pcr.report(landmask, os.path.join(output_folder, landmask_map_file_name %(i_sub_domain)))
+
+        extents.append((sub_west, north - row_max * cellsize, west + col_max * cellsize, sub_north))
+
+    return extents
+
+
+def write_ini_file(original_ini_file, new_ini_file, output_folder, number_of_sub_domains, attributes):
+    """
+    Write a copy of the ini file using the sub-domain clone and landmask maps (options in other sections are kept).
+    """
+
+    replacements = {'globalOptions': {'cloneMap'        : os.path.join(output_folder, clone_map_file_name),
+                                      'landmask'        : os.path.join(output_folder, landmask_map_file_name)},
+                    'reportingOptions': {'landmask_for_reporting': os.path.join(output_folder, landmask_map_file_name)},
+                    'globalMergingAndModflowOptions':
+                                     {'number_of_clones': str(number_of_sub_domains),
+                                      'xmin'            : str(attributes['xUL']),
+                                      'ymax'            : str(attributes['yUL']),
+                                      'xmax'            : str(attributes['xUL'] + attributes['cols'] * attributes['cellsize']),
+                                      'ymin'            : str(attributes['yUL'] - attributes['rows'] * attributes['cellsize']),
+                                      'cellsize_in_arcsec': str(int(round(attributes['cellsize'] * 3600.)))}}
+
+    section = None
+    lines = []
+    for line in open(original_ini_file):
+        found = re.match(r"^\s*\[(.+)\]", line)
+        if found is not None: section = found.group(1).strip()
+        found = re.match(r"^(\s*)([A-Za-z_0-9]+)(\s*=\s*)", line)
+        if section in replacements and found is not None and found.group(2) in replacements[section]:
+            line = found.group(1) + found.group(2) + found.group(3) + replacements[section][found.group(2)] + "\n"
+        lines.append(line)
+
+    with open(new_ini_file, "w") as f:
+        f.writelines(lines)
+
+
+def main():
+
+    import configuration
+
+    ini_file              = os.path.abspath(sys.argv[1])
+    number_of_sub_domains = int(sys.argv[2])
+    output_folder         = os.path.abspath(sys.argv[3])
+
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if os.path.exists(output_folder) == False: os.makedirs(output_folder)
+    tmp_folder = os.path.join(output_folder, "tmp")
+    if os.path.exists(tmp_folder) == False: os.makedirs(tmp_folder)
+
+    general_configuration = configuration.Configuration(iniFileName = ini_file, debug_mode = False, no_modification = False)
+    general_configuration.set_input_files()
+    global_options = general_configuration.globalOptions
+    clone_map = general_configuration.cloneMap
+
+    # domain, landmask and ldd
+    pcr.setclone(clone_map)
+    attributes = vos.getMapAttributesALL(clone_map)
+    ldd = vos.readPCRmapClone(general_configuration.routingOptions['lddMap'], clone_map, tmp_folder, global_options['inputDir'], True)
+    ldd = pcr.lddrepair(pcr.ldd(ldd))
+    landmask = pcr.defined(ldd)
+    if global_options['landmask'] != "None":
+        landmask = vos.readPCRmapClone(global_options['landmask'], clone_map, tmp_folder, global_options['inputDir'])
+        landmask = pcr.boolean(pcr.cover(landmask, pcr.boolean(0.0)))
+    landmask = pcr.ifthen(landmask, landmask)
+
+    # basins (one id per pit) within the landmask
+    basins = pcr.ifthen(landmask, pcr.catchment(ldd, pcr.nominal(pcr.uniqueid(pcr.ifthen(pcr.pit(ldd) != 0, pcr.boolean(1.0))))))
+    basin_ids = pcr.pcr2numpy(basins, 0).astype(np.int64)
+
+    sub_domains = assign_basins(basin_ids, number_of_sub_domains)
+    number_of_sub_domains = int(sub_domains.max())
+    write_sub_domain_maps(sub_domains, attributes, output_folder)
+
+    new_ini_file = os.path.join(output_folder, os.path.basename(ini_file).replace(".ini", "") + "_%i_sub_domains.ini" %(number_of_sub_domains))
+    write_ini_file(ini_file, new_ini_file, output_folder, number_of_sub_domains, attributes)
+    logger.info("The clone/landmask maps and the ini file " + new_ini_file + " are written to the folder " + output_folder)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Cache of daily seasonal climatologies (e.g. cropCoefficientNC, interceptCapNC and coverFractionNC of the land cover types).
+#
+# These netcdf files contain one year of daily values (366 or 365 time steps) that are used for every year of a run
+# (see virtualOS.netcdf2PCRobjClone with useDoy = 'daily_seasonal'). Such a file is read once (at the start of a run) for
+# all days of a (leap) year into a (366, land cell) float32 array. The daily maps are then given from this array, without file I/O.
+#
+# The values of a day are read with virtualOS.netcdf2PCRobjClone, i.e. with the same date selection and the same clone cropping
+# and regridding. The date selection of daily_seasonal depends only on the month and day for a file that contains one year.
+# Files with more than one year are not cached (they are read as usual).
+
+import datetime
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# a leap year, used to read the values for all days (month and day) of a year
+year_for_reading = 2000
+
+# caches (one per clone map) shared by all land cover types
+caches = {}
+
+
+def get_climatology_cache(cloneMapFileName, landmask):
+    """
+    Return the cache for a clone map (created at the first call).
+    """
+    if cloneMapFileName not in list(caches.keys()): caches[cloneMapFileName] = ClimatologyCache(cloneMapFileName, landmask)
+    return caches[cloneMapFileName]
+
+
+class ClimatologyCache(object):
+
+    def __init__(self, cloneMapFileName, landmask):
+        object.__init__(self)
+
+        self.cloneMapFileName = cloneMapFileName
+
+        # land cells (flat indices of the clone)
+        landmask = pcr.pcr2numpy(pcr.cover(landmask, pcr.boolean(0)), 0)
+        self.shape = landmask.shape
+        self.cells = np.flatnonzero(landmask)
+
+        # values (366, land cell) of every cached file and variable
+        self.values = {}
+
+    def preload(self, ncFile, varName):
+        """
+        Read the values of all days of a climatology file into the cache (if the file contains one year).
+        """
+
+        if (ncFile, varName) in list(self.values.keys()): return
+
+        if ncFile not in list(vos.filecache.keys()): vos.filecache[ncFile] = vos.nc.Dataset(ncFile)
+        time = vos.filecache[ncFile].variables['time']
+        if len(time) > 366 or vos.findFirstYearInNCTime(time) != vos.findLastYearInNCTime(time):
+            msg = "The file " + str(ncFile) + " contains more than one year. It is not cached as a climatology."
+            logger.warning(msg)
+            return
+
+        memory_in_mb = 366. * self.cells.size * 4. / (1024. * 1024.)
+        msg = "Reading the climatology " + str(varName) + " from the file " + str(ncFile) + " into the cache: 366 days x " + str(self.cells.size) + " land cells " + \
+              "(%.1f MB; total: %.1f MB)." %(memory_in_mb, self.memory_in_mb() + memory_in_mb)
+        logger.info(msg)
+
+        values = np.zeros((366, self.cells.size), dtype = np.float32)
+        for i_day in range(366):
+            date = datetime.datetime(year_for_reading, 1, 1) + datetime.timedelta(days = i_day)
+            daily_map = vos.netcdf2PCRobjClone(ncFile, varName, date, useDoy = 'daily_seasonal', cloneMapFileName = self.cloneMapFileName)
+            values[i_day] = pcr.pcr2numpy(daily_map, np.nan).ravel()[self.cells]
+        self.values[(ncFile, varName)] = values
+
+    def memory_in_mb(self):
+        return sum([values.nbytes for values in list(self.values.values())]) / (1024. * 1024.)
+
+    def read(self, ncFile, varName, date):
+        """
+        Return the map of a day (month and day of the date) from the cache, or from the file if it is not cached.
+        Cells outside the land cells have missing values.
+        """
+
+        if (ncFile, varName) not in list(self.values.keys()):
+            return vos.netcdf2PCRobjClone(ncFile, varName, date, useDoy = 'daily_seasonal', cloneMapFileName = self.cloneMapFileName)
+
+        if isinstance(date, str) == True: date = datetime.datetime.strptime(str(date),'%Y-%m-%d')
+        i_day = (datetime.datetime(year_for_reading, date.month, date.day) - datetime.datetime(year_for_reading, 1, 1)).days
+
+        grid = np.full(self.shape, vos.MV, dtype = np.float32)
+        values = self.values[(ncFile, varName)][i_day]
+        grid.ravel()[self.cells] = np.where(np.isnan(values), vos.MV, values)
+        return pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
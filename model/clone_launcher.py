@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Launcher for a set of parallel (clone) runs:
+# - the clone runs are executed as child processes, with a maximum number of concurrent runs;
+# - exit codes are captured and failed clone runs can be restarted (retried);
+# - wall time and peak memory use (RSS) of every clone run are reported.
+#
+# A run is either a command line (executed as a new process) or a python function that is
+# executed in a forked child of the current process (see multi_clone_runner.py).
+#
+# Only the launched processes are reaped (os.wait4 with their pids). The launcher is woken up by SIGCHLD
+# (through a pipe given to signal.set_wakeup_fd) instead of polling. If the runs wait for each other
+# (e.g. runs with merging and/or MODFLOW), all runs are terminated as soon as one of them fails.
+
+import os
+import sys
+import time
+import select
+import signal
+import threading
+import subprocess
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_available_memory_in_gb():
+    """
+    Return the available memory (GB) based on /proc/meminfo (Linux), or None if this is unknown.
+    """
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"): return float(line.split()[1]) / (1024. * 1024.)
+    except:
+        pass
+    return None
+
+
+def get_default_max_concurrency(memory_per_run_in_gb = None):
+    """
+    Default maximum number of concurrent runs: the number of available cores,
+    limited by the available memory if the memory needed per run is given.
+    """
+
+    try:
+        number_of_cores = len(os.sched_getaffinity(0))
+    except:
+        number_of_cores = os.cpu_count() or 1
+    max_concurrency = number_of_cores
+
+    if memory_per_run_in_gb is not None and memory_per_run_in_gb > 0.0:
+        available_memory = get_available_memory_in_gb()
+        if available_memory is not None:
+            max_concurrency = min(max_concurrency, int(available_memory / memory_per_run_in_gb))
+
+    return max(1, max_concurrency)
+
+
+def create_launcher_from_options(options, number_of_runs, runs_wait_for_each_other = False):
+    """
+    Create a CloneLauncher based on a dictionary of ini options (e.g. globalOptions):
+    - max_number_of_parallel_clone_runs   : maximum number of concurrent runs (default: based on the available cores and memory)
+    - memory_per_clone_run_in_gb          : estimated memory needed by a run (used to limit the default number of concurrent runs)
+    - max_number_of_retries_for_clone_runs: number of restarts for failed runs (default: 0)
+    If the runs wait for each other (e.g. runs with merging and/or modflow), all runs are executed at the same time,
+    failed runs are not restarted and all runs are terminated if one of them fails.
+    """
+
+    max_concurrency = None
+    if 'max_number_of_parallel_clone_runs' in list(options.keys()) and options['max_number_of_parallel_clone_runs'] != "None":
+        max_concurrency = int(options['max_number_of_parallel_clone_runs'])
+    memory_per_run_in_gb = None
+    if 'memory_per_clone_run_in_gb' in list(options.keys()) and options['memory_per_clone_run_in_gb'] != "None":
+        memory_per_run_in_gb = float(options['memory_per_clone_run_in_gb'])
+    max_retries = 0
+    if 'max_number_of_retries_for_clone_runs' in list(options.keys()):
+        max_retries = int(options['max_number_of_retries_for_clone_runs'])
+
+    if max_concurrency is None: max_concurrency = get_default_max_concurrency(memory_per_run_in_gb)
+
+    if runs_wait_for_each_other and max_concurrency < number_of_runs:
+        msg  = "The maximum number of parallel clone runs (" + str(max_concurrency) + ") is lower than the number of clones (" + str(number_of_runs) + "). "
+        msg += "This is not possible for runs with merging and/or modflow processes. All clones will be executed at the same time."
+        logger.warning(msg)
+        max_concurrency = number_of_runs
+
+    if runs_wait_for_each_other and max_retries > 0:
+        msg = "Failed clone runs cannot be restarted in runs with merging and/or modflow processes. The option max_number_of_retries_for_clone_runs is not used."
+        logger.warning(msg)
+        max_retries = 0
+
+    return CloneLauncher(max_concurrency = max_concurrency, max_retries = max_retries, runs_wait_for_each_other = runs_wait_for_each_other)
+
+
+class _ForkedProcess(object):
+    """
+    Process handle (with the same attributes as used from subprocess.Popen) for a python function executed in a forked child.
+    """
+
+    def __init__(self, function):
+        object.__init__(self)
+
+        self.returncode = None
+        self.pid = os.fork()
+        if self.pid == 0:
+            # child process (without the SIGCHLD wake up of the launcher, see CloneLauncher.start_waking_up_on_child_exit)
+            exit_code = 1
+            try:
+                CloneLauncher.stop_waking_up_on_child_exit()
+                exit_code = function()
+                if exit_code is None: exit_code = 0
+            except:
+                logger.exception("The forked run failed.")
+            finally:
+                sys.stdout.flush() ; sys.stderr.flush()
+                logging.shutdown()
+                os._exit(int(exit_code))
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0: self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None: os.kill(self.pid, signal.SIGTERM)
+
+
+class CloneRun(object):
+
+    def __init__(self, name, command):
+        object.__init__(self)
+
+        self.name    = name           # e.g. the clone code
+        self.command = command        # list of arguments, or a python function (executed in a forked child)
+
+        self.attempts    = 0
+        self.exit_code   = None
+        self.wall_time   = None       # seconds (of the last attempt)
+        self.peak_rss    = None       # MB (of the last attempt)
+        self.process     = None
+        self.start_time  = None
+
+    def start(self):
+
+        self.attempts  += 1
+        self.start_time = time.time()
+        if callable(self.command):
+            msg = "Starting the run " + str(self.name) + " (attempt " + str(self.attempts) + ") in a forked process."
+            logger.info(msg)
+            self.process = _ForkedProcess(self.command)
+        else:
+            msg = "Starting the run " + str(self.name) + " (attempt " + str(self.attempts) + "): " + " ".join(self.command)
+            logger.info(msg)
+            self.process = subprocess.Popen(self.command)
+
+    def finish(self, exit_code, peak_rss = None):
+
+        self.exit_code = exit_code
+        self.wall_time = time.time() - self.start_time
+        self.peak_rss  = peak_rss
+        self.process   = None
+
+        msg = "The run " + str(self.name) + " (attempt " + str(self.attempts) + ") finished with the exit code " + str(self.exit_code) + \
+              "; wall time: " + "%.1f" %(self.wall_time) + " seconds" + \
+              "; peak RSS: " + ("%.1f MB" %(self.peak_rss) if self.peak_rss is not None else "N/A")
+        if self.exit_code == 0:
+            logger.info(msg)
+        else:
+            logger.warning(msg)
+
+
+class CloneLauncher(object):
+
+    # pipe written by SIGCHLD (see start_waking_up_on_child_exit) and the previous SIGCHLD handler
+    wake_up_pipe = None
+    previous_sigchld_handler = None
+
+    def __init__(self, max_concurrency = None, max_retries = 0, memory_per_run_in_gb = None, runs_wait_for_each_other = False):
+        object.__init__(self)
+
+        if max_concurrency is None: max_concurrency = get_default_max_concurrency(memory_per_run_in_gb)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries     = max(0, int(max_retries))
+
+        # if the runs wait for each other, all runs are terminated as soon as one of them fails
+        self.runs_wait_for_each_other = runs_wait_for_each_other
+
+        # runs that do not occupy a slot and are not retried (e.g. the merging/MODFLOW process)
+        self.background_runs = []
+
+        # runs managed by the pool
+        self.runs            = []
+
+    def add_run(self, name, command):
+        self.runs.append(CloneRun(name, command))
+
+    def add_background_run(self, name, command):
+        self.background_runs.append(CloneRun(name, command))
+
+    @classmethod
+    def start_waking_up_on_child_exit(cls):
+
+        # SIGCHLD writes to a pipe (signal.set_wakeup_fd), so that the launcher can block until a child exits;
+        # this is only possible in the main thread (otherwise the launcher checks its children every second)
+        if cls.wake_up_pipe is not None or hasattr(signal, "SIGCHLD") == False or threading.current_thread() is not threading.main_thread(): return
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False) ; os.set_blocking(write_fd, False)
+        cls.previous_sigchld_handler = signal.signal(signal.SIGCHLD, lambda signal_number, frame: None)
+        signal.set_wakeup_fd(write_fd)
+        cls.wake_up_pipe = (read_fd, write_fd)
+
+    @classmethod
+    def stop_waking_up_on_child_exit(cls):
+
+        if cls.wake_up_pipe is None: return
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, cls.previous_sigchld_handler if cls.previous_sigchld_handler is not None else signal.SIG_DFL)
+        for fd in cls.wake_up_pipe: os.close(fd)
+        cls.wake_up_pipe = None
+
+    def _reap(self, run):
+        """
+        Reap the process of a run if it has exited (without blocking). Return its exit code and peak RSS (MB), or None if it is still running.
+        """
+
+        if hasattr(os, "wait4") == False:
+            # fallback (e.g. on Windows)
+            exit_code = run.process.poll()
+            if exit_code is None: return None
+            return exit_code, None
+
+        try:
+            pid, status, rusage = os.wait4(run.process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # already reaped (e.g. by Popen.send_signal in terminate)
+            return run.process.returncode, None
+        if pid == 0: return None
+        # let the Popen object know that the process has been reaped
+        exit_code = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else (status >> 8)
+        run.process.returncode = exit_code
+        # ru_maxrss is in kilobytes on Linux (and in bytes on macOS)
+        peak_rss = rusage.ru_maxrss / 1024.
+        if sys.platform == "darwin": peak_rss = peak_rss / 1024.
+        return exit_code, peak_rss
+
+    def _wait_for_any_child(self, running):
+        """
+        Block until one of the running processes exits. Return the run, its exit code and peak RSS (MB).
+        Other child processes of this process are not reaped.
+        """
+
+        while True:
+            for run in running:
+                result = self._reap(run)
+                if result is not None: return (run,) + result
+
+            # wait for SIGCHLD (a child that exits after the check above also writes to the pipe)
+            if CloneLauncher.wake_up_pipe is None:
+                time.sleep(1.0)
+                continue
+            read_fd = CloneLauncher.wake_up_pipe[0]
+            select.select([read_fd], [], [], 60.0)
+            try:
+                while len(os.read(read_fd, 512)) > 0: pass
+            except (BlockingIOError, InterruptedError):
+                pass
+
+    def run(self):
+        """
+        Execute all runs. Return True if all (pool) runs finished successfully.
+        """
+
+        msg = "Executing " + str(len(self.runs)) + " runs with a maximum of " + str(self.max_concurrency) + " concurrent runs and " + \
+              str(self.max_retries) + " retries for failed runs."
+        logger.info(msg)
+
+        self.start_waking_up_on_child_exit()
+        try:
+            return self.run_all()
+        finally:
+            self.stop_waking_up_on_child_exit()
+
+    def run_all(self):
+
+        waiting = list(self.runs)
+        running = []
+        failed  = []
+
+        for run in self.background_runs:
+            run.start()
+            running.append(run)
+
+        while len(waiting) > 0 or any(run not in self.background_runs for run in running):
+
+            # start new runs as long as there are free slots
+            while len(waiting) > 0 and len([run for run in running if run not in self.background_runs]) < self.max_concurrency:
+                run = waiting.pop(0)
+                run.start()
+                running.append(run)
+
+            run, exit_code, peak_rss = self._wait_for_any_child(running)
+            running.remove(run)
+            run.finish(exit_code, peak_rss)
+
+            if run in self.background_runs:
+                if exit_code != 0:
+                    # the clone runs may wait for this run (e.g. for the merging/MODFLOW process), so they are stopped
+                    msg = "The background run " + str(run.name) + " failed. The remaining runs will be terminated."
+                    logger.error(msg)
+                    failed.append(run)
+                    self.terminate_runs(running)
+                    failed += [run for run in running if run not in self.background_runs] + waiting
+                    running = []
+                    waiting = []
+                continue
+
+            if exit_code != 0 and self.runs_wait_for_each_other:
+                # the other runs (and the merging/MODFLOW process) wait for this run, so they are stopped
+                msg = "The run " + str(run.name) + " failed. The other runs wait for it, therefore the remaining runs will be terminated."
+                logger.error(msg)
+                failed.append(run)
+                self.terminate_runs(running)
+                failed += running + waiting
+                running = []
+                waiting = []
+                continue
+
+            if exit_code != 0:
+                if run.attempts <= self.max_retries:
+                    msg = "The run " + str(run.name) + " failed. It will be restarted."
+                    logger.warning(msg)
+                    waiting.append(run)
+                else:
+                    failed.append(run)
+
+        # wait for the background runs
+        while len(running) > 0:
+            run, exit_code, peak_rss = self._wait_for_any_child(running)
+            running.remove(run)
+            run.finish(exit_code, peak_rss)
+            if exit_code != 0: failed.append(run)
+
+        self.report_summary()
+
+        if len(failed) > 0:
+            msg = "The following runs failed: " + ", ".join([str(run.name) for run in failed])
+            logger.error(msg)
+
+        return len(failed) == 0
+
+    def terminate_runs(self, running):
+        """
+        Terminate the running processes and wait until they have exited.
+        """
+
+        for run in running:
+            msg = "Terminating the run " + str(run.name) + "."
+            logger.warning(msg)
+            run.process.terminate()
+
+        running = list(running)
+        while len(running) > 0:
+            run, exit_code, peak_rss = self._wait_for_any_child(running)
+            running.remove(run)
+            run.finish(exit_code, peak_rss)
+
+    def report_summary(self):
+
+        msg  = "\n"
+        msg += "Summary of the runs (name, attempts, exit code, wall time [s], peak RSS [MB]):\n"
+        for run in self.runs + self.background_runs:
+            peak_rss = "%.1f" %(run.peak_rss) if run.peak_rss is not None else "N/A"
+            wall_time = "%.1f" %(run.wall_time) if run.wall_time is not None else "N/A"
+            msg += "%-12s %3i %5s %12s %12s\n" %(str(run.name), run.attempts, str(run.exit_code), wall_time, peak_rss)
+        logger.info(msg)
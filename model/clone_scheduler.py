@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cost-model based partitioning of clone areas over several workers/nodes.
+#
+# The cost of every clone is estimated from:
+# - the number of landmask cells;
+# - the (mean) number of routing sub time steps per day found in the log file of a previous run;
+# - the wall time of a previous run (from its log file).
+# The clones are then distributed using the longest-processing-time-first (LPT) method and
+# the partition is written to a plan file that can be used by parallel_pcrglobwb_runner.py.
+#
+# Usage: python clone_scheduler.py <ini_file> <number_of_workers> <plan_file> [<output_folder_of_a_previous_run>]
+
+import os
+import sys
+import re
+import glob
+import datetime
+
+import pcraster as pcr
+
+from six.moves.configparser import RawConfigParser as ConfigParser
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# name of the section in the plan file
+plan_section = "clonePartitionPlan"
+
+
+def get_clone_codes(clone_areas):
+
+    clone_codes = [c.strip() for c in clone_areas.split(",")]
+    if clone_codes[0] == "Global": clone_codes = ['M%02d'%i for i in range(1,54,1)]
+    return clone_codes
+
+
+def get_clone_file_name(file_name_pattern, clone_code):
+    """
+    Fill in the clone code in a file name pattern, e.g. "mask_%s.map" or "mask_M%i.map".
+    """
+
+    try:
+        return file_name_pattern %(clone_code)
+    except TypeError:
+        return file_name_pattern %(int(clone_code.lstrip("M")))
+
+
+def get_clone_output_folder_name(clone_code):
+    """
+    Name of the output folder of a clone in a parallel run, e.g. "M0000001" for "M01" (as in deterministic_runner_with_arguments.py).
+    """
+
+    return "M%07i" %(int(clone_code.lstrip("M")))
+
+
+def count_landmask_cells(clone_map_file, landmask_file = None):
+
+    pcr.setclone(clone_map_file)
+    if landmask_file is None or landmask_file == "None":
+        landmask = pcr.defined(pcr.readmap(clone_map_file))
+    else:
+        landmask = pcr.boolean(pcr.readmap(landmask_file))
+    landmask = pcr.ifthen(landmask, landmask)
+    return float(pcr.cellvalue(pcr.maptotal(pcr.scalar(landmask)), 1)[0])
+
+
+def read_previous_run_statistics(log_folder):
+    """
+    Return the wall time (seconds) and the mean number of routing sub time steps per day based on the latest log file in 'log_folder'.
+    Values that cannot be derived are returned as None.
+    """
+
+    log_files = sorted(glob.glob(os.path.join(log_folder, "*.log")), key = os.path.getmtime)
+    if len(log_files) == 0: return None, None
+
+    time_format = "%Y-%m-%d %H:%M:%S"
+    first_time = None ; last_time = None
+    number_of_sub_time_steps = []
+    with open(log_files[-1]) as f:
+        for line in f:
+            try:
+                line_time = datetime.datetime.strptime(line[0:19], time_format)
+            except ValueError:
+                continue
+            if first_time is None: first_time = line_time
+            last_time = line_time
+            found = re.search("sub-daily time step 1 from ([0-9]+)", line)
+            if found is not None: number_of_sub_time_steps.append(int(found.group(1)))
+
+    wall_time = None
+    if first_time is not None and last_time > first_time: wall_time = (last_time - first_time).total_seconds()
+    mean_number_of_sub_time_steps = None
+    if len(number_of_sub_time_steps) > 0: mean_number_of_sub_time_steps = float(sum(number_of_sub_time_steps)) / len(number_of_sub_time_steps)
+
+    return wall_time, mean_number_of_sub_time_steps
+
+
+def estimate_costs(clone_codes, cell_counts, sub_time_steps = None, wall_times = None):
+    """
+    Estimate the cost of every clone (unit: seconds if wall times are available, otherwise relative).
+    - The basic cost is the number of cells times the mean number of routing sub time steps (1 if unknown).
+    - If wall times of a previous run are known for some clones, these are used directly and
+      the basic costs of the other clones are scaled with the mean ratio between wall time and basic cost.
+    """
+
+    if sub_time_steps is None: sub_time_steps = {}
+    if wall_times     is None: wall_times     = {}
+
+    basic_cost = {}
+    for clone_code in clone_codes:
+        steps = sub_time_steps.get(clone_code)
+        if steps is None: steps = 1.0
+        basic_cost[clone_code] = cell_counts[clone_code] * steps
+
+    measured = [c for c in clone_codes if wall_times.get(c) is not None and basic_cost[c] > 0.0]
+    scale = 1.0
+    if len(measured) > 0:
+        scale = sum(wall_times[c] for c in measured) / sum(basic_cost[c] for c in measured)
+
+    costs = {}
+    for clone_code in clone_codes:
+        if clone_code in measured:
+            costs[clone_code] = wall_times[clone_code]
+        else:
+            costs[clone_code] = basic_cost[clone_code] * scale
+
+    return costs
+
+
+def partition_clones(costs, number_of_workers):
+    """
+    Longest-processing-time-first: assign clones (in order of decreasing cost) to the worker with the lowest total cost.
+    Return a list of (clone_codes, total_cost) for every worker.
+    """
+
+    workers = [[[], 0.0] for i in range(number_of_workers)]
+    for clone_code in sorted(costs.keys(), key = lambda c: (-costs[c], c)):
+        worker = min(workers, key = lambda w: w[1])
+        worker[0].append(clone_code)
+        worker[1] += costs[clone_code]
+
+    return [(w[0], w[1]) for w in workers]
+
+
+def write_plan(plan_file, partitions):
+
+    config = ConfigParser()
+    config.optionxform = str
+    config.add_section(plan_section)
+    config.set(plan_section, "number_of_workers", str(len(partitions)))
+    for i_worker, (clone_codes, total_cost) in enumerate(partitions):
+        worker_name = "node_%i" %(i_worker + 1)
+        config.set(plan_section, worker_name, ",".join(clone_codes))
+        config.set(plan_section, worker_name + "_estimated_cost", "%.1f" %(total_cost))
+    with open(plan_file, "w") as f:
+        config.write(f)
+
+
+def read_plan(plan_file, worker_name):
+    """
+    Return the list of clone codes assigned to 'worker_name' (e.g. "node_1") in a plan file.
+    """
+
+    config = ConfigParser()
+    config.optionxform = str
+    config.read(plan_file)
+    return get_clone_codes(config.get(plan_section, worker_name))
+
+
+def main():
+
+    import configuration
+
+    ini_file          = os.path.abspath(sys.argv[1])
+    number_of_workers = int(sys.argv[2])
+    plan_file         = os.path.abspath(sys.argv[3])
+    previous_output   = None
+    if len(sys.argv) > 4: previous_output = os.path.abspath(sys.argv[4])
+
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    general_configuration = configuration.Configuration(iniFileName = ini_file, debug_mode = False, no_modification = False)
+    global_options = general_configuration.globalOptions
+
+    clone_codes = get_clone_codes(global_options['cloneAreas'])
+
+    cell_counts = {} ; sub_time_steps = {} ; wall_times = {}
+    for clone_code in clone_codes:
+        clone_map_file = vos.getFullPath(get_clone_file_name(global_options['cloneMap'], clone_code), global_options['inputDir'])
+        landmask_file  = None
+        if global_options['landmask'] != "None":
+            landmask_file = vos.getFullPath(get_clone_file_name(global_options['landmask'], clone_code), global_options['inputDir'])
+        cell_counts[clone_code] = count_landmask_cells(clone_map_file, landmask_file)
+
+        if previous_output is not None:
+            log_folder = os.path.join(previous_output, get_clone_output_folder_name(clone_code), "log")
+            wall_times[clone_code], sub_time_steps[clone_code] = read_previous_run_statistics(log_folder)
+            if wall_times[clone_code] is None:
+                msg = clone_code + ": no wall time of a previous run is found in " + log_folder + " ; the cost is estimated from the number of cells."
+                logger.warning(msg)
+
+        msg = clone_code + ": number of cells: " + str(cell_counts[clone_code]) + \
+                           " ; mean number of sub time steps: " + str(sub_time_steps.get(clone_code)) + \
+                           " ; previous wall time (s): " + str(wall_times.get(clone_code))
+        logger.info(msg)
+
+    costs = estimate_costs(clone_codes, cell_counts, sub_time_steps, wall_times)
+    partitions = partition_clones(costs, number_of_workers)
+    for i_worker, (codes, total_cost) in enumerate(partitions):
+        logger.info("node_%i : estimated cost %.1f : %s" %(i_worker + 1, total_cost, ",".join(codes)))
+
+    write_plan(plan_file, partitions)
+    logger.info("The partition plan is written to the file: " + plan_file)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Coordination between the clone runs and the merging/MODFLOW process.
+#
+# The processes still communicate through the "..._are_ready.txt" files (so that runs
+# spread over several nodes keep working), but waiting for them is now a blocking wait:
+# - on Linux, the directories containing the ready files are watched with inotify, so that
+#   the waiting process sleeps until a file appears in one of these directories;
+# - in addition (and on other platforms or on shared file systems where inotify events
+#   from other nodes are not delivered), the files are checked every 'check_interval' seconds.
+
+import os
+import sys
+import time
+import select
+import ctypes
+import ctypes.util
+
+import logging
+logger = logging.getLogger(__name__)
+
+# inotify constants (see: /usr/include/linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+# default settings (unit: seconds)
+default_check_interval  =   5.0
+default_report_interval = 300.0
+
+
+def mark_as_ready(filename):
+    """
+    Create an (empty) ready file. The file is created under a temporary name and then renamed,
+    so that a waiting process never sees a half-written file.
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok = True)
+
+    tmp_filename = filename + ".tmp." + str(os.getpid())
+    open(tmp_filename, "w").close()
+    os.replace(tmp_filename, filename)
+
+
+def remove_ready_file(filename):
+
+    if os.path.exists(filename): os.remove(filename)
+
+
+class _DirectoryWatcher(object):
+    """
+    Minimal inotify wrapper (using ctypes) to block until something is created in (a set of) directories.
+    If inotify is not available, wait() simply sleeps for the given timeout.
+    """
+
+    def __init__(self, directories):
+        object.__init__(self)
+
+        self.fd = None
+
+        if sys.platform.startswith("linux") == False: return
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except:
+            fd = -1
+        if fd < 0:
+            logger.debug("inotify is not available; falling back to periodic checks of the ready files.")
+            return
+
+        self.fd = fd
+        for directory in set(directories):
+            # directories that do not exist (yet) are covered by the periodic checks
+            if os.path.isdir(directory) == False: continue
+            libc.inotify_add_watch(self.fd, directory.encode(), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+
+    def wait(self, timeout):
+
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) > 0:
+            # discard the events; the caller will check the files themselves
+            try:
+                while len(os.read(self.fd, 4096)) > 0: pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+
+        if self.fd is not None: os.close(self.fd)
+        self.fd = None
+
+
+def wait_for_files(filenames, timeout = None, check_interval = default_check_interval, report_interval = default_report_interval, description = "ready files"):
+    """
+    Block until all files in 'filenames' exist.
+
+    The progress (number of files found) is logged every 'report_interval' seconds.
+    If 'timeout' (seconds) is given and exceeded, an exception is raised.
+    """
+
+    filenames = list(filenames)
+    waiting_for = [f for f in filenames if os.path.exists(f) == False]
+    if len(waiting_for) == 0: return
+
+    msg = "Waiting for " + str(len(waiting_for)) + " of " + str(len(filenames)) + " " + description + ", e.g. " + waiting_for[0]
+    logger.info(msg)
+
+    watcher = _DirectoryWatcher([os.path.dirname(os.path.abspath(f)) for f in waiting_for])
+
+    start_time       = time.time()
+    last_report_time = start_time
+    try:
+        while len(waiting_for) > 0:
+
+            waiting_time = check_interval
+            if timeout is not None: waiting_time = max(0.0, min(check_interval, start_time + timeout - time.time()))
+            watcher.wait(waiting_time)
+
+            waiting_for = [f for f in waiting_for if os.path.exists(f) == False]
+            if len(waiting_for) == 0: break
+
+            now = time.time()
+            if timeout is not None and now - start_time >= timeout:
+                msg = "Timeout (" + str(timeout) + " seconds) while waiting for " + description + ". Missing files: " + ", ".join(waiting_for)
+                logger.error(msg)
+                raise Exception('Error: ' + msg)
+
+            if now - last_report_time >= report_interval:
+                msg = "Still waiting for " + str(len(waiting_for)) + " of " + str(len(filenames)) + " " + description + " (" + "%.0f" %(now - start_time) + " seconds), e.g. " + waiting_for[0]
+                logger.info(msg)
+                last_report_time = now
+    finally:
+        watcher.close()
+
+    msg = "All " + description + " are available (after waiting " + "%.1f" %(time.time() - start_time) + " seconds)."
+    logger.info(msg)
+
+
+def get_waiting_options(options):
+    """
+    Return the timeout, check interval and report interval (seconds) from a dictionary of ini options (e.g. globalOptions).
+    """
+
+    timeout = None
+    if 'ready_file_timeout_in_seconds' in list(options.keys()) and options['ready_file_timeout_in_seconds'] not in ["None", "False"]:
+        timeout = float(options['ready_file_timeout_in_seconds'])
+    check_interval = default_check_interval
+    if 'ready_file_check_interval_in_seconds' in list(options.keys()):
+        check_interval = float(options['ready_file_check_interval_in_seconds'])
+    report_interval = default_report_interval
+    if 'ready_file_report_interval_in_seconds' in list(options.keys()):
+        report_interval = float(options['ready_file_report_interval_in_seconds'])
+
+    return timeout, check_interval, report_interval
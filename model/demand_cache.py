@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cache of the monthly non irrigation water demand (domestic, industry and livestock gross and netto demand netcdf files).
+#
+# These files are read on the first day of every month (see virtualOS.netcdf2PCRobjClone with useDoy = 'monthly'). For a year 
+# that is not available in a file, the first or the last year of the file is used, so that the same monthly fields are read 
+# again every year (e.g. for runs beyond the period of the demand files). The monthly values of the first and the last years 
+# of a file are kept in memory as (land cell) float32 arrays and given without file I/O when the same (clamped) date is needed again.
+#
+# With preloading (the 'preloadNonIrrigationWaterDemand' option), all monthly values that are needed for the run period 
+# (clamped to the years of the file) are read at the start of the run.
+
+import datetime
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class MonthlyDemandCache(object):
+
+    def __init__(self, cloneMapFileName, landmask):
+        object.__init__(self)
+
+        self.cloneMapFileName = cloneMapFileName
+
+        # land cells (flat indices of the clone)
+        landmask = pcr.pcr2numpy(pcr.cover(landmask, pcr.boolean(0)), 0)
+        self.shape = landmask.shape
+        self.cells = np.flatnonzero(landmask)
+
+        # first and last years of every file
+        self.years = {}
+
+        # values (land cell) of every file, variable, year and month
+        self.values = {}
+
+    def get_years(self, ncFile):
+        """
+        Return the first and the last years of a file.
+        """
+        if ncFile not in list(self.years.keys()):
+            if ncFile not in list(vos.filecache.keys()): vos.filecache[ncFile] = vos.nc.Dataset(ncFile)
+            time = vos.filecache[ncFile].variables['time']
+            self.years[ncFile] = (vos.findFirstYearInNCTime(time), vos.findLastYearInNCTime(time))
+        return self.years[ncFile]
+
+    def get_key(self, ncFile, varName, date):
+        """
+        Return the key of a date (the year is limited to the years of the file, as in virtualOS.netcdf2PCRobjClone).
+        """
+        if isinstance(date, str) == True: date = datetime.datetime.strptime(str(date),'%Y-%m-%d')
+        first_year, last_year = self.get_years(ncFile)
+        return (ncFile, varName, min(max(date.year, first_year), last_year), date.month)
+
+    def read_from_file(self, key):
+        ncFile, varName, year, month = key
+        monthly_map = vos.netcdf2PCRobjClone(ncFile, varName, datetime.datetime(year, month, 1), useDoy = 'monthly', cloneMapFileName = self.cloneMapFileName)
+        return pcr.pcr2numpy(monthly_map, np.nan).ravel()[self.cells]
+
+    def preload(self, ncFile, varName, first_year, last_year):
+        """
+        Read the monthly values of the years first_year to last_year (limited to the years of the file) into the cache.
+        """
+
+        first_year = min(max(first_year, self.get_years(ncFile)[0]), self.get_years(ncFile)[1])
+        last_year  = min(max(last_year , self.get_years(ncFile)[0]), self.get_years(ncFile)[1])
+
+        number_of_months = 12 * (last_year - first_year + 1)
+        memory_in_mb = number_of_months * self.cells.size * 4. / (1024. * 1024.)
+        msg = "Reading the monthly " + str(varName) + " (" + str(first_year) + " to " + str(last_year) + ") from the file " + str(ncFile) + " into the cache: " + \
+              str(number_of_months) + " months x " + str(self.cells.size) + " land cells " + \
+              "(%.1f MB; total: %.1f MB)." %(memory_in_mb, self.memory_in_mb() + memory_in_mb)
+        logger.info(msg)
+
+        for year in range(first_year, last_year + 1):
+            for month in range(1, 13):
+                key = (ncFile, varName, year, month)
+                if key not in list(self.values.keys()): self.values[key] = self.read_from_file(key)
+
+    def memory_in_mb(self):
+        return sum([values.nbytes for values in list(self.values.values())]) / (1024. * 1024.)
+
+    def read(self, ncFile, varName, date):
+        """
+        Return the map of a month (of the date) from the cache, or from the file if it is not cached. 
+        The values of the first and the last years of the file (that are also used for the years outside the file) are cached.
+        Cells outside the land cells have missing values.
+        """
+
+        if isinstance(date, str) == True: date = datetime.datetime.strptime(str(date),'%Y-%m-%d')
+        key = self.get_key(ncFile, varName, date)
+        if key in list(self.values.keys()):
+            values = self.values[key]
+        else:
+            values = self.read_from_file(key)
+            # - the first and the last years of a file are used for all years before and after the period of the file
+            if key[2] in self.get_years(ncFile):
+                msg = "The monthly " + str(varName) + " of " + str(key[2]) + "-" + str(key[3]) + " is kept in the cache (the file is used from " + \
+                      str(self.get_years(ncFile)[0]) + " to " + str(self.get_years(ncFile)[1]) + ")."
+                logger.debug(msg)
+                self.values[key] = values
+
+        grid = np.full(self.shape, vos.MV, dtype = np.float32)
+        grid.ravel()[self.cells] = np.where(np.isnan(values), vos.MV, values)
+        return pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
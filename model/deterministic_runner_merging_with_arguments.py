@@ -24,7 +24,6 @@
 
 import os
 import sys
-import datetime
 import glob
 import shutil
 
@@ -46,6 +45,7 @@ except:
     pass
 
 import virtualOS as vos
+import coordination
 
 import logging
 logger = logging.getLogger(__name__)
@@ -116,14 +116,7 @@ class DeterministicRunner(DynamicModel):
         if self.modelTime.isLastDayOfMonth():
             
             # wait until all pcrglobwb model runs are done
-            pcrglobwb_is_ready = False
-            self.count_check = 0
-            while pcrglobwb_is_ready == False:
-                if datetime.datetime.now().second == 14 or\
-                   datetime.datetime.now().second == 29 or\
-                   datetime.datetime.now().second == 34 or\
-                   datetime.datetime.now().second == 49:\
-                   pcrglobwb_is_ready = self.check_pcrglobwb_status()
+            self.check_pcrglobwb_status()
                 
             # merging netcdf files at daily resolution
             start_date = '%04i-%02i-01' %(self.modelTime.year, self.modelTime.month)             # TODO: Make it flexible for a run starting not on the 1st January.
@@ -229,8 +222,7 @@ class DeterministicRunner(DynamicModel):
             outputDirectory = str(self.configuration.main_output_directory) + "/global/maps/"
             if os.path.exists(outputDirectory) == False: os.makedirs(outputDirectory) 
             filename = outputDirectory + "/merged_files_for_" + str(self.modelTime.fulldate)+"_are_ready.txt"
-            if os.path.exists(filename): os.remove(filename)
-            open(filename, "w").close()    
+            coordination.mark_as_ready(filename)
 
 
     def merging_netcdf_files(self, nc_report_type, start_date, end_date, max_number_of_cores = 20):
@@ -293,37 +285,14 @@ class DeterministicRunner(DynamicModel):
 
     def check_pcrglobwb_status(self):
 
-        # ~ if self.configuration.globalOptions['cloneAreas'] == "Global" or \
-           # ~ self.configuration.globalOptions['cloneAreas'] == "part_one":
-            # ~ clone_areas = ['M%02d'%i for i in range(1,53+1,1)]
-        
-        # ~ # for the Ulysses project
-        # ~ elif self.configuration.globalOptions['cloneAreas'] == "GlobalUlysses":
-            # ~ clone_areas = ['M%07d'%i for i in range(1,71+1,1)]
-        
-        # ~ else:
-            # ~ clone_areas = list(set(self.configuration.globalOptions['cloneAreas'].split(",")))
-
+        # blocking wait until the ready files of all clones are available (see coordination.py) 
         clone_areas = ['M%07d'%i for i in range(1, int(self.number_of_clones) + 1, 1)]
+        status_files = [str(self.configuration.main_output_directory) + "/" +str(clone_area) + "/maps/pcrglobwb_files_for_" + str(self.modelTime.fulldate) + "_are_ready.txt" for clone_area in clone_areas]
+
+        timeout, check_interval, report_interval = coordination.get_waiting_options(self.configuration.globalOptions)
+        coordination.wait_for_files(status_files, timeout, check_interval, report_interval, description = "pcrglobwb clone files")
         
-        for clone_area in clone_areas:
-            status_file = str(self.configuration.main_output_directory) + "/" +str(clone_area) + "/maps/pcrglobwb_files_for_" + str(self.modelTime.fulldate) + "_are_ready.txt"
-            msg = 'Waiting for the file: '+status_file
-            if self.count_check == 1: logger.info(msg)
-            if self.count_check < 7:
-                #~ logger.debug(msg)		# INACTIVATE THIS AS THIS MAKE A HUGE DEBUG (dbg) FILE
-                self.count_check += 1
-            status = os.path.exists(status_file)
-
-            # ~ # for debugging
-            # ~ status = True
-
-            if status == False: return status
-            if status: self.count_check = 0            
-                    
-        print(status)
-        
-        return status
+        return True
 
 def modify_ini_file(original_ini_file,
                     system_argument): 
@@ -25,7 +25,6 @@
 import os
 import sys
 import shutil
-import datetime
 
 import pcraster as pcr
 from pcraster.framework import DynamicModel
@@ -38,6 +37,8 @@ from spinUp import SpinUp
 
 from pcrglobwb import PCRGlobWB
 
+import coordination
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -322,50 +323,26 @@ class DeterministicRunner(DynamicModel):
             
             # wait until modflow files are ready
             if self.configuration.online_coupling_between_pcrglobwb_and_modflow:
-                modflow_is_ready = False
-                self.count_check = 0
-                while modflow_is_ready == False:
-                    if datetime.datetime.now().second == 14 or\
-                       datetime.datetime.now().second == 29 or\
-                       datetime.datetime.now().second == 34 or\
-                       datetime.datetime.now().second == 59:\
-                       modflow_is_ready = self.check_modflow_status()
+                self.check_modflow_status()
                 
             # wait until merged files are ready
-            merged_files_are_ready = False
-            while merged_files_are_ready == False:
-                self.count_check = 0
-                if datetime.datetime.now().second == 14 or\
-                   datetime.datetime.now().second == 29 or\
-                   datetime.datetime.now().second == 34 or\
-                   datetime.datetime.now().second == 59:\
-                   merged_files_are_ready = self.check_merging_status()
+            self.check_merging_status()
 
     def check_modflow_status(self):
 
+        # blocking wait (see coordination.py) 
         status_file = str(self.configuration.main_output_directory) + "/modflow/transient/maps/modflow_files_for_" + str(self.modelTime.fulldate) + "_are_ready.txt"
-        msg = 'Waiting for the file: ' + status_file
-        if self.count_check == 1: logger.info(msg)
-        if self.count_check < 7:
-            #~ logger.debug(msg)			# INACTIVATE THIS AS THIS MAKE A HUGE DEBUG (dbg) FILE
-            self.count_check += 1
-        status = os.path.exists(status_file)
-        if status == False: return status	
-        if status: self.count_check = 0            
-        return status
+        timeout, check_interval, report_interval = coordination.get_waiting_options(self.configuration.globalOptions)
+        coordination.wait_for_files([status_file], timeout, check_interval, report_interval, description = "modflow files")
+        return True
 
     def check_merging_status(self):
 
+        # blocking wait (see coordination.py) 
         status_file = str(self.configuration.main_output_directory) + "/global/maps/merged_files_for_"    + str(self.modelTime.fulldate) + "_are_ready.txt"
-        msg = 'Waiting for the file: ' + status_file
-        if self.count_check == 1: logger.info(msg)
-        if self.count_check < 7:
-            #~ logger.debug(msg)			# INACTIVATE THIS AS THIS MAKE A HUGE DEBUG (dbg) FILE
-            self.count_check += 1
-        status = os.path.exists(status_file)
-        if status == False: return status	
-        if status: self.count_check = 0            
-        return status
+        timeout, check_interval, report_interval = coordination.get_waiting_options(self.configuration.globalOptions)
+        coordination.wait_for_files([status_file], timeout, check_interval, report_interval, description = "merged files")
+        return True
  
  
 def modify_ini_file(original_ini_file,
@@ -557,24 +534,32 @@ def main():
     
     # for a parallel run (e.g. usually for 5min and 6min runs), we assign a specific directory based on the clone number/code:
     if this_run_is_part_of_a_set_of_parallel_run:
-        # modfiying outputDir, clone-map landmask, etc (based on the given system arguments)
-        # - clone code in string
-        clone_code = str(sys.argv[3])
-        # - output folder
-        output_folder_with_clone_code = "M%07i" %int(clone_code)
-        configuration.globalOptions['outputDir'] += "/" + output_folder_with_clone_code 
-        # - clone map
-        configuration.globalOptions['cloneMap'] = configuration.globalOptions['cloneMap'] %(int(clone_code))
-        # - landmask for model calculation
-        if configuration.globalOptions['landmask'] != "None":
-            configuration.globalOptions['landmask']   = configuration.globalOptions['landmask'] %(int(clone_code))
-        # - landmask for reporting
-        if configuration.reportingOptions['landmask_for_reporting'] != "None":
-            configuration.reportingOptions['landmask_for_reporting'] = configuration.reportingOptions['landmask_for_reporting'] %(int(clone_code))
+        set_configuration_for_clone(configuration, clone_code = str(sys.argv[3]))
 
     # set configuration
     configuration.set_configuration(system_arguments = sys.argv)
     
+    # execute the run (including spin-up)
+    run(configuration, system_argument = sys.argv)
+
+
+def set_configuration_for_clone(configuration, clone_code):
+
+    # modfiying outputDir, clone-map landmask, etc (based on the given clone number/code)
+    # - output folder
+    output_folder_with_clone_code = "M%07i" %int(clone_code)
+    configuration.globalOptions['outputDir'] += "/" + output_folder_with_clone_code 
+    # - clone map
+    configuration.globalOptions['cloneMap'] = configuration.globalOptions['cloneMap'] %(int(clone_code))
+    # - landmask for model calculation
+    if configuration.globalOptions['landmask'] != "None":
+        configuration.globalOptions['landmask']   = configuration.globalOptions['landmask'] %(int(clone_code))
+    # - landmask for reporting
+    if configuration.reportingOptions['landmask_for_reporting'] != "None":
+        configuration.reportingOptions['landmask_for_reporting'] = configuration.reportingOptions['landmask_for_reporting'] %(int(clone_code))
+
+
+def run(configuration, system_argument):
 
     # timeStep info: year, month, day, doy, hour, etc
     currTimeStep = ModelTime() 
@@ -596,7 +581,7 @@ def main():
                     configuration.globalOptions['startTime'],
                     spinUpRun, noSpinUps)
             logger.info('Spin-Up Run No. '+str(spinUpRun))
-            deterministic_runner = DeterministicRunner(configuration, currTimeStep, initial_state, sys.argv, spinUpRun = True)
+            deterministic_runner = DeterministicRunner(configuration, currTimeStep, initial_state, system_argument, spinUpRun = True)
             
             all_state_begin = deterministic_runner.model.getAllState() 
             
@@ -617,7 +602,7 @@ def main():
                                       configuration.globalOptions['endTime'])
     
     logger.info('Transient simulation run started.')
-    deterministic_runner = DeterministicRunner(configuration, currTimeStep, initial_state, sys.argv, spinUpRun = False)
+    deterministic_runner = DeterministicRunner(configuration, currTimeStep, initial_state, system_argument, spinUpRun = False)
     
     dynamic_framework = DynamicFramework(deterministic_runner,currTimeStep.nrOfTimeSteps)
     dynamic_framework.setQuiet(True)
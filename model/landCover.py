@@ -23,8 +23,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import time
 import types
 
+import numpy as np
 import netCDF4 as nc
 import pcraster as pcr
 
@@ -34,6 +36,11 @@ logger = logging.getLogger(__name__)
 import virtualOS as vos
 from ncConverter import *
 
+import climatology_cache
+import soil_water_kernel
+import zone_allocation
+import yearly_input_cache
+
 class LandCover(object):
 
     def __init__(self,iniItems,nameOfSectionInIniFile,soil_and_topo_parameters,landmask,irrigationEfficiency,usingAllocSegments = False):
@@ -256,6 +263,44 @@ class LandCover(object):
 
         if 'coverFractionNC' in list(self.iniItemsLC.keys()) and self.iniItemsLC['coverFractionNC'] == "None": self.coverFractionNC = None 
         if 'interceptCapNC'  in list(self.iniItemsLC.keys()) and self.iniItemsLC['interceptCapNC' ] == "None": self.interceptCapNC  = None
+
+        # option to read the daily seasonal climatologies (cropCoefficientNC, interceptCapNC and coverFractionNC) once into memory (see climatology_cache.py)
+        self.climatologyCache = None
+        if 'climatologyCache' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['climatologyCache'] == "True":
+            self.climatologyCache = climatology_cache.get_climatology_cache(self.cloneMap, self.landmask)
+            if self.iniItemsLC['cropCoefficientNC'] != "None": self.climatologyCache.preload(self.cropCoefficientNC, 'kc')
+            if self.interceptCapNC != None and self.coverFractionNC != None:
+                self.climatologyCache.preload(self.interceptCapNC , 'interceptCapInput')
+                self.climatologyCache.preload(self.coverFractionNC, 'coverFractionInput')
+        
+        # option to calculate the interception, snow and soil states and fluxes (of upperSoilUpdate) with the NumPy kernel (see soil_water_kernel.py)
+        # - with benchmarkSoilWaterKernel, the PCRaster calculations are also done and their (daily) calculation times and the differences are reported
+        self.soilWaterKernel = None
+        self.benchmarkSoilWaterKernel = False
+        if 'soilWaterKernel' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['soilWaterKernel'] == "NumPy":
+            self.soilWaterKernel = soil_water_kernel.SoilWaterKernel(self.landmask, self.numberOfLayers)
+            if 'benchmarkSoilWaterKernel' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['benchmarkSoilWaterKernel'] == "True":
+                self.benchmarkSoilWaterKernel = True
+        
+        # option to do the water abstraction and allocation over the allocation zones/segments with zone indices (see zone_allocation.py)
+        self.zoneIndexedWaterAllocation = False
+        if 'zoneIndexedWaterAllocation' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['zoneIndexedWaterAllocation'] == "True":
+            self.zoneIndexedWaterAllocation = True
+        
+        # memos of the transpiration fractions and of the total evapotranspiration estimates (see getTranspirationFractions and estimateTranspirationAndBareSoilEvap)
+        self.transpirationFractionsMemo = None
+        self.totalEvapotranspirationEstimateMemo = None
+        
+        # option to keep the yearly irrigation inputs in memory (see yearly_input_cache.py)
+        # - the (extrapolated) irrigation efficiency of a static input or of a year is also calculated only once
+        self.yearlyInputCache = None
+        self.irrigationEfficiencyMemo = {}
+        if 'yearlyIrrigationInputCache' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['yearlyIrrigationInputCache'] == "True":
+            self.yearlyInputCache = yearly_input_cache.get_yearly_input_cache(self.cloneMap)
+        
+        # option to skip the extrapolation of the irrigation efficiency (see updateIrrigationWaterEfficiency)
+        self.noParameterExtrapolation = False
+        if "noParameterExtrapolation" in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions["noParameterExtrapolation"] == "True": self.noParameterExtrapolation = True
         
         # for reporting: output in netCDF files:
         self.report = True
@@ -331,16 +376,22 @@ class LandCover(object):
 
             input = self.iniItemsLC[var]
 
+            memo_key = None
             try:
                             # static input
                             self.irrigationEfficiency = vos.readPCRmapClone(input,self.cloneMap,
                                             self.tmpDir,self.inputDir)
+                            memo_key = 'static'
             except:
                             # dynamic input
                             if 'nc' in os.path.splitext(input)[1]:
                                 #-netCDF file
                                 ncFileIn = vos.getFullPath(input,self.inputDir)
-                                self.irrigationEfficiency = vos.netcdf2PCRobjClone(ncFileIn,var, \
+                                if self.yearlyInputCache is not None:
+                                    self.irrigationEfficiency = self.yearlyInputCache.read(ncFileIn, var, currTimeStep.year)
+                                    memo_key = self.yearlyInputCache.get_year(ncFileIn, currTimeStep.year)
+                                else:
+                                    self.irrigationEfficiency = vos.netcdf2PCRobjClone(ncFileIn,var, \
                            currTimeStep, useDoy = 'yearly',\
                            cloneMapFileName = self.cloneMap)
                             else:
@@ -348,31 +399,40 @@ class LandCover(object):
                                 input= input + '%04d.map' % currTimeStep.year
                                 self.irrigationEfficiency = vos.readPCRmapClone(input,self.cloneMap,
                                             self.tmpDir,self.inputDir)
+                                memo_key = currTimeStep.year
             
-            extrapolate = True
-            if "noParameterExtrapolation" in iniItems.landSurfaceOptions.keys() and iniItems.landSurfaceOptions["noParameterExtrapolation"] == "True": extrapolate = False
-
-            if extrapolate:
-
-                 # extrapolate efficiency map:                                                # TODO: Make a better extrapolation algorithm (considering cell size, etc.). 
-                 window_size = 1.25 * pcr.clone().cellSize()
-                 window_size = min(window_size, min(pcr.clone().nrRows(), pcr.clone().nrCols())*pcr.clone().cellSize())
-
-                 try:
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, 0.75))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, 1.00))
-                     self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, 1.50))
-                 except:                                                 
-                     pass
-
-            self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, 1.0)
-            self.irrigationEfficiency = pcr.max(0.1, self.irrigationEfficiency)
-            self.irrigationEfficiency = pcr.ifthen(self.landmask, self.irrigationEfficiency)
+            if self.yearlyInputCache is not None and memo_key in list(self.irrigationEfficiencyMemo.keys()):
+
+                # the efficiency has been calculated before (for the static input or for the same year)
+                self.irrigationEfficiency = self.irrigationEfficiencyMemo[memo_key]
+
+            else:
+
+                extrapolate = not self.noParameterExtrapolation
+
+                if extrapolate:
+
+                     # extrapolate efficiency map:                                                # TODO: Make a better extrapolation algorithm (considering cell size, etc.). 
+                     window_size = 1.25 * pcr.clone().cellSize()
+                     window_size = min(window_size, min(pcr.clone().nrRows(), pcr.clone().nrCols())*pcr.clone().cellSize())
+
+                     try:
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, window_size))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, 0.75))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, 1.00))
+                         self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, pcr.windowaverage(self.irrigationEfficiency, 1.50))
+                     except:                                                 
+                         pass
+
+                self.irrigationEfficiency = pcr.cover(self.irrigationEfficiency, 1.0)
+                self.irrigationEfficiency = pcr.max(0.1, self.irrigationEfficiency)
+                self.irrigationEfficiency = pcr.ifthen(self.landmask, self.irrigationEfficiency)
+
+                if self.yearlyInputCache is not None and memo_key is not None: self.irrigationEfficiencyMemo[memo_key] = self.irrigationEfficiency
 
         else:
 
@@ -1107,9 +1167,7 @@ class LandCover(object):
             cropKC = pcr.ifthen(self.landmask, pcr.spatial(pcr.scalar(0.0)))
         else:
             cropKC = pcr.cover(
-                     vos.netcdf2PCRobjClone(self.cropCoefficientNC,'kc', \
-                                            currTimeStep.fulldate, useDoy = 'daily_seasonal',\
-                                            cloneMapFileName = self.cloneMap), 0.0)
+                     self.readDailySeasonal(self.cropCoefficientNC,'kc', currTimeStep), 0.0)
         self.inputCropKC = cropKC                                               # This line is needed for debugging. (Can we remove this?)
         self.cropKC = pcr.max(cropKC, self.minCropKC)                                
 
@@ -1133,6 +1191,14 @@ class LandCover(object):
                                   True,\
                                   currTimeStep.fulldate,threshold=5e-4)
 
+    def readDailySeasonal(self, ncFile, varName, currTimeStep):
+
+        # daily seasonal climatology values, from the cache (if used) or from the netcdf file
+        if self.climatologyCache is not None: return self.climatologyCache.read(ncFile, varName, currTimeStep.fulldate)
+        return vos.netcdf2PCRobjClone(ncFile, varName, \
+                                      currTimeStep.fulldate, useDoy = 'daily_seasonal',\
+                                      cloneMapFileName = self.cloneMap)
+
     def interceptionUpdate(self, meteo, currTimeStep):
         
         if self.debugWaterBalance:
@@ -1144,17 +1210,13 @@ class LandCover(object):
         if self.interceptCapNC != None and self.coverFractionNC != None:
             interceptCap = \
                      pcr.cover(
-                     vos.netcdf2PCRobjClone(self.interceptCapNC,\
-                                    'interceptCapInput',\
-                                     currTimeStep.fulldate, useDoy = 'daily_seasonal',\
-                                     cloneMapFileName = self.cloneMap), 0.0)
+                     self.readDailySeasonal(self.interceptCapNC,\
+                                    'interceptCapInput', currTimeStep), 0.0)
             self.interceptCapInput = interceptCap                        # This line is needed for debugging. 
             coverFraction = \
                      pcr.cover(
-                     vos.netcdf2PCRobjClone(self.coverFractionNC,\
-                                    'coverFractionInput',\
-                                     currTimeStep.fulldate, useDoy = 'daily_seasonal',\
-                                     cloneMapFileName = self.cloneMap), 0.0)
+                     self.readDailySeasonal(self.coverFractionNC,\
+                                    'coverFractionInput', currTimeStep), 0.0)
             coverFraction = pcr.cover(coverFraction, 0.0)
             interceptCap = coverFraction * interceptCap                  # original Rens line: ICC[TYPE] = CFRAC[TYPE]*INTCMAX[TYPE];                                
 
@@ -1164,6 +1226,31 @@ class LandCover(object):
         # Edwin added the following line to extend the interception definition.
         self.interceptCap = pcr.max(interceptCap, self.minInterceptCap) 
         
+        # throughfall, snowfall, liquid precipitation and interception evaporation (and update interception storage)
+        if self.soilWaterKernel is None:
+            self.updateInterception(meteo)
+        else:
+            self.runSoilWaterKernel("interception", lambda: self.updateInterception(meteo), \
+                                    lambda: self.soilWaterKernel.update_interception(self, meteo), currTimeStep)
+
+        if self.debugWaterBalance:
+            vos.waterBalanceCheck([self.throughfall],\
+                                  [self.snowfall, self.liquidPrecip],\
+                                  [],\
+                                  [],\
+                                  'rain-snow-partitioning',\
+                                  True,\
+                                  currTimeStep.fulldate, threshold=1e-5)
+            vos.waterBalanceCheck([meteo.precipitation],
+                                  [self.throughfall, self.interceptEvap],
+                                  prevStates,\
+                                  [self.interceptStor],\
+                                  'interceptStor',\
+                                  True,\
+                                  currTimeStep.fulldate,threshold=1e-4)
+
+    def updateInterception(self, meteo):
+
         # throughfall = surplus above the interception storage threshold 
         if self.interceptionModuleType == "Modified":
             # extended interception definition/scope (not only canopy)
@@ -1173,8 +1260,8 @@ class LandCover(object):
                                                                          # Edwin modified this line to extend the interception scope (not only canopy interception).
         if self.interceptionModuleType == "Original":
             # only canopy interception (not only canopy)
-            self.throughfall   = (1.0 - coverFraction) * meteo.precipitation +\
-                          pcr.max(0.0,  coverFraction  * meteo.precipitation + self.interceptStor - self.interceptCap)
+            self.throughfall   = (1.0 - self.coverFraction) * meteo.precipitation +\
+                          pcr.max(0.0,  self.coverFraction  * meteo.precipitation + self.interceptStor - self.interceptCap)
 
         # update interception storage after throughfall 
         self.interceptStor = pcr.max(0.0, self.interceptStor + \
@@ -1239,22 +1326,6 @@ class LandCover(object):
         self.actualET  = 0. # interceptEvap is the first flux in ET 
         self.actualET += self.interceptEvap
 
-        if self.debugWaterBalance:
-            vos.waterBalanceCheck([self.throughfall],\
-                                  [self.snowfall, self.liquidPrecip],\
-                                  [],\
-                                  [],\
-                                  'rain-snow-partitioning',\
-                                  True,\
-                                  currTimeStep.fulldate, threshold=1e-5)
-            vos.waterBalanceCheck([meteo.precipitation],
-                                  [self.throughfall, self.interceptEvap],
-                                  prevStates,\
-                                  [self.interceptStor],\
-                                  'interceptStor',\
-                                  True,\
-                                  currTimeStep.fulldate,threshold=1e-4)
-
     def interceptionUpdateOriginalVersion(self,meteo,currTimeStep):
         
         # TODO: Rewrite this method as defined by Rens. 
@@ -1365,6 +1436,40 @@ class LandCover(object):
             prevSnowCoverSWE  = self.snowCoverSWE
             prevSnowFreeWater = self.snowFreeWater
 
+        # changes in snow cover, snow melt, net liquid water to soil and evaporation from snowFreeWater (and update snow states)
+        if self.soilWaterKernel is None:
+            self.updateSnowCover(meteo)
+        else:
+            self.runSoilWaterKernel("snow", lambda: self.updateSnowCover(meteo), \
+                                    lambda: self.soilWaterKernel.update_snow_cover(self, meteo), currTimeStep)
+        deltaSnowCover = self.deltaSnowCover
+
+        if self.debugWaterBalance:
+            vos.waterBalanceCheck([self.snowfall, self.liquidPrecip],
+                                  [self.netLqWaterToSoil,\
+                                   self.actSnowFreeWaterEvap],
+                                   prevStates,\
+                                  [self.snowCoverSWE, self.snowFreeWater],\
+                                  'snow module',\
+                                   True,\
+                                   currTimeStep.fulldate,threshold=1e-4)
+            vos.waterBalanceCheck([self.snowfall, deltaSnowCover],\
+                                  [pcr.scalar(0.0)],\
+                                  [prevSnowCoverSWE],\
+                                  [self.snowCoverSWE],\
+                                  'snowCoverSWE',\
+                                   True,\
+                                   currTimeStep.fulldate,threshold=5e-4)
+            vos.waterBalanceCheck([self.liquidPrecip],
+                                  [deltaSnowCover, self.actSnowFreeWaterEvap, self.netLqWaterToSoil],
+                                  [prevSnowFreeWater],\
+                                  [self.snowFreeWater],\
+                                  'snowFreeWater',\
+                                   True,\
+                                   currTimeStep.fulldate,threshold=5e-4)
+
+    def updateSnowCover(self, meteo):
+
         # changes in snow cover: - melt ; + gain in snow or refreezing
         deltaSnowCover = \
             pcr.ifthenelse(meteo.temperature <= self.freezingT, \
@@ -1413,29 +1518,8 @@ class LandCover(object):
         # update actual evaporation (after evaporation from snowFreeWater) 
         self.actualET += self.actSnowFreeWaterEvap                      # EACT_L[TYPE]= EACT_L[TYPE]+ES_a[TYPE];
 
-        if self.debugWaterBalance:
-            vos.waterBalanceCheck([self.snowfall, self.liquidPrecip],
-                                  [self.netLqWaterToSoil,\
-                                   self.actSnowFreeWaterEvap],
-                                   prevStates,\
-                                  [self.snowCoverSWE, self.snowFreeWater],\
-                                  'snow module',\
-                                   True,\
-                                   currTimeStep.fulldate,threshold=1e-4)
-            vos.waterBalanceCheck([self.snowfall, deltaSnowCover],\
-                                  [pcr.scalar(0.0)],\
-                                  [prevSnowCoverSWE],\
-                                  [self.snowCoverSWE],\
-                                  'snowCoverSWE',\
-                                   True,\
-                                   currTimeStep.fulldate,threshold=5e-4)
-            vos.waterBalanceCheck([self.liquidPrecip],
-                                  [deltaSnowCover, self.actSnowFreeWaterEvap, self.netLqWaterToSoil],
-                                  [prevSnowFreeWater],\
-                                  [self.snowFreeWater],\
-                                  'snowFreeWater',\
-                                   True,\
-                                   currTimeStep.fulldate,threshold=5e-4)
+        # changes in snow cover (for the water balance checks of snowMeltHBVSimple)
+        self.deltaSnowCover = deltaSnowCover
 
     def getSoilStates(self):
 
@@ -1743,7 +1827,7 @@ class LandCover(object):
             logger.debug("Allocation of supply from desalination water.")
         #  
             volDesalinationAbstraction, volDesalinationAllocation = \
-              vos.waterAbstractionAndAllocation(
+              self.waterAbstractionAndAllocation(
               water_demand_volume = self.totalPotentialGrossDemand*routing.cellArea,\
               available_water_volume = pcr.max(0.00, desalinationWaterUse*routing.cellArea),\
               allocation_zones = allocSegments,\
@@ -1848,7 +1932,7 @@ class LandCover(object):
             logger.debug("Allocation of surface water abstraction.")
         #  
             volActSurfaceWaterAbstract, volAllocSurfaceWaterAbstract = \
-             vos.waterAbstractionAndAllocation(
+             self.waterAbstractionAndAllocation(
              water_demand_volume = surface_water_demand*routing.cellArea,\
              available_water_volume = pcr.max(0.00, routing.readAvlChannelStorage),\
              allocation_zones = allocSegments,\
@@ -2024,7 +2108,7 @@ class LandCover(object):
             
             # non fossil groundwater abstraction and allocation in volume (unit: m3)
             volActGroundwaterAbstract, volAllocGroundwaterAbstract = \
-             vos.waterAbstractionAndAllocation(
+             self.waterAbstractionAndAllocation(
              water_demand_volume = self.potGroundwaterAbstract*routing.cellArea,\
              available_water_volume = pcr.max(0.00, readAvlStorGroundwater*routing.cellArea),\
              allocation_zones = groundwater.allocSegments,\
@@ -2251,7 +2335,7 @@ class LandCover(object):
 
                     # fossil groundwater abstraction and allocation in volume (unit: m3)
                     volActGroundwaterAbstract, volAllocGroundwaterAbstract = \
-                       vos.waterAbstractionAndAllocation(
+                       self.waterAbstractionAndAllocation(
                        water_demand_volume = self.potFossilGroundwaterAbstract*routing.cellArea,\
                        available_water_volume = pcr.max(0.00, readAvlFossilGroundwater*routing.cellArea),\
                        allocation_zones = groundwater.allocSegments,\
@@ -2395,6 +2479,13 @@ class LandCover(object):
         
                                  
 
+    def waterAbstractionAndAllocation(self, **arguments):
+
+        # abstraction and allocation over the allocation zones/segments, with zone indices (zone_allocation.py) or with PCRaster (virtualOS.py)
+        if self.zoneIndexedWaterAllocation:
+            return zone_allocation.waterAbstractionAndAllocation(**arguments)
+        return vos.waterAbstractionAndAllocation(**arguments)
+
     def calculateDirectRunoff(self):
 
         # topWaterLater is partitioned into directRunoff (and infiltration)
@@ -2556,12 +2647,22 @@ class LandCover(object):
         self.topWaterLayer = pcr.min( self.topWaterLayer , \
                                       self.minTopWaterLayer)
 
-    def estimateTranspirationAndBareSoilEvap(self, returnTotalEstimation = False, returnTotalTranspirationOnly = False):
+    def getTranspirationInputs(self):
+        if self.numberOfLayers == 2: return [self.storUpp, self.storLow, self.adjRootFrUpp, self.adjRootFrLow]
+        if self.numberOfLayers == 3: return [self.storUpp000005, self.storUpp005030, self.storLow030150, \
+                                             self.adjRootFrUpp000005, self.adjRootFrUpp005030, self.adjRootFrLow030150]
+
+    def isMemoValid(self, memo, inputs):
+        # a memo is valid if all its input maps are (still) the same objects
+        return memo is not None and len(memo[0]) == len(inputs) and all([a is b for a, b in zip(memo[0], inputs)])
+
+    def getTranspirationFractions(self):
+
+        # fractions for distributing transpiration (based on rott fraction and actual layer storages)
+        # - memorized for the current storages and root fractions, as they are needed several times per time step
+        inputs = self.getTranspirationInputs()
+        if self.isMemoValid(self.transpirationFractionsMemo, inputs): return self.transpirationFractionsMemo[1]
 
-        # TRANSPIRATION
-        #
-        # - fractions for distributing transpiration (based on rott fraction and actual layer storages)
-        #
         if self.numberOfLayers == 2:
             dividerTranspFracs = pcr.max( 1e-9, self.adjRootFrUpp*self.storUpp +\
                                                 self.adjRootFrLow*self.storLow )
@@ -2599,6 +2700,28 @@ class LandCover(object):
                                 self.adjRootFrLow030150*self.storLow030150/ dividerTranspFracs, \
                                 self.adjRootFrLow030150)
 
+        if self.numberOfLayers == 2: transpFracs = (transpFracUpp, transpFracLow)
+        if self.numberOfLayers == 3: transpFracs = (transpFracUpp000005, transpFracUpp005030, transpFracLow030150)
+        self.transpirationFractionsMemo = (inputs, transpFracs)
+        return transpFracs
+
+    def estimateTranspirationAndBareSoilEvap(self, returnTotalEstimation = False, returnTotalTranspirationOnly = False):
+
+        # the total estimates (returnTotalEstimation, used twice in calculateWaterDemand) are memorized for the current states and potential fluxes
+        if returnTotalEstimation:
+            memoInputs = self.getTranspirationInputs() + [self.potTranspiration, self.potBareSoilEvap, self.topWaterLayer]
+            if self.isMemoValid(self.totalEvapotranspirationEstimateMemo, memoInputs):
+                totalTranspiration, totalEvapotranspiration = self.totalEvapotranspirationEstimateMemo[1]
+                if returnTotalTranspirationOnly: return totalTranspiration
+                return totalEvapotranspiration
+
+        # TRANSPIRATION
+        #
+        # - fractions for distributing transpiration (based on rott fraction and actual layer storages)
+        #
+        if self.numberOfLayers == 2: transpFracUpp, transpFracLow = self.getTranspirationFractions()
+        if self.numberOfLayers == 3: transpFracUpp000005, transpFracUpp005030, transpFracLow030150 = self.getTranspirationFractions()
+
         relActTranspiration = pcr.scalar(1.0) # no reduction in case of returnTotalEstimation
         if returnTotalEstimation == False:
             # reduction factor for transpiration
@@ -2685,22 +2808,22 @@ class LandCover(object):
             actBareSoilEvap = pcr.ifthenelse(self.topWaterLayer > treshold, 0.0, actBareSoilEvap)
         
         # return the calculated variables:
+        if returnTotalEstimation:
+            if self.numberOfLayers == 2:
+                totalTranspiration      = actTranspiUpp+ actTranspiLow
+                totalEvapotranspiration = actBareSoilEvap+ actTranspiUpp+ actTranspiLow
+            if self.numberOfLayers == 3:
+                totalTranspiration      = actTranspiUpp000005+ actTranspiUpp005030+ actTranspiLow030150
+                totalEvapotranspiration = actBareSoilEvap+ actTranspiUpp000005+ actTranspiUpp005030+ actTranspiLow030150
+            self.totalEvapotranspirationEstimateMemo = (memoInputs, (totalTranspiration, totalEvapotranspiration))
+            if returnTotalTranspirationOnly:
+                return totalTranspiration
+            else:     
+                return totalEvapotranspiration
         if self.numberOfLayers == 2:
-            if returnTotalEstimation:
-                if returnTotalTranspirationOnly:
-                    return actTranspiUpp+ actTranspiLow
-                else:     
-                    return actBareSoilEvap+ actTranspiUpp+ actTranspiLow
-            else:
-                return actBareSoilEvap, actTranspiUpp, actTranspiLow 
+            return actBareSoilEvap, actTranspiUpp, actTranspiLow 
         if self.numberOfLayers == 3:
-            if returnTotalEstimation:
-                if returnTotalTranspirationOnly:
-                    return actTranspiUpp000005+ actTranspiUpp005030+ actTranspiLow030150
-                else:     
-                    return actBareSoilEvap+ actTranspiUpp000005+ actTranspiUpp005030+ actTranspiLow030150
-            else:
-                return actBareSoilEvap, actTranspiUpp000005, actTranspiUpp005030, actTranspiLow030150
+            return actBareSoilEvap, actTranspiUpp000005, actTranspiUpp005030, actTranspiLow030150
 
     def estimateSoilFluxes(self,capRiseFrac,groundwater):
 
@@ -3659,36 +3782,7 @@ class LandCover(object):
         # landSurfaceRunoff (needed for routing)                        
         self.landSurfaceRunoff = self.directRunoff + self.interflowTotal
 
-    def upperSoilUpdate(self,meteo,groundwater,routing,\
-                        capRiseFrac,\
-                        nonIrrGrossDemandDict,swAbstractionFractionDict,\
-                        currTimeStep,\
-                        allocSegments,\
-                        desalinationWaterUse,\
-                        groundwater_pumping_region_ids,regionalAnnualGroundwaterAbstractionLimit):
-
-        if self.debugWaterBalance:
-            netLqWaterToSoil = self.netLqWaterToSoil # input            
-            preTopWaterLayer = self.topWaterLayer
-            if self.numberOfLayers == 2: 
-                preStorUpp       = self.storUpp
-                preStorLow       = self.storLow
-            if self.numberOfLayers == 3: 
-                preStorUpp000005 = self.storUpp000005
-                preStorUpp005030 = self.storUpp005030
-                preStorLow030150 = self.storLow030150
-        
-        # given soil storages, we can calculate several derived states, such as 
-        # effective degree of saturation, unsaturated hydraulic conductivity, and 
-        # readily available water within the root zone.
-        self.getSoilStates()
-        
-        # calculate water demand (including partitioning to different source)
-        self.calculateWaterDemand(nonIrrGrossDemandDict, swAbstractionFractionDict, \
-                                  groundwater, routing, \
-                                  allocSegments, currTimeStep,\
-                                  desalinationWaterUse,\
-                                  groundwater_pumping_region_ids,regionalAnnualGroundwaterAbstractionLimit)
+    def updateSoilFluxesAndStates(self, capRiseFrac, groundwater):
 
         # calculate openWaterEvap: open water evaporation from the paddy field, 
         # and update topWaterLayer after openWaterEvap.  
@@ -3720,6 +3814,85 @@ class LandCover(object):
         # update all soil states (including get final/corrected fluxes) 
         self.updateSoilStates()
 
+    def runSoilWaterKernel(self, stage, pcraster_calculation, kernel_calculation, currTimeStep):
+
+        if self.benchmarkSoilWaterKernel == False:
+            kernel_calculation()
+            return
+
+        # PCRaster calculation (the results are reported and discarded)
+        initial_values = dict(vars(self))
+        start_time = time.time()
+        pcraster_calculation()
+        pcraster_time = time.time() - start_time
+        pcraster_values = dict(vars(self))
+        for var in list(vars(self).keys()):
+            if var not in initial_values: delattr(self, var)
+        vars(self).update(initial_values)
+
+        # NumPy kernel calculation
+        start_time = time.time()
+        kernel_calculation()
+        kernel_time = time.time() - start_time
+
+        # maximum absolute differences of the results
+        max_difference, max_difference_var = 0.0, None
+        for var in list(pcraster_values.keys()):
+            if pcraster_values[var] is initial_values.get(var) or isinstance(pcraster_values[var], (pcr.Field, float, int)) == False: continue
+            difference = self.soilWaterKernel.get('benchmark.pcraster', pcraster_values[var]) - \
+                         self.soilWaterKernel.get('benchmark.numpy', vars(self)[var])
+            difference = float(np.nanmax(np.abs(difference))) if np.any(~np.isnan(difference)) else 0.0
+            if difference > max_difference or max_difference_var is None: max_difference, max_difference_var = difference, var
+
+        msg = "Soil water kernel (" + stage + ") for " + str(self.name) + " on " + str(currTimeStep.fulldate) + ": " + \
+              "PCRaster %.4f s, NumPy %.4f s; maximum absolute difference %e (%s)" %(pcraster_time, kernel_time, max_difference, str(max_difference_var))
+        if max_difference > 1e-5:
+            logger.warning(msg)
+        else:
+            logger.info(msg)
+
+    def upperSoilUpdate(self,meteo,groundwater,routing,\
+                        capRiseFrac,\
+                        nonIrrGrossDemandDict,swAbstractionFractionDict,\
+                        currTimeStep,\
+                        allocSegments,\
+                        desalinationWaterUse,\
+                        groundwater_pumping_region_ids,regionalAnnualGroundwaterAbstractionLimit):
+
+        if self.debugWaterBalance:
+            netLqWaterToSoil = self.netLqWaterToSoil # input            
+            preTopWaterLayer = self.topWaterLayer
+            if self.numberOfLayers == 2: 
+                preStorUpp       = self.storUpp
+                preStorLow       = self.storLow
+            if self.numberOfLayers == 3: 
+                preStorUpp000005 = self.storUpp000005
+                preStorUpp005030 = self.storUpp005030
+                preStorLow030150 = self.storLow030150
+        
+        # given soil storages, we can calculate several derived states, such as 
+        # effective degree of saturation, unsaturated hydraulic conductivity, and 
+        # readily available water within the root zone.
+        if self.soilWaterKernel is None:
+            self.getSoilStates()
+        else:
+            self.runSoilWaterKernel("soil states", self.getSoilStates, \
+                                    lambda: self.soilWaterKernel.get_soil_states(self), currTimeStep)
+        
+        # calculate water demand (including partitioning to different source)
+        self.calculateWaterDemand(nonIrrGrossDemandDict, swAbstractionFractionDict, \
+                                  groundwater, routing, \
+                                  allocSegments, currTimeStep,\
+                                  desalinationWaterUse,\
+                                  groundwater_pumping_region_ids,regionalAnnualGroundwaterAbstractionLimit)
+
+        # calculate the soil fluxes and update the soil states
+        if self.soilWaterKernel is None:
+            self.updateSoilFluxesAndStates(capRiseFrac, groundwater)
+        else:
+            self.runSoilWaterKernel("soil fluxes and states", lambda: self.updateSoilFluxesAndStates(capRiseFrac, groundwater), \
+                                    lambda: self.soilWaterKernel.update_soil_fluxes_and_states(self, capRiseFrac, groundwater), currTimeStep)
+
         # reporting irrigation transpiration deficit
         self.irrigationTranspirationDeficit = 0.0
         if self.name.startswith('irr'): self.irrigationTranspirationDeficit = pcr.max(0.0, self.potTranspiration - self.actTranspiTotal)
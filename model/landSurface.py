@@ -33,6 +33,9 @@ from ncConverter import *
 
 import landCover as lc
 import parameterSoilAndTopo as parSoilAndTopo
+import land_cover_stack
+import demand_cache
+import yearly_input_cache
 
 class LandSurface(object):
     
@@ -379,6 +382,16 @@ class LandSurface(object):
                     self.landCoverObj[coverType].irrTypeFracOverIrr = vos.getValDivZero(self.landCoverObj[coverType].fracVegCover,\
                                                                                         totalIrrAreaFrac, vos.smallNumber) 
 
+        # an option to stack the values of all land cover types into (land cover type, land cell) arrays (see land_cover_stack.py)
+        # - used for the land cover fraction correction, the transfer of states and the scaling to the irrigation areas
+        self.landCoverStack = None
+        if 'stackedLandCoverEngine' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['stackedLandCoverEngine'] == "True":
+            logger.info("Using stacked land cover arrays for the land cover fractions and the transfer of states.")
+            # - with incrementalLandCoverUpdate, the arithmetic of the yearly land cover fraction correction and state transfer is only done for the cells with changed fractions
+            #   (the maps are still converted for all cells)
+            incremental = 'incrementalLandCoverUpdate' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['incrementalLandCoverUpdate'] == "True"
+            self.landCoverStack = land_cover_stack.LandCoverStack(self.landmask, self.coverTypes, incremental)
+
         # get the initial conditions (for every land cover type)
         self.getInitialConditions(iniItems, initialState)
 
@@ -630,6 +643,19 @@ class LandSurface(object):
             self.livestockWaterDemandFile = vos.getFullPath(\
              iniItems.landSurfaceOptions['livestockWaterDemandFile'],self.inputDir,False)
         
+        # option to keep the monthly non irrigation water demand (netcdf files) in memory (see demand_cache.py)
+        # - with preloadNonIrrigationWaterDemand, the monthly values of the run period are read at the start of the run
+        self.nonIrrWaterDemandCache = None
+        if 'nonIrrigationWaterDemandCache' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['nonIrrigationWaterDemandCache'] == "True":
+            self.nonIrrWaterDemandCache = demand_cache.MonthlyDemandCache(self.cloneMap, self.landmask)
+            if 'preloadNonIrrigationWaterDemand' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['preloadNonIrrigationWaterDemand'] == "True":
+                first_year = int(iniItems.globalOptions['startTime'][0:4])
+                last_year  = int(iniItems.globalOptions['endTime'][0:4])
+                for sector in ['domestic', 'industry', 'livestock']:
+                    if vars(self)[sector + 'WaterDemandOption'] and vars(self)[sector + 'WaterDemandFile'].endswith(vos.netcdf_suffixes):
+                        self.nonIrrWaterDemandCache.preload(vars(self)[sector + 'WaterDemandFile'], sector + 'GrossDemand', first_year, last_year)
+                        self.nonIrrWaterDemandCache.preload(vars(self)[sector + 'WaterDemandFile'], sector + 'NettoDemand', first_year, last_year)
+        
         # historical irrigation area (unit: hectar)
         self.dynamicIrrigationArea = False
         if iniItems.landSurfaceOptions['historicalIrrigationArea'] != "None":
@@ -640,6 +666,12 @@ class LandSurface(object):
             self.dynamicIrrigationAreaFile = vos.getFullPath(\
                iniItems.landSurfaceOptions['historicalIrrigationArea'],self.inputDir,False)
         
+        # option to keep the yearly irrigation inputs (netcdf files) in memory (see yearly_input_cache.py)
+        # - the maps are read when they are needed; only the current year and the year before are kept
+        self.yearlyInputCache = None
+        if 'yearlyIrrigationInputCache' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['yearlyIrrigationInputCache'] == "True":
+            self.yearlyInputCache = yearly_input_cache.get_yearly_input_cache(self.cloneMap)
+        
         # irrigation efficiency map (in percentage)                     # TODO: Using the time series of efficiency (considering historical technological development).         
         self.irrigationEfficiency = vos.readPCRmapClone(\
                                     iniItems.landSurfaceOptions['irrigationEfficiency'],
@@ -851,6 +883,13 @@ class LandSurface(object):
         if abs(a) > threshold or abs(b) > threshold:
             logger.error("fraction total (from all land cover types) is not equal to 1.0 ... Min %f Max %f Mean %f" %(a,b,c)) 
 
+    def readNonIrrWaterDemand(self, ncFile, varName, currTimeStep):
+        # monthly non irrigation water demand from the cache (see demand_cache.py) or from the netcdf file
+        # - the cache holds the fields read at the first day of every month; a run that starts in the middle of a month reads its first month with the actual date
+        if self.nonIrrWaterDemandCache is not None and currTimeStep.day == 1:
+            return self.nonIrrWaterDemandCache.read(ncFile, varName, currTimeStep.fulldate)
+        return vos.netcdf2PCRobjClone(ncFile, varName, currTimeStep.fulldate, useDoy = 'monthly', cloneMapFileName = self.cloneMap)
+
     def obtainNonIrrWaterDemand(self,routing,currTimeStep):
         # get NON-Irrigation GROSS water demand and its return flow fraction
 
@@ -861,16 +900,14 @@ class LandSurface(object):
                 if self.domesticWaterDemandFile.endswith(vos.netcdf_suffixes):  
                     #
                     self.domesticGrossDemand = pcr.max(0.0, pcr.cover(\
-                     vos.netcdf2PCRobjClone(self.domesticWaterDemandFile,\
+                     self.readNonIrrWaterDemand(self.domesticWaterDemandFile,\
                                                 'domesticGrossDemand',\
-                         currTimeStep.fulldate, useDoy = 'monthly',\
-                                 cloneMapFileName = self.cloneMap), 0.0))
+                                                currTimeStep), 0.0))
                     #
                     self.domesticNettoDemand = pcr.max(0.0, pcr.cover(\
-                     vos.netcdf2PCRobjClone(self.domesticWaterDemandFile,\
+                     self.readNonIrrWaterDemand(self.domesticWaterDemandFile,\
                                                 'domesticNettoDemand',\
-                         currTimeStep.fulldate, useDoy = 'monthly',\
-                                 cloneMapFileName = self.cloneMap), 0.0))
+                                                currTimeStep), 0.0))
                 else:
                     string_month = str(currTimeStep.month)
                     if currTimeStep.month < 10: string_month = "0"+str(currTimeStep.month)
@@ -897,16 +934,14 @@ class LandSurface(object):
                 if self.industryWaterDemandFile.endswith(vos.netcdf_suffixes):  
                     #
                     self.industryGrossDemand = pcr.max(0.0, pcr.cover(\
-                     vos.netcdf2PCRobjClone(self.industryWaterDemandFile,\
+                     self.readNonIrrWaterDemand(self.industryWaterDemandFile,\
                                                 'industryGrossDemand',\
-                         currTimeStep.fulldate, useDoy = 'monthly',\
-                                 cloneMapFileName = self.cloneMap), 0.0))
+                                                currTimeStep), 0.0))
                     #
                     self.industryNettoDemand = pcr.max(0.0, pcr.cover(\
-                     vos.netcdf2PCRobjClone(self.industryWaterDemandFile,\
+                     self.readNonIrrWaterDemand(self.industryWaterDemandFile,\
                                                 'industryNettoDemand',\
-                         currTimeStep.fulldate, useDoy = 'monthly',\
-                                 cloneMapFileName = self.cloneMap), 0.0))
+                                                currTimeStep), 0.0))
                 else:
                     grossFileName = self.industryWaterDemandFile+"w"+str(currTimeStep.year)+".map"
                     self.industryGrossDemand = pcr.max(0.0, pcr.cover(\
@@ -931,16 +966,14 @@ class LandSurface(object):
                 if self.livestockWaterDemandFile.endswith(vos.netcdf_suffixes):  
                     #
                     self.livestockGrossDemand = pcr.max(0.0, pcr.cover(\
-                     vos.netcdf2PCRobjClone(self.livestockWaterDemandFile,\
+                     self.readNonIrrWaterDemand(self.livestockWaterDemandFile,\
                                                 'livestockGrossDemand',\
-                         currTimeStep.fulldate, useDoy = 'monthly',\
-                                 cloneMapFileName = self.cloneMap), 0.0))
+                                                currTimeStep), 0.0))
                     #
                     self.livestockNettoDemand = pcr.max(0.0, pcr.cover(\
-                     vos.netcdf2PCRobjClone(self.livestockWaterDemandFile,\
+                     self.readNonIrrWaterDemand(self.livestockWaterDemandFile,\
                                                 'livestockNettoDemand',\
-                         currTimeStep.fulldate, useDoy = 'monthly',\
-                                 cloneMapFileName = self.cloneMap), 0.0))
+                                                currTimeStep), 0.0))
                 else:
                     string_month = str(currTimeStep.month)
                     if currTimeStep.month < 10: string_month = "0"+str(currTimeStep.month)
@@ -1196,11 +1229,14 @@ class LandSurface(object):
         # read historical irrigation areas  
         if self.dynamicIrrigationAreaFile.endswith(('.nc4','.nc')):
             fulldateInString = yearInString+"-01"+"-01"   
-            self.irrigationArea = 10000. * pcr.cover(\
-                 vos.netcdf2PCRobjClone(self.dynamicIrrigationAreaFile,\
+            if self.yearlyInputCache is not None:
+                irrigationArea = self.yearlyInputCache.read(self.dynamicIrrigationAreaFile, 'irrigationArea', yearInInteger)
+            else:
+                irrigationArea = vos.netcdf2PCRobjClone(self.dynamicIrrigationAreaFile,\
                                             'irrigationArea',\
                      fulldateInString, useDoy = 'yearly',\
-                             cloneMapFileName = self.cloneMap), 0.0)        # unit: m2 (input file is in hectare)
+                             cloneMapFileName = self.cloneMap)
+            self.irrigationArea = 10000. * pcr.cover(irrigationArea, 0.0)   # unit: m2 (input file is in hectare)
         else:
             irrigation_pcraster_file = self.dynamicIrrigationAreaFile + yearInString + ".map"
             logger.debug('reading irrigation area map from : '+irrigation_pcraster_file)
@@ -1215,19 +1251,26 @@ class LandSurface(object):
         self.irrigationArea = pcr.max(self.irrigationArea, 0.0)              
         self.irrigationArea = pcr.min(self.irrigationArea, self.cellArea)   # limited by cellArea
         
-        # calculate fracVegCover (for irrigation only)
-        for coverType in self.coverTypes:
-            if coverType.startswith('irr'):
+        # calculate and rescale fracVegCover of all land cover types with one (vectorized) operation over the stacked land cover fractions
+        if self.landCoverStack is not None:
+            a,b,c = self.landCoverStack.scale_dynamic_irrigation(self.landCoverObj, self.irrigationArea, self.cellArea)
+            threshold = 1e-4
+            if abs(a) > threshold or abs(b) > threshold:
+                logger.error("fraction total (from all land cover types) is not equal to 1.0 ... Min %f Max %f Mean %f" %(a,b,c)) 
+        else:
+            # calculate fracVegCover (for irrigation only)
+            for coverType in self.coverTypes:
+                if coverType.startswith('irr'):
                 
-                self.landCoverObj[coverType].fractionArea = 0.0    # reset 
-                self.landCoverObj[coverType].fractionArea = self.landCoverObj[coverType].irrTypeFracOverIrr * self.irrigationArea # unit: m2
-                self.landCoverObj[coverType].fracVegCover = pcr.min(1.0, self.landCoverObj[coverType].fractionArea/ self.cellArea) 
+                    self.landCoverObj[coverType].fractionArea = 0.0    # reset 
+                    self.landCoverObj[coverType].fractionArea = self.landCoverObj[coverType].irrTypeFracOverIrr * self.irrigationArea # unit: m2
+                    self.landCoverObj[coverType].fracVegCover = pcr.min(1.0, self.landCoverObj[coverType].fractionArea/ self.cellArea) 
 
-                # avoid small values
-                self.landCoverObj[coverType].fracVegCover = pcr.rounddown(self.landCoverObj[coverType].fracVegCover * 1000.)/1000.
+                    # avoid small values
+                    self.landCoverObj[coverType].fracVegCover = pcr.rounddown(self.landCoverObj[coverType].fracVegCover * 1000.)/1000.
 
-        # rescale land cover fractions (for all land cover types):
-        self.scaleModifiedLandCoverFractions()
+            # rescale land cover fractions (for all land cover types):
+            self.scaleModifiedLandCoverFractions()
         
     def update(self,meteo,groundwater,routing,currTimeStep):
         
@@ -1277,22 +1320,25 @@ class LandSurface(object):
 
             ####################################################################################################################################################################
             # correcting land cover fractions
-            total_fractions = pcr.scalar(0.0)
-            for coverType in self.coverTypes:
-                total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
+            if self.landCoverStack is not None:
+                self.landCoverStack.normalize_fractions(self.landCoverObj)
+            else:
+                total_fractions = pcr.scalar(0.0)
+                for coverType in self.coverTypes:
+                    total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
             
-            if 'grassland' in list(self.landCoverObj.keys()):
-                self.landCoverObj['grassland'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['grassland'].fracVegCover, 1.0)
+                if 'grassland' in list(self.landCoverObj.keys()):
+                    self.landCoverObj['grassland'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['grassland'].fracVegCover, 1.0)
             
-            if 'short_natural' in list(self.landCoverObj.keys()):
-                self.landCoverObj['short_natural'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['short_natural'].fracVegCover, 1.0)
+                if 'short_natural' in list(self.landCoverObj.keys()):
+                    self.landCoverObj['short_natural'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['short_natural'].fracVegCover, 1.0)
             
-            total_fractions = pcr.scalar(0.0)
-            for coverType in self.coverTypes:
-                total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
+                total_fractions = pcr.scalar(0.0)
+                for coverType in self.coverTypes:
+                    total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
             
-            for coverType in self.coverTypes:
-                self.landCoverObj[coverType].fracVegCover = self.landCoverObj[coverType].fracVegCover / total_fractions                                                                                                   
+                for coverType in self.coverTypes:
+                    self.landCoverObj[coverType].fracVegCover = self.landCoverObj[coverType].fracVegCover / total_fractions                                                                                                   
             ####################################################################################################################################################################
 
 
@@ -1308,22 +1354,25 @@ class LandSurface(object):
 
             ####################################################################################################################################################################
             # correcting land cover fractions
-            total_fractions = pcr.scalar(0.0)
-            for coverType in self.coverTypes:
-                total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
+            if self.landCoverStack is not None:
+                self.landCoverStack.normalize_fractions(self.landCoverObj)
+            else:
+                total_fractions = pcr.scalar(0.0)
+                for coverType in self.coverTypes:
+                    total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
             
-            if 'grassland' in list(self.landCoverObj.keys()):
-                self.landCoverObj['grassland'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['grassland'].fracVegCover, 1.0)
+                if 'grassland' in list(self.landCoverObj.keys()):
+                    self.landCoverObj['grassland'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['grassland'].fracVegCover, 1.0)
             
-            if 'short_natural' in list(self.landCoverObj.keys()):
-                self.landCoverObj['short_natural'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['short_natural'].fracVegCover, 1.0)
+                if 'short_natural' in list(self.landCoverObj.keys()):
+                    self.landCoverObj['short_natural'].fracVegCover = pcr.ifthenelse(total_fractions > 0.1, self.landCoverObj['short_natural'].fracVegCover, 1.0)
             
-            total_fractions = pcr.scalar(0.0)
-            for coverType in self.coverTypes:
-                total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
+                total_fractions = pcr.scalar(0.0)
+                for coverType in self.coverTypes:
+                    total_fractions += self.landCoverObj[coverType].fracVegCover                                                                                                   
             
-            for coverType in self.coverTypes:
-                self.landCoverObj[coverType].fracVegCover = self.landCoverObj[coverType].fracVegCover / total_fractions                                                                                                   
+                for coverType in self.coverTypes:
+                    self.landCoverObj[coverType].fracVegCover = self.landCoverObj[coverType].fracVegCover / total_fractions                                                                                                   
             ####################################################################################################################################################################
 
 
@@ -1334,56 +1383,66 @@ class LandSurface(object):
         #
         if ((self.dynamicIrrigationArea and self.includeIrrigation) or self.noAnnualChangesInLandCoverParameter == False) and currTimeStep.doy == 1:
             #
-            # loop for all main states:
-            for var in self.mainStates:
+            if self.landCoverStack is not None:
+                check = self.landCoverStack.transfer_states(self.landCoverObj, self.mainStates)
+                for var in self.mainStates:
+                    a,b,c = check[var]
+                    threshold = 1e-5
+                    if abs(a) > threshold or abs(b) > threshold:
+                        logger.warning("Error in transfering states (due to dynamic in land cover fractions) ... Min %f Max %f Mean %f" %(a,b,c))
+                    else:     
+                        logger.info("Successful in transfering states (after change in land cover fractions) ... Min %f Max %f Mean %f" %(a,b,c))
+            else:
+                # loop for all main states:
+                for var in self.mainStates:
                 
-                logger.info("Transfering states for the variable "+str(var))
+                    logger.info("Transfering states for the variable "+str(var))
 
-                moving_fraction = pcr.scalar(0.0)                       # total land cover fractions that will be transferred
-                moving_states   = pcr.scalar(0.0)                       # total states that will be transferred
+                    moving_fraction = pcr.scalar(0.0)                       # total land cover fractions that will be transferred
+                    moving_states   = pcr.scalar(0.0)                       # total states that will be transferred
                 
-                for coverType in self.coverTypes:
+                    for coverType in self.coverTypes:
                     
-                    old_fraction = self.landCoverObj[coverType].previousFracVegCover
-                    new_fraction = self.landCoverObj[coverType].fracVegCover
+                        old_fraction = self.landCoverObj[coverType].previousFracVegCover
+                        new_fraction = self.landCoverObj[coverType].fracVegCover
                     
-                    moving_fraction += pcr.max(0.0, old_fraction-new_fraction)
-                    moving_states   += pcr.max(0.0, old_fraction-new_fraction) * vars(self.landCoverObj[coverType])[var]
+                        moving_fraction += pcr.max(0.0, old_fraction-new_fraction)
+                        moving_states   += pcr.max(0.0, old_fraction-new_fraction) * vars(self.landCoverObj[coverType])[var]
 
-                previous_state = pcr.scalar(0.0)
-                rescaled_state = pcr.scalar(0.0)
+                    previous_state = pcr.scalar(0.0)
+                    rescaled_state = pcr.scalar(0.0)
                 
-                # correcting states
-                for coverType in self.coverTypes:
+                    # correcting states
+                    for coverType in self.coverTypes:
                     
-                    old_states   = vars(self.landCoverObj[coverType])[var]
-                    old_fraction = self.landCoverObj[coverType].previousFracVegCover
-                    new_fraction = self.landCoverObj[coverType].fracVegCover
+                        old_states   = vars(self.landCoverObj[coverType])[var]
+                        old_fraction = self.landCoverObj[coverType].previousFracVegCover
+                        new_fraction = self.landCoverObj[coverType].fracVegCover
                     
-                    correction   = moving_states *\
-                                   vos.getValDivZero( pcr.max(0.0, new_fraction - old_fraction),\
-                                                      moving_fraction, vos.smallNumber )
+                        correction   = moving_states *\
+                                       vos.getValDivZero( pcr.max(0.0, new_fraction - old_fraction),\
+                                                          moving_fraction, vos.smallNumber )
                      
-                    new_states   = pcr.ifthenelse(new_fraction > old_fraction, 
-                                   vos.getValDivZero( 
-                                   old_states * old_fraction + correction, \
-                                   new_fraction, vos.smallNumber), old_states) 
+                        new_states   = pcr.ifthenelse(new_fraction > old_fraction, 
+                                       vos.getValDivZero( 
+                                       old_states * old_fraction + correction, \
+                                       new_fraction, vos.smallNumber), old_states) 
                     
-                    new_states   = pcr.ifthenelse(new_fraction > 0.0, new_states, pcr.scalar(0.0))
+                        new_states   = pcr.ifthenelse(new_fraction > 0.0, new_states, pcr.scalar(0.0))
                     
-                    vars(self.landCoverObj[coverType])[var] = new_states
+                        vars(self.landCoverObj[coverType])[var] = new_states
 
-                    previous_state += old_fraction * old_states
-                    rescaled_state += new_fraction * new_states
+                        previous_state += old_fraction * old_states
+                        rescaled_state += new_fraction * new_states
             
-                # check and make sure that previous_state == rescaled_state
-                check_map = previous_state - rescaled_state
-                a,b,c = vos.getMinMaxMean(check_map)
-                threshold = 1e-5
-                if abs(a) > threshold or abs(b) > threshold:
-                    logger.warning("Error in transfering states (due to dynamic in land cover fractions) ... Min %f Max %f Mean %f" %(a,b,c))
-                else:     
-                    logger.info("Successful in transfering states (after change in land cover fractions) ... Min %f Max %f Mean %f" %(a,b,c))
+                    # check and make sure that previous_state == rescaled_state
+                    check_map = previous_state - rescaled_state
+                    a,b,c = vos.getMinMaxMean(check_map)
+                    threshold = 1e-5
+                    if abs(a) > threshold or abs(b) > threshold:
+                        logger.warning("Error in transfering states (due to dynamic in land cover fractions) ... Min %f Max %f Mean %f" %(a,b,c))
+                    else:     
+                        logger.info("Successful in transfering states (after change in land cover fractions) ... Min %f Max %f Mean %f" %(a,b,c))
 
         # for the last day of the year, we have to save the previous land cover fractions (to be considered in the next time step) 
         if self.dynamicIrrigationArea and self.includeIrrigation and currTimeStep.isLastDayOfYear:     
@@ -1439,6 +1498,7 @@ class LandSurface(object):
         for var in self.aggrVars: vars(self)[var] = pcr.scalar(0.0)
         #
         # get or calculate the values of all aggregated values/variables
+        # - also with stacked land cover arrays, this is done with PCRaster (see land_cover_stack.py)
         for coverType in self.coverTypes:
             # calculate the aggregrated or global landSurface values: 
             for var in self.aggrVars:
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Stacked land cover arrays (the 'stackedLandCoverEngine' option of the landSurfaceOptions).
+#
+# The states, fluxes and fractions (fracVegCover) of all land cover types are stacked into (land cover type, land cell) arrays,
+# so that the operations over all land cover types are done with one (vectorized) operation instead of one loop per land cover type:
+# - the correction (normalization) of the land cover fractions,
+# - the transfer of states due to changes in the land cover fractions (at the beginning of each year),
+# - the scaling of the fractions to the (dynamic) irrigation areas.
+#
+# The states and fluxes remain PCRaster maps of every land cover type (they are only stacked for these operations). The daily aggregation
+# of the land cover values (fraction weighted sums in landSurface.update) is therefore done with PCRaster: converting every aggregated
+# value from and to a map was 5 to 7 times slower than the PCRaster loop.
+#
+# The land cover types are summed in the order of the coverTypes (in float32), as in the loops of landSurface.py.
+# Missing values are propagated (as NaN).
+#
+# With the 'incrementalLandCoverUpdate' option, the arithmetic of the yearly correction of the fractions and of the transfer of states
+# is only done for the land cells at which the fractions have changed (the other cells keep their values), and the state maps of the
+# land cover types without any change are kept. Note that the maps of all land cover types are still converted from (and the fractions
+# to) the stacked arrays for all land cells, as the states are PCRaster maps (see above). Therefore, the calculation time of the yearly
+# update is not proportional to the number of changed cells.
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LandCoverStack(object):
+
+    def __init__(self, landmask, coverTypes, incremental = False):
+        object.__init__(self)
+
+        # land cells (flat indices of the clone)
+        landmask = pcr.pcr2numpy(pcr.cover(landmask, pcr.boolean(0)), 0)
+        self.shape = landmask.shape
+        self.cells = np.flatnonzero(landmask)
+
+        self.coverTypes = list(coverTypes)
+
+        # fractions (land cover type, land cell) and the fracVegCover maps they are based on
+        self.fractionMaps = None
+        self.fractions    = None
+
+        # change detection (incrementalLandCoverUpdate): the fractions before and after the last correction
+        self.incremental = incremental
+        self.uncorrectedFractions = None
+        self.correctedFractions   = None
+
+    def to_array(self, pcr_map):
+        """
+        Return the values of a (spatial or non-spatial) map at the land cells (missing values as NaN).
+        """
+        return pcr.pcr2numpy(pcr.spatial(pcr.scalar(pcr_map)), np.nan).ravel()[self.cells]
+
+    def to_map(self, values):
+        """
+        Return a scalar map of values at the land cells (NaN and cells outside the land cells as missing values).
+        """
+        grid = np.full(self.shape, vos.MV, dtype = np.float32)
+        grid.ravel()[self.cells] = np.where(np.isnan(values), vos.MV, values)
+        return pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
+
+    def stack(self, landCoverObj, var, coverTypes = None):
+        """
+        Return the values (land cover type, land cell) of a variable of all land cover types (or of the given coverTypes).
+        """
+        if coverTypes is None: coverTypes = self.coverTypes
+        values = np.empty((len(coverTypes), self.cells.size), dtype = np.float32)
+        for i_cover, coverType in enumerate(coverTypes):
+            values[i_cover] = self.to_array(vars(landCoverObj[coverType])[var])
+        return values
+
+    def get_fractions(self, landCoverObj):
+        """
+        Return the land cover fractions (land cover type, land cell). They are only stacked again if a fracVegCover has changed.
+        """
+        fractionMaps = [landCoverObj[coverType].fracVegCover for coverType in self.coverTypes]
+        if self.fractionMaps is None or any(new is not old for new, old in zip(fractionMaps, self.fractionMaps)):
+            self.fractions    = self.stack(landCoverObj, 'fracVegCover')
+            self.fractionMaps = fractionMaps
+        return self.fractions
+
+    def set_fractions(self, landCoverObj, fractions):
+        """
+        Set the fracVegCover maps of all land cover types (and keep the given fractions).
+        """
+        for i_cover, coverType in enumerate(self.coverTypes):
+            landCoverObj[coverType].fracVegCover = self.to_map(fractions[i_cover])
+        self.fractions    = fractions
+        self.fractionMaps = [landCoverObj[coverType].fracVegCover for coverType in self.coverTypes]
+
+    def changed_cells(self, old_fractions, new_fractions):
+        """
+        Return the land cells (indices) at which the fraction of any land cover type has changed (also from or to missing values).
+        """
+        unchanged = (old_fractions == new_fractions) | (np.isnan(old_fractions) & np.isnan(new_fractions))
+        return np.flatnonzero(~unchanged.all(axis = 0))
+
+    def normalized(self, fractions, coverTypesWithFullCover, min_total):
+        """
+        Return the fractions (land cover type, cell) corrected such that their total is one.
+        """
+        fractions = fractions.copy()
+
+        total_fractions = fractions.sum(axis = 0)
+        for i_cover, coverType in enumerate(self.coverTypes):
+            if coverType in coverTypesWithFullCover:
+                fractions[i_cover] = np.where(np.isnan(total_fractions), np.nan, \
+                                     np.where(total_fractions > min_total, fractions[i_cover], np.float32(1.0)))
+
+        fractions /= fractions.sum(axis = 0)[np.newaxis]
+        return fractions
+
+    def normalize_fractions(self, landCoverObj, coverTypesWithFullCover = ('grassland', 'short_natural'), min_total = 0.1):
+        """
+        Correct the land cover fractions such that their total is one. The land cover types coverTypesWithFullCover get
+        a fraction of one in cells with a total fraction below min_total.
+        """
+        uncorrected_fractions = self.get_fractions(landCoverObj)
+
+        if self.incremental and self.uncorrectedFractions is not None:
+            # only the cells with changed (uncorrected) fractions are corrected again
+            cells = self.changed_cells(self.uncorrectedFractions, uncorrected_fractions)
+            msg = "Correcting the land cover fractions of " + str(cells.size) + " (changed) land cells of " + str(self.cells.size) + "."
+            logger.info(msg)
+            fractions = self.correctedFractions.copy()
+            fractions[:, cells] = self.normalized(uncorrected_fractions[:, cells], coverTypesWithFullCover, min_total)
+        else:
+            fractions = self.normalized(uncorrected_fractions, coverTypesWithFullCover, min_total)
+
+        self.set_fractions(landCoverObj, fractions)
+
+        if self.incremental:
+            self.uncorrectedFractions = uncorrected_fractions
+            self.correctedFractions   = fractions
+
+    def scale_dynamic_irrigation(self, landCoverObj, irrigationArea, cellArea):
+        """
+        Set the fractions of all land cover types for the given irrigation areas (see landSurface.scaleDynamicIrrigation and 
+        scaleModifiedLandCoverFractions): the irrigation types get their shares (irrTypeFracOverIrr) of the irrigation areas 
+        (scaled to a total of at most one) and the other types share the remaining fraction (naturalFracVegCover).
+        Return the (min, max, mean) of the total fractions minus one.
+        """
+        irrigated = [coverType.startswith('irr') for coverType in self.coverTypes]
+        irrCoverTypes = [coverType for coverType in self.coverTypes if coverType.startswith('irr')]
+        natCoverTypes = [coverType for coverType in self.coverTypes if not coverType.startswith('irr')]
+
+        irrigationArea = self.to_array(irrigationArea)
+        cellArea       = self.to_array(cellArea)
+
+        # fractions of the irrigation types
+        fractionArea = self.stack(landCoverObj, 'irrTypeFracOverIrr', irrCoverTypes) * irrigationArea[np.newaxis]          # unit: m2
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            irrFractions = np.minimum(np.float32(1.0), np.where(cellArea == 0.0, np.nan, fractionArea / cellArea))
+        irrFractions = np.floor(irrFractions * np.float32(1000.)) / np.float32(1000.)
+
+        # correcting/scaling the fractions of the irrigation types if their total is above one
+        irrigatedAreaFrac = irrFractions.sum(axis = 0)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            irrFractions = np.where(np.isnan(irrigatedAreaFrac), np.nan, \
+                           np.where(irrigatedAreaFrac > 1.0, irrFractions / irrigatedAreaFrac, irrFractions))
+        irrigatedAreaFrac = irrFractions.sum(axis = 0)
+
+        # fractions of the other (natural) types
+        natFractions = self.stack(landCoverObj, 'naturalFracVegCover', natCoverTypes) * np.maximum(np.float32(0.0), np.float32(1.0) - irrigatedAreaFrac)
+
+        fractions = np.empty((len(self.coverTypes), self.cells.size), dtype = np.float32)
+        fractions[np.array(irrigated)] = irrFractions
+        fractions[~np.array(irrigated)] = natFractions
+        self.set_fractions(landCoverObj, fractions)
+        for i_cover, coverType in enumerate(irrCoverTypes):
+            landCoverObj[coverType].fractionArea = self.to_map(fractionArea[i_cover])
+
+        # check: the total fractions minus one (at land cells with missing values: zero)
+        totalArea = irrigatedAreaFrac + np.where(np.isnan(natFractions), np.float32(0.0), natFractions).sum(axis = 0) - np.float32(1.0)
+        totalArea = np.where(np.isnan(totalArea), np.float32(0.0), totalArea)
+        if totalArea.size == 0: return (0.0, 0.0, 0.0)
+        return (float(totalArea.min()), float(totalArea.max()), float(totalArea.mean()))
+
+    def transfer_states(self, landCoverObj, states):
+        """
+        Transfer the states of land cover types with decreasing fractions to the land cover types with increasing fractions
+        (from previousFracVegCover to fracVegCover). Return a dictionary of the (min, max, mean) of the difference between
+        the fraction weighted sums of the states before and after the transfer.
+        """
+        old_fractions = self.stack(landCoverObj, 'previousFracVegCover')
+        new_fractions = self.get_fractions(landCoverObj)
+
+        # cells at which the states are transferred
+        cells = slice(None)
+        if self.incremental:
+            cells = self.changed_cells(old_fractions, new_fractions)
+            msg = "Transfering the states of " + str(cells.size) + " (changed) land cells of " + str(self.cells.size) + "."
+            logger.info(msg)
+        old_fractions_of_cells = old_fractions[:, cells]
+        new_fractions_of_cells = new_fractions[:, cells]
+
+        decrease = np.maximum(np.float32(0.0), old_fractions_of_cells - new_fractions_of_cells)
+        increase = np.maximum(np.float32(0.0), new_fractions_of_cells - old_fractions_of_cells)
+
+        # total land cover fractions that will be transferred and the shares of the receiving land cover types
+        moving_fraction = decrease.sum(axis = 0)
+        with np.errstate(over = 'ignore', invalid = 'ignore'):
+            share = np.where(moving_fraction > vos.smallNumber, increase / np.maximum(np.float32(vos.smallNumber), moving_fraction), np.float32(0.0))
+
+        check = {}
+        for var in states:
+
+            logger.info("Transfering states for the variable "+str(var))
+
+            old_states = self.stack(landCoverObj, var)
+
+            # states of the cells without changes: set to zero for zero fractions
+            new_states = np.where(new_fractions > 0.0, old_states, np.float32(0.0))
+            new_states = np.where(np.isnan(old_fractions) | np.isnan(new_fractions), np.nan, new_states)
+            old_states_of_cells = old_states[:, cells]
+
+            # total states that will be transferred
+            moving_states = (decrease * old_states_of_cells).sum(axis = 0)
+
+            # correcting states
+            with np.errstate(over = 'ignore', invalid = 'ignore'):
+                correction = moving_states * share
+                new_states_of_cells = np.where(new_fractions_of_cells > vos.smallNumber, \
+                                      (old_states_of_cells * old_fractions_of_cells + correction) / np.maximum(np.float32(vos.smallNumber), new_fractions_of_cells), np.float32(0.0))
+            new_states_of_cells = np.where(new_fractions_of_cells > old_fractions_of_cells, new_states_of_cells, old_states_of_cells)
+            new_states_of_cells = np.where(new_fractions_of_cells > 0.0, new_states_of_cells, np.float32(0.0))
+            new_states_of_cells = np.where(np.isnan(old_fractions_of_cells) | np.isnan(new_fractions_of_cells), np.nan, new_states_of_cells)
+            new_states[:, cells] = new_states_of_cells
+
+            for i_cover, coverType in enumerate(self.coverTypes):
+                # - with change detection, the maps of land cover types without any change are kept
+                if self.incremental and np.array_equal(new_states[i_cover], old_states[i_cover], equal_nan = True): continue
+                vars(landCoverObj[coverType])[var] = self.to_map(new_states[i_cover])
+
+            # the difference between the previous and rescaled states (should be zero; zero at the cells without changes)
+            check_values = np.where(np.isnan(old_fractions.sum(axis = 0) + new_fractions.sum(axis = 0)), np.nan, np.float32(0.0))
+            check_values[cells] = (old_fractions_of_cells * old_states_of_cells).sum(axis = 0) - (new_fractions_of_cells * new_states_of_cells).sum(axis = 0)
+            check_values = check_values[~np.isnan(check_values)]
+            if check_values.size == 0:
+                check[var] = (0.0, 0.0, 0.0)
+            else:
+                check[var] = (float(check_values.min()), float(check_values.max()), float(check_values.mean()))
+
+        return check
+
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Executing a set of parallel (clone) runs from one orchestrating process.
+#
+# Instead of starting a new python process for every clone (that imports PCRaster/netCDF4 and parses
+# the ini file again), this process does these things once and then forks one child per clone.
+# Before forking, clone-independent data are prepared, so that the children share them copy-on-write:
+# - the map attributes of the clone maps (virtualOS.mapattrcache),
+# - the opened (local) forcing netcdf files (virtualOS.filecache), only if 'multi_clone_share_netcdf_handles' is True (default: False);
+#   netCDF4/HDF5 handles are not fork-safe (the children share the file descriptors, and the HDF5 library state is copied), 
+#   therefore every clone opens the forcing files itself by default.
+#
+# Note that the clones cannot be executed in threads of one process, as PCRaster has one (global) clone map per process.
+#
+# Usage (with the same optional arguments as deterministic_runner_with_arguments.py, e.g. -mod):
+#   python multi_clone_runner.py <ini_file> parallel <first_clone_number>-<last_clone_number> [-mod ...]
+#   python multi_clone_runner.py <ini_file> parallel 1,2,5 [-mod ...]
+
+import os
+import sys
+import copy
+import logging
+
+import virtualOS as vos
+import clone_launcher
+
+from configuration import Configuration
+
+import deterministic_runner_with_arguments as runner
+
+logger = logging.getLogger(__name__)
+
+import disclaimer
+
+
+def get_clone_numbers(argument):
+
+    clone_numbers = []
+    for part in argument.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            clone_numbers += list(range(int(first), int(last) + 1))
+        else:
+            clone_numbers.append(int(part))
+    return clone_numbers
+
+
+def open_shared_netcdf_files(configuration):
+    """
+    Open the (local) forcing netcdf files in the virtualOS.filecache, so that all clones (children) use the same handles.
+    """
+
+    for key in ['precipitationNC', 'temperatureNC', 'refETPotFileNC']:
+        if key not in list(configuration.meteoOptions.keys()): continue
+        ncFile = vos.getFullPath(configuration.meteoOptions[key], configuration.globalOptions['inputDir'])
+        # - files on OPeNDAP servers (sockets) and files that are set per year are not shared
+        if ncFile.startswith("http") or "%" in ncFile or os.path.exists(ncFile) == False: continue
+        if ncFile not in list(vos.filecache.keys()):
+            logger.info("Opening the netcdf file " + ncFile + " (shared by all clones).")
+            vos.filecache[ncFile] = vos.nc.Dataset(ncFile)
+
+
+def run_clone(general_configuration, clone_number, system_argument):
+    """
+    Execute the run of one clone (in a forked child).
+    """
+
+    # the child writes its own log files (see Configuration.initialize_logging)
+    for handler in list(logging.getLogger().handlers): logging.getLogger().removeHandler(handler)
+
+    configuration = copy.deepcopy(general_configuration)
+    runner.set_configuration_for_clone(configuration, clone_code = str(clone_number))
+
+    clone_system_argument = [system_argument[0], system_argument[1], system_argument[2], str(clone_number)] + system_argument[4:]
+    configuration.set_configuration(system_arguments = clone_system_argument)
+
+    runner.run(configuration, system_argument = clone_system_argument)
+    return 0
+
+
+def main():
+
+    iniFileName   = os.path.abspath(sys.argv[1])
+    debug_mode    = sys.argv[2] == "debug_parallel" or sys.argv[2] == "debug-parallel"
+    clone_numbers = get_clone_numbers(sys.argv[3])
+
+    # modify ini file (once for all clones) and return it in a new location
+    if "-mod" in sys.argv:
+        iniFileName = runner.modify_ini_file(original_ini_file = iniFileName, \
+                                             system_argument = [sys.argv[0], sys.argv[1], "multi_clone"] + sys.argv[3:])
+
+    # object to handle configuration/ini file (parsed once for all clones)
+    general_configuration = Configuration(iniFileName = iniFileName, \
+                                          debug_mode = debug_mode, \
+                                          no_modification = False)
+
+    # logging of this orchestrating process
+    log_folder = os.path.join(general_configuration.globalOptions['outputDir'], "multi_clone_runner", "log") + "/"
+    if os.path.exists(log_folder) == False: os.makedirs(log_folder)
+    general_configuration.initialize_logging(log_folder, sys.argv)
+
+    # preparing clone-independent data before forking
+    for clone_number in clone_numbers:
+        clone_map = vos.getFullPath(general_configuration.globalOptions['cloneMap'] %(int(clone_number)), general_configuration.globalOptions['inputDir'])
+        vos.getMapAttributesALL(clone_map)
+    share_netcdf_handles = False
+    if 'multi_clone_share_netcdf_handles' in list(general_configuration.globalOptions.keys()) and\
+       general_configuration.globalOptions['multi_clone_share_netcdf_handles'] == "True":
+        share_netcdf_handles = True
+    if share_netcdf_handles:
+        msg = "The opened forcing netcdf files are shared by the forked clones (multi_clone_share_netcdf_handles = True). Note that netCDF4/HDF5 handles are not fork-safe."
+        logger.warning(msg)
+        open_shared_netcdf_files(general_configuration)
+
+    # the clones wait for each other if merging and/or modflow processes are included
+    runs_wait_for_each_other = general_configuration.online_coupling_between_pcrglobwb_and_modflow or\
+                               ('with_merging' in list(general_configuration.globalOptions.keys()) and general_configuration.globalOptions['with_merging'] == "True")
+
+    launcher = clone_launcher.create_launcher_from_options(general_configuration.globalOptions, len(clone_numbers), runs_wait_for_each_other)
+    for clone_number in clone_numbers:
+        launcher.add_run("M%07i" %(clone_number), lambda clone_number = clone_number: run_clone(general_configuration, clone_number, sys.argv))
+
+    all_runs_are_successful = launcher.run()
+    if all_runs_are_successful == False: return 1
+    return 0
+
+if __name__ == '__main__':
+    # print disclaimer
+    disclaimer.print_disclaimer(with_logger = True)
+    sys.exit(main())
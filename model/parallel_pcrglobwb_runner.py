@@ -33,7 +33,8 @@ import datetime
 import pcraster as pcr
 
 import configuration
-import virtualOS as vos
+import clone_launcher
+import clone_scheduler
 
 import logging
 logger = logging.getLogger(__name__)
@@ -53,9 +54,19 @@ if len(sys.argv) > 2: debug_option = str(sys.argv[2])
 # object to handle configuration/ini file
 generalConfiguration = configuration.Configuration(iniFileName = iniFileName, debug_mode = False, no_modification = False)
 
+# option to use a partition plan made by clone_scheduler.py; in this case 'cloneAreas' is the worker/node name in the plan (e.g. node_1)
+clone_partition_plan = None
+if 'clone_partition_plan' in list(generalConfiguration.globalOptions.keys()) and\
+   generalConfiguration.globalOptions['clone_partition_plan'] != "None":
+    clone_partition_plan = generalConfiguration.globalOptions['clone_partition_plan']
+
+# a run that covers only a part of the clones (e.g. one of the nodes)
+this_run_is_a_partial_run = generalConfiguration.globalOptions['cloneAreas'] == "part_one" or\
+                            generalConfiguration.globalOptions['cloneAreas'] == "part_two" or\
+                            clone_partition_plan is not None
+
 clean_previous_output = True
-if generalConfiguration.globalOptions['cloneAreas'] == "part_one" or\
-   generalConfiguration.globalOptions['cloneAreas'] == "part_two":
+if this_run_is_a_partial_run:
     clean_previous_output = False
 
 # clean any files exists on the ouput directory (this can be done for global runs)
@@ -87,8 +98,7 @@ else:
 
 # make the backup of these python scripts to a specific backup folder and go to the backup folder
 scriptDir = generalConfiguration.globalOptions['outputDir'] + "/global/scripts/"
-if generalConfiguration.globalOptions['cloneAreas'] == "part_one" or\
-   generalConfiguration.globalOptions['cloneAreas'] == "part_two":
+if this_run_is_a_partial_run:
     scriptDir = scriptDir + "/" + generalConfiguration.globalOptions['cloneAreas'] + "/"
 logger.info('Making the backup of the python scripts used to the folder %s', scriptDir)
 if os.path.exists(scriptDir): shutil.rmtree(scriptDir)
@@ -152,39 +162,46 @@ if clone_codes[0] == "part_two":
     #
     # the execution of merging and modflow processes are done in another node
     with_merging_or_modflow = False
+#
+# - using a partition plan over several nodes (see clone_scheduler.py):
+if clone_partition_plan is not None:
+    #
+    node_name   = generalConfiguration.globalOptions['cloneAreas']
+    clone_codes = clone_scheduler.read_plan(clone_partition_plan, node_name)
+    logger.info('Using the clones assigned to ' + node_name + ' in the partition plan ' + clone_partition_plan + ': ' + ",".join(clone_codes))
+    #
+    # the execution of merging and modflow processes are done in the first node only
+    if node_name != "node_1": with_merging_or_modflow = False
+
+
+# the clone runs wait for each other at the end of every month if the ini file sets them with merging and/or modflow (see deterministic_runner_with_arguments.py), 
+# also if the merging and modflow processes are executed in another node 
+clone_runs_wait_for_each_other = generalConfiguration.online_coupling_between_pcrglobwb_and_modflow
+if "with_merging" in list(generalConfiguration.globalOptions.keys()) and generalConfiguration.globalOptions["with_merging"] == "True":
+    clone_runs_wait_for_each_other = True
 
+# the launcher for the clone runs (see clone_launcher.py for the options in the globalOptions)
+# - if the clone runs wait for each other, they must run at the same time 
+launcher = clone_launcher.create_launcher_from_options(generalConfiguration.globalOptions, len(clone_codes), runs_wait_for_each_other = clone_runs_wait_for_each_other)
 
-# command line(s) for PCR-GLOBWB 
+
+# PCR-GLOBWB clone runs 
 logger.info('Running transient PCR-GLOBWB with/without MODFLOW ')
-i_clone = 0
-cmd = ''
 for clone_code in clone_codes:
-
-   cmd += "python deterministic_runner_glue_with_parallel_and_modflow_options.py " + iniFileName  + " " + debug_option + " " + clone_code + " "
-   cmd = cmd + " & "
-   i_clone += 1
+   launcher.add_run(clone_code, [sys.executable, "deterministic_runner_glue_with_parallel_and_modflow_options.py", iniFileName, debug_option, clone_code])
 
 
 # Note that for runs with spin-up, we should not combine it with modflow 
 
 
-# command line(s) for merging and MODFLOW processes:       
+# merging and MODFLOW processes (executed next to the clone runs, without retries):       
 if with_merging_or_modflow:
 
    logger.info('Also with merging and/or MODFLOW processes ')
    
-   cmd += "python deterministic_runner_for_monthly_modflow_and_merging.py " + iniFileName +" "+debug_option +" transient"
-
-   cmd = cmd + " & "       
-
-
-# don't foget to add the following line
-cmd = cmd + "wait"       
-
-print(cmd)
-msg = "Call: "+str(cmd)
-logger.debug(msg)
+   launcher.add_background_run("merging", [sys.executable, "deterministic_runner_for_monthly_modflow_and_merging.py", iniFileName, debug_option, "transient"])
 
 
 # execute PCR-GLOBWB and MODFLOW
-vos.cmd_line(cmd, using_subprocess = False)      
+all_runs_are_successful = launcher.run()
+if all_runs_are_successful == False: sys.exit(1)
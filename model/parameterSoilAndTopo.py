@@ -23,10 +23,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
 
+import numpy as np
 import pcraster as pcr
 import virtualOS as vos
 
+import logging
+logger = logging.getLogger(__name__)
+
+# version of the cached parameter files (soilAndTopoParameterCacheDir); to be increased if the derivation of the parameters changes
+cache_version = 1
+
+# options that are used for the derivation of the parameters (from the given optionDict and from the landSurfaceOptions)
+cache_options = ['topographyNC', 'soilPropertiesNC', 'noParameterExtrapolation',
+                 'tanslope', 'slopeLength', 'orographyBeta',
+                 'dzRel0001', 'dzRel0005', 'dzRel0010', 'dzRel0020', 'dzRel0030', 'dzRel0040', 'dzRel0050',
+                 'dzRel0060', 'dzRel0070', 'dzRel0080', 'dzRel0090', 'dzRel0100',
+                 'airEntryValue1', 'airEntryValue2', 'poreSizeBeta1', 'poreSizeBeta2', 'resVolWC1', 'resVolWC2',
+                 'satVolWC1', 'satVolWC2', 'KSat1', 'KSat2', 'percolationImp',
+                 'firstStorDepth', 'secondStorDepth', 'soilWaterStorageCap1', 'soilWaterStorageCap2',
+                 'clappAddCoeff', 'matricSuctionFC', 'matricSuction50', 'matricSuctionWP', 'maxGWCapRise']
+
 class SoilAndTopoParameters(object):
 
     def __init__(self, iniItems, landmask):
@@ -43,9 +61,72 @@ class SoilAndTopoParameters(object):
 
     def read(self, iniItems, optionDict = None):
         
+        # option to save/load all derived parameters to/from one (.npz) file per set of input files, clone and options
+        cacheFile = None
+        if 'soilAndTopoParameterCacheDir' in list(iniItems.landSurfaceOptions.keys()) and iniItems.landSurfaceOptions['soilAndTopoParameterCacheDir'] != "None":
+            cacheFile = self.getCacheFileName(iniItems, optionDict)
+            if os.path.exists(cacheFile):
+                self.loadFromCache(cacheFile)
+                return
+
+        attributes = list(vars(self).keys())
+
         self.readTopo(iniItems, optionDict)
         self.readSoil(iniItems, optionDict)
 
+        if cacheFile is not None:
+            self.saveToCache(cacheFile, [var for var in list(vars(self).keys()) if var not in attributes])
+
+    def getCacheFileName(self, iniItems, optionDict = None):
+        """
+        Return the name of the cache file, based on a hash of the cache version, the clone, the options and the input files (names, sizes and modification times).
+        """
+
+        # a dictionary/section of options that will be used
+        if optionDict == None: optionDict = iniItems.landSurfaceOptions
+
+        key  = "version: " + str(cache_version) + "\n"
+        key += "clone: " + str(self.cloneMap) + " " + str(sorted(vos.getMapAttributesALL(self.cloneMap).items())) + "\n"
+        key += "numberOfLayers: " + str(self.numberOfLayers) + "\n"
+        for option in cache_options:
+            for value in [optionDict.get(option), iniItems.landSurfaceOptions.get(option)]:
+                key += option + ": " + str(value)
+                fileName = str(value) if os.path.isabs(str(value)) else os.path.join(self.inputDir, str(value))
+                if value is not None and os.path.isfile(fileName):
+                    stat = os.stat(fileName)
+                    key += " (" + str(stat.st_size) + " bytes, modified " + str(stat.st_mtime) + ")"
+                key += "\n"
+
+        cacheDir = vos.getFullPath(iniItems.landSurfaceOptions['soilAndTopoParameterCacheDir'], iniItems.globalOptions['outputDir'], False)
+        return os.path.join(cacheDir, "soil_and_topo_parameters_" + hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+    def saveToCache(self, cacheFile, parameters):
+
+        msg = "Saving " + str(len(parameters)) + " soil and topography parameters to the file " + str(cacheFile) + "."
+        logger.info(msg)
+
+        values = {}
+        for var in parameters:
+            values[var] = pcr.pcr2numpy(pcr.spatial(pcr.scalar(vars(self)[var])), np.nan)
+        values['cache_version'] = np.array(cache_version)
+
+        # - written to a temporary file first, as other (clone) runs may read the cache file at the same time
+        cacheDir = os.path.dirname(cacheFile)
+        if os.path.exists(cacheDir) == False: os.makedirs(cacheDir, exist_ok = True)
+        temporaryFile = cacheFile + "." + str(os.getpid()) + ".tmp"
+        with open(temporaryFile, 'wb') as f: np.savez(f, **values)
+        os.replace(temporaryFile, cacheFile)
+
+    def loadFromCache(self, cacheFile):
+
+        msg = "Loading the soil and topography parameters from the file " + str(cacheFile) + "."
+        logger.info(msg)
+
+        with np.load(cacheFile) as values:
+            for var in values.files:
+                if var == 'cache_version': continue
+                vars(self)[var] = pcr.numpy2pcr(pcr.Scalar, np.where(np.isnan(values[var]), vos.MV, values[var]), vos.MV)
+
     def readTopo(self, iniItems, optionDict):
 
         # a dictionary/section of options that will be used
@@ -35,6 +35,8 @@ import meteo
 import landSurface
 import groundwater
 import routing
+import coordination
+import static_input_store
 
 
 import logging
@@ -53,6 +55,10 @@ class PCRGlobWB(object):
         
         pcr.setclone(configuration.cloneMap)
 
+        # option to read the static input maps from the prepared input store (see static_input_store.py)
+        if 'staticInputStore' in list(configuration.globalOptions.keys()) and configuration.globalOptions['staticInputStore'] != "None":
+            static_input_store.open_store(configuration)
+
         # Read the ldd map.
         self.lddMap = vos.readPCRmapClone(\
                   configuration.routingOptions['lddMap'],
@@ -153,6 +159,11 @@ class PCRGlobWB(object):
              str(variable)+"_"+
              specific_date_string+".map",\
              outputDirectory)
+
+        # rolling statistics of the routing as one array (see routing_statistics.py)
+        if self.routing.vectorizedRollingStatistics:
+            self.routing.synchronize_rolling_statistics()
+            self.routing.rollingStatistics.save(os.path.join(outputDirectory, "rollingStatistics_" + specific_date_string + ".npz"))
         
     def calculateAndDumpMonthlyValuesForMODFLOW(self, outputDirectory, timeStamp = "Default"):
 
@@ -503,6 +514,5 @@ class PCRGlobWB(object):
             # - for a spinUpRun, merging will be skipped
             if self.spinUpRun is not None and self.spinUpRun == False:
                 filename = self._configuration.mapsDir + "/pcrglobwb_files_for_" + str(self._modelTime.fulldate)+"_are_ready.txt"
-                if os.path.exists(filename): os.remove(filename)
-                open(filename, "w").close()    
+                coordination.mark_as_ready(filename)    
 
@@ -27,6 +27,7 @@ import types
 import math
 import types
 import itertools
+import tracemalloc
 
 from six.moves import map
 
@@ -40,6 +41,9 @@ import virtualOS as vos
 from ncConverter import *
 
 import waterBodies
+import routing_network
+import routing_kernel
+import routing_statistics
 
 class Routing(object):
     
@@ -119,6 +123,59 @@ class Routing(object):
         # ldd mask 
         self.lddMap = pcr.lddmask(self.lddMap, self.landmask)
 
+        # engine used for the kinematic wave and upstream operations in the kinematic wave method:
+        # - "pcraster": pcr.kinematic and pcr.upstream (default)
+        # - "numpy"   : topologically sorted routing network on flat numpy arrays of the land cells (see routing_network.py)
+        self.routingEngine = "pcraster"
+        if 'routingEngine' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['routingEngine'] != "None":
+            self.routingEngine = iniItems.routingOptions['routingEngine']
+        if self.routingEngine not in ["pcraster", "numpy"]:
+            msg = "Unknown routingEngine: " + str(self.routingEngine) + " (use pcraster or numpy)."
+            raise Exception('Error: ' + msg)
+        if self.routingEngine == "numpy":
+            self.routingNetwork = routing_network.RoutingNetwork(pcr.pcr2numpy(self.lddMap, 0), pcr.pcr2numpy(self.landmask, 0))
+            self.routingNetworkLdd = pcr.pcr2numpy(self.lddMap, 0)[self.routingNetwork.rows, self.routingNetwork.cols]
+            # - flat indices of the network cells in the clone (e.g. for the sparse lakes and reservoirs, see update_water_bodies_for_fused_kernel)
+            self.routingNetworkCells = np.ravel_multi_index((self.routingNetwork.rows, self.routingNetwork.cols), self.routingNetwork.shape)
+            msg = "Using the numpy routing engine: " + str(self.routingNetwork.number_of_cells) + " cells in " + str(self.routingNetwork.number_of_levels) + " topological levels."
+            logger.info(msg)
+            # - without the fused kernel, every call converts the maps of the entire clone (both ways) and the time grows with the number of levels
+            msg = "The numpy routing engine is slower than the PCRaster operations on ldd maps with many topological levels. " + \
+                  "Compare both engines for this ldd map first (python routing_network.py <ldd_map>)."
+            logger.warning(msg)
+
+        # option to evaluate the sub time steps of the kinematic wave method with the fused kernel (see routing_kernel.py)
+        # - all stages of a sub time step are evaluated on flat arrays of the cells of the routing network, using preallocated buffers
+        # - this requires the numpy routing engine
+        self.fusedSubStepKernel = False
+        if 'fusedSubStepKernel' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['fusedSubStepKernel'] == "True":
+            if self.routingEngine != "numpy":
+                msg = "The option fusedSubStepKernel requires routingEngine = numpy."
+                raise Exception('Error: ' + msg)
+            msg = "The sub time steps of the kinematic wave method are evaluated with the fused kernel."
+            logger.info(msg)
+            self.fusedSubStepKernel = True
+        # - the kernel (and its buffers) is created at the first time step 
+        self.subStepKernel = None
+        # - the kernels of the basin classes (see basinLocalSubTimeSteps) are created with the classes
+        self.subStepKernelsOfBasinClasses = []
+
+        self.routingNetworkProfileIndex = None
+
+        # option to report the memory allocated during the sub time steps of every day (traced by tracemalloc)
+        self.reportSubStepMemoryAllocation = False
+        if 'reportSubStepMemoryAllocation' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['reportSubStepMemoryAllocation'] == "True":
+            self.reportSubStepMemoryAllocation = True
+            if tracemalloc.is_tracing() == False: tracemalloc.start()
+
+        # option to traverse the network only once per day in the accuTravelTime method
+        # - only pcr.accutraveltimeflux is evaluated; the remaining storage (accutraveltimestate) follows from the mass balance of every cell
+        self.singleTraversalAccuTravelTime = False
+        if 'singleTraversalAccuTravelTime' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['singleTraversalAccuTravelTime'] == "True":
+            msg = "The channel storage after the accuTravelTime routing is derived from the mass balance (single traversal)."
+            logger.info(msg)
+            self.singleTraversalAccuTravelTime = True
+
         # cell area (unit: m2)
         self.cellArea = vos.readPCRmapClone(\
                   iniItems.routingOptions['cellAreaMap'],
@@ -133,6 +190,19 @@ class Routing(object):
         # maximum number of days (timesteps) to calculate short term average values (default: 1 month = 1 * 30 days = 30)
         self.maxTimestepsToAvgDischargeShort = 30.                            
 
+        # option to update the rolling statistics (avgDischarge, m2tDischarge, avgDischargeShort and avgBaseflow) on one matrix (statistic x land cell)
+        # - see calculate_rolling_statistics and routing_statistics.py
+        # - the matrix can be float64 (rollingStatisticsInFloat64) and is saved as one array in the state files (see pcrglobwb.PCRGlobWB.dumpState)
+        # - the matrix can be initialized from such a state file (rollingStatisticsIni); otherwise, it is initialized from the initial condition maps
+        self.vectorizedRollingStatistics = False
+        if 'vectorizedRollingStatistics' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['vectorizedRollingStatistics'] == "True":
+            self.vectorizedRollingStatistics = True
+            self.rollingStatisticsPrecision = np.float32
+            if 'rollingStatisticsInFloat64' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['rollingStatisticsInFloat64'] == "True":
+                self.rollingStatisticsPrecision = np.float64
+            msg = "The rolling statistics of discharge and baseflow are updated on one matrix (" + np.dtype(self.rollingStatisticsPrecision).name + ")."
+            logger.info(msg)
+
         routingParameters = ['gradient','manningsN']
         for var in routingParameters:
             input = iniItems.routingOptions[str(var)]
@@ -212,6 +282,11 @@ class Routing(object):
 
         # initiate/create WaterBody class
         self.WaterBodies = waterBodies.WaterBodies(iniItems,self.landmask)
+        # - without lakes and reservoirs, all cells have the water body id -1 (see the method update); this is done with the maps (as before)
+        if self.includeWaterBodies == False and self.WaterBodies.useSparseWaterBodies:
+            msg = "The option sparseWaterBodies is not used as includeWaterBodies = False."
+            logger.info(msg)
+            self.WaterBodies.useSparseWaterBodies = False
 
         # crop evaporation coefficient for surface water bodies
         self.no_zero_crop_water_coefficient = True
@@ -246,7 +321,75 @@ class Routing(object):
                                                self.limit_num_of_sub_time_steps)                                 
         # 
         self.limit_num_of_sub_time_steps = np.int(self.limit_num_of_sub_time_steps)
-        
+
+        # option to use basin-local numbers of sub time steps (only for the kinematic wave method)
+        # - basins (catchments of the pits in the lddMap) do not exchange water; therefore each basin needs only
+        #   the number of sub time steps based on its own cells (instead of the one for the entire clone)
+        # - basins are grouped in classes; each class is routed with its own number of sub time steps
+        # - every class is evaluated with the fused kernel on its own basins only (see routing_kernel.SubsetSubStepKernel); 
+        #   therefore, this option requires fusedSubStepKernel = True (the maps of a class would cover the entire clone)
+        # - the number of sub time steps of a class is updated every day (see get_number_of_loops_per_basin_class)
+        self.basinLocalSubTimeSteps = False
+        if 'basinLocalSubTimeSteps' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['basinLocalSubTimeSteps'] == "True":
+
+            if self.fusedSubStepKernel == False:
+                msg = "The option basinLocalSubTimeSteps requires fusedSubStepKernel = True."
+                raise Exception('Error: ' + msg)
+
+            msg = "The number of sub time steps of the kinematic wave method is determined per basin."
+            logger.info(msg)
+
+            self.basinLocalSubTimeSteps = True
+
+            # basin ids (one id for every pit)
+            self.basinIds = pcr.ifthen(self.landmask, pcr.catchment(self.lddMap, pcr.pit(self.lddMap)))
+
+            # number of sub time steps for every basin (same criteria as the one above, but using the basin minimum channel length)
+            design_length_of_sub_time_step = pcr.areaminimum(self.courantNumber * self.channelLength / design_flood_speed, self.basinIds)
+            self.basin_num_of_sub_time_steps = pcr.roundup(vos.secondsPerDay() / design_length_of_sub_time_step)
+            self.basin_num_of_sub_time_steps = pcr.max(24.0, self.basin_num_of_sub_time_steps)
+            if 'maxiumLengthOfSubTimeStep' in list(iniItems.routingOptions.keys()):
+                self.basin_num_of_sub_time_steps = pcr.max(minimum_number_of_sub_time_step, self.basin_num_of_sub_time_steps)
+            self.basin_num_of_sub_time_steps = pcr.min(self.limit_num_of_sub_time_steps, self.basin_num_of_sub_time_steps)
+
+            # ratio between the numbers of sub time steps of two subsequent basin classes
+            self.sub_time_step_class_ratio = 2.0
+            if 'subTimeStepClassRatio' in list(iniItems.routingOptions.keys()):
+                self.sub_time_step_class_ratio = max(1.0, float(iniItems.routingOptions['subTimeStepClassRatio']))
+
+            # basin classes and their numbers of sub time steps (see the method get_basin_classes_for_sub_time_steps)
+            self.basin_classes = None
+
+        # option to route only the basins with water (the active set) within the sub time steps (only for the kinematic wave method)
+        # - a basin is active if it has channel storage, runoff, return flow or lakes/reservoirs (see the method get_active_cells_for_routing)
+        # - the other (dry) basins get their states without the sub time step loop (see the method get_dry_routing_states)
+        # - all cells are routed if the fraction of active cells is larger than maxActiveCellFraction
+        # - the active basins are evaluated with the fused kernel on their own subnetwork (see get_sub_step_kernel_of_active_cells); 
+        #   therefore, this option requires fusedSubStepKernel = True (the maps of the active cells would cover the entire clone)
+        self.activeSetRouting = False
+        if 'activeSetRouting' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['activeSetRouting'] == "True":
+
+            if self.fusedSubStepKernel == False:
+                msg = "The option activeSetRouting requires fusedSubStepKernel = True."
+                raise Exception('Error: ' + msg)
+
+            msg = "The sub time steps of the kinematic wave method are limited to the basins with water (active set)."
+            logger.info(msg)
+
+            self.activeSetRouting = True
+
+            # basin ids (one id for every pit)
+            if self.basinLocalSubTimeSteps == False:
+                self.basinIds = pcr.ifthen(self.landmask, pcr.catchment(self.lddMap, pcr.pit(self.lddMap)))
+
+            self.max_active_cell_fraction = 0.50
+            if 'maxActiveCellFraction' in list(iniItems.routingOptions.keys()):
+                self.max_active_cell_fraction = float(iniItems.routingOptions['maxActiveCellFraction'])
+
+            # fused kernels of the active cells of the current and the previous day (see get_sub_step_kernel_of_active_cells)
+            self.subStepKernelsOfActiveCells         = []
+            self.previousSubStepKernelsOfActiveCells = []
+
         # critical water height (m) used to select stable length of sub time step in kinematic wave methods/approaches
         self.critical_water_height = 0.25;  # used in Van Beek et al. (2011)
 
@@ -285,6 +428,9 @@ class Routing(object):
             self.nrZLevels, self.areaFractions, self.relZ, self.floodVolume, self.kSlope, self.mInterval = \
                             self.getElevationProfile(iniItems)
 
+            # the same profile as tables (level x land cell) used in returnInundationFractionAndFloodDepth
+            self.setElevationProfileTables()
+
             # get bankfull capacity (unit: m3)
             self.predefinedBankfullCapacity = None
             self.usingFixedBankfullCapacity = False
@@ -321,6 +467,9 @@ class Routing(object):
         if 'maxFloodDepth' in list(iniItems.routingOptions.keys()):
             self.maxFloodDepth = vos.readPCRmapClone(iniItems.routingOptions['maxFloodDepth'], self.cloneMap, self.tmpDir, self.inputDir)
         
+        # static parts of the calculation of alpha (kinematic wave) and the characteristic distance (accuTravelTime)
+        self.precompute_static_routing_parameters()
+
         # initiate old style reporting                                  # This is still very useful during the 'debugging' process. 
         self.initiate_old_style_routing_reporting(iniItems)
 
@@ -407,6 +556,47 @@ class Routing(object):
         if self.waterBodyStorage is not None:
             self.waterBodyStorage = pcr.ifthen(self.landmask, pcr.cover(self.waterBodyStorage, 0.0))
 
+        # matrix of the rolling statistics
+        if self.vectorizedRollingStatistics: self.initiate_rolling_statistics(iniItems, iniConditions)
+
+    def initiate_rolling_statistics(self, iniItems, iniConditions = None):
+
+        # land cells (flat indices of the clone) of the matrix
+        landmask = pcr.pcr2numpy(self.landmask, 0)
+        self.rollingStatisticsShape = landmask.shape
+        self.rollingStatisticsCells = np.flatnonzero(landmask)
+        self.rollingStatistics = routing_statistics.RollingStatistics(self.rollingStatisticsCells.size, self.rollingStatisticsPrecision)
+
+        # the maps of the statistics that correspond to the matrix (see synchronize_rolling_statistics)
+        self.rollingStatisticsMaps = {}
+        # scratch grid for converting the statistics to maps (see rolling_statistics_to_map)
+        self.rollingStatisticsGrid = np.full(self.rollingStatisticsShape, vos.MV, dtype = np.float32)
+        self.synchronize_rolling_statistics()
+
+        # the values from a state file (e.g. float64 values of a previous run) replace the initial condition maps
+        if iniConditions == None and 'rollingStatisticsIni' in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['rollingStatisticsIni'] != "None":
+            file_name = vos.getFullPath(iniItems.routingOptions['rollingStatisticsIni'], self.inputDir)
+            msg = "Reading the rolling statistics from the file " + str(file_name)
+            logger.info(msg)
+            self.rollingStatistics.load(file_name)
+            for var in routing_statistics.statistic_names:
+                vars(self)[var] = self.rolling_statistics_to_map(self.rollingStatistics.get(var))
+                self.rollingStatisticsMaps[var] = vars(self)[var]
+
+    def synchronize_rolling_statistics(self, names = routing_statistics.statistic_names):
+
+        # statistics (maps) that have been replaced outside the matrix (e.g. initial conditions, avgInflow and avgOutflow) are copied into the matrix
+        # - avgInflow and avgOutflow are only needed in the matrix for saving it (see pcrglobwb.PCRGlobWB.dumpState)
+        for var in names:
+            if var not in list(self.rollingStatisticsMaps.keys()) or self.rollingStatisticsMaps[var] is not vars(self)[var]:
+                self.rollingStatistics.set(var, pcr.pcr2numpy(vars(self)[var], np.nan).ravel()[self.rollingStatisticsCells])
+                self.rollingStatisticsMaps[var] = vars(self)[var]
+
+    def rolling_statistics_to_map(self, values):
+
+        self.rollingStatisticsGrid.ravel()[self.rollingStatisticsCells] = np.where(np.isnan(values), vos.MV, values)
+        return pcr.numpy2pcr(pcr.Scalar, self.rollingStatisticsGrid, vos.MV)
+
 
     def estimateBankfullDischarge(self, bankfullWidth, factor = 4.8):
 
@@ -544,6 +734,83 @@ class Routing(object):
         return nrZLevels, areaFractions, relZ, floodVolume, kSlope, mInterval
 
 
+    def setElevationProfileTables(self):
+
+        # flood volume, area fraction, slope and smoothing interval of every level (rows) for the land cells (columns)
+        # - values are kept in float32 (as in the pcraster maps), so that the lookup gives identical results
+        self.profileCells = pcr.pcr2numpy(self.landmask, 0) == 1
+        self.floodVolumeTable   = self.getProfileTable(self.floodVolume)
+        self.areaFractionsTable = np.array(self.areaFractions, dtype = np.float32)
+        self.kSlopeTable        = self.getProfileTable(self.kSlope)
+        self.mIntervalTable     = self.getProfileTable(self.mInterval)
+
+        # cells with missing values in their profile
+        self.profileMissing = np.isnan(self.floodVolumeTable).any(axis = 0) | \
+                              np.isnan(self.kSlopeTable).any(axis = 0) | \
+                              np.isnan(self.mIntervalTable).any(axis = 0)
+
+    def getProfileTable(self, profile):
+
+        table = np.zeros((self.nrZLevels, int(self.profileCells.sum())), dtype = np.float32)
+        for iCnt in range(self.nrZLevels):
+            table[iCnt] = pcr.pcr2numpy(pcr.spatial(pcr.scalar(profile[iCnt])), np.nan)[self.profileCells]
+        return table
+
+    def searchFloodVolumeLevels(self, values):
+
+        # binary search: for every cell, the first level (from 1 to nrZLevels-1) with floodVolume > values (nrZLevels if there is none)
+        cells = np.arange(values.size)
+        lower = np.ones(values.size, dtype = np.int64)
+        upper = np.full(values.size, self.nrZLevels, dtype = np.int64)
+        while np.any(lower < upper):
+            searching = lower < upper
+            middle = (lower + upper) // 2
+            above = self.floodVolumeTable[np.minimum(middle, self.nrZLevels - 1), cells] > values
+            upper = np.where(searching &  above, middle, upper)
+            lower = np.where(searching & ~above, middle + 1, lower)
+        return lower
+
+    def lookupFloodVolumeLevel(self, excess):
+
+        # find the level (from 1 to nrZLevels-1) with the floodVolume closest to the excessVolume, 
+        # i.e. the same level as the one found in the loop over all levels (from the highest level downwards, using the first closest one) 
+        # - input and output values are given for the land cells (see setElevationProfileTables)
+        # - the floodVolume values of the levels are non-decreasing
+        cells  = np.arange(excess.size)
+        highest_level = self.nrZLevels - 1
+        
+        # - the candidate levels: the highest level with floodVolume <= excess and the (highest) level with the next floodVolume value
+        above = self.searchFloodVolumeLevels(excess)
+        below = above - 1
+        has_above = above <= highest_level
+        above = np.where(has_above, self.searchFloodVolumeLevels(self.floodVolumeTable[np.minimum(above, highest_level), cells]) - 1, highest_level)
+        has_below = below >= 1
+        below = np.maximum(below, 1)
+        #
+        deltaXAbove = excess - self.floodVolumeTable[above, cells]
+        deltaXBelow = excess - self.floodVolumeTable[below, cells]
+        use_above = has_above & ((has_below == False) | (np.abs(deltaXAbove) <= np.abs(deltaXBelow)))
+        level = np.where(use_above, above, below)
+        deltaX = np.where(use_above, deltaXAbove, deltaXBelow)
+        
+        # - the level is used only if it is closer than the initial value of the loop (floodVolume of the highest level)
+        found = (has_above | has_below) & (np.abs(deltaX) < np.abs(self.floodVolumeTable[highest_level]))
+        
+        deltaXMin = np.where(found, deltaX, self.floodVolumeTable[highest_level])
+        y_i       = np.where(found, self.areaFractionsTable[level], np.float32(1.0))
+        k_0       = np.where(found, self.kSlopeTable[level - 1, cells], np.float32(0.0))
+        k_1       = np.where(found, self.kSlopeTable[level, cells], np.float32(0.0))
+        mInt      = np.where(found, self.mIntervalTable[level, cells], np.float32(0.0))
+
+        missing = np.isnan(excess) | self.profileMissing
+        return [np.where(missing, np.nan, values) for values in [deltaXMin, y_i, k_0, k_1, mInt]]
+
+    def profileValuesToMap(self, values):
+
+        grid = np.full(self.profileCells.shape, vos.MV, dtype = np.float64)
+        grid[self.profileCells] = np.where(np.isnan(values), vos.MV, values)
+        return pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
+
     def getRoutingParamAvgDischarge(self, avgDischarge, dist2celllength = None):
         # obtain routing parameters based on average (longterm) discharge
         # output: channel dimensions and 
@@ -566,8 +833,52 @@ class Routing(object):
 
         return (yMean, wMean)
 
+    def precompute_static_routing_parameters(self):
+
+        # static terms used in every (sub) time step; these are calculated once and 
+        # recalculated only if one of the parameters has been changed/replaced (e.g. by the multiplier_for_manningsN in adusting_parameters) 
+        self.gradientPowerHalf          = self.gradient**(0.5)
+        self.gradientPowerMinusHalf     = self.gradient**(-0.5)
+        self.manningsNPowerOneAndHalf   = self.manningsN**(1.5)
+        self.cellAreaPerChannelLength   = self.cellArea / self.channelLength
+        if self.floodPlain:
+            self.floodplainManNPowerOneAndHalf = self.floodplainManN**(1.5)
+
+        # the parameters used for the static terms above
+        self.parameters_of_static_terms = self.get_parameters_of_static_terms()
+
+        # the cached terms of the characteristic distance must be recalculated as well (see getCharacteristicDistance)
+        self.characteristicDistanceCache = {}
+
+    def get_parameters_of_static_terms(self):
+
+        parameters = [self.gradient, self.manningsN, self.cellArea, self.channelLength]
+        if self.floodPlain: parameters.append(self.floodplainManN)
+        return parameters
+
+    def check_static_routing_parameters(self):
+
+        # recalculate the static terms if a parameter has been replaced (e.g. self.manningsN = multiplier * self.manningsN)
+        if any([current is not used for current, used in zip(self.get_parameters_of_static_terms(), self.parameters_of_static_terms)]):
+            msg = "Routing parameters have been changed. The static terms for alpha and characteristic distance are recalculated."
+            logger.info(msg)
+            self.precompute_static_routing_parameters()
+
     def getCharacteristicDistance(self, yMean, wMean):
 
+        # static terms (recalculated only if the parameters have been changed)
+        self.check_static_routing_parameters()
+
+        # the terms based on the lakes and reservoirs are recalculated only if the ldd and/or the water bodies have been changed/replaced (e.g. every year)
+        cache = self.characteristicDistanceCache
+        if 'lddMap' not in list(cache.keys()) or cache['lddMap'] is not self.lddMap or \
+                                                 cache['waterBodyIds'] is not self.WaterBodies.waterBodyIds or \
+                                                 cache['waterBodyOut'] is not self.WaterBodies.waterBodyOut:
+            cache['lddMap']       = self.lddMap
+            cache['waterBodyIds'] = self.WaterBodies.waterBodyIds
+            cache['waterBodyOut'] = self.WaterBodies.waterBodyOut
+            cache['distanceToWaterBodyOutlets'] = self.getDistanceToWaterBodyOutlets()
+
         # Manning's coefficient:
         usedManningsN = self.manningsN
 
@@ -576,9 +887,9 @@ class Routing(object):
 
             # wetted perimeter
             flood_only_wetted_perimeter = self.floodDepth * (2.0) + \
-                                          pcr.max(0.0, self.innundatedFraction*self.cellArea/self.channelLength - self.channelWidth)
+                                          pcr.max(0.0, self.innundatedFraction*self.cellAreaPerChannelLength - self.channelWidth)
             channel_only_wetted_perimeter = \
-                        pcr.min(self.channelDepth, vos.getValDivZero(self.channelStorage, self.channelLength*self.channelWidth, 0.0)) * 2.0 + \
+                        pcr.min(self.channelDepth, vos.getValDivZero(self.channelStorage, self.channelBedArea, 0.0)) * 2.0 + \
                         self.channelWidth
             # total channel wetted perimeter (unit: m)
             channel_wetted_perimeter = channel_only_wetted_perimeter + \
@@ -586,8 +897,8 @@ class Routing(object):
             # minimum channel wetted perimeter = 10 cm
             channel_wetted_perimeter = pcr.max(0.1, channel_wetted_perimeter)                             
 
-            usedManningsN = ((channel_only_wetted_perimeter/channel_wetted_perimeter) *      self.manningsN**(1.5) + \
-                             (  flood_only_wetted_perimeter/channel_wetted_perimeter) * self.floodplainManN**(1.5))**(2./3.)
+            usedManningsN = ((channel_only_wetted_perimeter/channel_wetted_perimeter) *      self.manningsNPowerOneAndHalf + \
+                             (  flood_only_wetted_perimeter/channel_wetted_perimeter) * self.floodplainManNPowerOneAndHalf)**(2./3.)
         
         # characteristicDistance (dimensionless)
         # - This will be used for accutraveltimeflux & accutraveltimestate
@@ -598,7 +909,7 @@ class Routing(object):
         characteristicDistance = \
              ( (yMean *   wMean)/ \
                (wMean + 2*yMean) )**(2./3.) * \
-              ((self.gradient)**(0.5))/ \
+              self.gradientPowerHalf/ \
                 usedManningsN * \
                 vos.secondsPerDay()                                     # meter/day
 
@@ -610,14 +921,9 @@ class Routing(object):
         lakeReservoirCharacteristicDistance = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
                                               pcr.areaaverage(characteristicDistance, self.WaterBodies.waterBodyIds))
         #
-        # - make sure that all outflow will be released outside lakes and reservoirs
-        outlets = pcr.cover(pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyOut) > 0, pcr.spatial(pcr.boolean(1))), pcr.spatial(pcr.boolean(0)))
-        distance_to_outlets = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
-                              pcr.ldddist(self.lddMap, outlets, pcr.scalar(1.0)))
-        #~ lakeReservoirCharacteristicDistance = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
-                                              #~ pcr.max(distance_to_outlets + pcr.downstreamdist(self.lddMap)*1.50, lakeReservoirCharacteristicDistance))
+        # - make sure that all outflow will be released outside lakes and reservoirs (see getDistanceToWaterBodyOutlets)
         lakeReservoirCharacteristicDistance = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
-                                              pcr.max(distance_to_outlets + pcr.downstreamdist(self.lddMap)*2.50, lakeReservoirCharacteristicDistance))
+                                              pcr.max(cache['distanceToWaterBodyOutlets'], lakeReservoirCharacteristicDistance))
         lakeReservoirCharacteristicDistance = pcr.areamaximum(lakeReservoirCharacteristicDistance, self.WaterBodies.waterBodyIds)
         #
         # TODO: calculate lakeReservoirCharacteristicDistance while obtaining lake & reservoir parameters
@@ -642,6 +948,16 @@ class Routing(object):
 
         return characteristicDistance
 
+    def getDistanceToWaterBodyOutlets(self):
+
+        # minimum characteristic distance (arcDeg/day) of the lakes and reservoirs
+        # - make sure that all outflow will be released outside lakes and reservoirs
+        outlets = pcr.cover(pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyOut) > 0, pcr.spatial(pcr.boolean(1))), pcr.spatial(pcr.boolean(0)))
+        distance_to_outlets = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
+                              pcr.ldddist(self.lddMap, outlets, pcr.scalar(1.0)))
+        #~ return pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0., distance_to_outlets + pcr.downstreamdist(self.lddMap)*1.50)
+        return pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0., distance_to_outlets + pcr.downstreamdist(self.lddMap)*2.50)
+
     def accuTravelTime(self):
                 
         # accuTravelTime ROUTING OPERATIONS
@@ -674,9 +990,12 @@ class Routing(object):
         self.Q = pcr.max(0.0, self.Q)                                    # unit: m3/day        
 
         # updating channelStorage (after routing)
-        self.channelStorage = pcr.accutraveltimestate(self.lddMap,\
-                              channelStorageForAccuTravelTime,\
-                              pcr.max(0.0, characteristicDistance)) # unit: m3
+        if self.singleTraversalAccuTravelTime:
+            self.channelStorage = self.getAccuTravelTimeStateFromFlux(channelStorageForAccuTravelTime, self.Q)   # unit: m3
+        else:
+            self.channelStorage = pcr.accutraveltimestate(self.lddMap,\
+                                  channelStorageForAccuTravelTime,\
+                                  pcr.max(0.0, characteristicDistance)) # unit: m3
 
         # return channelStorageThatWillNotMove to channelStorage:
         self.channelStorage += channelStorageThatWillNotMove             # unit: m3
@@ -686,11 +1005,38 @@ class Routing(object):
         self.subDischarge = pcr.ifthen(self.landmask, self.subDischarge)
          
 
+    def getAccuTravelTimeStateFromFlux(self, storage, flux):
+
+        # the remaining storage of the accutraveltime routing (as pcr.accutraveltimestate), from the mass balance of every cell:
+        # storage + inflow from the upstream cells - outflow (without a second traversal of the network)
+        channelStorage = pcr.ifthen(self.landmask, storage + pcr.upstream(self.lddMap, flux) - flux)
+
+        # negative storage (e.g. due to float32 rounding or a missing flux covered by zero) is set to zero; its volume is reported
+        negativeVolume = pcr.cellvalue(pcr.maptotal(pcr.cover(pcr.max(0.0, -channelStorage), 0.0)), 1)[0]
+        if negativeVolume > 0.0:
+            msg = "Negative channel storage from the mass balance of the accuTravelTime routing is set to zero: " + str(negativeVolume) + " m3."
+            logger.info(msg)
+
+        return pcr.max(0.0, channelStorage)
+
     def estimate_length_of_sub_time_step(self): 
 
+        number_of_sub_time_steps = self.estimate_number_of_sub_time_steps(self.landmask)
+        #
+        number_of_loops = max(1.0, pcr.cellvalue(pcr.mapmaximum(number_of_sub_time_steps),1)[1])     # minimum number of sub_time_steps = 1 
+        number_of_loops = int(max(self.limit_num_of_sub_time_steps, number_of_loops))
+        
+        # actual length of sub-time step (s)
+        length_of_sub_time_step = vos.secondsPerDay() / number_of_loops
+
+        return (length_of_sub_time_step, number_of_loops)                               
+
+    def estimate_number_of_sub_time_steps(self, area): 
+
         # estimate the length of sub-time step (unit: s):
         # - the shorter is the better
         # - estimated based on the initial or latest sub-time step discharge (unit: m3/s)
+        # - the minimum length is taken within every 'area' (the landmask for the entire clone, or the basin ids)
         # 
         length_of_sub_time_step = pcr.ifthenelse(self.subDischarge > 0.0, 
                                   self.water_height * self.dynamicFracWat * self.cellArea / \
@@ -707,18 +1053,12 @@ class Routing(object):
                                    pcr.cover(
                                    pcr.areaminimum(\
                                    pcr.ifthen(critical_condition, \
-                                              length_of_sub_time_step),self.landmask),\
+                                              length_of_sub_time_step),area),\
                                              vos.secondsPerDay()/self.limit_num_of_sub_time_steps)   
         number_of_sub_time_steps = 1.25 * number_of_sub_time_steps + 1
         number_of_sub_time_steps = pcr.roundup(number_of_sub_time_steps)
-        #
-        number_of_loops = max(1.0, pcr.cellvalue(pcr.mapmaximum(number_of_sub_time_steps),1)[1])     # minimum number of sub_time_steps = 1 
-        number_of_loops = int(max(self.limit_num_of_sub_time_steps, number_of_loops))
-        
-        # actual length of sub-time step (s)
-        length_of_sub_time_step = vos.secondsPerDay() / number_of_loops
 
-        return (length_of_sub_time_step, number_of_loops)                               
+        return number_of_sub_time_steps
 
     def simplifiedKinematicWave(self): 
         """
@@ -858,6 +1198,9 @@ class Routing(object):
         # channel width (unit: m)
         self.channelWidth = self.wMean
         
+        # channel bed area (unit: m2) ; used in every sub time step
+        self.channelBedArea = self.channelLength * self.channelWidth
+
         # channel depth (unit: m)
         self.channelDepth = pcr.max(0.0, self.yMean)
         #
@@ -876,7 +1219,7 @@ class Routing(object):
         # fraction of channel (dimensionless)
         # - mininum inundated fraction
         self.channelFraction = pcr.max(0.0, pcr.min(1.0,\
-                               self.channelWidth * self.channelLength / (self.cellArea)))
+                               self.channelBedArea / (self.cellArea)))
         
         # fraction of innundation due to flood (dimensionless) and flood/innundation depth (m)
         self.innundatedFraction, self.floodDepth = self.returnInundationFractionAndFloodDepth(self.channelStorage)
@@ -897,6 +1240,7 @@ class Routing(object):
         if self.method == "kinematicWave": \
            self.kinematic_wave_update(landSurface, groundwater, currTimeStep, meteo)                 
         # NOTE that this method require abstraction from fossil groundwater.
+        #
         
         # infiltration from surface water bodies (rivers/channels, as well as lakes and/or reservoirs) to groundwater bodies
         # - this exchange fluxes will be handed in the next time step
@@ -1141,10 +1485,7 @@ class Routing(object):
                                 self.WaterBodies.waterBodyStorage)
         
         # transfer outflow from lakes and/or reservoirs to channelStorages
-        waterBodyOutflow = pcr.cover(\
-                           pcr.ifthen(\
-                           self.WaterBodies.waterBodyOut,
-                           self.WaterBodies.waterBodyOutflow), 0.0)          # unit: m3/day
+        waterBodyOutflow = self.WaterBodies.getWaterBodyOutflowAtOutlets()          # unit: m3/day
         
         if self.method == "accuTravelTime":
             # distribute outflow to water body storage
@@ -1209,6 +1550,9 @@ class Routing(object):
         # - assuming rectangular channel
         # - flood innundated areas with 
 
+        # static terms (recalculated only if the parameters have been changed)
+        self.check_static_routing_parameters()
+
         # channel wetted area (m2)
         # - the minimum wetted area is: water height x channel width (Edwin introduce this) 
         # - channel wetted area is mainly based on channelStorage and channelLength (Rens's approach)
@@ -1218,9 +1562,9 @@ class Routing(object):
 
         # wetted perimeter
         flood_only_wetted_perimeter = floodDepth * (2.0) + \
-                                      pcr.max(0.0, innundatedFraction*self.cellArea/self.channelLength - self.channelWidth)
+                                      pcr.max(0.0, innundatedFraction*self.cellAreaPerChannelLength - self.channelWidth)
         channel_only_wetted_perimeter = \
-                    pcr.min(self.channelDepth, vos.getValDivZero(channelStorage, self.channelLength*self.channelWidth, 0.0)) * 2.0 + \
+                    pcr.min(self.channelDepth, vos.getValDivZero(channelStorage, self.channelBedArea, 0.0)) * 2.0 + \
                     self.channelWidth
         # total channel wetted perimeter (unit: m)
         channel_wetted_perimeter = channel_only_wetted_perimeter + \
@@ -1230,14 +1574,14 @@ class Routing(object):
             
         # corrected Manning's coefficient: 
         if self.floodPlain:
-            usedManningsN = ((channel_only_wetted_perimeter/channel_wetted_perimeter) *      self.manningsN**(1.5) + \
-                             (  flood_only_wetted_perimeter/channel_wetted_perimeter) * self.floodplainManN**(1.5))**(2./3.)
+            usedManningsN = ((channel_only_wetted_perimeter/channel_wetted_perimeter) *      self.manningsNPowerOneAndHalf + \
+                             (  flood_only_wetted_perimeter/channel_wetted_perimeter) * self.floodplainManNPowerOneAndHalf)**(2./3.)
         else:
             usedManningsN = self.manningsN
         
         # alpha (dimensionless) and initial estimate of channel discharge (m3/s)
         #
-        alpha = (usedManningsN*channel_wetted_perimeter**(2./3.)*self.gradient**(-0.5))**self.beta  # dimensionless
+        alpha = (usedManningsN*channel_wetted_perimeter**(2./3.)*self.gradientPowerMinusHalf)**self.beta  # dimensionless
         dischargeInitial = pcr.ifthenelse(alpha > 0.0,\
                                          (channel_wetted_area / alpha)**(1.0/self.beta), 0.0)       # unit: m3
         
@@ -1323,21 +1667,11 @@ class Routing(object):
             
             # find the match on the basis of the shortest distance 
             # to the available intersections or steps
+            # - using a table lookup (binary search) instead of a loop over all levels
             #
-            deltaXMin = self.floodVolume[self.nrZLevels-1]
-            y_i  =  pcr.scalar(1.0)                                          
-            k    = [pcr.scalar(0.0)]*2
-            mInt =  pcr.scalar(0.0)
-            for iCnt in range(self.nrZLevels-1,0,-1):
-                # - find x_i for current volume and update match if applicable
-                #   also update slope and intercept
-                deltaX    = excessVolume - self.floodVolume[iCnt]
-                mask      = pcr.abs(deltaX) < pcr.abs(deltaXMin)
-                deltaXMin = pcr.ifthenelse(mask, deltaX, deltaXMin)
-                y_i  = pcr.ifthenelse(mask, self.areaFractions[iCnt], y_i)
-                k[0] = pcr.ifthenelse(mask, self.kSlope[iCnt-1], k[0])
-                k[1] = pcr.ifthenelse(mask, self.kSlope[iCnt], k[1])
-                mInt = pcr.ifthenelse(mask, self.mInterval[iCnt], mInt)
+            excess = pcr.pcr2numpy(excessVolume, np.nan)[self.profileCells]
+            deltaXMin, y_i, k_0, k_1, mInt = [self.profileValuesToMap(values) for values in self.lookupFloodVolumeLevel(excess)]
+            k = [k_0, k_1]
         
             # all values returned, process data: calculate scaled deltaX and smoothed function
             # on the basis of the integrated logistic functions PHI(x) and 1-PHI(x)
@@ -1368,30 +1702,36 @@ class Routing(object):
             
         return inundatedFraction, floodDepth
 
-    def return_water_body_storage_to_channel(self, channelStorage):
+    def return_water_body_storage_to_channel(self, channelStorage, landmask = None):
+
+        if landmask is None: landmask = self.landmask
+
+        # - calculated only at the cells of lakes and reservoirs (see waterBodies.WaterBodies.buildSparseWaterBodies)
+        if self.WaterBodies.useSparseWaterBodies:
+            return self.WaterBodies.returnStorageToChannel(channelStorage, self.cellArea, landmask)
 
         # return waterBodyStorage to channelStorage  
         #
         waterBodyStorageTotal = \
          pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
          pcr.areaaverage(\
-         pcr.ifthen(self.landmask,self.WaterBodies.waterBodyStorage),\
-         pcr.ifthen(self.landmask,self.WaterBodies.waterBodyIds)) + \
+         pcr.ifthen(landmask,self.WaterBodies.waterBodyStorage),\
+         pcr.ifthen(landmask,self.WaterBodies.waterBodyIds)) + \
          pcr.areatotal(pcr.cover(\
-         pcr.ifthen(self.landmask,channelStorage), 0.0),\
-         pcr.ifthen(self.landmask,self.WaterBodies.waterBodyIds)))
+         pcr.ifthen(landmask,channelStorage), 0.0),\
+         pcr.ifthen(landmask,self.WaterBodies.waterBodyIds)))
         waterBodyStoragePerCell = \
          waterBodyStorageTotal*\
                        self.cellArea/\
          pcr.areatotal(pcr.cover(\
          self.cellArea, 0.0),\
-         pcr.ifthen(self.landmask,self.WaterBodies.waterBodyIds))
+         pcr.ifthen(landmask,self.WaterBodies.waterBodyIds))
         waterBodyStoragePerCell = \
          pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,
          waterBodyStoragePerCell)                                                      # unit: m3
         #
         channelStorage = pcr.cover(waterBodyStoragePerCell, channelStorage)            # unit: m3
-        channelStorage = pcr.ifthen(self.landmask, channelStorage)
+        channelStorage = pcr.ifthen(landmask, channelStorage)
         return channelStorage
 
     def kinematic_wave_update_before_19_feb_2018(self, landSurface, groundwater, currTimeStep, meteo): 
@@ -1456,10 +1796,7 @@ class Routing(object):
                                 self.WaterBodies.waterBodyStorage)
         #
         # outflow from lakes and/or reservoirs at lake/reservoir outlet cells
-        waterBodyOutflow = pcr.cover(\
-                           pcr.ifthen(\
-                           self.WaterBodies.waterBodyOut,
-                           self.WaterBodies.waterBodyOutflow), 0.0)          # unit: m3/day
+        waterBodyOutflow = self.WaterBodies.getWaterBodyOutflowAtOutlets()          # unit: m3/day
 
         # route only non negative channelStorage (otherwise stay):
         # - note that, the following includes storages in 
@@ -1821,10 +2158,7 @@ class Routing(object):
                                     self.downstreamDemand)
             #
             # - waterBodyOutflow (m3/length_of_sub_time_step) from lakes and/or reservoirs at lake/reservoir outlet cells
-            waterBodyOutflow = pcr.cover(\
-                               pcr.ifthen(\
-                               self.WaterBodies.waterBodyOut,
-                               self.WaterBodies.waterBodyOutflow), 0.0)
+            waterBodyOutflow = self.WaterBodies.getWaterBodyOutflowAtOutlets()
             waterBodyOutflow = pcr.ifthen(self.landmask, waterBodyOutflow)
             #
             # - waterBodyStorage (m3) after outflow (values given are per water body id (not per cell))
@@ -1962,18 +2296,152 @@ class Routing(object):
         self.water_height = channelStorageForRouting /\
                            (pcr.max(self.min_fracwat_for_water_height, self.dynamicFracWat) * self.cellArea)
 
-        # estimate the length of sub-time step (unit: s):
-        length_of_sub_time_step, number_of_loops = self.estimate_length_of_sub_time_step()
+        # active set: cells of the basins with water
+        if self.activeSetRouting: self.get_active_cells_for_routing(landSurface)
 
+        if self.reportSubStepMemoryAllocation: self.start_tracing_memory_allocation()
+
+        if self.basinLocalSubTimeSteps == False:
+
+            # estimate the length of sub-time step (unit: s):
+            length_of_sub_time_step, number_of_loops = self.estimate_length_of_sub_time_step()
+
+            channelStorageForRouting, channelStorageThatWillNotMove, \
+            acc_local_input_to_surface_water, acc_water_body_evaporation_volume, acc_discharge_volume = \
+                self.kinematic_wave_sub_time_steps_of_active_cells(landSurface, currTimeStep, meteo, \
+                                                                   channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops)
+
+        else:
+
+            # every basin class is routed with its own number of sub time steps
+            channelStorageForRouting, channelStorageThatWillNotMove, \
+            acc_local_input_to_surface_water, acc_water_body_evaporation_volume, acc_discharge_volume = \
+                self.kinematic_wave_sub_time_steps_per_basin_class(landSurface, currTimeStep, meteo, \
+                                                                   channelStorageForRouting, channelStorageThatWillNotMove)
+
+        if self.reportSubStepMemoryAllocation: self.report_memory_allocation()
+        
+        # evaporation (m/day)
+        self.waterBodyEvaporation = acc_water_body_evaporation_volume / self.cellArea
+        
+        # local input to surface water (m3)
+        self.local_input_to_surface_water += acc_local_input_to_surface_water
+
+        # channel discharge (m3/day) = self.Q
+        self.Q = acc_discharge_volume
+
+        # updating channelStorage (after routing)
+        self.channelStorage = channelStorageForRouting
+
+        # return channelStorageThatWillNotMove to channelStorage:
+        self.channelStorage += channelStorageThatWillNotMove         
+        
+        # channel discharge (m3/s): for current time step
+        #
+        self.discharge = self.Q / vos.secondsPerDay()
+        self.discharge = pcr.max(0., self.discharge)                   # reported channel discharge cannot be negative
+        self.discharge = pcr.ifthen(self.landmask, self.discharge)
+        #
+        self.disChanWaterBody = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,\
+                                pcr.areamaximum(self.discharge,self.WaterBodies.waterBodyIds))
+        self.disChanWaterBody = pcr.cover(self.disChanWaterBody, self.discharge)
+        self.disChanWaterBody = pcr.ifthen(self.landmask, self.disChanWaterBody)
+        #
+        self.disChanWaterBody = pcr.max(0.,self.disChanWaterBody)      # reported channel discharge cannot be negative
+
+        # calculate the statistics of long and short term flow values
+        self.calculate_statistics(groundwater)
+
+
+
+    def to_routing_network(self, pcr_map):
+
+        # values of a (scalar) map at the cells of the routing network (missing values become NaN)
+        values = self.routingNetwork.to_flat(pcr.pcr2numpy(pcr.spatial(pcr.scalar(pcr_map)), vos.MV))
+        values[values >= vos.MV] = np.nan
+        return values
+
+    def from_routing_network(self, values):
+
+        # map of values given at the cells of the routing network
+        grid = self.routingNetwork.to_grid(values, vos.MV)
+        grid[np.isnan(grid)] = vos.MV
+        return pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
+
+    def cells_of_ldd_in_routing_network(self, ldd):
+
+        # the numpy routing engine uses the network of self.lddMap; another ldd is only allowed if it is the part of self.lddMap with complete basins
+        # (e.g. pcr.lddmask(self.lddMap, mask) for basin classes or active basins); return its cells in the network (None for self.lddMap) 
+        if ldd is self.lddMap: return None
+        if vars(self).get('routingNetworkLddCells') is not None and self.routingNetworkLddCells[0] is ldd: return self.routingNetworkLddCells[1]
+
+        network  = self.routingNetwork
+        ldd_grid = pcr.pcr2numpy(ldd, 0)
+        cells    = ldd_grid[network.rows, network.cols] != 0
+        # - the same directions as self.lddMap and no flow between the cells of the ldd and the other cells
+        has_downstream = network.downstream >= 0
+        if np.count_nonzero(ldd_grid) != np.count_nonzero(cells) or \
+           np.array_equal(ldd_grid[network.rows, network.cols][cells], self.routingNetworkLdd[cells]) == False or \
+           np.array_equal(cells[has_downstream], cells[network.downstream[has_downstream]]) == False:
+            msg = "The numpy routing engine can only be used for the ldd of the routing network or for a part of it with complete basins."
+            raise Exception('Error: ' + msg)
+
+        self.routingNetworkLddCells = (ldd, cells)
+        return cells
+
+    def from_routing_network_for_ldd(self, values, ldd):
+
+        # map of values given at the cells of the routing network, limited to the cells of the ldd (see cells_of_ldd_in_routing_network)
+        cells = self.cells_of_ldd_in_routing_network(ldd)
+        if cells is not None: values[cells == False] = np.nan
+        return self.from_routing_network(values)
+
+    def upstream(self, ldd, values):
+
+        # sum of the values of the upstream cells (using the selected routing engine)
+        if self.routingEngine == "numpy":
+            return self.from_routing_network_for_ldd(self.routingNetwork.upstream(self.to_routing_network(values)), ldd)
+        return pcr.upstream(ldd, values)
+
+    def kinematic(self, ldd, dischargeInitial, lateralInflow, alpha, beta, numberOfTimeSlices, length_of_time_step, channelLength):
+
+        # kinematic wave discharge (m3/s) (using the selected routing engine)
+        if self.routingEngine == "numpy":
+            # - constant lateral inflow is not converted; channelLength is converted only if it has been replaced
+            if isinstance(lateralInflow, (int, float)) == False: lateralInflow = self.to_routing_network(lateralInflow)
+            if vars(self).get('routingNetworkChannelLength') is None or self.routingNetworkChannelLength[0] is not channelLength:
+                self.routingNetworkChannelLength = (channelLength, self.to_routing_network(channelLength))
+            return self.from_routing_network_for_ldd(\
+                   self.routingNetwork.kinematic(self.to_routing_network(dischargeInitial), lateralInflow, \
+                                                 self.to_routing_network(alpha), beta, numberOfTimeSlices, length_of_time_step, \
+                                                 self.routingNetworkChannelLength[1]), ldd)
+        return pcr.kinematic(ldd, dischargeInitial, lateralInflow, alpha, beta, numberOfTimeSlices, length_of_time_step, channelLength)
+
+    def kinematic_wave_sub_time_steps(self, landSurface, currTimeStep, meteo, channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops, ldd = None, landmask = None, \
+                                      sub_step_kernel = None):
+        """
+        The sub time step loop of the kinematic wave method (within a day).
+        The calculation can be limited to a part of the clone (e.g. a class of basins) by giving its ldd and landmask.
+        With the fused kernel, the kernel of this part can be given (e.g. the one of a basin class); otherwise the kernel for all cells is used.
+        """
+
+        if ldd is None: ldd = self.lddMap
+        if landmask is None: landmask = self.landmask
+
+        if self.fusedSubStepKernel:
+            return self.kinematic_wave_sub_time_steps_with_fused_kernel(landSurface, currTimeStep, meteo, \
+                                                                        channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops, landmask, sub_step_kernel)
+
+        # length of sub-time step (unit: s)
+        length_of_sub_time_step = vos.secondsPerDay() / number_of_loops
 
-        #######################################################################################################################
         for i_loop in range(number_of_loops):
             
             msg = "sub-daily time step "+str(i_loop+1)+" from "+str(number_of_loops)
             logger.info(msg)
             
             if self.debugWaterBalance:\
-                preStorage = pcr.ifthen(self.landmask,\
+                preStorage = pcr.ifthen(landmask,\
                              channelStorageForRouting)
 
             # initiating accumulated values:
@@ -2036,23 +2504,20 @@ class Routing(object):
                                     self.downstreamDemand)
             #
             # - waterBodyOutflow (m3/length_of_sub_time_step) from lakes or reservoirs at outlet cells
-            waterBodyOutflow = pcr.cover(\
-                               pcr.ifthen(\
-                               self.WaterBodies.waterBodyOut,
-                               self.WaterBodies.waterBodyOutflow), 0.0)
-            waterBodyOutflow = pcr.ifthen(self.landmask, waterBodyOutflow)
+            waterBodyOutflow = self.WaterBodies.getWaterBodyOutflowAtOutlets()
+            waterBodyOutflow = pcr.ifthen(landmask, waterBodyOutflow)
             #
             # - waterBodyOutflow in m3/s at lake/reservoir outlet cells
             waterBodyOutflowInM3PerSec = waterBodyOutflow / length_of_sub_time_step
             #
             # - waterBodyStorage (m3) after outflow (values given are per water body id (not per cell))
-            self.waterBodyStorage = pcr.ifthen(self.landmask, self.WaterBodies.waterBodyStorage)
+            self.waterBodyStorage = pcr.ifthen(landmask, self.WaterBodies.waterBodyStorage)
 
             # update channelStorage (m3) after waterBodyOutflow (m3) - Note that local_input_to_surface_water does not include waterBodyOutflow.            
             # - update channelStorage (m3)  - after waterBodyOutflow (m3)
             #~ storage_change_in_volume = waterBodyOutflow                                                 # NOT CORRECT
-            #~ storage_change_in_volume = pcr.upstream(self.lddMap, waterBodyOutflow) - waterBodyOutflow   # NOT CORRECT
-            storage_change_in_volume    = pcr.upstream(self.lddMap, waterBodyOutflow)                      # PS: I think this is the correct one. 
+            #~ storage_change_in_volume = pcr.upstream(ldd, waterBodyOutflow) - waterBodyOutflow   # NOT CORRECT
+            storage_change_in_volume    = self.upstream(ldd, waterBodyOutflow)                      # PS: I think this is the correct one. 
             channelStorageForRouting   += storage_change_in_volume 
 
             # estimate of water height (m)
@@ -2079,12 +2544,12 @@ class Routing(object):
             
             # discharge estimate (dischargeInitial) in m3/s
             dischargeInitial = pcr.cover(dischargeInitial, 0.0)
-            dischargeInitial = pcr.ifthen(self.landmask, dischargeInitial)
+            dischargeInitial = pcr.ifthen(landmask, dischargeInitial)
 
 
             # discharge (m3/s) based on the KINEMATIC WAVE approximation
             #~ logger.debug('start pcr.kinematic')
-            self.subDischarge = pcr.kinematic(self.lddMap, dischargeInitial, 0.0, 
+            self.subDischarge = self.kinematic(ldd, dischargeInitial, 0.0, 
                                               alpha, self.beta, \
                                               1, length_of_sub_time_step, self.channelLength)
             self.subDischarge = pcr.max(0.0, pcr.cover(self.subDischarge, 0.0))
@@ -2098,21 +2563,21 @@ class Routing(object):
             
             # make sure that we do not get negative channel storage
             self.subDischarge = pcr.min(self.subDischarge * length_of_sub_time_step, \
-                                pcr.max(0.0, channelStorageForRouting + pcr.upstream(self.lddMap, self.subDischarge * length_of_sub_time_step)))/length_of_sub_time_step
+                                pcr.max(0.0, channelStorageForRouting + self.upstream(ldd, self.subDischarge * length_of_sub_time_step)))/length_of_sub_time_step
 
 
             # update channelStorage (m3) after lateral flows in channels
-            storage_change_in_volume  = pcr.upstream(self.lddMap, self.subDischarge * length_of_sub_time_step) - self.subDischarge * length_of_sub_time_step 
+            storage_change_in_volume  = self.upstream(ldd, self.subDischarge * length_of_sub_time_step) - self.subDischarge * length_of_sub_time_step 
             channelStorageForRouting += storage_change_in_volume 
 
 
             # return waterBodyStorage to channelStorage  
-            channelStorageForRouting = self.return_water_body_storage_to_channel(channelStorageForRouting)
+            channelStorageForRouting = self.return_water_body_storage_to_channel(channelStorageForRouting, landmask)
             
 
             # include waterBodyOutflowInM3PerSec to subDischarge
             self.subDischarge += waterBodyOutflowInM3PerSec                             
-            self.subDischarge = pcr.ifthen(self.landmask, self.subDischarge)
+            self.subDischarge = pcr.ifthen(landmask, self.subDischarge)
 
             # total discharge_volume (m3) until this present i_loop
             acc_discharge_volume += self.subDischarge * length_of_sub_time_step
@@ -2128,7 +2593,7 @@ class Routing(object):
             # - fraction of channel (including its excess above bankfull capacity) 
             self.dynamicFracWat += pcr.max(0.0, 1.0 - self.dynamicFracWat) * pcr.max(self.channelFraction, self.innundatedFraction)
             # - maximum value of dynamicFracWat is 1.0
-            self.dynamicFracWat = pcr.ifthen(self.landmask, pcr.min(1.0, self.dynamicFracWat))
+            self.dynamicFracWat = pcr.ifthen(landmask, pcr.min(1.0, self.dynamicFracWat))
 
 
             # for the next calculation and loop, route only non negative channelStorage
@@ -2139,41 +2604,425 @@ class Routing(object):
             # estimate water_height
             # - this water height includes the one for lake and reservoirs
             self.water_height = pcr.max(0.0, channelStorageForRouting) / (pcr.max(self.min_fracwat_for_water_height, self.dynamicFracWat) * self.cellArea)
-            
-        #######################################################################################################################
-        
-        # evaporation (m/day)
-        self.waterBodyEvaporation = acc_water_body_evaporation_volume / self.cellArea
-        
-        # local input to surface water (m3)
-        self.local_input_to_surface_water += acc_local_input_to_surface_water
 
-        # channel discharge (m3/day) = self.Q
-        self.Q = acc_discharge_volume
 
-        # updating channelStorage (after routing)
-        self.channelStorage = channelStorageForRouting
+        return channelStorageForRouting, channelStorageThatWillNotMove, \
+               acc_local_input_to_surface_water, acc_water_body_evaporation_volume, acc_discharge_volume
 
-        # return channelStorageThatWillNotMove to channelStorage:
-        self.channelStorage += channelStorageThatWillNotMove         
-        
-        # channel discharge (m3/s): for current time step
-        #
-        self.discharge = self.Q / vos.secondsPerDay()
-        self.discharge = pcr.max(0., self.discharge)                   # reported channel discharge cannot be negative
-        self.discharge = pcr.ifthen(self.landmask, self.discharge)
-        #
-        self.disChanWaterBody = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0.,\
-                                pcr.areamaximum(self.discharge,self.WaterBodies.waterBodyIds))
-        self.disChanWaterBody = pcr.cover(self.disChanWaterBody, self.discharge)
-        self.disChanWaterBody = pcr.ifthen(self.landmask, self.disChanWaterBody)
-        #
-        self.disChanWaterBody = pcr.max(0.,self.disChanWaterBody)      # reported channel discharge cannot be negative
+    def create_sub_step_kernel(self, network):
 
-        # calculate the statistics of long and short term flow values
-        self.calculate_statistics(groundwater)
+        # fused kernel for the cells of a routing network
+        return routing_kernel.SubStepKernel(network, self.beta, self.min_fracwat_for_water_height, self.floodPlain, \
+                                            criterion_kk = vars(self).get('criterionKK'), small_number = vos.smallNumber)
+
+    def kinematic_wave_sub_time_steps_with_fused_kernel(self, landSurface, currTimeStep, meteo, channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops, landmask, \
+                                                        sub_step_kernel = None):
+        """
+        The sub time step loop of the kinematic wave method (see kinematic_wave_sub_time_steps), evaluated with the fused kernel (see routing_kernel.py).
+        The terms that do not change within the day are given to the kernel once. Lakes and reservoirs are updated by WaterBodies.update.
+        Note that the water balance checks within the sub time steps (debugWaterBalance) are not done.
+        """
+
+        if sub_step_kernel is None:
+            if self.subStepKernel is None: self.subStepKernel = self.create_sub_step_kernel(self.routingNetwork)
+            sub_step_kernel = self.subStepKernel
+
+        # length of sub-time step (unit: s)
+        length_of_sub_time_step = vos.secondsPerDay() / number_of_loops
+
+        # static terms (recalculated only if the parameters have been changed)
+        self.check_static_routing_parameters()
+
+        # potential evaporation over the surface water area (m/day), i.e. the one for dynamicFracWat = 1.0 (see calculate_potential_evaporation)
+        dynamicFracWat = self.dynamicFracWat
+        self.dynamicFracWat = pcr.scalar(1.0)
+        potential_evaporation = self.calculate_potential_evaporation(landSurface, currTimeStep, meteo)
+        self.dynamicFracWat = dynamicFracWat
+
+        # dynamicFracWat at the end of every sub time step (this does not depend on the channel storage)
+        dynamicFracWatAfterSubTimeStep  = pcr.cover(pcr.min(1.0, self.WaterBodies.fracWat), 0.0)
+        dynamicFracWatAfterSubTimeStep += pcr.max(0.0, 1.0 - dynamicFracWatAfterSubTimeStep) * pcr.max(self.channelFraction, self.innundatedFraction)
+        dynamicFracWatAfterSubTimeStep  = pcr.min(1.0, dynamicFracWatAfterSubTimeStep)
+
+        # values that do not change within the day
+        daily_maps = {'cell_area'                           : self.cellArea,
+                      'channel_length'                      : self.channelLength,
+                      'channel_width'                       : self.channelWidth,
+                      'channel_depth'                       : self.channelDepth,
+                      'channel_bed_area'                    : self.channelBedArea,
+                      'cell_area_per_channel_length'        : self.cellAreaPerChannelLength,
+                      'gradient_power_minus_half'           : self.gradientPowerMinusHalf,
+                      'mannings_n'                          : self.manningsN,
+                      'mannings_n_power_one_and_half'       : self.manningsNPowerOneAndHalf,
+                      'channel_fraction'                    : self.channelFraction,
+                      'innundated_fraction'                 : self.innundatedFraction,
+                      'local_input'                         : (self.runoff + landSurface.nonIrrReturnFlow) * self.cellArea,
+                      'potential_evaporation'               : potential_evaporation,
+                      'dynamic_frac_wat_after_sub_time_step': dynamicFracWatAfterSubTimeStep,
+                      'water_body_ids'                      : pcr.scalar(self.WaterBodies.waterBodyIds),
+                      'water_body_outlets'                  : pcr.scalar(pcr.cover(self.WaterBodies.waterBodyOut, pcr.boolean(0.0)))}
+        if self.floodPlain:
+            daily_maps['floodplain_mannings_n_power_one_and_half'] = self.floodplainManNPowerOneAndHalf
+            daily_maps['channel_storage_capacity']                 = self.channelStorageCapacity
+            if self.maxFloodDepth is not None: daily_maps['max_flood_depth'] = self.maxFloodDepth
+        daily_values = {}
+        for name in routing_kernel.daily_value_names: daily_values[name] = None
+        for name in list(daily_maps.keys()): daily_values[name] = self.to_routing_network(daily_maps[name])
+        daily_values['region']             = self.to_routing_network(pcr.ifthen(landmask, pcr.scalar(1.0))) == 1.0
+        daily_values['water_body_outlets'] = daily_values['water_body_outlets'] == 1.0
+        sub_step_kernel.set_daily_values(daily_values)
+
+        initial_values = {'storage'                   : self.to_routing_network(channelStorageForRouting),
+                          'storage_that_will_not_move': self.to_routing_network(channelStorageThatWillNotMove),
+                          'dynamic_frac_wat'          : self.to_routing_network(self.dynamicFracWat),
+                          'flood_depth'               : self.to_routing_network(self.floodDepth)}
+        
+        lookup_flood_volume_level = None
+        if self.floodPlain: lookup_flood_volume_level = self.lookup_flood_volume_level_for_fused_kernel
+        sub_step_kernel.run(number_of_loops, length_of_sub_time_step, vos.secondsPerDay(), initial_values, \
+                               lambda storage: self.update_water_bodies_for_fused_kernel(storage, currTimeStep, length_of_sub_time_step), \
+                               lookup_flood_volume_level)
+
+        # maps of the lakes and reservoirs (after the last sub time step)
+        if self.WaterBodies.useSparseWaterBodies: self.WaterBodies.synchronizeSparseMaps()
+
+        # results
+        kernel = sub_step_kernel
+        self.water_height      = self.from_routing_network(kernel.water_height)
+        self.dynamicFracWat    = self.from_routing_network(kernel.dynamic_frac_wat)
+        self.subDischarge      = self.from_routing_network(kernel.sub_discharge)
+        self.inundatedFraction = self.from_routing_network(kernel.inundated_fraction)
+        self.floodDepth        = self.from_routing_network(kernel.flood_depth)
+        self.waterBodyPotEvap  = self.from_routing_network(kernel.water_body_pot_evap)
+        self.waterBodyStorage  = pcr.ifthen(landmask, self.WaterBodies.waterBodyStorage)
+
+        return self.from_routing_network(kernel.storage), self.from_routing_network(kernel.storage_that_will_not_move), \
+               self.from_routing_network(kernel.acc_local_input), self.from_routing_network(kernel.acc_evaporation), self.from_routing_network(kernel.acc_discharge)
+
+    def update_water_bodies_for_fused_kernel(self, storage_at_water_bodies, currTimeStep, length_of_sub_time_step):
+
+        # update lakes and reservoirs with the storage (m3) moved from the channel (given at the cells of the routing network);
+        # return their outflow at the outlets (m3) and their storage (m3) at the cells of the routing network
+        # - with sparseWaterBodies (and without debugWaterBalance), only at the cells of lakes and reservoirs and without maps (see kinematic_wave_sub_time_steps_with_fused_kernel)
+        if self.WaterBodies.useSparseWaterBodies and self.WaterBodies.debugWaterBalance == False:
+            return self.WaterBodies.updateSparseWaterBodiesOnNetwork(storage_at_water_bodies,\
+                                                                     self.routingNetworkCells,\
+                                                                     self.timestepsToAvgDischarge,\
+                                                                     self.maxTimestepsToAvgDischargeShort,\
+                                                                     self.maxTimestepsToAvgDischargeLong,\
+                                                                     self.avgDischarge,\
+                                                                     length_of_sub_time_step,\
+                                                                     self.downstreamDemand)
+        storageAtLakeAndReservoirs = pcr.numpy2pcr(pcr.Scalar, self.routingNetwork.to_grid(storage_at_water_bodies, 0.0), vos.MV)
+        self.WaterBodies.update(storageAtLakeAndReservoirs,\
+                                self.timestepsToAvgDischarge,\
+                                self.maxTimestepsToAvgDischargeShort,\
+                                self.maxTimestepsToAvgDischargeLong,\
+                                currTimeStep,\
+                                self.avgDischarge,\
+                                length_of_sub_time_step,\
+                                self.downstreamDemand)
+        return self.to_routing_network(self.WaterBodies.getWaterBodyOutflowAtOutlets()), self.to_routing_network(self.WaterBodies.waterBodyStorage)
+
+    def lookup_flood_volume_level_for_fused_kernel(self, excess):
+
+        # the flood volume level (see lookupFloodVolumeLevel) for the excess volume given at the cells of the routing network
+        if self.routingNetworkProfileIndex is None:
+            profile_index = np.full(self.profileCells.shape, -1, dtype = np.int64)
+            profile_index[self.profileCells] = np.arange(int(self.profileCells.sum()))
+            self.routingNetworkProfileIndex = profile_index[self.routingNetwork.rows, self.routingNetwork.cols]
+            self.numberOfProfileCells = int(self.profileCells.sum())
+        excess_at_profile_cells = np.full(self.numberOfProfileCells, np.nan)
+        excess_at_profile_cells[self.routingNetworkProfileIndex] = excess
+        return [values[self.routingNetworkProfileIndex].astype(np.float32) for values in self.lookupFloodVolumeLevel(excess_at_profile_cells)]
+
+    def start_tracing_memory_allocation(self):
+
+        # memory traced at the beginning of the sub time steps; the peak is reset
+        if hasattr(tracemalloc, "reset_peak"): tracemalloc.reset_peak()
+        self.traced_memory_before_sub_time_steps = tracemalloc.get_traced_memory()[0]
+
+    def report_memory_allocation(self):
+
+        # report the memory allocated during the sub time steps (note that the PCRaster maps are not traced)
+        current, peak = tracemalloc.get_traced_memory()
+        msg  = "Memory allocated during the sub time steps (traced, without PCRaster maps): "
+        msg += "peak " + "%.1f" %((peak - self.traced_memory_before_sub_time_steps) / (1024. * 1024.)) + " MB, "
+        msg += "remaining " + "%.1f" %((current - self.traced_memory_before_sub_time_steps) / (1024. * 1024.)) + " MB"
+        kernels = [kernel for kernel in [self.subStepKernel] + self.subStepKernelsOfBasinClasses if kernel is not None]
+        if self.activeSetRouting: kernels += [kernel for cells, kernel in self.subStepKernelsOfActiveCells]
+        if len(kernels) > 0: msg += "; preallocated buffers of the fused kernel: " + "%.1f" %(sum([kernel.memory_in_mb for kernel in kernels])) + " MB"
+        logger.info(msg)
+
+    def get_basin_classes_for_sub_time_steps(self):
+        """
+        Group the basins in classes based on their numbers of sub time steps.
+        Return the map of class numbers (1, 2, ...) and the number of sub time steps of every class.
+        """
+
+        # basins connected by a lake/reservoir (e.g. a lake with several pits) must be in the same class
+        number_of_sub_time_steps = self.basin_num_of_sub_time_steps
+        water_body_ids = pcr.ifthen(pcr.scalar(self.WaterBodies.waterBodyIds) > 0., self.WaterBodies.waterBodyIds)
+        number_of_sub_time_steps = pcr.cover(pcr.areamaximum(number_of_sub_time_steps, water_body_ids), number_of_sub_time_steps)
+        number_of_sub_time_steps = pcr.areamaximum(number_of_sub_time_steps, self.basinIds)
+
+        # the number of sub time steps of a class is at most sub_time_step_class_ratio times the smallest one in this class
+        cell_values = pcr.pcr2numpy(pcr.cover(number_of_sub_time_steps, 0.0), 0.0)
+        active = cell_values > 0.0
+        if self.sub_time_step_class_ratio > 1.0:
+            class_keys = np.floor(np.log(cell_values[active] / cell_values[active].min()) / np.log(self.sub_time_step_class_ratio) + 1e-6)
+        else:
+            class_keys = cell_values[active]
+        keys, class_index = np.unique(class_keys, return_inverse = True)
+
+        class_numbers = np.zeros(cell_values.shape, dtype = np.int32)
+        class_numbers[active] = class_index + 1
+        basin_classes = pcr.ifthen(self.landmask, pcr.nominal(pcr.numpy2pcr(pcr.Nominal, class_numbers, 0)))
+
+        number_of_loops_per_class = []
+        number_of_cells_per_class = []
+        for i_class in range(len(keys)):
+            number_of_loops_per_class.append(int(cell_values[active][class_index == i_class].max()))
+            number_of_cells_per_class.append(int(np.sum(class_index == i_class)))
+
+        # number of cell updates per day (design numbers of sub time steps) compared to the one using the same number of sub time steps for the entire clone
+        # - every class is evaluated on its own cells (see create_sub_step_kernels_of_basin_classes)
+        # - the calculation times are compared by routing_kernel.benchmark_basin_classes
+        basin_local_cell_updates = sum([n * c for n, c in zip(number_of_loops_per_class, number_of_cells_per_class)])
+        clone_wide_cell_updates  = self.limit_num_of_sub_time_steps * int(np.sum(active))
+        msg  = "Basin-local sub time steps: " + str(len(keys)) + " basin classes with " + str(number_of_loops_per_class) + " sub time steps (design) and " + \
+               str(number_of_cells_per_class) + " cells. "
+        msg += "Cell updates per day: " + str(basin_local_cell_updates) + " (clone-wide sub time steps: " + str(clone_wide_cell_updates) + ", reduction: " + \
+               "%.1f" %(100. * (1.0 - float(basin_local_cell_updates) / max(1, clone_wide_cell_updates))) + " %)."
+        logger.info(msg)
+
+        return basin_classes, number_of_loops_per_class
+
+    def get_number_of_loops_per_basin_class(self):
+        """
+        Return the number of sub time steps of every basin class for the current day: the maximum (within the class) of the design
+        number of sub time steps and the one estimated from the latest sub time step discharge (see estimate_number_of_sub_time_steps).
+        """
+
+        # estimated number of sub time steps for every basin
+        number_of_sub_time_steps = pcr.max(self.basin_num_of_sub_time_steps, self.estimate_number_of_sub_time_steps(self.basinIds))
+        number_of_sub_time_steps = pcr.areamaximum(number_of_sub_time_steps, self.basin_classes)
+
+        cell_values   = pcr.pcr2numpy(pcr.cover(number_of_sub_time_steps, 0.0), 0.0)
+        class_numbers = pcr.pcr2numpy(pcr.cover(self.basin_classes, 0), 0)
+        number_of_loops_per_class = []
+        for i_class in range(len(self.design_number_of_loops_per_class)):
+            in_class = class_numbers == i_class + 1
+            number_of_loops = self.design_number_of_loops_per_class[i_class]
+            if np.any(in_class): number_of_loops = max(number_of_loops, int(cell_values[in_class].max()))
+            number_of_loops_per_class.append(number_of_loops)
+
+        return number_of_loops_per_class
+
+    def create_sub_step_kernels_of_basin_classes(self):
+
+        # fused kernels that evaluate every basin class only on the subnetwork of its basins
+        class_numbers = self.to_routing_network(self.basin_classes)
+        self.subStepKernelsOfBasinClasses = []
+        for i_class in range(len(self.design_number_of_loops_per_class)):
+            cells = np.nonzero(class_numbers == i_class + 1)[0]
+            kernel = None
+            if cells.size > 0:
+                kernel = routing_kernel.SubsetSubStepKernel(self.routingNetwork, cells, self.create_sub_step_kernel(self.routingNetwork.subnetwork(cells)))
+            self.subStepKernelsOfBasinClasses.append(kernel)
+
+    def cover_within_mask(self, mask, value, other):
+
+        # use 'value' within the mask and 'other' elsewhere
+        if other is None: return pcr.ifthen(mask, value)
+        return pcr.cover(pcr.ifthen(mask, value), other)
+
+    def kinematic_wave_sub_time_steps_per_basin_class(self, landSurface, currTimeStep, meteo, channelStorageForRouting, channelStorageThatWillNotMove):
+        """
+        The sub time step loop of the kinematic wave method, executed separately for every basin class
+        (with the number of sub time steps of this class). The results are merged afterwards.
+        """
+
+        # basin classes (updated at the beginning of every year, as lakes and reservoirs may change)
+        if self.basin_classes is None or currTimeStep.timeStepPCR == 1 or currTimeStep.doy == 1:
+            self.basin_classes, self.design_number_of_loops_per_class = self.get_basin_classes_for_sub_time_steps()
+            self.create_sub_step_kernels_of_basin_classes()
+
+        # numbers of sub time steps of the classes for this day
+        self.number_of_loops_per_class = self.get_number_of_loops_per_basin_class()
+
+        # variables that are updated within the sub time steps and their values at the beginning of the day
+        routing_variables    = ['water_height', 'dynamicFracWat', 'subDischarge', 'floodDepth', 'inundatedFraction', 'waterBodyPotEvap', 'waterBodyStorage']
+        water_body_variables = ['waterBodyStorage', 'avgInflow', 'avgOutflow', 'inflow', 'inflowInM3PerSec', 'waterBodyOutflow', 'waterBodyBalance']
+        initial_routing_values    = {}
+        for var in routing_variables: initial_routing_values[var] = vars(self).get(var)
+        initial_water_body_values = {}
+        for var in water_body_variables: initial_water_body_values[var] = vars(self.WaterBodies).get(var)
+
+        merged_routing_values    = dict(initial_routing_values)
+        merged_water_body_values = dict(initial_water_body_values)
+        merged_output            = [None] * 5
+
+        for i_class in range(len(self.number_of_loops_per_class)):
+
+            number_of_loops = self.number_of_loops_per_class[i_class]
+
+            msg = "Routing basin class " + str(i_class + 1) + " from " + str(len(self.number_of_loops_per_class)) + " with " + str(number_of_loops) + " sub time steps."
+            logger.info(msg)
+
+            class_mask = pcr.ifthen(self.basin_classes == pcr.nominal(i_class + 1), pcr.boolean(1.0))
+
+            # start from the values at the beginning of the day
+            for var in routing_variables:
+                if initial_routing_values[var] is not None: vars(self)[var] = pcr.ifthen(class_mask, initial_routing_values[var])
+            for var in water_body_variables:
+                if initial_water_body_values[var] is not None: vars(self.WaterBodies)[var] = initial_water_body_values[var]
+
+            sub_step_kernel = self.subStepKernelsOfBasinClasses[i_class]
+            output = self.kinematic_wave_sub_time_steps_of_active_cells(landSurface, currTimeStep, meteo, \
+                                                                        pcr.ifthen(class_mask, channelStorageForRouting), \
+                                                                        pcr.ifthen(class_mask, channelStorageThatWillNotMove), \
+                                                                        number_of_loops, landmask = class_mask, sub_step_kernel = sub_step_kernel)
+
+            # merge the results of this class
+            for i_output in range(len(output)):
+                merged_output[i_output] = self.cover_within_mask(class_mask, output[i_output], merged_output[i_output])
+            for var in routing_variables:
+                merged_routing_values[var] = self.cover_within_mask(class_mask, vars(self)[var], merged_routing_values[var])
+            for var in water_body_variables:
+                if vars(self.WaterBodies).get(var) is not None:
+                    merged_water_body_values[var] = self.cover_within_mask(class_mask, vars(self.WaterBodies)[var], merged_water_body_values[var])
 
+        for var in routing_variables: vars(self)[var] = merged_routing_values[var]
+        for var in water_body_variables: vars(self.WaterBodies)[var] = merged_water_body_values[var]
 
+        return tuple(merged_output)
+
+    def get_active_cells_for_routing(self, landSurface):
+        """
+        Determine the active cells (self.activeCells): the cells of the basins that have channel storage, runoff, return flow or lakes/reservoirs.
+        The fraction of active cells is reported; if it is larger than max_active_cell_fraction, all cells are routed (self.routeAllCells).
+        """
+
+        # cells with water (cells with missing values are considered as active)
+        wet = (self.channelStorage != 0.0) | (self.runoff != 0.0) | (landSurface.nonIrrReturnFlow != 0.0) |\
+              (pcr.cover(pcr.scalar(self.WaterBodies.waterBodyIds), 0.0) > 0.0) |\
+              (self.WaterBodies.waterBodyStorage != 0.0) | (self.WaterBodies.avgInflow != 0.0) | (self.WaterBodies.avgOutflow != 0.0)
+        wet = pcr.cover(wet, pcr.boolean(1.0))
+
+        # basins do not exchange water; therefore a basin is active if one of its cells has water 
+        self.activeCells = pcr.ifthen(self.landmask, pcr.areamaximum(pcr.scalar(wet), self.basinIds) > 0.0)
+
+        number_of_active_cells = pcr.cellvalue(pcr.maptotal(pcr.scalar(self.activeCells)), 1)[0]
+        number_of_cells        = pcr.cellvalue(pcr.maptotal(pcr.scalar(pcr.defined(self.activeCells))), 1)[0]
+        active_cell_fraction   = number_of_active_cells / max(1.0, number_of_cells)
+        self.routeAllCells     = active_cell_fraction > self.max_active_cell_fraction
+
+        msg = "Active cells for routing: " + "%.1f" %(100. * active_cell_fraction) + " % (" + str(int(number_of_active_cells)) + " from " + str(int(number_of_cells)) + " cells)"
+        if self.routeAllCells: msg += "; all cells are routed (the fraction is larger than " + "%.1f" %(100. * self.max_active_cell_fraction) + " %)."
+        if self.routeAllCells == False: msg += "; dry basins are not routed."
+        logger.info(msg)
+
+        # the kernels of the active cells of the previous day can be reused if the active cells have not been changed
+        self.previousSubStepKernelsOfActiveCells = self.subStepKernelsOfActiveCells
+        self.subStepKernelsOfActiveCells         = []
+
+    def get_sub_step_kernel_of_active_cells(self, active_mask):
+
+        # fused kernel that evaluates the sub time steps only on the subnetwork of the active basins (within the active_mask)
+        cells = np.nonzero(self.to_routing_network(pcr.scalar(active_mask)) == 1.0)[0]
+        for previous_cells, kernel in self.subStepKernelsOfActiveCells + self.previousSubStepKernelsOfActiveCells:
+            if np.array_equal(previous_cells, cells): break
+        else:
+            kernel = routing_kernel.SubsetSubStepKernel(self.routingNetwork, cells, self.create_sub_step_kernel(self.routingNetwork.subnetwork(cells)))
+        self.subStepKernelsOfActiveCells.append((cells, kernel))
+        return kernel
+
+    def get_dry_routing_states(self, landSurface, currTimeStep, meteo, channelStorageThatWillNotMove, number_of_loops, inactive_mask):
+        """
+        The results of the sub time step loop (see kinematic_wave_sub_time_steps) for inactive cells, calculated without the loop.
+        In basins without water, all storages and fluxes remain zero; only the potential evaporation is accumulated over the sub time steps.
+        Return the output of the loop and the values of the routing variables (for the inactive cells).
+        """
+
+        zero = pcr.ifthen(inactive_mask, pcr.scalar(0.0))
+
+        # length of sub-time step (unit: s)
+        length_of_sub_time_step = vos.secondsPerDay() / number_of_loops
+
+        dry_values = {}
+        dry_values['water_height']     = zero
+        dry_values['subDischarge']     = zero
+        dry_values['waterBodyStorage'] = pcr.ifthen(inactive_mask, self.WaterBodies.waterBodyStorage)
+        
+        # flood fraction and flood depth for zero channel storage
+        inundatedFraction, floodDepth = self.returnInundationFractionAndFloodDepth(zero)
+        dry_values['inundatedFraction'] = pcr.ifthen(inactive_mask, inundatedFraction)
+        dry_values['floodDepth']        = pcr.ifthen(inactive_mask, floodDepth)
+        
+        # dynamicFracWat (as at the end of every sub time step)
+        dynamicFracWat  = pcr.cover(pcr.min(1.0, self.WaterBodies.fracWat), 0.0)
+        dynamicFracWat += pcr.max(0.0, 1.0 - dynamicFracWat) * pcr.max(self.channelFraction, self.innundatedFraction)
+        dry_values['dynamicFracWat'] = pcr.ifthen(inactive_mask, pcr.min(1.0, dynamicFracWat))
+        
+        # potential evaporation accumulated over the sub time steps
+        # - the first sub time step uses dynamicFracWat at the beginning of the day, the other ones the one given above
+        first_potential_evaporation = self.calculate_potential_evaporation(landSurface,currTimeStep,meteo) *\
+                                      length_of_sub_time_step/vos.secondsPerDay()
+        dynamicFracWatAtTheBeginning = self.dynamicFracWat
+        self.dynamicFracWat = dry_values['dynamicFracWat']
+        other_potential_evaporation = self.calculate_potential_evaporation(landSurface,currTimeStep,meteo) *\
+                                      length_of_sub_time_step/vos.secondsPerDay()
+        self.dynamicFracWat = dynamicFracWatAtTheBeginning
+        waterBodyPotEvap  = pcr.scalar(0.0)
+        waterBodyPotEvap += first_potential_evaporation
+        for i_loop in range(1, number_of_loops): waterBodyPotEvap += other_potential_evaporation
+        dry_values['waterBodyPotEvap'] = pcr.ifthen(inactive_mask, waterBodyPotEvap)
+        
+        # output: channelStorageForRouting, channelStorageThatWillNotMove, acc_local_input_to_surface_water, acc_water_body_evaporation_volume, acc_discharge_volume
+        dry_output = [zero, pcr.ifthen(inactive_mask, channelStorageThatWillNotMove), zero, zero, zero]
+
+        return dry_output, dry_values
+
+    def kinematic_wave_sub_time_steps_of_active_cells(self, landSurface, currTimeStep, meteo, channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops, landmask = None, \
+                                                      sub_step_kernel = None):
+        """
+        The sub time step loop of the kinematic wave method (see kinematic_wave_sub_time_steps), limited to the active cells (if activeSetRouting is used).
+        The inactive cells get their states from get_dry_routing_states; the active cells are evaluated with the fused kernel of their subnetwork.
+        The calculation can be limited to a part of the clone by giving its landmask (and the fused kernel of this part).
+        """
+
+        if self.activeSetRouting == False or self.routeAllCells:
+            if landmask is None:
+                return self.kinematic_wave_sub_time_steps(landSurface, currTimeStep, meteo, \
+                                                          channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops)
+            return self.kinematic_wave_sub_time_steps(landSurface, currTimeStep, meteo, \
+                                                      channelStorageForRouting, channelStorageThatWillNotMove, number_of_loops, \
+                                                      ldd = pcr.lddmask(self.lddMap, landmask), landmask = landmask, sub_step_kernel = sub_step_kernel)
+
+        if landmask is None: landmask = self.landmask
+
+        active_mask   = pcr.ifthen(landmask, self.activeCells)
+        inactive_mask = pcr.ifthen(pcr.pcrnot(active_mask), pcr.boolean(1.0))
+        active_mask   = pcr.ifthen(active_mask, pcr.boolean(1.0))
+
+        # states of the inactive cells (this must be done first, as it uses the values at the beginning of the day)
+        dry_output, dry_values = self.get_dry_routing_states(landSurface, currTimeStep, meteo, channelStorageThatWillNotMove, number_of_loops, inactive_mask)
+
+        if pcr.cellvalue(pcr.mapmaximum(pcr.scalar(pcr.defined(active_mask))), 1)[0] == 0.0:
+            for var in list(dry_values.keys()): vars(self)[var] = dry_values[var]
+            return tuple(dry_output)
+
+        output = self.kinematic_wave_sub_time_steps(landSurface, currTimeStep, meteo, \
+                                                    pcr.ifthen(active_mask, channelStorageForRouting), \
+                                                    pcr.ifthen(active_mask, channelStorageThatWillNotMove), \
+                                                    number_of_loops, \
+                                                    ldd = pcr.lddmask(self.lddMap, active_mask), landmask = active_mask, \
+                                                    sub_step_kernel = self.get_sub_step_kernel_of_active_cells(active_mask))
+
+        # merge the results of the active and inactive cells
+        for var in list(dry_values.keys()): vars(self)[var] = self.cover_within_mask(active_mask, vars(self)[var], dry_values[var])
+        return tuple([self.cover_within_mask(active_mask, output[i_output], dry_output[i_output]) for i_output in range(len(output))])
 
     def calculate_statistics(self, groundwater):
 
@@ -2181,6 +3030,10 @@ class Routing(object):
         self.avgInflow  = pcr.ifthen(self.landmask, pcr.cover(self.WaterBodies.avgInflow , 0.0)) 
         self.avgOutflow = pcr.ifthen(self.landmask, pcr.cover(self.WaterBodies.avgOutflow, 0.0))
 
+        if self.vectorizedRollingStatistics:
+            self.calculate_rolling_statistics(groundwater)
+            return
+
         # short term and long term average discharge (m3/s)
         # - see: online algorithm on http://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
         #
@@ -2213,6 +3066,27 @@ class Routing(object):
                            pcr.min(self.maxTimestepsToAvgDischargeLong, self.timestepsToAvgDischarge)                
         self.avgBaseflow = pcr.max(0.0, self.avgBaseflow)
 
+    def calculate_rolling_statistics(self, groundwater):
+
+        # the same statistics as above, but updated in one step on the matrix of the rolling statistics (see routing_statistics.py)
+        # - per day, only the two inputs are converted to the matrix and the four updated statistics are converted to maps
+        self.synchronize_rolling_statistics(routing_statistics.updated_statistic_names)
+
+        dishargeUsed      = pcr.max(0.0, self.discharge)
+        dishargeUsed      = pcr.max(dishargeUsed, self.disChanWaterBody)
+        baseflowM3PerSec  = groundwater.baseflow * self.cellArea / vos.secondsPerDay()
+
+        timestepsToAvgDischarge = pcr.cellvalue(pcr.mapmaximum(self.timestepsToAvgDischarge), 1)[0]
+        self.rollingStatistics.update(pcr.pcr2numpy(dishargeUsed,     np.nan).ravel()[self.rollingStatisticsCells],\
+                                      pcr.pcr2numpy(baseflowM3PerSec, np.nan).ravel()[self.rollingStatisticsCells],\
+                                      min(self.maxTimestepsToAvgDischargeLong,  timestepsToAvgDischarge),\
+                                      min(self.maxTimestepsToAvgDischargeShort, timestepsToAvgDischarge))
+
+        # maps of the updated statistics
+        for var in routing_statistics.updated_statistic_names:
+            vars(self)[var] = self.rolling_statistics_to_map(self.rollingStatistics.get(var))
+            self.rollingStatisticsMaps[var] = vars(self)[var]
+
     def estimate_discharge_for_environmental_flow(self, channelStorage):
 
         # statistical assumptions:
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fused sub time step kernel of the kinematic wave method (see routing.Routing.kinematic_wave_sub_time_steps).
+#
+# The stages of a sub time step are evaluated in place on flat float32 arrays (as the PCRaster maps) of the land cells
+# of a routing network (see routing_network.py), using buffers that are allocated once:
+# - local input (runoff and return flow) and evaporation from surface water,
+# - transfer of channel storage to lakes and reservoirs (the lakes and reservoirs are updated by a given function),
+# - alpha and the initial discharge, kinematic wave and the limitation of discharge to the available channel storage,
+# - return of lake and reservoir storage to the channel, flood inundation, dynamicFracWat and water height.
+#
+# The terms that do not change within a day (local input, potential evaporation over surface water, channel geometry,
+# dynamicFracWat after a sub time step, ...) are given once per day (see set_daily_values). Cells that are not part
+# of the routed region (e.g. the cells of other basin classes) get missing values (NaN).
+#
+# The operations are done in the same order as in the map based sub time steps. Therefore, thresholds on the storage (e.g. rounded
+# down storage moved to lakes and reservoirs) give the same results as with the PCRaster maps.
+#
+# The basin-local sub time steps (see routing.Routing.kinematic_wave_sub_time_steps_per_basin_class) use one SubsetSubStepKernel per basin class:
+# the sub time steps of a class are only evaluated on the subnetwork of its basins, with the values given for all cells.
+#
+# Usage (timing of the basin classes and of the same number of sub time steps for all cells on a synthetic network):
+#   python routing_kernel.py <number_of_rows> <number_of_columns> [<number_of_repetitions>]
+
+import sys
+import time
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# buffers (one value per cell)
+buffer_names = ['storage', 'storage_that_will_not_move', 'water_height', 'dynamic_frac_wat', 'sub_discharge', 'inundated_fraction', 'flood_depth',
+                'acc_local_input', 'acc_evaporation', 'acc_discharge', 'water_body_pot_evap',
+                'evaporation', 'water_body_transfer', 'water_body_outflow', 'upstream', 'discharge_initial', 'alpha',
+                'wetted_area', 'wetted_perimeter', 'channel_wetted_perimeter', 'flood_wetted_perimeter', 'excess', 'tmp', 'tmp2', 'tmp3']
+
+# buffers with the results of the sub time steps
+result_names = ['storage', 'storage_that_will_not_move', 'water_height', 'dynamic_frac_wat', 'sub_discharge', 'inundated_fraction', 'flood_depth',
+                'acc_local_input', 'acc_evaporation', 'acc_discharge', 'water_body_pot_evap']
+
+# daily values (one value per cell) given by set_daily_values
+daily_value_names = ['region', 'cell_area', 'channel_length', 'channel_width', 'channel_depth', 'channel_bed_area', 'cell_area_per_channel_length',
+                     'gradient_power_minus_half', 'mannings_n', 'mannings_n_power_one_and_half', 'floodplain_mannings_n_power_one_and_half',
+                     'channel_storage_capacity', 'channel_fraction', 'max_flood_depth', 'innundated_fraction',
+                     'local_input', 'potential_evaporation', 'dynamic_frac_wat_after_sub_time_step',
+                     'water_body_ids', 'water_body_outlets']
+
+
+class SubStepKernel(object):
+
+    def __init__(self, network, beta, min_fracwat_for_water_height, flood_plain, criterion_kk = None, small_number = 1E-39):
+        object.__init__(self)
+
+        self.network = network
+        self.number_of_cells = network.number_of_cells
+
+        self.beta = beta
+        self.min_fracwat_for_water_height = min_fracwat_for_water_height
+        self.flood_plain  = flood_plain
+        self.criterion_kk = criterion_kk
+        self.small_number = small_number
+
+        # buffers (allocated once) and boolean buffers
+        for name in buffer_names: vars(self)[name] = np.zeros(self.number_of_cells, dtype = np.float32)
+        self.condition = np.zeros(self.number_of_cells, dtype = bool)
+        self.memory_in_mb = (len(buffer_names) * 4. + 1.) * self.number_of_cells / (1024. * 1024.)
+
+        msg = "Fused sub time step kernel: " + str(len(buffer_names)) + " buffers of " + str(self.number_of_cells) + " cells (" + "%.1f" %(self.memory_in_mb) + " MB)."
+        logger.info(msg)
+
+    def set_daily_values(self, values):
+        """
+        Set the values that do not change within a day (a dictionary with the daily_value_names; flat arrays or scalars).
+        - region                  : cells that are routed (boolean)
+        - local_input             : runoff and return flow (m3/day)
+        - potential_evaporation   : non negative potential evaporation over the surface water area (m/day)
+        - water_body_ids          : ids of lakes and reservoirs (values <= 0 or NaN: no lake/reservoir)
+        - water_body_outlets      : outlets of lakes and reservoirs (boolean)
+        - max_flood_depth         : None if not used
+        """
+
+        for name in daily_value_names: vars(self)[name] = values[name]
+        for name in daily_value_names:
+            if isinstance(vars(self)[name], np.ndarray) and vars(self)[name].dtype == np.float64: vars(self)[name] = vars(self)[name].astype(np.float32)
+        self.outside_region = self.region == False
+
+        # lakes and reservoirs in the region: cells, index of their lake/reservoir and the total cell area of every lake/reservoir
+        water_body_ids = np.where(np.isnan(self.water_body_ids), 0.0, self.water_body_ids)
+        self.water_body_cells = water_body_ids > 0.0
+        self.water_body_cells_in_region = np.nonzero(self.water_body_cells & self.region)[0]
+        self.not_water_body_cells_in_region = np.ones(self.number_of_cells, dtype = bool)
+        self.not_water_body_cells_in_region[self.water_body_cells_in_region] = False
+        unique_ids, self.water_body_index = np.unique(water_body_ids[self.water_body_cells_in_region], return_inverse = True)
+        self.number_of_water_bodies = unique_ids.size
+        cell_area = np.broadcast_to(self.cell_area, (self.number_of_cells,))[self.water_body_cells_in_region]
+        self.water_body_area = np.bincount(self.water_body_index, weights = np.where(np.isnan(cell_area), 0.0, cell_area), minlength = self.number_of_water_bodies).astype(np.float32)
+
+        # channel bed area used as a denominator (see virtualOS.getValDivZero)
+        self.no_channel_bed_area = (self.channel_bed_area > self.small_number) == False
+        self.channel_bed_area_for_division = np.maximum(self.small_number, self.channel_bed_area)
+
+    def run(self, number_of_loops, length_of_sub_time_step, seconds_per_day, initial_values, update_water_bodies, lookup_flood_volume_level = None):
+        """
+        Execute the sub time steps.
+        - initial_values            : dictionary with storage, storage_that_will_not_move, dynamic_frac_wat and flood_depth (flat arrays)
+        - update_water_bodies       : function with the storage moved to lakes and reservoirs (m3) as argument, returning their outflow at
+                                      the outlets (m3 per sub time step) and their storage (m3) (flat arrays)
+        - lookup_flood_volume_level : function returning deltaXMin, y_i, k_0, k_1 and mInt for the excess volume (see routing.Routing.lookupFloodVolumeLevel)
+        The results are given in the buffers (e.g. self.storage, self.sub_discharge).
+        """
+
+        dt = length_of_sub_time_step
+
+        self.start_sub_time_steps(dt, seconds_per_day, initial_values)
+
+        for i_loop in range(number_of_loops):
+
+            msg = "sub-daily time step "+str(i_loop+1)+" from "+str(number_of_loops)+" (fused kernel)"
+            logger.info(msg)
+
+            self.sub_time_step_before_water_bodies(dt, seconds_per_day)
+
+            # - update lakes and reservoirs, their outflow (m3) enters the downstream cells of the outlets
+            water_body_outflow, water_body_storage = update_water_bodies(self.water_body_transfer)
+
+            self.sub_time_step_after_water_bodies(dt, water_body_outflow, water_body_storage)
+
+            # flood fraction and flood depth
+            if self.flood_plain:
+                self.excess_from_storage()
+                self.inundation_from_flood_volume_level(*lookup_flood_volume_level(self.excess))
+            else:
+                self.inundation_without_flood_plain()
+
+            self.end_sub_time_step()
+
+        self.finish_sub_time_steps()
+
+    # The stages of the sub time steps (see run).
+
+    def start_sub_time_steps(self, dt, seconds_per_day, initial_values):
+
+        for name in ['storage', 'storage_that_will_not_move', 'dynamic_frac_wat', 'flood_depth']: self.buffers_from_values(name, initial_values[name])
+        for name in ['acc_local_input', 'acc_evaporation', 'acc_discharge', 'water_body_pot_evap']: vars(self)[name].fill(0.0)
+        self.water_height_from_storage()
+
+        # local input per sub time step (m3)
+        self.local_input_per_sub_time_step = self.local_input * dt / seconds_per_day
+
+    def sub_time_step_before_water_bodies(self, dt, seconds_per_day):
+
+        # local input
+        self.storage += self.local_input_per_sub_time_step
+        self.acc_local_input += self.local_input_per_sub_time_step
+
+        # potential evaporation (m, over the entire cell area) and evaporation volume (m3), limited to the available storage
+        np.multiply(self.potential_evaporation, self.dynamic_frac_wat, out = self.tmp)
+        self.tmp *= dt
+        self.tmp /= seconds_per_day
+        self.water_body_pot_evap += self.tmp
+        self.tmp *= self.cell_area
+        self.tmp *= dt
+        self.tmp /= seconds_per_day
+        np.maximum(self.storage, 0.0, out = self.evaporation)
+        np.minimum(self.evaporation, self.tmp, out = self.evaporation)
+        self.storage -= self.evaporation
+        self.acc_local_input -= self.evaporation
+        self.acc_evaporation += self.evaporation
+
+        # storage moved to lakes and reservoirs (m3; only non negative values and rounded down values)
+        np.floor(self.storage, out = self.water_body_transfer)
+        np.maximum(self.water_body_transfer, 0.0, out = self.water_body_transfer)
+        np.copyto(self.water_body_transfer, 0.0, where = self.not_water_body_cells_in_region)
+        self.storage -= self.water_body_transfer
+        np.maximum(self.storage, 0.0, out = self.storage)
+
+    def sub_time_step_after_water_bodies(self, dt, water_body_outflow, water_body_storage):
+
+        # outflow (m3) of lakes and reservoirs enters the downstream cells of the outlets
+        np.copyto(self.water_body_outflow, water_body_outflow)
+        np.copyto(self.water_body_outflow, np.nan, where = self.outside_region)
+        self.storage += self.network.upstream(self.water_body_outflow, out = self.upstream)
+        # - in m3/s
+        self.water_body_outflow /= dt
+
+        # alpha and initial discharge (m3/s) ; at outlets of lakes and reservoirs: their outflow; for zero storage: zero
+        self.water_height_from_storage()
+        self.alpha_and_initial_discharge()
+        np.copyto(self.discharge_initial, self.water_body_outflow, where = self.water_body_outlets)
+        np.greater(self.storage, 0.0, out = self.condition)
+        np.logical_not(self.condition, out = self.condition)
+        np.copyto(self.discharge_initial, 0.0, where = self.condition)
+        np.isnan(self.discharge_initial, out = self.condition)
+        np.copyto(self.discharge_initial, 0.0, where = self.condition)
+        np.copyto(self.discharge_initial, np.nan, where = self.outside_region)
+
+        # discharge (m3/s) based on the kinematic wave ; zero at lake and reservoir cells
+        np.copyto(self.sub_discharge, self.network.kinematic(self.discharge_initial, 0.0, self.alpha, self.beta, 1, dt, self.channel_length))
+        np.isnan(self.sub_discharge, out = self.condition)
+        np.copyto(self.sub_discharge, 0.0, where = self.condition)
+        np.maximum(self.sub_discharge, 0.0, out = self.sub_discharge)
+        np.copyto(self.sub_discharge, 0.0, where = self.water_body_cells)
+
+        # no negative channel storage
+        np.multiply(self.sub_discharge, dt, out = self.tmp)
+        np.add(self.storage, self.network.upstream(self.tmp, out = self.upstream), out = self.tmp2)
+        np.maximum(self.tmp2, 0.0, out = self.tmp2)
+        np.minimum(self.tmp, self.tmp2, out = self.tmp)
+        np.divide(self.tmp, dt, out = self.sub_discharge)
+
+        # storage after lateral flows in channels
+        np.multiply(self.sub_discharge, dt, out = self.tmp)
+        np.subtract(self.network.upstream(self.tmp, out = self.upstream), self.tmp, out = self.tmp)
+        self.storage += self.tmp
+
+        # return the storage of lakes and reservoirs to the channel
+        self.return_water_body_storage_to_channel(water_body_storage)
+
+        # discharge including the outflow of lakes and reservoirs
+        self.sub_discharge += self.water_body_outflow
+        np.multiply(self.sub_discharge, dt, out = self.tmp)
+        self.acc_discharge += self.tmp
+
+    def end_sub_time_step(self):
+
+        # dynamicFracWat (the same value at the end of every sub time step)
+        np.copyto(self.dynamic_frac_wat, self.dynamic_frac_wat_after_sub_time_step)
+
+        # route only non negative storage in the next sub time step
+        np.minimum(self.storage, 0.0, out = self.tmp)
+        self.storage_that_will_not_move += self.tmp
+        np.maximum(self.storage, 0.0, out = self.storage)
+
+        # water height
+        self.water_height_from_storage()
+
+    def finish_sub_time_steps(self):
+
+        # missing values outside the region
+        for name in result_names: np.copyto(vars(self)[name], np.nan, where = self.outside_region)
+
+    def buffers_from_values(self, name, values):
+
+        # copy values (flat arrays or scalars) to a buffer; missing values outside the region
+        np.copyto(vars(self)[name], values)
+        np.copyto(vars(self)[name], np.nan, where = self.outside_region)
+
+    def water_height_from_storage(self):
+
+        # water height (m)
+        np.maximum(self.dynamic_frac_wat, self.min_fracwat_for_water_height, out = self.tmp)
+        self.tmp *= self.cell_area
+        np.maximum(self.storage, 0.0, out = self.water_height)
+        self.water_height /= self.tmp
+
+    def alpha_and_initial_discharge(self):
+
+        # alpha and initial discharge for the kinematic wave (see routing.Routing.calculate_alpha_and_initial_discharge_for_kinematic_wave)
+
+        # channel wetted area (m2)
+        np.multiply(self.water_height, self.channel_width, out = self.wetted_area)
+        np.divide(self.storage, self.channel_length, out = self.tmp)
+        np.maximum(self.wetted_area, self.tmp, out = self.wetted_area)
+
+        # wetted perimeter (m)
+        np.multiply(self.innundated_fraction, self.cell_area_per_channel_length, out = self.flood_wetted_perimeter)
+        self.flood_wetted_perimeter -= self.channel_width
+        np.maximum(self.flood_wetted_perimeter, 0.0, out = self.flood_wetted_perimeter)
+        np.multiply(self.flood_depth, 2.0, out = self.tmp)
+        self.flood_wetted_perimeter += self.tmp
+        #
+        np.divide(self.storage, self.channel_bed_area_for_division, out = self.channel_wetted_perimeter)
+        np.copyto(self.channel_wetted_perimeter, 0.0, where = self.no_channel_bed_area)
+        np.minimum(self.channel_depth, self.channel_wetted_perimeter, out = self.channel_wetted_perimeter)
+        self.channel_wetted_perimeter *= 2.0
+        self.channel_wetted_perimeter += self.channel_width
+        #
+        np.add(self.channel_wetted_perimeter, self.flood_wetted_perimeter, out = self.wetted_perimeter)
+        np.maximum(self.wetted_perimeter, 0.1, out = self.wetted_perimeter)
+
+        # corrected Manning's coefficient (in self.alpha)
+        if self.flood_plain:
+            np.divide(self.channel_wetted_perimeter, self.wetted_perimeter, out = self.alpha)
+            self.alpha *= self.mannings_n_power_one_and_half
+            np.divide(self.flood_wetted_perimeter, self.wetted_perimeter, out = self.tmp)
+            self.tmp *= self.floodplain_mannings_n_power_one_and_half
+            self.alpha += self.tmp
+            np.power(self.alpha, 2./3., out = self.alpha)
+        else:
+            np.copyto(self.alpha, self.mannings_n)
+
+        # alpha
+        np.power(self.wetted_perimeter, 2./3., out = self.tmp)
+        self.alpha *= self.tmp
+        self.alpha *= self.gradient_power_minus_half
+        np.power(self.alpha, self.beta, out = self.alpha)
+
+        # initial discharge (m3/s)
+        np.divide(self.wetted_area, self.alpha, out = self.discharge_initial)
+        np.power(self.discharge_initial, 1.0/self.beta, out = self.discharge_initial)
+        np.greater(self.alpha, 0.0, out = self.condition)
+        np.logical_not(self.condition, out = self.condition)
+        np.copyto(self.discharge_initial, 0.0, where = self.condition)
+
+    def return_water_body_storage_to_channel(self, water_body_storage):
+
+        # the storage of every lake/reservoir and the channel storage at its cells are distributed over its cells (by cell area)
+        # (see routing.Routing.return_water_body_storage_to_channel)
+        if self.number_of_water_bodies == 0: return
+
+        cells = self.water_body_cells_in_region
+        index = self.water_body_index
+
+        # - totals and averages per lake/reservoir are summed in float64 
+        storage_at_cells = water_body_storage[cells]
+        defined = np.isnan(storage_at_cells) == False
+        average_storage = (np.bincount(index[defined], weights = storage_at_cells[defined], minlength = self.number_of_water_bodies) /\
+                           np.bincount(index[defined], minlength = self.number_of_water_bodies)).astype(np.float32)
+        channel_storage = self.storage[cells]
+        total_storage = average_storage + \
+                        np.bincount(index, weights = np.where(np.isnan(channel_storage), 0.0, channel_storage), minlength = self.number_of_water_bodies).astype(np.float32)
+
+        self.storage[cells] = total_storage[index] * np.broadcast_to(self.cell_area, (self.number_of_cells,))[cells] / self.water_body_area[index]
+
+    # flood fraction and flood depth (see routing.Routing.returnInundationFractionAndFloodDepth)
+
+    def inundation_without_flood_plain(self):
+
+        np.copyto(self.inundated_fraction, self.channel_fraction)
+        self.flood_depth.fill(0.0)
+
+    def excess_from_storage(self):
+
+        # excess volume above the bankfull capacity (m3)
+        np.subtract(self.storage, self.channel_storage_capacity, out = self.excess)
+        np.maximum(self.excess, 0.0, out = self.excess)
+
+    def inundation_from_flood_volume_level(self, deltaX, y_i, k_0, k_1, mInt):
+
+        # deltaX, y_i, k_0, k_1 and mInt of the flood volume level of the excess volume (see excess_from_storage)
+
+        # scaled deltaX (in self.tmp) and the integrals of the logistic functions (in self.tmp2 and self.flood_depth)
+        np.maximum(mInt, 1.0, out = self.tmp)
+        np.divide(deltaX, self.tmp, out = self.tmp)
+        np.abs(self.tmp, out = self.tmp)
+        np.minimum(self.tmp, self.criterion_kk, out = self.tmp)
+        negative_deltaX = deltaX < 0.0
+        np.negative(self.tmp, out = self.tmp, where = negative_deltaX)
+        np.negative(self.tmp, out = self.tmp2)
+        np.exp(self.tmp2, out = self.tmp2)
+        self.tmp2 += 1.0
+        np.log(self.tmp2, out = self.tmp2)
+        np.add(self.tmp, self.tmp2, out = self.flood_depth)
+
+        # inundated fraction: smoothed near the intersections, otherwise linear
+        np.multiply(k_0, mInt, out = self.tmp3)
+        self.tmp2 *= self.tmp3
+        np.multiply(k_1, mInt, out = self.tmp3)
+        self.flood_depth *= self.tmp3
+        np.subtract(y_i, self.tmp2, out = self.inundated_fraction)
+        self.inundated_fraction += self.flood_depth
+        #
+        np.abs(self.tmp, out = self.tmp)
+        np.less(self.tmp, self.criterion_kk, out = self.condition)
+        linear = y_i + np.where(negative_deltaX, k_0, k_1) * deltaX
+        np.copyto(self.inundated_fraction, linear, where = self.condition == False)
+        #
+        np.greater(self.excess, 0.0, out = self.condition)
+        np.copyto(self.inundated_fraction, 0.0, where = self.condition == False)
+        # - minimum value is channelFraction and maximum value is 1.0
+        np.maximum(self.inundated_fraction, self.channel_fraction, out = self.inundated_fraction)
+        np.minimum(self.inundated_fraction, 1.0, out = self.inundated_fraction)
+        np.maximum(self.inundated_fraction, 0.0, out = self.inundated_fraction)
+        # - missing values for missing storage
+        np.isnan(self.excess, out = self.condition)
+        np.copyto(self.inundated_fraction, np.nan, where = self.condition)
+
+        # flood depth (m) above the floodplain
+        np.maximum(self.inundated_fraction, self.min_fracwat_for_water_height, out = self.tmp)
+        self.tmp *= self.cell_area
+        np.divide(self.excess, self.tmp, out = self.flood_depth)
+        np.greater(self.inundated_fraction, 0.0, out = self.condition)
+        np.copyto(self.flood_depth, 0.0, where = self.condition == False)
+        np.isnan(self.inundated_fraction, out = self.condition)
+        np.copyto(self.flood_depth, np.nan, where = self.condition)
+        # - maximum flood depth
+        if self.max_flood_depth is not None:
+            np.minimum(self.flood_depth, self.max_flood_depth, out = self.flood_depth)
+            np.maximum(self.flood_depth, 0.0, out = self.flood_depth)
+
+
+class SubsetSubStepKernel(object):
+
+    def __init__(self, network, cells, kernel):
+        """
+        The kernel of a subset of complete basins (e.g. a basin class; see routing.Routing.kinematic_wave_sub_time_steps_per_basin_class),
+        with the values given and returned for all cells of the network. The sub time steps are only evaluated for the cells of the subset,
+        by the given kernel (SubStepKernel) of the subnetwork of these cells (see RoutingNetwork.subnetwork).
+        """
+        object.__init__(self)
+
+        self.network = network
+        self.number_of_cells = network.number_of_cells
+        self.cells  = cells
+        self.kernel = kernel
+
+        # results for all cells (missing values outside the subset) and the values exchanged with the lakes/reservoirs and the flood volume levels
+        for name in result_names + ['water_body_transfer', 'excess']: vars(self)[name] = np.full(self.number_of_cells, np.nan, dtype = np.float32)
+        self.water_body_transfer.fill(0.0)
+        self.memory_in_mb = (len(result_names) + 2) * 4. * self.number_of_cells / (1024. * 1024.) + kernel.memory_in_mb
+
+    def set_daily_values(self, values):
+
+        self.kernel.set_daily_values(dict([(name, _part(values[name], self.cells)) for name in daily_value_names]))
+
+    def run(self, number_of_loops, length_of_sub_time_step, seconds_per_day, initial_values, update_water_bodies, lookup_flood_volume_level = None):
+        """
+        Execute the sub time steps (see SubStepKernel.run). The results are given in the buffers (for all cells).
+        """
+
+        cells = self.cells
+
+        # the lakes/reservoirs and the flood volume levels are given/returned for all cells
+        def update_water_bodies_of_subset(water_body_transfer):
+            self.water_body_transfer[cells] = water_body_transfer
+            water_body_outflow, water_body_storage = update_water_bodies(self.water_body_transfer)
+            return water_body_outflow[cells], water_body_storage[cells]
+        def lookup_flood_volume_level_of_subset(excess):
+            self.excess[cells] = excess
+            return [values[cells] for values in lookup_flood_volume_level(self.excess)]
+
+        self.kernel.run(number_of_loops, length_of_sub_time_step, seconds_per_day, \
+                        dict([(name, _part(initial_values[name], cells)) for name in list(initial_values.keys())]), \
+                        update_water_bodies_of_subset, None if lookup_flood_volume_level is None else lookup_flood_volume_level_of_subset)
+
+        for name in result_names: vars(self)[name][cells] = vars(self.kernel)[name]
+
+def _part(values, cells):
+
+    # the values of the cells of a subset (scalars and None are returned as they are)
+    if values is None or np.ndim(values) == 0: return values
+    return values[cells]
+
+
+def synthetic_network_and_values(number_of_rows, number_of_columns):
+
+    # synthetic network of many basins draining to the north and random daily and initial values (without lakes/reservoirs and flood plain)
+    import routing_network
+
+    random = np.random.RandomState(0)
+    ldd = random.randint(7, 10, (number_of_rows, number_of_columns))
+    ldd[0, :] = 5 ; ldd[:, 0] = 5 ; ldd[:, -1] = 5
+    ldd[random.random_sample(ldd.shape) > 0.99] = 5
+    network = routing_network.RoutingNetwork(ldd)
+    n = network.number_of_cells
+
+    def uniform(low, high): return random.uniform(low, high, n).astype(np.float32)
+    daily_values = {'region': np.ones(n, dtype = bool), 'cell_area': uniform(5e6, 8e6), 'channel_length': uniform(2e3, 4e3), 'channel_width': uniform(5., 50.),
+                    'channel_depth': uniform(0.5, 3.), 'gradient_power_minus_half': uniform(10., 100.), 'mannings_n': np.float32(0.04),
+                    'mannings_n_power_one_and_half': np.float32(0.04**1.5), 'floodplain_mannings_n_power_one_and_half': None,
+                    'channel_storage_capacity': None, 'channel_fraction': uniform(0.01, 0.1), 'max_flood_depth': None, 'innundated_fraction': uniform(0.01, 0.2),
+                    'local_input': uniform(0., 1e5), 'potential_evaporation': uniform(0., 0.005), 'dynamic_frac_wat_after_sub_time_step': uniform(0.01, 0.3),
+                    'water_body_ids': np.full(n, np.nan), 'water_body_outlets': np.zeros(n, dtype = bool)}
+    daily_values['channel_bed_area'] = daily_values['channel_length'] * daily_values['channel_width']
+    daily_values['cell_area_per_channel_length'] = daily_values['cell_area'] / daily_values['channel_length']
+    initial_values = {'storage': uniform(0., 3e6), 'storage_that_will_not_move': np.zeros(n, dtype = np.float32),
+                      'dynamic_frac_wat': uniform(0.01, 0.3), 'flood_depth': np.zeros(n, dtype = np.float32)}
+    no_water_bodies = lambda transfer: (np.zeros(n, dtype = np.float32), np.full(n, np.nan, dtype = np.float32))
+
+    return network, daily_values, initial_values, no_water_bodies
+
+
+def benchmark_basin_classes(number_of_rows, number_of_columns, number_of_repetitions = 1, numbers_of_loops = [24, 48, 96], fractions_of_basins = [0.6, 0.3, 0.1]):
+    """
+    Compare the calculation times of the basin-local sub time steps (see routing.Routing.kinematic_wave_sub_time_steps_per_basin_class)
+    with the ones of the same number of sub time steps for all cells (the largest one), on a synthetic network with random numbers of
+    sub time steps per basin:
+    - clone-wide          : one kernel for all cells with the largest number of sub time steps,
+    - classes (region)    : every class with its own number of sub time steps, evaluated on all cells (the other classes outside the region);
+                            only used to check the results of the subnetworks (routing.py always uses the subnetworks),
+    - classes (subnetwork): every class with its own number of sub time steps, evaluated on the subnetwork of its basins (SubsetSubStepKernel).
+    """
+
+    network, daily_values, initial_values, no_water_bodies = synthetic_network_and_values(number_of_rows, number_of_columns)
+
+    # class of every basin
+    basins = network.basins()
+    class_of_basin = np.random.RandomState(1).choice(len(numbers_of_loops), network.number_of_cells, p = fractions_of_basins)
+    class_of_cell = class_of_basin[basins]
+    class_cells = [np.nonzero(class_of_cell == i_class)[0] for i_class in range(len(numbers_of_loops))]
+
+    msg = "Synthetic network: " + str(network.number_of_cells) + " cells in " + str(network.number_of_levels) + " topological levels; " + \
+          "basin classes with " + str(numbers_of_loops) + " sub time steps and " + str([cells.size for cells in class_cells]) + " cells."
+    logger.info(msg)
+
+    def run_classes(kernels):
+        results = [np.full(network.number_of_cells, np.nan, dtype = np.float32) for result_name in result_names]
+        for i_class, (kernel, cells, number_of_loops) in enumerate(zip(kernels, class_cells, numbers_of_loops)):
+            kernel.set_daily_values(dict(daily_values, region = class_of_cell == i_class))
+            kernel.run(number_of_loops, 86400. / number_of_loops, 86400., initial_values, no_water_bodies)
+            for values, result_name in zip(results, result_names): values[cells] = vars(kernel)[result_name][cells]
+        return results
+
+    def run_clone_wide(kernel):
+        kernel.set_daily_values(daily_values)
+        kernel.run(max(numbers_of_loops), 86400. / max(numbers_of_loops), 86400., initial_values, no_water_bodies)
+        return [vars(kernel)[result_name].copy() for result_name in result_names]
+
+    kernel = SubStepKernel(network, 0.6, 0.001, False)
+    results = {}
+    for name, run in [('clone-wide',           lambda: run_clone_wide(kernel)), \
+                      ('classes (region)',     lambda: run_classes([kernel] * len(class_cells))), \
+                      ('classes (subnetwork)', lambda: run_classes(subset_kernels))]:
+        if name == 'classes (subnetwork)':
+            subset_kernels = [SubsetSubStepKernel(network, cells, SubStepKernel(network.subnetwork(cells), 0.6, 0.001, False)) for cells in class_cells]
+        start = time.time()
+        for i in range(number_of_repetitions): results[name] = run()
+        msg = name + ": " + str((time.time() - start) / number_of_repetitions) + " seconds per day."
+        logger.info(msg)
+
+    identical = all([np.array_equal(a, b, equal_nan = True) for a, b in zip(results['classes (region)'], results['classes (subnetwork)'])])
+    msg = "The results of the classes evaluated on all cells and on their subnetworks are " + ("" if identical else "NOT ") + "identical."
+    logger.info(msg)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    number_of_repetitions = 1
+    if len(sys.argv) > 3: number_of_repetitions = int(sys.argv[3])
+    benchmark_basin_classes(int(sys.argv[1]), int(sys.argv[2]), number_of_repetitions)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Routing network (based on a local drainage direction map) on flat numpy arrays.
+#
+# The land cells are numbered in a topological order (every cell comes after all of its upstream cells)
+# and are grouped in levels: the cells of a level only have upstream cells in the previous levels.
+# The upstream cells of every cell are stored as CSR arrays (upstream_ptr, upstream_idx).
+#
+# The network is built once and can then be used instead of the PCRaster operations:
+# - upstream : sum of the values of the upstream neighbours (as pcr.upstream),
+# - kinematic: kinematic wave (as pcr.kinematic), using the same Newton-Raphson scheme, evaluated level by level.
+#   Every level is a separate (vectorized) step; the time of a call therefore also grows with the number of levels (the longest flow path).
+#
+# The PCRaster operations remain the default in the routing module (routingEngine = pcraster). Before the numpy engine is used, its timing
+# should be compared with the PCRaster operations on the ldd maps of the run, e.g. at 30 arcmin and at 5 arcmin (one line per map and operation).
+#
+# Usage (comparison with the PCRaster operations): python routing_network.py <ldd_map> [<ldd_map> ...] [<number_of_repetitions>]
+
+import sys
+import time
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# row and column offsets of the ldd directions (1 to 9, numeric keypad; 5 is a pit)
+ldd_row_offsets    = np.array([0,  1,  1,  1,  0,  0,  0, -1, -1, -1], dtype = np.int64)
+ldd_column_offsets = np.array([0, -1,  0,  1, -1,  0,  1, -1,  0,  1], dtype = np.int64)
+
+# settings of the Newton-Raphson iteration (as in the PCRaster kinematic operator)
+# - PCRaster iterates in long double until |f(Q)| <= epsilon; in float64, |f(Q)| cannot get below about 1e-16 * |c| (see iterate_to_new_discharge),
+#   therefore the tolerance is epsilon * max(1, |c|) here (relative for large values); the results are compared in tests/test_routing_network.py
+kinematic_epsilon        = 1e-12
+kinematic_max_iterations = 3000
+kinematic_min_discharge  = 1e-30
+
+
+class RoutingNetwork(object):
+
+    def __init__(self, ldd, landmask = None):
+        """
+        ldd     : 2D numpy array with the ldd directions (1 to 9; other values are not part of the network)
+        landmask: 2D numpy array (optional), cells with zero/False values are not part of the network
+        """
+        object.__init__(self)
+
+        ldd = np.asarray(ldd).astype(np.int64)
+        self.shape = ldd.shape
+
+        valid = (ldd >= 1) & (ldd <= 9)
+        if landmask is not None: valid = valid & (np.asarray(landmask) != 0)
+
+        rows, cols = np.nonzero(valid)
+        number_of_cells = rows.size
+
+        # downstream cell of every cell (-1: pit or outside the network)
+        grid_index = np.full(self.shape, -1, dtype = np.int64)
+        grid_index[rows, cols] = np.arange(number_of_cells)
+        direction  = ldd[rows, cols]
+        down_rows  = rows + ldd_row_offsets[direction]
+        down_cols  = cols + ldd_column_offsets[direction]
+        inside     = (direction != 5) & (down_rows >= 0) & (down_rows < self.shape[0]) & (down_cols >= 0) & (down_cols < self.shape[1])
+        downstream = np.full(number_of_cells, -1, dtype = np.int64)
+        downstream[inside] = grid_index[down_rows[inside], down_cols[inside]]
+
+        # topological order (Kahn's algorithm, one level at a time)
+        number_of_upstream_cells = np.bincount(downstream[downstream >= 0], minlength = number_of_cells)
+        remaining = number_of_upstream_cells.copy()
+        levels  = []
+        current = np.nonzero(remaining == 0)[0]
+        while current.size > 0:
+            levels.append(current)
+            down = downstream[current]
+            down = down[down >= 0]
+            np.subtract.at(remaining, down, 1)
+            current = np.unique(down[remaining[down] == 0])
+        order = np.concatenate(levels) if len(levels) > 0 else np.zeros(0, dtype = np.int64)
+        if order.size != number_of_cells:
+            msg = "The ldd contains " + str(number_of_cells - order.size) + " cells in cycles. Please use a sound ldd (pcr.lddrepair)."
+            raise Exception('Error: ' + msg)
+
+        # renumber the cells in the topological order
+        rank = np.empty(number_of_cells, dtype = np.int64)
+        rank[order] = np.arange(number_of_cells)
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.number_of_cells = number_of_cells
+        self.downstream = np.where(downstream[order] >= 0, rank[np.maximum(downstream[order], 0)], -1)
+        self.level_bounds = np.concatenate([[0], np.cumsum([level.size for level in levels])]).astype(np.int64)
+        self.number_of_levels = len(levels)
+
+        # upstream cells (CSR): the upstream cells of the cell i are upstream_idx[upstream_ptr[i]:upstream_ptr[i+1]]
+        has_downstream = np.nonzero(self.downstream >= 0)[0]
+        sorting = np.argsort(self.downstream[has_downstream], kind = 'stable')
+        self.upstream_idx = has_downstream[sorting]
+        counts = np.bincount(self.downstream[has_downstream], minlength = number_of_cells)
+        self.upstream_ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.cells_with_upstream = np.nonzero(counts > 0)[0]
+
+        # for every level: the range of cells_with_upstream that belong to this level
+        self.level_upstream_bounds = np.searchsorted(self.cells_with_upstream, self.level_bounds)
+
+        msg = "Routing network: " + str(self.number_of_cells) + " cells in " + str(self.number_of_levels) + " topological levels."
+        logger.debug(msg)
+
+    def to_flat(self, grid):
+        """
+        Return the values of a 2D array at the network cells (in the topological order) as float64.
+        """
+
+        return np.asarray(grid)[self.rows, self.cols].astype(np.float64)
+
+    def to_grid(self, values, missing_value = np.nan):
+        """
+        Return a 2D array with the values of the network cells ('missing_value' elsewhere).
+        """
+
+        grid = np.full(self.shape, missing_value, dtype = np.float64)
+        grid[self.rows, self.cols] = values
+        return grid
+
+    def upstream(self, values, out = None):
+        """
+        Sum of the values of the upstream neighbours of every cell (as pcr.upstream), summed in float64.
+        The result can be written in a given (preallocated) array.
+        """
+
+        if out is None:
+            result = np.zeros(self.number_of_cells, dtype = np.float64)
+        else:
+            result = out
+            result.fill(0.0)
+        if self.upstream_idx.size > 0:
+            result[self.cells_with_upstream] = np.add.reduceat(values[self.upstream_idx], self.upstream_ptr[self.cells_with_upstream], dtype = np.float64)
+        return result
+
+    def upstream_within_level(self, values, i_level):
+        """
+        Sum of the values of the upstream neighbours for the cells of one level (the upstream cells are in previous levels).
+        """
+
+        start, end = self.level_bounds[i_level], self.level_bounds[i_level + 1]
+        result = np.zeros(end - start, dtype = np.float64)
+        first, last = self.level_upstream_bounds[i_level], self.level_upstream_bounds[i_level + 1]
+        if last > first:
+            cells = self.cells_with_upstream[first:last]
+            upstream_values = values[self.upstream_idx[self.upstream_ptr[cells[0]]:self.upstream_ptr[cells[-1] + 1]]]
+            result[cells - start] = np.add.reduceat(upstream_values, self.upstream_ptr[cells] - self.upstream_ptr[cells[0]])
+        return result
+
+    def basins(self):
+        """
+        Return the basin of every cell: the index of its pit (the most downstream cell).
+        """
+
+        basin = np.arange(self.number_of_cells)
+        for i_level in range(self.number_of_levels - 1, -1, -1):
+            start, end = self.level_bounds[i_level], self.level_bounds[i_level + 1]
+            down = self.downstream[start:end]
+            basin[start:end] = np.where(down >= 0, basin[np.maximum(down, 0)], basin[start:end])
+        return basin
+
+    def subnetwork(self, cells):
+        """
+        Return the network of a subset of cells (indices in ascending order), e.g. a group of complete basins.
+        The cells of the subnetwork are in the same (relative) order as in this network.
+        """
+
+        rows, cols = self.rows[cells], self.cols[cells]
+        first_row, first_col = rows.min(), cols.min()
+        shape = (rows.max() - first_row + 1, cols.max() - first_col + 1)
+
+        # ldd directions of the subset (cells without downstream cell in the subset are pits)
+        direction_of_offsets = np.zeros((3, 3), dtype = np.int64)
+        direction_of_offsets[ldd_row_offsets[1:] + 1, ldd_column_offsets[1:] + 1] = np.arange(1, 10)
+        in_subset = np.zeros(self.number_of_cells, dtype = bool)
+        in_subset[cells] = True
+        down = self.downstream[cells]
+        has_down = (down >= 0) & in_subset[np.maximum(down, 0)]
+        ldd = np.zeros(shape, dtype = np.int64)
+        ldd[rows - first_row, cols - first_col] = 5
+        ldd[rows[has_down] - first_row, cols[has_down] - first_col] = \
+                 direction_of_offsets[self.rows[down[has_down]] - rows[has_down] + 1, self.cols[down[has_down]] - cols[has_down] + 1]
+
+        network = RoutingNetwork(ldd)
+        if np.array_equal(network.rows + first_row, rows) == False or np.array_equal(network.cols + first_col, cols) == False:
+            msg = "The cells of the subnetwork are not in the same order as in the network. The subset must consist of complete basins."
+            raise Exception('Error: ' + msg)
+        return network
+
+    def kinematic(self, discharge, lateral_inflow, alpha, beta, number_of_time_slices, length_of_time_step, channel_length):
+        """
+        Kinematic wave (as pcr.kinematic): return the new discharge (m3/s) of every cell.
+
+        discharge            : discharge at the beginning of the time step (m3/s)
+        lateral_inflow       : lateral inflow per unit channel length (m2/s)
+        alpha, beta          : parameters of the kinematic wave (alpha * Q**beta = A)
+        number_of_time_slices: number of time slices within length_of_time_step
+        length_of_time_step  : (s)
+        channel_length       : (m)
+        All arrays must be given for the network cells in the topological order (see to_flat); scalars are also allowed.
+        """
+
+        delta_t = float(length_of_time_step) / number_of_time_slices
+
+        # the inputs as float64 arrays of all cells (scalars are broadcast once, not for every level) and delta_t/delta_x
+        lateral_inflow, alpha, channel_length = [np.broadcast_to(np.asarray(values, dtype = np.float64), (self.number_of_cells,)) \
+                                                 for values in [lateral_inflow, alpha, channel_length]]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            delta_tx = delta_t / channel_length
+
+        q_old = np.broadcast_to(np.asarray(discharge, dtype = np.float64), (self.number_of_cells,))
+        for i_slice in range(number_of_time_slices):
+            q_new = np.zeros(self.number_of_cells, dtype = np.float64)
+            for i_level in range(self.number_of_levels):
+                start, end = self.level_bounds[i_level], self.level_bounds[i_level + 1]
+                q_in = self.upstream_within_level(q_new, i_level)
+                q_new[start:end] = newton_raphson(q_in, q_old[start:end], lateral_inflow[start:end], alpha[start:end], beta, delta_t, delta_tx[start:end])
+            q_old = q_new
+
+        return q_old
+
+
+def iterate_to_new_discharge(q_in, q_old, q, alpha, beta, delta_t, delta_x):
+    """
+    Solve delta_t/delta_x * Q + alpha * Q**beta = delta_t/delta_x * q_in + alpha * q_old**beta + delta_t * q
+    with the Newton-Raphson method (vectorized version of the scheme used in the PCRaster kinematic operator).
+    """
+
+    q_in, q_old, q, alpha, delta_x = [values.astype(np.float64) for values in np.broadcast_arrays(q_in, q_old, q, alpha, delta_x)]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        delta_tx = delta_t / delta_x
+    return newton_raphson(q_in, q_old, q, alpha, beta, delta_t, delta_tx)
+
+
+def newton_raphson(q_in, q_old, q, alpha, beta, delta_t, delta_tx):
+
+    # see iterate_to_new_discharge; all arguments (except beta and delta_t) are float64 arrays of the same size
+    result = np.zeros(q_in.size, dtype = np.float64)
+
+    # if there is no input, the output is zero
+    active = (q_in + q_old + q) != 0.0
+    if active.all() == False:
+        if active.any() == False: return result
+        q_in  = q_in[active] ; q_old    = q_old[active] ; q = q[active]
+        alpha = alpha[active]; delta_tx = delta_tx[active]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+
+        # common terms
+        ab_pq = alpha * beta * ((q_old + q_in) / 2.0)**(beta - 1.0)
+        c     = delta_tx * q_in + alpha * q_old**beta + delta_t * q
+
+        # initial guess
+        q_k1 = (delta_tx * q_in + q_old * ab_pq + delta_t * q) / (delta_tx + ab_pq)
+        q_k1 = np.where(np.isnan(q_k1) & (np.isnan(c) == False), 0.0, q_k1)
+        q_k1 = np.maximum(q_k1, kinematic_min_discharge)
+
+        # iterations until |f(Q)| <= epsilon * max(1, |c|) (see kinematic_epsilon); the arrays are reduced to the cells
+        # that did not converge yet only if some cells converged
+        tolerance = kinematic_epsilon * np.maximum(1.0, np.abs(c))
+        iterating = np.arange(q_k1.size)
+        q_kx = q_k1
+        for i_iteration in range(kinematic_max_iterations):
+            f_qkx  = delta_tx * q_kx + alpha * q_kx**beta - c
+            df_qkx = delta_tx + alpha * beta * q_kx**(beta - 1.0)
+            q_kx   = np.maximum(q_kx - f_qkx / df_qkx, kinematic_min_discharge)
+            q_k1[iterating] = q_kx
+            not_converged = np.abs(f_qkx) > tolerance
+            if not_converged.all(): continue
+            iterating = iterating[not_converged]
+            if iterating.size == 0: break
+            q_kx  = q_kx[not_converged] ; c = c[not_converged] ; tolerance = tolerance[not_converged]
+            alpha = alpha[not_converged]; delta_tx = delta_tx[not_converged]
+
+    if active.all(): return q_k1
+    result[active] = q_k1
+    return result
+
+
+def main():
+
+    # comparison (results and timing) between the numpy routing network and the PCRaster operations (for one or several ldd maps)
+
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    ldd_maps = sys.argv[1:]
+    number_of_repetitions = 1
+    if len(ldd_maps) > 1 and ldd_maps[-1].isdigit(): number_of_repetitions = int(ldd_maps.pop())
+
+    summary = []
+    for ldd_map in ldd_maps: summary += compare_with_pcraster(ldd_map, number_of_repetitions)
+
+    msg = "Summary (ldd map, operation, PCRaster time, numpy time, numpy time / PCRaster time):\n"
+    for ldd_map, name, pcraster_time, numpy_time in summary:
+        msg += "%-40s %-16s %8.3f s %8.3f s %8.2f\n" %(ldd_map, name, pcraster_time, numpy_time, numpy_time / max(1e-9, pcraster_time))
+    logger.info(msg)
+
+
+def compare_with_pcraster(ldd_map, number_of_repetitions):
+
+    # results and timing of the numpy routing network and the PCRaster operations for an ldd map; return (ldd_map, operation, PCRaster time, numpy time)
+
+    import pcraster as pcr
+
+    logger.info("Ldd map: " + ldd_map)
+    pcr.setclone(ldd_map)
+    ldd = pcr.lddrepair(pcr.ldd(pcr.readmap(ldd_map)))
+
+    start_time = time.time()
+    network = RoutingNetwork(pcr.pcr2numpy(ldd, 0))
+    logger.info("Building the network of %i cells (%i levels): %.3f s" %(network.number_of_cells, network.number_of_levels, time.time() - start_time))
+
+    # synthetic input: random discharge and alpha values (fixed seed)
+    random = np.random.RandomState(1)
+    mask = pcr.defined(ldd)
+    discharge_values = random.gamma(0.5, 20.0, network.number_of_cells)
+    alpha_values     = random.uniform(1.0, 10.0, network.number_of_cells)
+    discharge = pcr.ifthen(mask, pcr.numpy2pcr(pcr.Scalar, network.to_grid(discharge_values, -9999.), -9999.))
+    alpha     = pcr.ifthen(mask, pcr.numpy2pcr(pcr.Scalar, network.to_grid(alpha_values    , -9999.), -9999.))
+    # - the values used by PCRaster (float32)
+    discharge_values = network.to_flat(pcr.pcr2numpy(discharge, 0.0))
+    alpha_values     = network.to_flat(pcr.pcr2numpy(alpha, 0.0))
+    beta = 0.6 ; length_of_time_step = 3600. ; channel_length = 5000.
+
+    # the numpy engine as used by the routing module (see routing.Routing.kinematic): including the conversion of the maps
+    def numpy_kinematic_of_maps():
+        values = network.kinematic(network.to_flat(pcr.pcr2numpy(discharge, 0.0)), 0.0, network.to_flat(pcr.pcr2numpy(alpha, 0.0)), \
+                                   beta, 1, length_of_time_step, channel_length)
+        return pcr.numpy2pcr(pcr.Scalar, network.to_grid(values, -9999.), -9999.)
+
+    summary = []
+    for name, pcraster_function, numpy_function in \
+        [("upstream" , lambda: pcr.upstream(ldd, discharge), \
+                       lambda: network.upstream(discharge_values)),
+         ("kinematic", lambda: pcr.kinematic(ldd, discharge, 0.0, alpha, beta, 1, length_of_time_step, channel_length), \
+                       lambda: network.kinematic(discharge_values, 0.0, alpha_values, beta, 1, length_of_time_step, channel_length)),
+         ("kinematic (maps)", lambda: pcr.kinematic(ldd, discharge, 0.0, alpha, beta, 1, length_of_time_step, channel_length), \
+                              numpy_kinematic_of_maps)]:
+
+        start_time = time.time()
+        for i in range(number_of_repetitions): pcraster_result = pcraster_function()
+        pcraster_time = (time.time() - start_time) / number_of_repetitions
+
+        start_time = time.time()
+        for i in range(number_of_repetitions): numpy_result = numpy_function()
+        numpy_time = (time.time() - start_time) / number_of_repetitions
+
+        pcraster_result = network.to_flat(pcr.pcr2numpy(pcraster_result, np.nan))
+        if isinstance(numpy_result, np.ndarray) == False: numpy_result = network.to_flat(pcr.pcr2numpy(numpy_result, np.nan))
+        difference = np.abs(numpy_result - pcraster_result) / np.maximum(1.0, np.abs(pcraster_result))
+        msg = "%-16s PCRaster: %.3f s ; numpy: %.3f s (%.1f us per topological level) ; maximum relative difference: %.3e" \
+              %(name, pcraster_time, numpy_time, 1e6 * numpy_time / max(1, network.number_of_levels), np.nanmax(difference))
+        logger.info(msg)
+        summary.append((ldd_map, name, pcraster_time, numpy_time))
+
+    return summary
+
+if __name__ == '__main__':
+    sys.exit(main())
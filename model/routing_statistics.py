@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Rolling (running) statistics of discharge and baseflow (see routing.Routing.calculate_statistics).
+#
+# The statistics are stored in one contiguous matrix (statistic x land cell), so that all running means are updated
+# with one vectorized step of the online (Welford) algorithm (see http://en.wikipedia.org/wiki/Algorithms_for_calculating_variance):
+#   delta = x - mean ; mean = max(0, mean + delta / n) ; m2 = m2 + abs(delta * (x - mean))
+# The matrix is float32 (the same as the PCRaster maps) or float64 (to avoid the drift of float32 running means in long runs).
+#
+# The lake/reservoir statistics (avgInflow and avgOutflow) are updated within the sub time steps by waterBodies.WaterBodies.
+# They are only copied into the matrix, so that the matrix contains all statistics that are saved as one array (see save and load).
+
+import sys
+import time
+import types
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# rows of the matrix: the running means (updated by update), the sum of squares (m2) of discharge and the copied lake/reservoir statistics
+statistic_names = ['avgDischarge', 'avgDischargeShort', 'avgBaseflow', 'm2tDischarge', 'avgInflow', 'avgOutflow']
+number_of_running_means = 3
+
+# statistics that are updated by update (the others are only copied)
+updated_statistic_names = statistic_names[0:4]
+
+
+class RollingStatistics(object):
+
+    def __init__(self, number_of_cells, dtype = np.float32):
+        object.__init__(self)
+
+        self.number_of_cells = number_of_cells
+        self.dtype = np.dtype(dtype)
+
+        self.values = np.zeros((len(statistic_names), self.number_of_cells), dtype = self.dtype)
+        self.row = dict([(name, i_row) for i_row, name in enumerate(statistic_names)])
+
+        # buffers for the input values and the deltas of the running means
+        self.input_values = np.zeros((number_of_running_means, self.number_of_cells), dtype = self.dtype)
+        self.delta        = np.zeros((number_of_running_means, self.number_of_cells), dtype = self.dtype)
+
+        msg = "Rolling statistics: " + str(len(statistic_names)) + " statistics of " + str(self.number_of_cells) + " cells (" + str(self.dtype) + ")."
+        logger.info(msg)
+
+    def get(self, name):
+        """
+        Return the values of a statistic (a view on the row of the matrix).
+        """
+        return self.values[self.row[name]]
+
+    def set(self, name, values):
+        self.values[self.row[name]] = values
+
+    def update(self, discharge, baseflow, number_of_time_steps_long, number_of_time_steps_short):
+        """
+        One step of the online algorithm for all running means (flat arrays of discharge and baseflow, in m3/s).
+        The numbers of time steps are the (limited) numbers of values used for the long and short term averages.
+        """
+
+        means = self.values[0:number_of_running_means]
+
+        self.input_values[0] = discharge
+        self.input_values[1] = discharge
+        self.input_values[2] = baseflow
+
+        number_of_time_steps = np.array([[number_of_time_steps_long], [number_of_time_steps_short], [number_of_time_steps_long]], dtype = self.dtype)
+
+        np.subtract(self.input_values, means, out = self.delta)
+        means += self.delta / number_of_time_steps
+        np.maximum(means, 0.0, out = means)
+
+        # sum of squares of the differences from the (long term) average discharge
+        m2 = self.values[self.row['m2tDischarge']]
+        m2 += np.abs(self.delta[0] * (self.input_values[0] - means[0]))
+
+    def save(self, file_name):
+        """
+        Save the matrix (and the names of the statistics) as one array in a numpy (.npz) file.
+        """
+        np.savez(file_name, values = self.values, statistic_names = np.array(statistic_names))
+
+    def load(self, file_name):
+
+        content = np.load(file_name)
+        names = [str(name) for name in content['statistic_names']]
+        values = content['values']
+        if values.shape[1] != self.number_of_cells:
+            msg = "The number of cells in the file " + str(file_name) + " (" + str(values.shape[1]) + ") does not match the number of land cells (" + str(self.number_of_cells) + ")."
+            raise Exception('Error: ' + msg)
+        for name in statistic_names:
+            if name in names: self.set(name, values[names.index(name)])
+
+
+def synthetic_routing(number_of_rows, number_of_columns, vectorized, dtype = np.float32):
+    """
+    Routing object (routing.Routing, without its initialization) with the attributes used by calculate_statistics,
+    on a clone of number_of_rows x number_of_columns land cells, and its groundwater object (for the baseflow).
+    """
+    import pcraster as pcr
+    import routing
+
+    pcr.setclone(number_of_rows, number_of_columns, 1.0, 0.0, float(number_of_rows))
+    random_state = np.random.RandomState(0)
+    def random_map(scale):
+        return pcr.numpy2pcr(pcr.Scalar, scale * random_state.random_sample((number_of_rows, number_of_columns)), -9999.)
+
+    routing_object = routing.Routing.__new__(routing.Routing)
+    routing_object.landmask = pcr.spatial(pcr.boolean(1.0))
+    routing_object.cellArea = random_map(1e8)
+    routing_object.maxTimestepsToAvgDischargeLong  = 1825.
+    routing_object.maxTimestepsToAvgDischargeShort = 30.
+    routing_object.timestepsToAvgDischarge = pcr.spatial(pcr.scalar(1.0))
+    for var in statistic_names: vars(routing_object)[var] = random_map(100.)
+    routing_object.WaterBodies = types.SimpleNamespace(avgInflow = random_map(100.), avgOutflow = random_map(100.))
+
+    routing_object.vectorizedRollingStatistics = vectorized
+    routing_object.rollingStatisticsPrecision = dtype
+    if vectorized: routing_object.initiate_rolling_statistics(None, iniConditions = {})
+
+    return routing_object, types.SimpleNamespace(baseflow = random_map(0.))
+
+def set_synthetic_daily_values(routing_object, groundwater, day):
+    """
+    Random discharge and baseflow of a day (the same for all routing objects of the same size), and the number of days of the averages.
+    """
+    import pcraster as pcr
+
+    random_state = np.random.RandomState(day)
+    shape = pcr.pcr2numpy(routing_object.landmask, 0).shape
+    routing_object.discharge        = pcr.numpy2pcr(pcr.Scalar, 200. * random_state.random_sample(shape) - 20., -9999.)
+    routing_object.disChanWaterBody = pcr.numpy2pcr(pcr.Scalar, 100. * random_state.random_sample(shape), -9999.)
+    groundwater.baseflow            = pcr.numpy2pcr(pcr.Scalar, 0.001 * random_state.random_sample(shape), -9999.)
+    routing_object.timestepsToAvgDischarge = pcr.spatial(pcr.scalar(float(day)))
+
+def benchmark(number_of_rows, number_of_columns, number_of_days = 30):
+    """
+    Compare the calculation times of the daily statistics of routing.Routing.calculate_statistics (PCRaster maps) with the ones of
+    calculate_rolling_statistics (the matrix, including the conversions of the inputs and of the updated statistics to maps),
+    on a synthetic clone of land cells, and report the maximum differences of the statistics.
+    """
+
+    routing_objects = {}
+    calculation_times = {}
+    for vectorized in [False, True]:
+        routing_object, groundwater = synthetic_routing(number_of_rows, number_of_columns, vectorized)
+        calculation_times[vectorized] = 0.0
+        for day in range(1, number_of_days + 1):
+            set_synthetic_daily_values(routing_object, groundwater, day)
+            start_time = time.time()
+            routing_object.calculate_statistics(groundwater)
+            calculation_times[vectorized] += time.time() - start_time
+        routing_objects[vectorized] = routing_object
+
+    import pcraster as pcr
+    max_difference = max([float(np.max(np.abs(pcr.pcr2numpy(vars(routing_objects[True])[var], np.nan) - pcr.pcr2numpy(vars(routing_objects[False])[var], np.nan)))) \
+                          for var in updated_statistic_names])
+
+    msg = "Rolling statistics of " + str(number_of_rows * number_of_columns) + " cells over " + str(number_of_days) + " days: " + \
+          "PCRaster maps %.4f s, matrix %.4f s per day; maximum absolute difference %e" %(calculation_times[False] / number_of_days, \
+                                                                                       calculation_times[True]  / number_of_days, max_difference)
+    logger.info(msg)
+    return calculation_times, max_difference
+
+
+if __name__ == '__main__':
+    # python routing_statistics.py <rows> <cols> [<days>]
+    logging.basicConfig(level = logging.INFO)
+    number_of_days = 30
+    if len(sys.argv) > 3: number_of_days = int(sys.argv[3])
+    benchmark(int(sys.argv[1]), int(sys.argv[2]), number_of_days)
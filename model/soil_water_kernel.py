@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# NumPy kernel of the soil water calculations of a land cover type (the 'soilWaterKernel = NumPy' option of the landSurfaceOptions).
+#
+# This is an alternative for the PCRaster calculations in LandCover.interceptionUpdate, snowMeltHBVSimple and upperSoilUpdate:
+# - update_interception            : LandCover.updateInterception,
+# - update_snow_cover              : LandCover.updateSnowCover,
+# - get_soil_states                : LandCover.getSoilStates,
+# - update_soil_fluxes_and_states  : LandCover.calculateOpenWaterEvap, calculateDirectRunoff (improvedArnoScheme), calculateInfiltration,
+#                                    estimateTranspirationAndBareSoilEvap, estimateSoilFluxes, scaleAllFluxes (scaleAllFluxesForIrrigatedAreas)
+#                                    and updateSoilStates.
+# The interception capacity and cover fraction (LandCover.interceptionUpdate) are still read with PCRaster and the water demand
+# (LandCover.calculateWaterDemand) is still calculated with PCRaster (between get_soil_states and update_soil_fluxes_and_states).
+#
+# The calculations are done on (float32) vectors of the land cells, following the PCRaster expressions (line by line).
+# The inputs are taken from the land cover object (and from the soil parameters and the groundwater object) and the results are
+# set as maps on the land cover object. For every input, the map and its vector are kept: a map is only converted again if it has
+# been replaced. Therefore, the static parameters and the states calculated by this kernel are converted only once.
+# Missing values are NaN. Divisions by zero give missing values (as in PCRaster).
+#
+# The intermediate values that are not returned (e.g. Pn, WFRAC, ADJUST) are calculated in preallocated scratch vectors (see scratch),
+# using out= and in-place operations; they are allocated once and reused every time step. The results are new vectors, as they are
+# kept as the inputs of the next time step (see get). The grid for converting the results to maps is reused as well.
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def cover(values, default):
+    return np.where(np.isnan(values), default, values)
+
+def divide(numerator, denominator, out = None):
+    # division with missing values for zero denominators (as in PCRaster); the result is written to out (if given)
+    if out is None: out = np.empty(np.broadcast(numerator, denominator).shape, dtype = np.float32)
+    out.fill(np.nan)
+    return np.divide(numerator, denominator, out = out, where = denominator != 0.0)
+
+def getValDivZero(x, y, y_lim = vos.smallNumber, z_def = 0.):
+    # see virtualOS.getValDivZero
+    return np.where(y > y_lim, x / np.maximum(np.float32(y_lim), y), z_def)
+
+
+class SoilWaterKernel(object):
+
+    def __init__(self, landmask, numberOfLayers):
+        object.__init__(self)
+
+        # land cells (flat indices of the clone)
+        landmask = pcr.pcr2numpy(pcr.cover(landmask, pcr.boolean(0)), 0)
+        self.shape = landmask.shape
+        self.cells = np.flatnonzero(landmask)
+
+        self.numberOfLayers = numberOfLayers
+
+        # inputs/results: name -> (map, vector)
+        self.values = {}
+
+        # scratch grid for converting vectors to maps
+        self.grid = np.full(self.shape, vos.MV, dtype = np.float32)
+
+        # scratch vectors for the intermediate values: name -> vector (see scratch)
+        self.scratchVectors = {}
+
+    def scratch(self, name):
+        """
+        Return the preallocated (float32) vector of the land cells for an intermediate value (allocated at the first call).
+        Its values are overwritten by the next calculation; therefore it must not be returned as a result.
+        """
+        if name not in list(self.scratchVectors.keys()): self.scratchVectors[name] = np.empty(self.cells.size, dtype = np.float32)
+        return self.scratchVectors[name]
+
+    def get(self, name, pcr_map):
+        """
+        Return the vector of a map (or a number). The map is only converted if it differs from the map given earlier for this name.
+        """
+        if name in list(self.values.keys()) and self.values[name][0] is pcr_map: return self.values[name][1]
+        values = pcr.pcr2numpy(pcr.spatial(pcr.scalar(pcr_map)), np.nan).ravel()[self.cells]
+        self.values[name] = (pcr_map, values)
+        return values
+
+    def get_attributes(self, obj, names, prefix = ""):
+        return [self.get(prefix + name, vars(obj)[name]) for name in names]
+
+    def set_attributes(self, obj, results):
+        """
+        Set the vectors of a dictionary as maps (attributes) of an object.
+        """
+        for name, values in list(results.items()):
+            self.grid.ravel()[self.cells] = np.where(np.isnan(values), vos.MV, values)
+            pcr_map = pcr.numpy2pcr(pcr.Scalar, self.grid, vos.MV)
+            vars(obj)[name] = pcr_map
+            self.values[name] = (pcr_map, values)
+
+    def get_soil_states(self, landCover):
+        """
+        Derived soil states (see LandCover.getSoilStates).
+        """
+        with np.errstate(all = 'ignore'):
+            if self.numberOfLayers == 2: results = self.get_soil_states_two_layers(landCover, landCover.parameters)
+            if self.numberOfLayers == 3: results = self.get_soil_states_three_layers(landCover, landCover.parameters)
+        self.set_attributes(landCover, results)
+
+        landCover.satAreaFrac = None
+
+    def get_soil_states_two_layers(self, lc, parameters):
+
+        storUpp, storLow, maxRootDepth = self.get_attributes(lc, ['storUpp', 'storLow', 'maxRootDepth'])
+        storCapUpp, storCapLow, airEntryValueUpp, airEntryValueLow, poreSizeBetaUpp, poreSizeBetaLow, \
+        campbellBetaUpp, campbellBetaLow, kSatUpp, kSatLow, kUnsatAtFieldCapUpp, kUnsatAtFieldCapLow, thickUpp, thickLow, \
+        effSatAtWiltPointUpp, effSatAtWiltPointLow, satVolMoistContUpp, satVolMoistContLow, resVolMoistContUpp, resVolMoistContLow = \
+            self.get_attributes(parameters, ['storCapUpp', 'storCapLow', 'airEntryValueUpp', 'airEntryValueLow', 'poreSizeBetaUpp', 'poreSizeBetaLow',
+                                             'campbellBetaUpp', 'campbellBetaLow', 'kSatUpp', 'kSatLow', 'kUnsatAtFieldCapUpp', 'kUnsatAtFieldCapLow', 'thickUpp', 'thickLow',
+                                             'effSatAtWiltPointUpp', 'effSatAtWiltPointLow', 'satVolMoistContUpp', 'satVolMoistContLow', 'resVolMoistContUpp', 'resVolMoistContLow'],
+                                prefix = "parameters.")
+
+        r = {}
+        r['soilWaterStorage'] = np.maximum(0., storUpp + storLow)
+
+        effSatUpp = np.maximum(0., divide(storUpp, storCapUpp))
+        effSatLow = np.maximum(0., divide(storLow, storCapLow))
+        effSatUpp = cover(np.minimum(1., effSatUpp), 1.0)
+        effSatLow = cover(np.minimum(1., effSatLow), 1.0)
+
+        matricSuctionUpp = airEntryValueUpp * (np.maximum(0.01, effSatUpp) ** -poreSizeBetaUpp)
+        matricSuctionLow = airEntryValueLow * (np.maximum(0.01, effSatLow) ** -poreSizeBetaLow)
+
+        kUnsatUpp = np.maximum(0., (effSatUpp ** campbellBetaUpp) * kSatUpp)
+        kUnsatLow = np.maximum(0., (effSatLow ** campbellBetaLow) * kSatLow)
+        kUnsatUpp = np.minimum(kUnsatUpp, kSatUpp)
+        kUnsatLow = np.minimum(kUnsatLow, kSatLow)
+
+        r['kThVertUppLow'] = np.minimum(np.sqrt(kUnsatUpp * kUnsatLow), \
+                                        (kUnsatUpp * kUnsatLow * kUnsatAtFieldCapUpp * kUnsatAtFieldCapLow) ** 0.25)
+
+        gradientUppLow = np.maximum(0.0, divide((matricSuctionUpp - matricSuctionLow) * 2., thickUpp + thickLow) - 1.0)
+        r['gradientUppLow'] = cover(gradientUppLow, 0.0)
+
+        r['readAvlWater'] = (np.maximum(0., effSatUpp - effSatAtWiltPointUpp)) * (satVolMoistContUpp - resVolMoistContUpp) * \
+                             np.minimum(thickUpp, maxRootDepth) + \
+                            (np.maximum(0., effSatLow - effSatAtWiltPointLow)) * (satVolMoistContLow - resVolMoistContLow) * \
+                             np.minimum(thickLow, np.maximum(maxRootDepth - thickUpp, 0.))
+
+        r['effSatUpp'], r['effSatLow'] = effSatUpp, effSatLow
+        r['matricSuctionUpp'], r['matricSuctionLow'] = matricSuctionUpp, matricSuctionLow
+        r['kUnsatUpp'], r['kUnsatLow'] = kUnsatUpp, kUnsatLow
+        return r
+
+    def get_soil_states_three_layers(self, lc, parameters):
+
+        layers = ['Upp000005', 'Upp005030', 'Low030150']
+
+        stor = self.get_attributes(lc, ['stor' + layer for layer in layers])
+        maxRootDepth = self.get('maxRootDepth', lc.maxRootDepth)
+        p = {}
+        for var in ['storCap', 'airEntryValue', 'poreSizeBeta', 'campbellBeta', 'kSat', 'kUnsatAtFieldCap', 'thick',
+                    'effSatAtWiltPoint', 'satVolMoistCont', 'resVolMoistCont']:
+            p[var] = self.get_attributes(parameters, [var + layer for layer in layers], prefix = "parameters.")
+
+        r = {}
+        r['soilWaterStorage'] = np.maximum(0., stor[0] + stor[1] + stor[2])
+
+        effSat = [np.minimum(1., np.maximum(0., divide(stor[i], p['storCap'][i]))) for i in range(3)]
+        matricSuction = [p['airEntryValue'][i] * (np.maximum(0.01, effSat[i]) ** -p['poreSizeBeta'][i]) for i in range(3)]
+        kUnsat = [np.minimum(np.maximum(0., (effSat[i] ** p['campbellBeta'][i]) * p['kSat'][i]), p['kSat'][i]) for i in range(3)]
+
+        r['kThVertUpp000005Upp005030'] = np.minimum(np.sqrt(kUnsat[0] * kUnsat[1]), \
+                                                    (kUnsat[0] * kUnsat[1] * p['kUnsatAtFieldCap'][0] * p['kUnsatAtFieldCap'][1]) ** 0.25)
+        r['kThVertUpp005030Low030150'] = np.minimum(np.sqrt(kUnsat[1] * kUnsat[2]), \
+                                                    (kUnsat[1] * kUnsat[2] * p['kUnsatAtFieldCap'][1] * p['kUnsatAtFieldCap'][2]) ** 0.25)
+
+        r['gradientUpp000005Upp005030'] = np.maximum(0., divide(2. * (matricSuction[0] - matricSuction[1]), p['thick'][0] + p['thick'][1]) - 1.)
+        r['gradientUpp005030Low030150'] = np.maximum(0., divide(2. * (matricSuction[1] - matricSuction[2]), p['thick'][1] + p['thick'][2]) - 1.)
+
+        # - as in LandCover.getSoilStates (note that the root depth in the second layer is not limited to zero)
+        r['readAvlWater'] = (np.maximum(0., effSat[0] - p['effSatAtWiltPoint'][0])) * (p['satVolMoistCont'][0] - p['resVolMoistCont'][0]) * \
+                             np.minimum(p['thick'][0], maxRootDepth) + \
+                            (np.maximum(0., effSat[1] - p['effSatAtWiltPoint'][1])) * (p['satVolMoistCont'][1] - p['resVolMoistCont'][1]) * \
+                             np.minimum(p['thick'][1], maxRootDepth - p['thick'][0]) + \
+                            (np.maximum(0., effSat[2] - p['effSatAtWiltPoint'][2])) * (p['satVolMoistCont'][2] - p['resVolMoistCont'][2]) * \
+                             np.minimum(p['thick'][2], np.maximum(maxRootDepth - p['thick'][1], 0.))
+
+        for i, layer in enumerate(layers):
+            r['effSat'        + layer] = effSat[i]
+            r['matricSuction' + layer] = matricSuction[i]
+            r['kUnsat'        + layer] = kUnsat[i]
+        return r
+
+    def update_interception(self, landCover, meteo):
+        """
+        Throughfall, snowfall, liquid precipitation and interception evaporation (see LandCover.updateInterception).
+        """
+        lc = landCover
+        with np.errstate(all = 'ignore'):
+
+            r = {}
+
+            precipitation = self.get('meteo.precipitation', meteo.precipitation)
+            temperature   = self.get('meteo.temperature'  , meteo.temperature)
+            interceptStor, interceptCap, coverFraction, potBareSoilEvap, potTranspiration, freezingT = \
+                self.get_attributes(lc, ['interceptStor', 'interceptCap', 'coverFraction', 'potBareSoilEvap', 'potTranspiration', 'freezingT'])
+
+            # throughfall and interception storage
+            if lc.interceptionModuleType == "Modified":
+                throughfall = np.maximum(0.0, interceptStor + precipitation - interceptCap)
+            if lc.interceptionModuleType == "Original":
+                throughfall = (1.0 - coverFraction) * precipitation + np.maximum(0.0, coverFraction * precipitation + interceptStor - interceptCap)
+            interceptStor = np.maximum(0.0, interceptStor + precipitation - throughfall)
+
+            # snowfall and liquid precipitation (missing values for a missing temperature, as pcr.ifthenelse)
+            estimSnowfall = np.where(np.isnan(temperature - freezingT), np.nan, np.where(temperature < freezingT, precipitation, 0.0))
+            snowfall = estimSnowfall * getValDivZero(throughfall, precipitation, vos.smallNumber)
+            liquidPrecip = np.maximum(0.0, throughfall - snowfall)
+
+            # interception evaporation
+            if lc.interceptionModuleType == 'Original': potInterceptionFlux = potTranspiration
+            if lc.interceptionModuleType == 'Modified': potInterceptionFlux = self.get('totalPotET', lc.totalPotET)
+            interceptEvap = np.minimum(interceptStor, potInterceptionFlux * (getValDivZero(interceptStor, interceptCap, vos.smallNumber, 0.) ** (2.00/3.00)))
+            interceptStor = np.maximum(0.0, interceptStor - interceptEvap)
+
+            # potBareSoilEvap and potTranspiration after interceptEvap
+            if lc.interceptionModuleType == 'Modified':
+                fracPotBareSoilEvap = np.maximum(0.0, np.minimum(1.0, getValDivZero(potBareSoilEvap, potBareSoilEvap + potTranspiration, vos.smallNumber)))
+                # - as in LandCover.updateInterception, the attribute fracPotBareSoilEvap is used for the transpiration fraction
+                fracPotTranspiration = 1.0 - self.get('fracPotBareSoilEvap', lc.fracPotBareSoilEvap)
+                r['potBareSoilEvap'] = np.maximum(0.0, potBareSoilEvap - fracPotBareSoilEvap * interceptEvap)
+                potTranspiration = np.maximum(0.0, potTranspiration - fracPotTranspiration * interceptEvap)
+            if lc.interceptionModuleType == 'Original':
+                potTranspiration = np.maximum(0.0, potTranspiration - interceptEvap)
+
+            r['throughfall'], r['interceptStor'], r['snowfall'], r['liquidPrecip'] = throughfall, interceptStor, snowfall, liquidPrecip
+            r['potInterceptionFlux'], r['interceptEvap'], r['potTranspiration'] = potInterceptionFlux, interceptEvap, potTranspiration
+            r['actualET'] = 0. + interceptEvap
+
+        self.set_attributes(lc, r)
+
+    def update_snow_cover(self, landCover, meteo):
+        """
+        Snow cover, snow melt, net liquid water to soil and evaporation from snowFreeWater (see LandCover.updateSnowCover).
+        """
+        lc = landCover
+        with np.errstate(all = 'ignore'):
+
+            r = {}
+
+            temperature = self.get('meteo.temperature', meteo.temperature)
+            snowCoverSWE, snowFreeWater, snowfall, liquidPrecip, potBareSoilEvap, actualET, \
+            freezingT, degreeDayFactor, snowWaterHoldingCap, refreezingCoeff = \
+                self.get_attributes(lc, ['snowCoverSWE', 'snowFreeWater', 'snowfall', 'liquidPrecip', 'potBareSoilEvap', 'actualET',
+                                         'freezingT', 'degreeDayFactor', 'snowWaterHoldingCap', 'refreezingCoeff'])
+
+            # changes in snow cover: - melt ; + gain in snow or refreezing (missing values for a missing temperature, as pcr.ifthenelse)
+            deltaSnowCover = np.where(temperature <= freezingT, refreezingCoeff * snowFreeWater, \
+                                      -np.minimum(snowCoverSWE, np.maximum(temperature - freezingT, 0.0) * degreeDayFactor)*1.0*1.0)
+            deltaSnowCover[np.isnan(temperature - freezingT)] = np.nan
+            snowCoverSWE = np.maximum(0.0, snowfall + deltaSnowCover + snowCoverSWE)
+            snowMelt = np.where(deltaSnowCover < 0.0, deltaSnowCover * -1.0, 0.0)
+            snowMelt[np.isnan(deltaSnowCover)] = np.nan
+
+            # snowFreeWater, netLqWaterToSoil and evaporation from snowFreeWater
+            snowFreeWater = snowFreeWater - deltaSnowCover + liquidPrecip
+            netLqWaterToSoil = np.maximum(0., snowFreeWater - snowWaterHoldingCap * snowCoverSWE)
+            snowFreeWater = np.maximum(0., snowFreeWater - netLqWaterToSoil)
+            actSnowFreeWaterEvap = np.minimum(snowFreeWater, potBareSoilEvap)
+            snowFreeWater = np.maximum(0.0, snowFreeWater - actSnowFreeWaterEvap)
+
+            r['deltaSnowCover'], r['snowCoverSWE'], r['snowMelt'], r['snowFreeWater'] = deltaSnowCover, snowCoverSWE, snowMelt, snowFreeWater
+            r['netLqWaterToSoil'], r['actSnowFreeWaterEvap'] = netLqWaterToSoil, actSnowFreeWaterEvap
+            r['potBareSoilEvap'] = np.maximum(0, potBareSoilEvap - actSnowFreeWaterEvap)
+            r['actualET'] = actualET + actSnowFreeWaterEvap
+
+        self.set_attributes(lc, r)
+
+    def update_soil_fluxes_and_states(self, landCover, capRiseFrac, groundwater):
+        """
+        Soil fluxes and states, after the water demand calculation (see LandCover.upperSoilUpdate).
+        """
+        lc = landCover
+        isPaddy = lc.name == 'irrPaddy' or lc.name == "irr_paddy"
+        isIrrigated = lc.name.startswith('irr') and lc.includeIrrigation
+
+        with np.errstate(all = 'ignore'):
+
+            r = {}
+
+            # inputs that are the same for two and three layers
+            topWaterLayer, netLqWaterToSoil, irrGrossDemand, potBareSoilEvap, potTranspiration, soilWaterStorage, minTopWaterLayer, \
+            arnoBeta, rootZoneWaterStorageMin, rootZoneWaterStorageRange, effSatAt50, effPoreSizeBetaAt50, interflow, reducedCapRise, actualET = \
+                self.get_attributes(lc, ['topWaterLayer', 'netLqWaterToSoil', 'irrGrossDemand', 'potBareSoilEvap', 'potTranspiration', 'soilWaterStorage', 'minTopWaterLayer',
+                                         'arnoBeta', 'rootZoneWaterStorageMin', 'rootZoneWaterStorageRange', 'effSatAt50', 'effPoreSizeBetaAt50', 'interflow', 'reducedCapRise', 'actualET'])
+            rootZoneWaterStorageCap = self.get('parameters.rootZoneWaterStorageCap', lc.parameters.rootZoneWaterStorageCap)
+            percolationImp          = self.get('parameters.percolationImp'         , lc.parameters.percolationImp)
+            interflowConcTime       = self.get('parameters.interflowConcTime'      , lc.parameters.interflowConcTime)
+            capRiseFrac             = self.get('capRiseFrac', capRiseFrac)
+            productiveAquifer       = self.get('groundwater.productive_aquifer', groundwater.productive_aquifer)
+            storGroundwater         = self.get('groundwater.storGroundwater', groundwater.storGroundwater)
+
+            if self.numberOfLayers == 2:
+                layers = ['Upp', 'Low']
+                stor          = self.get_attributes(lc, ['storUpp', 'storLow'])
+                adjRootFr     = self.get_attributes(lc, ['adjRootFrUpp', 'adjRootFrLow'])
+                effSat        = self.get_attributes(lc, ['effSatUpp', 'effSatLow'])
+                kUnsat        = self.get_attributes(lc, ['kUnsatUpp', 'kUnsatLow'])
+                kThVert       = self.get_attributes(lc, ['kThVertUppLow'])
+                gradient      = self.get_attributes(lc, ['gradientUppLow'])
+            if self.numberOfLayers == 3:
+                layers = ['Upp000005', 'Upp005030', 'Low030150']
+                stor          = self.get_attributes(lc, ['stor'      + layer for layer in layers])
+                adjRootFr     = self.get_attributes(lc, ['adjRootFr' + layer for layer in layers])
+                effSat        = self.get_attributes(lc, ['effSat'    + layer for layer in layers])
+                kUnsat        = self.get_attributes(lc, ['kUnsat'    + layer for layer in layers])
+                kThVert       = self.get_attributes(lc, ['kThVertUpp000005Upp005030', 'kThVertUpp005030Low030150'])
+                gradient      = self.get_attributes(lc, ['gradientUpp000005Upp005030', 'gradientUpp005030Low030150'])
+            storCap           = self.get_attributes(lc.parameters, ['storCap'          + layer for layer in layers], prefix = "parameters.")
+            kSat              = self.get_attributes(lc.parameters, ['kSat'             + layer for layer in layers], prefix = "parameters.")
+            kUnsatAtFieldCap  = self.get_attributes(lc.parameters, ['kUnsatAtFieldCap' + layer for layer in layers], prefix = "parameters.")
+            effSatAtFieldCap  = self.get_attributes(lc.parameters, ['effSatAtFieldCap' + layer for layer in layers], prefix = "parameters.")
+
+            # open water evaporation (LandCover.calculateOpenWaterEvap)
+            topWaterLayer = topWaterLayer + np.maximum(0., netLqWaterToSoil + irrGrossDemand)
+            remainingPotETP = np.add(potBareSoilEvap, potTranspiration, out = self.scratch('remainingPotETP'))
+            openWaterEvap = np.zeros_like(topWaterLayer)
+            if isPaddy: openWaterEvap = np.minimum(np.maximum(0., topWaterLayer), remainingPotETP)
+            potBareSoilEvap  = cover(np.maximum(0.0, potBareSoilEvap  - getValDivZero(potBareSoilEvap , remainingPotETP) * openWaterEvap), 0.0)
+            potTranspiration = cover(np.maximum(0.0, potTranspiration - getValDivZero(potTranspiration, remainingPotETP) * openWaterEvap), 0.0)
+            topWaterLayer = np.maximum(0., topWaterLayer - openWaterEvap)
+
+            # direct runoff (LandCover.calculateDirectRunoff and improvedArnoScheme)
+            Pn = np.add(soilWaterStorage, topWaterLayer, out = self.scratch('Pn'))
+            Pn -= np.maximum(rootZoneWaterStorageMin, soilWaterStorage, out = self.scratch('tmp'))
+            soilWaterStorage = np.where(Pn < 0., rootZoneWaterStorageMin + Pn, np.maximum(soilWaterStorage, rootZoneWaterStorageMin))
+            np.maximum(0., Pn, out = Pn)
+            DW = np.subtract(rootZoneWaterStorageCap, soilWaterStorage, out = self.scratch('DW'))
+            np.maximum(0.0, DW, out = DW)
+            WFRAC = np.minimum(1.0, divide(DW, rootZoneWaterStorageRange, out = self.scratch('WFRAC')), out = self.scratch('WFRAC'))
+            np.copyto(WFRAC, 1.0, where = (rootZoneWaterStorageRange > 0.0) == False)
+            WFRACB = WFRAC ** divide(np.float32(1.), 1. + arnoBeta)
+            satAreaFrac = np.where(WFRACB > 0., 1. - WFRACB ** arnoBeta, 1.)
+            satAreaFrac = np.maximum(np.minimum(satAreaFrac, 1.0), 0.0)
+
+            directRunoffReduction = np.zeros_like(Pn)
+            if lc.improvedArnoSchemeMethod == "Default" or lc.improvedArnoSchemeMethod == "Modified":
+                directRunoffReduction = np.minimum(kUnsat[-1], np.sqrt(kUnsat[-1] * kUnsatAtFieldCap[-1]))
+            if lc.improvedArnoSchemeMethod == "Modified":
+                saturation_treshold = 0.999
+                directRunoffReduction = np.where(getValDivZero(soilWaterStorage, rootZoneWaterStorageCap) > saturation_treshold, directRunoffReduction, 0.0)
+
+            condition = np.add(arnoBeta, 1., out = self.scratch('condition'))
+            condition *= rootZoneWaterStorageRange
+            condition *= WFRACB
+            directRunoff = np.maximum(0.0, Pn - (rootZoneWaterStorageCap + directRunoffReduction - soilWaterStorage) + \
+                           np.where(Pn >= condition, 0.0, \
+                                    rootZoneWaterStorageRange * (WFRACB - divide(Pn, (arnoBeta + 1.) * rootZoneWaterStorageRange)) ** (arnoBeta + 1.)))
+            directRunoff = cover(directRunoff, 0.0)
+
+            directRunoff = np.minimum(topWaterLayer, directRunoff)
+            if isIrrigated: directRunoff = np.zeros_like(directRunoff)
+            topWaterLayer = np.maximum(0., topWaterLayer - directRunoff)
+
+            # infiltration (LandCover.calculateInfiltration)
+            infiltration = np.minimum(topWaterLayer, kSat[0])
+            if isPaddy and lc.includeIrrigation:
+                irrigationEfficiencyUsed = self.get('irrigationEfficiencyUsed', lc.irrigationEfficiencyUsed)
+                designPercolationLoss    = self.get('design_percolation_loss' , lc.design_percolation_loss)
+                infiltration_loss = np.maximum(designPercolationLoss, ((1. / irrigationEfficiencyUsed) - 1.) * topWaterLayer)
+                infiltration = np.minimum(infiltration_loss, infiltration)
+            topWaterLayer = np.maximum(0.0, topWaterLayer - infiltration)
+            directRunoff = directRunoff + np.maximum(0.0, topWaterLayer - minTopWaterLayer)
+            topWaterLayer = np.minimum(topWaterLayer, minTopWaterLayer)
+
+            # transpiration and bare soil evaporation (LandCover.estimateTranspirationAndBareSoilEvap)
+            weightedStor = np.multiply(adjRootFr[0], stor[0], out = self.scratch('weightedStor'))
+            for i in range(1, len(layers)): weightedStor += np.multiply(adjRootFr[i], stor[i], out = self.scratch('tmp'))
+            dividerTranspFracs = np.maximum(1e-9, weightedStor, out = self.scratch('dividerTranspFracs'))
+            totalStor = self.scratch('totalStor')
+            np.copyto(totalStor, stor[0])
+            for i in range(1, len(layers)): totalStor += stor[i]
+            transpFrac = [np.where(totalStor > 0., adjRootFr[i] * stor[i] / dividerTranspFracs, adjRootFr[i]) for i in range(len(layers))]
+
+            relActTranspiration = divide(rootZoneWaterStorageCap + arnoBeta * rootZoneWaterStorageRange * (1. - divide(1. + arnoBeta, arnoBeta) * WFRACB), \
+                                         rootZoneWaterStorageCap + arnoBeta * rootZoneWaterStorageRange * (1. - WFRACB))
+            relActTranspiration = divide(1. - satAreaFrac, \
+                                         1. + divide(np.maximum(0.01, relActTranspiration), effSatAt50) ** (effPoreSizeBetaAt50 * -3.0), out = self.scratch('relActTranspiration'))
+            np.minimum(1.0, np.maximum(0.0, relActTranspiration, out = relActTranspiration), out = relActTranspiration)
+            if isIrrigated: relActTranspiration = np.ones_like(relActTranspiration)
+
+            if self.numberOfLayers == 2:
+                potTranspirationUpp = np.minimum(transpFrac[0] * potTranspiration, potTranspiration)
+                potTranspirationLow = np.maximum(0.0, potTranspiration - potTranspirationUpp)
+                potTranspirationLayers = [potTranspirationUpp, potTranspirationLow]
+            if self.numberOfLayers == 3:
+                potTranspirationUpp000005 = np.minimum(transpFrac[0] * potTranspiration, potTranspiration)
+                potTranspirationUpp005030 = np.minimum(transpFrac[1] * potTranspiration, np.maximum(0.0, potTranspiration - potTranspirationUpp000005))
+                potTranspirationLow030150 = np.maximum(0.0, potTranspiration - potTranspirationUpp000005 - potTranspirationUpp005030)
+                potTranspirationLayers = [potTranspirationUpp000005, potTranspirationUpp005030, potTranspirationLow030150]
+            actTranspi = [cover(relActTranspiration * potTranspirationLayers[i], 0.0) for i in range(len(layers))]
+
+            actBareSoilEvap = satAreaFrac * np.minimum(potBareSoilEvap, kSat[0]) + \
+                              (1. - satAreaFrac) * np.minimum(potBareSoilEvap, kUnsat[0])
+            actBareSoilEvap = cover(np.minimum(np.maximum(0.0, actBareSoilEvap), potBareSoilEvap), 0.0)
+            if isPaddy:
+                treshold = potBareSoilEvap + potTranspiration
+                actBareSoilEvap = np.where(topWaterLayer > treshold, 0.0, actBareSoilEvap)
+
+            # percolation, capillary rise and interflow (LandCover.estimateSoilFluxes)
+            perc = []
+            inflow = infiltration
+            for i in range(len(layers) - 1):
+                percolation = kThVert[i] * 1.
+                percolation = np.where(effSat[i] > effSatAtFieldCap[i], \
+                                       np.minimum(np.maximum(0., effSat[i] - effSatAtFieldCap[i]) * storCap[i], percolation), percolation) + \
+                              np.maximum(0., inflow - (storCap[i] - stor[i]))
+                perc.append(percolation)
+                inflow = percolation
+            perc.append(np.minimum(kUnsat[-1], np.sqrt(kUnsat[-1] * kUnsatAtFieldCap[-1])))
+            if self.numberOfLayers == 3:
+                perc[-1] = np.minimum(kUnsat[-1], np.sqrt(kUnsatAtFieldCap[-1] * kUnsat[-1]))
+
+            capRise = [np.minimum(np.maximum(0., effSatAtFieldCap[i] - effSat[i]) * storCap[i], kThVert[i] * gradient[i]) for i in range(len(layers) - 1)]
+            capRiseLow = 0.5 * (satAreaFrac + capRiseFrac) * \
+                         np.minimum((1. - effSat[-1]) * np.sqrt(kSat[-1] * kUnsat[-1]), \
+                                    np.maximum(0.0, effSatAtFieldCap[-1] - effSat[-1]) * storCap[-1])
+            capRiseLow = np.where(np.isnan(productiveAquifer), np.nan, np.where(productiveAquifer > 0., capRiseLow, 0.0))
+            capRise.append(capRiseLow)
+
+            percToInterflow = np.add(perc[-2], capRise[-1], out = self.scratch('percToInterflow'))
+            percToInterflow -= np.add(perc[-1], capRise[-2], out = self.scratch('tmp'))
+            np.multiply(percolationImp, percToInterflow, out = percToInterflow)
+            interflow = np.maximum(interflowConcTime * percToInterflow + (1. - interflowConcTime) * interflow, 0.0)
+
+            # scaling all fluxes to the available water (LandCover.scaleAllFluxesForIrrigatedAreas and scaleAllFluxes)
+            if isIrrigated:
+                interflow = np.zeros_like(interflow)
+                startingKC = 0.20
+                cropKC = self.get('cropKC', lc.cropKC)
+                irrigationEfficiencyUsed = self.get('irrigationEfficiencyUsed', lc.irrigationEfficiencyUsed)
+                deep_percolation_loss = np.maximum(perc[-1], np.maximum(0.0, stor[-1]) * ((1. / irrigationEfficiencyUsed) - 1.))
+                perc[-1] = np.where(cropKC > startingKC, deep_percolation_loss, perc[-1])
+
+            ADJUST = self.adjust_factor(stor[0] + infiltration, [actBareSoilEvap, actTranspi[0], perc[0]])
+            if self.numberOfLayers == 2: np.copyto(ADJUST, 0.0, where = np.isnan(ADJUST))
+            actBareSoilEvap = ADJUST * actBareSoilEvap
+            perc[0]         = ADJUST * perc[0]
+            actTranspi[0]   = ADJUST * actTranspi[0]
+
+            if self.numberOfLayers == 3:
+                ADJUST = self.adjust_factor(stor[1] + perc[0], [actTranspi[1], perc[1]])
+                perc[1]       = ADJUST * perc[1]
+                actTranspi[1] = ADJUST * actTranspi[1]
+
+            ADJUST = self.adjust_factor(stor[-1] + perc[-2], [actTranspi[-1], perc[-1], interflow])
+            if self.numberOfLayers == 2: np.copyto(ADJUST, 0.0, where = np.isnan(ADJUST))
+            perc[-1]       = ADJUST * perc[-1]
+            actTranspi[-1] = ADJUST * actTranspi[-1]
+            interflow      = ADJUST * interflow
+
+            capRise[-1] = np.maximum(0., np.minimum(np.maximum(0., storGroundwater - reducedCapRise), capRise[-1]))
+            estimateStorBeforeCapRise = self.storage_minus_fluxes(stor[-1] + perc[-2], [actTranspi[-1], perc[-1], interflow])
+            capRise[-2] = np.minimum(estimateStorBeforeCapRise, capRise[-2])
+            if self.numberOfLayers == 3:
+                estimateStorBeforeCapRise = self.storage_minus_fluxes(stor[1] + perc[0], [actTranspi[1], perc[1]])
+                capRise[0] = np.minimum(estimateStorBeforeCapRise, capRise[0])
+
+            # soil states (LandCover.updateSoilStates)
+            stor = list(stor)
+            if self.numberOfLayers == 2:
+                stor[1] = np.maximum(0., stor[1] + perc[0] + capRise[1] - (perc[1] + interflow + actTranspi[1] + capRise[0]))
+                percUpp = perc[0]
+                if lc.allowNegativePercolation:
+                    perc[0] = percUpp - np.maximum(0., stor[1] - storCap[1])
+                else:
+                    stor[1], perc[0], capRise[1], interflow = self.limit_storage(stor[1], storCap[1], perc[0], capRise[1], interflow)
+                    stor[1] = np.minimum(stor[1], storCap[1])
+            if self.numberOfLayers == 3:
+                stor[2] = np.maximum(0., stor[2] + perc[1] + capRise[2] - (perc[2] + interflow + actTranspi[2] + capRise[1]))
+                stor[2], perc[1], capRise[2], interflow = self.limit_storage(stor[2], storCap[2], perc[1], capRise[2], interflow)
+                stor[2] = np.minimum(stor[2], storCap[2])
+
+                stor[1] = np.maximum(0., stor[1] + perc[0] + capRise[1] - (perc[1] + actTranspi[1] + capRise[0]))
+                stor[1], perc[0], capRise[1], interflowUpp005030 = self.limit_storage(stor[1], storCap[1], perc[0], capRise[1], None)
+                r['interflowUpp005030'] = interflowUpp005030
+
+            stor[0] = np.maximum(0., stor[0] + infiltration + capRise[0] - (perc[0] + actTranspi[0] + actBareSoilEvap))
+            satExcess = np.maximum(0., stor[0] - storCap[0])
+            topWaterLayer = topWaterLayer + satExcess
+            directRunoff = directRunoff + np.maximum(0., topWaterLayer - minTopWaterLayer)
+            topWaterLayer = np.minimum(topWaterLayer, minTopWaterLayer)
+            for i in range(len(layers)): stor[i] = np.minimum(stor[i], storCap[i])
+
+            evaporation = actBareSoilEvap + openWaterEvap
+            for i in range(len(layers)): evaporation = evaporation + actTranspi[i]
+            r['actualET'] = actualET + evaporation
+
+            for i, layer in enumerate(layers):
+                r['stor'       + layer] = stor[i]
+                r['actTranspi' + layer] = actTranspi[i]
+                r['perc'       + layer] = perc[i]
+                r['capRise'    + layer] = capRise[i]
+
+            if self.numberOfLayers == 2:
+                r['actTranspiTotal']    = actTranspi[0] + actTranspi[1]
+                r['netPercUpp']         = perc[0] - capRise[0]
+                r['gwRecharge']         = perc[1] - capRise[1]
+                r['storUppTotal']       = stor[0]
+                r['storLowTotal']       = stor[1]
+                r['actTranspiUppTotal'] = actTranspi[0]
+                r['actTranspiLowTotal'] = actTranspi[1]
+                r['interflowTotal']     = interflow
+            if self.numberOfLayers == 3:
+                r['actTranspiUppTotal'] = actTranspi[0] + actTranspi[1]
+                r['actTranspiTotal']    = r['actTranspiUppTotal'] + actTranspi[2]
+                r['netPercUpp000005']   = perc[0] - capRise[0]
+                r['netPercUpp005030']   = perc[1] - capRise[1]
+                r['gwRecharge']         = perc[2] - capRise[2]
+                r['storUppTotal']       = stor[0] + stor[1]
+                r['storLowTotal']       = stor[2]
+                r['actTranspiLowTotal'] = actTranspi[2]
+                r['interflowTotal']     = interflow + r['interflowUpp005030']
+
+            r['landSurfaceRunoff'] = directRunoff + r['interflowTotal']
+
+            r['topWaterLayer']    = topWaterLayer
+            r['openWaterEvap']    = openWaterEvap
+            r['potBareSoilEvap']  = potBareSoilEvap
+            r['potTranspiration'] = potTranspiration
+            r['WFRACB']           = WFRACB
+            r['satAreaFrac']      = satAreaFrac
+            r['directRunoff']     = directRunoff
+            r['infiltration']     = infiltration
+            r['actBareSoilEvap']  = actBareSoilEvap
+            r['interflow']        = interflow
+            r['satExcess']        = satExcess
+
+        lc.satAreaFracOld = lc.satAreaFrac
+        self.set_attributes(lc, r)
+
+    def adjust_factor(self, available, fluxes):
+        """
+        The factor (at most one) to scale the fluxes to the available storage (see LandCover.scaleAllFluxes), in a scratch vector:
+        ADJUST = sum(fluxes); ADJUST = ifthenelse(ADJUST > 0.0, min(1.0, max(0.0, available) / ADJUST), 0.0).
+        """
+        total = self.scratch('ADJUST.total')
+        np.copyto(total, fluxes[0])
+        for flux in fluxes[1:]: total += flux
+        ADJUST = divide(np.maximum(0.0, available, out = available), total, out = self.scratch('ADJUST'))
+        np.minimum(1.0, ADJUST, out = ADJUST)
+        np.copyto(ADJUST, 0.0, where = (total > 0.0) == False)
+        return ADJUST
+
+    def storage_minus_fluxes(self, storage, fluxes):
+        """
+        The storage minus the (sum of the) fluxes, at least zero (see LandCover.scaleAllFluxes), in a scratch vector.
+        """
+        total = self.scratch('estimateStorBeforeCapRise.total')
+        np.copyto(total, fluxes[0])
+        for flux in fluxes[1:]: total += flux
+        return np.maximum(0, np.subtract(storage, total, out = storage), out = self.scratch('estimateStorBeforeCapRise'))
+
+    def limit_storage(self, stor, storCap, perc, capRise, interflow):
+        """
+        Reduce the percolation and capillary rise inputs of a storage that exceeds its capacity and release the remaining
+        excess as (additional) interflow (see LandCover.updateSoilStates). If interflow is None, the excess is returned as interflow.
+        """
+        percReduced = np.maximum(0., perc - np.maximum(0., stor - storCap))
+        stor = stor - perc + percReduced
+        capRiseReduced = np.maximum(0., capRise - np.maximum(0., stor - storCap))
+        stor = stor - capRise + capRiseReduced
+        addInterflow = np.maximum(0., stor - storCap)
+        if interflow is None:
+            interflow = addInterflow
+        else:
+            interflow = interflow + addInterflow
+        stor = stor - addInterflow
+        return stor, percReduced, capRiseReduced, interflow
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Prepared input store of the static input maps (the 'staticInputStore' option of the globalOptions).
+#
+# During the initialization of a model, hundreds of static maps are read with virtualOS.readPCRmapClone and 
+# virtualOS.netcdf2PCRobjCloneWithoutTime (each with opening a file and cropping/resampling it to the clone). 
+# With this module, the maps of these calls are resolved once for an ini file and a clone and written into one raw array file
+# (all maps after each other) with an index (json file: the call, the position and type of the map, and the size and 
+# modification time of the source file). At the start of a run, the array file is memory-mapped and the maps are given 
+# from it (with numpy2pcr) if the source file has not changed since the preparation. Other calls read their files as usual.
+#
+# Preparing the store (with the same arguments as deterministic_runner_with_arguments.py):
+#   python static_input_store.py <ini_file> [parallel <clone_number>] [-mod ...]
+
+import os
+import sys
+import json
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# version of the store files; to be increased if the format changes
+store_version = 1
+
+# missing values of the numpy arrays (per value scale) in the store
+missing_values = {'Boolean': 255, 'Ldd': 255, 'Nominal': -2147483648, 'Ordinal': -2147483648, 'Scalar': vos.MV, 'Directional': vos.MV}
+
+
+def get_store_file_name(configuration):
+    """
+    Return the name of the (array) file of the store of a clone (the index is in the same file name with '.json').
+    """
+    storeDir  = vos.getFullPath(configuration.globalOptions['staticInputStore'], configuration.globalOptions['outputDir'], False)
+    cloneName = os.path.splitext(os.path.basename(configuration.cloneMap))[0]
+    return os.path.join(storeDir, "static_inputs_" + cloneName + ".dat")
+
+
+def open_store(configuration):
+    """
+    Open the store of the clone (if it is prepared) as virtualOS.staticinputstore.
+    """
+    fileName = get_store_file_name(configuration)
+    if vos.staticinputstore is not None and vos.staticinputstore.fileName == fileName: return
+    if os.path.exists(fileName) and os.path.exists(fileName + ".json"):
+        vos.staticinputstore = StaticInputStore(fileName)
+    else:
+        vos.staticinputstore = None
+        msg = "The static input store " + str(fileName) + " is not prepared (see static_input_store.py). The static input files are read."
+        logger.warning(msg)
+
+
+class StaticInputStore(object):
+
+    def __init__(self, fileName, recording = False):
+        object.__init__(self)
+
+        self.fileName  = fileName
+        self.recording = recording
+
+        if self.recording:
+            # maps (numpy arrays) and index entries recorded during the initialization of a model
+            self.maps  = []
+            self.index = {}
+            self.depth = 0
+        else:
+            with open(self.fileName + ".json") as f: store_index = json.load(f)
+            if store_index['version'] != store_version:
+                msg = "The static input store " + str(self.fileName) + " has version " + str(store_index['version']) + " (instead of " + str(store_version) + "). It is not used."
+                logger.warning(msg)
+                store_index['entries'] = {}
+            self.index = store_index['entries']
+            self.data  = np.memmap(self.fileName, dtype = np.uint8, mode = 'r')
+            msg = "Using the static input store " + str(self.fileName) + " (" + str(len(self.index)) + " maps)."
+            logger.info(msg)
+
+    def read(self, key, sourceFileName, read_function):
+        """
+        Return the map of a call (key) from the store, or read it with the read_function (and record it while preparing the store).
+        """
+
+        if self.recording:
+            # - calls within another call (e.g. netcdf2PCRobjCloneWithoutTime within readPCRmapClone) are not recorded
+            self.depth += 1
+            try:
+                pcr_map = read_function()
+            finally:
+                self.depth -= 1
+            if self.depth == 0 and pcr_map is not None and repr(key) not in list(self.index.keys()): self.record(key, sourceFileName, pcr_map)
+            return pcr_map
+
+        entry = self.index.get(repr(key))
+        if entry is not None and self.is_valid(entry, sourceFileName):
+            logger.debug('read file/value from the static input store: '+str(sourceFileName))
+            values = np.frombuffer(self.data, dtype = entry['dtype'], count = entry['count'], offset = entry['offset']).reshape(entry['shape'])
+            return pcr.numpy2pcr(getattr(pcr, entry['valuescale']), values, missing_values[entry['valuescale']])
+        return read_function()
+
+    def is_valid(self, entry, sourceFileName):
+        # the source file has not changed since the preparation of the store
+        try:
+            stat = os.stat(sourceFileName)
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+    def record(self, key, sourceFileName, pcr_map):
+
+        try:
+            stat = os.stat(sourceFileName)
+        except OSError:
+            return
+
+        valuescale = [name for name in list(missing_values.keys()) if pcr_map.dataType() == getattr(pcr, name)][0]
+        values = np.ascontiguousarray(pcr.pcr2numpy(pcr_map, missing_values[valuescale]))
+        self.maps.append(values)
+        self.index[repr(key)] = {'file': sourceFileName, 'size': stat.st_size, 'mtime': stat.st_mtime, \
+                                 'valuescale': valuescale, 'dtype': values.dtype.str, 'shape': list(values.shape), 'count': int(values.size)}
+
+    def write(self):
+        """
+        Write the recorded maps into the array file and the index.
+        """
+
+        storeDir = os.path.dirname(self.fileName)
+        if os.path.exists(storeDir) == False: os.makedirs(storeDir, exist_ok = True)
+
+        offset = 0
+        with open(self.fileName, 'wb') as f:
+            for entry, values in zip(list(self.index.values()), self.maps):
+                entry['offset'] = offset
+                f.write(values.tobytes())
+                offset += values.nbytes
+                # - the maps start at multiples of 8 bytes
+                padding = (-offset) % 8
+                f.write(b'\0' * padding)
+                offset += padding
+        with open(self.fileName + ".json", 'w') as f:
+            json.dump({'version': store_version, 'entries': self.index}, f, indent = 1)
+
+        msg = "The static input store " + str(self.fileName) + " contains " + str(len(self.maps)) + " maps (%.1f MB)." %(offset / (1024. * 1024.))
+        logger.info(msg)
+
+
+def main():
+
+    import deterministic_runner_with_arguments as runner
+    from configuration import Configuration
+    from currTimeStep import ModelTime
+    from pcrglobwb import PCRGlobWB
+
+    # get the full path of configuration/ini file given in the system argument
+    iniFileName = os.path.abspath(sys.argv[1])
+
+    # modify ini file and return it in a new location 
+    if "-mod" in sys.argv:
+        iniFileName = runner.modify_ini_file(original_ini_file = iniFileName, \
+                                             system_argument = sys.argv)
+
+    # object to handle configuration/ini file
+    configuration = Configuration(iniFileName = iniFileName, \
+                                  debug_mode = False, \
+                                  no_modification = False)      
+
+    # for a parallel run, the clone is given by the clone number/code
+    if len(sys.argv) > 3 and sys.argv[2] == "parallel":
+        runner.set_configuration_for_clone(configuration, clone_code = str(sys.argv[3]))
+
+    # set configuration
+    configuration.set_configuration(system_arguments = sys.argv)
+    if 'staticInputStore' not in list(configuration.globalOptions.keys()) or configuration.globalOptions['staticInputStore'] == "None":
+        logger.error("The option 'staticInputStore' (globalOptions) is not set.")
+        return 1
+
+    # recording the static input maps while initializing the model
+    currTimeStep = ModelTime() 
+    currTimeStep.getStartEndTimeSteps(configuration.globalOptions['startTime'],
+                                      configuration.globalOptions['endTime'])
+    vos.staticinputstore = StaticInputStore(get_store_file_name(configuration), recording = True)
+    PCRGlobWB(configuration, currTimeStep, None)
+
+    vos.staticinputstore.write()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
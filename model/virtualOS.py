@@ -54,6 +54,12 @@ logger = logging.getLogger(__name__)
 # file cache to minimize/reduce opening/closing files.  
 filecache = dict()
 
+# cache of map attributes (see getMapAttributesALL) to avoid calling 'mapattr' for every file read
+mapattrcache = dict()
+
+# prepared input store of the static input maps (see static_input_store.py), used by readPCRmapClone and netcdf2PCRobjCloneWithoutTime
+staticinputstore = None
+
 # Global variables:
 MV = 1e20
 smallNumber = 1E-39
@@ -100,6 +106,18 @@ def netcdf2PCRobjCloneWithoutTime(ncFile, varName,\
                                   specificFillValue = None,\
                                   absolutePath = None):
     
+    # using the prepared input store (see static_input_store.py)
+    if staticinputstore is not None:
+        return staticinputstore.read(('netcdf2PCRobjCloneWithoutTime', ncFile, varName, cloneMapFileName, LatitudeLongitude, specificFillValue, absolutePath),\
+                                     ncFile,\
+                                     lambda: tryNetcdf2PCRobjCloneWithoutTime(ncFile, varName, cloneMapFileName, LatitudeLongitude, specificFillValue))
+    return tryNetcdf2PCRobjCloneWithoutTime(ncFile, varName, cloneMapFileName, LatitudeLongitude, specificFillValue)
+
+def tryNetcdf2PCRobjCloneWithoutTime(ncFile, varName,\
+                                     cloneMapFileName  = None,\
+                                     LatitudeLongitude = True,\
+                                     specificFillValue = None):
+    
     iter_try = 0
     while iter_try < max_num_of_tries:
         try:     
@@ -1539,6 +1557,15 @@ def writePCRmapToDir(v,outFileName,outDir):
 
 def readPCRmapClone(v, cloneMapFileName, tmpDir, absolutePath = None, isLddMap = False, cover = None, isNomMap = False):
     
+    # using the prepared input store (see static_input_store.py), for files only (not for values)
+    if staticinputstore is not None and v != "None" and not re.match(r"[0-9.-]*$",v):
+        return staticinputstore.read(('readPCRmapClone', v, cloneMapFileName, absolutePath, isLddMap, cover, isNomMap),\
+                                     getFullPath(v, absolutePath) if absolutePath != None else v,\
+                                     lambda: tryReadPCRmapClone(v, cloneMapFileName, tmpDir, absolutePath, isLddMap, cover, isNomMap))
+    return tryReadPCRmapClone(v, cloneMapFileName, tmpDir, absolutePath, isLddMap, cover, isNomMap)
+
+def tryReadPCRmapClone(v, cloneMapFileName, tmpDir, absolutePath = None, isLddMap = False, cover = None, isNomMap = False):
+    
     iter_try = 0
     while iter_try < max_num_of_tries:
         try:     
@@ -1834,6 +1861,13 @@ def isLastDayOfMonth(date):
         return False
 
 def getMapAttributesALL(cloneMap,arcDegree=True):
+    
+    # the attributes of a map file do not change during a run
+    key = (str(cloneMap), arcDegree)
+    if key not in mapattrcache: mapattrcache[key] = singleCallGetMapAttributesALL(cloneMap, arcDegree)
+    return dict(mapattrcache[key])
+
+def singleCallGetMapAttributesALL(cloneMap,arcDegree=True):
     cOut,err = subprocess.Popen(str('mapattr -p %s ' %(cloneMap)), stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
 
     if err !=None or cOut == []:
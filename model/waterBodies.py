@@ -25,6 +25,8 @@
 import os
 import types
 
+import numpy as np
+
 from pcraster.framework import *
 import pcraster as pcr
 
@@ -33,6 +35,24 @@ logger = logging.getLogger(__name__)
 
 
 import virtualOS as vos
+import routing_network
+
+# numpy equivalents of pcraster operations (missing values are given as NaN), used for the sparse calculation of lakes and reservoirs
+def numpy_cover(values, cover_values):
+    return np.where(np.isnan(values), cover_values, values)
+
+def numpy_ifthen(condition, values):
+    return np.where(condition, values, np.nan)
+
+def numpy_ifthenelse(condition, defined, values, other_values):
+    return np.where(defined, np.where(condition, values, other_values), np.nan)
+
+def numpy_divide(values, divisor):
+    # division by zero gives a missing value (as in pcraster)
+    return np.where(divisor == 0.0, np.nan, values / divisor)
+
+# maps of the lakes and reservoirs used by the sparse calculation (the compact representation is rebuilt if their values change)
+sparse_parameter_names = ['waterBodyIds', 'waterBodyOut', 'waterBodyArea', 'waterBodyCap', 'waterBodyTyp', 'minResvrFrac', 'maxResvrFrac']
 
 class WaterBodies(object):
 
@@ -107,6 +127,12 @@ class WaterBodies(object):
             self.maxResvrFrac = vos.readPCRmapClone(maxResvrFrac,
                                                     self.cloneMap, self.tmpDir, self.inputDir)
 
+        # option to calculate lakes and reservoirs only at their cells (using arrays indexed by water body), instead of over the entire maps
+        self.useSparseWaterBodies = False
+        if "sparseWaterBodies" in list(iniItems.routingOptions.keys()) and iniItems.routingOptions['sparseWaterBodies'] == "True":
+            logger.info("Lakes and reservoirs are calculated only at their cells (sparseWaterBodies).")
+            self.useSparseWaterBodies = True
+
 
     def getParameterFiles(self,currTimeStep,cellArea,ldd,\
                                initial_condition_dictionary = None,\
@@ -397,24 +423,36 @@ class WaterBodies(object):
                            length_of_time_step = vos.secondsPerDay(),\
                            downstreamDemand = None):
 
-        if self.debugWaterBalance:\
-           preStorage = self.waterBodyStorage    # unit: m
+        # - also needed for waterBodyBalance (below)
+        preStorage = self.waterBodyStorage    # unit: m
      
         self.timestepsToAvgDischarge = timestepsToAvgDischarge          # TODO: include this one in "currTimeStep"     
         
-        # obtain inflow (and update storage)
-        self.moveFromChannelToWaterBody(\
-         newStorageAtLakeAndReservoirs,\
-             timestepsToAvgDischarge,\
-             maxTimestepsToAvgDischargeShort,\
-             length_of_time_step)
-        
-        # calculate outflow (and update storage)
-        self.getWaterBodyOutflow(\
-             maxTimestepsToAvgDischargeLong,\
-             avgChannelDischarge,\
-             length_of_time_step,\
-             downstreamDemand)
+        if self.useSparseWaterBodies:
+            # obtain inflow and calculate outflow (and update storage) only at the cells of lakes and reservoirs
+            self.checkSparseWaterBodies()
+            self.updateSparseWaterBodies(\
+                 self.getSparseValues(newStorageAtLakeAndReservoirs),\
+                 maxTimestepsToAvgDischargeShort,\
+                 maxTimestepsToAvgDischargeLong,\
+                 avgChannelDischarge,\
+                 length_of_time_step,\
+                 downstreamDemand)
+            self.synchronizeSparseMaps()
+        else:
+            # obtain inflow (and update storage)
+            self.moveFromChannelToWaterBody(\
+             newStorageAtLakeAndReservoirs,\
+                 timestepsToAvgDischarge,\
+                 maxTimestepsToAvgDischargeShort,\
+                 length_of_time_step)
+            
+            # calculate outflow (and update storage)
+            self.getWaterBodyOutflow(\
+                 maxTimestepsToAvgDischargeLong,\
+                 avgChannelDischarge,\
+                 length_of_time_step,\
+                 downstreamDemand)
         
         if self.debugWaterBalance:\
            vos.waterBalanceCheck([          pcr.cover(self.inflow/self.waterBodyArea,0.0)],\
@@ -425,8 +463,10 @@ class WaterBodies(object):
                                   True,\
                                   currTimeStep.fulldate,threshold=5e-3)
         
-        self.waterBodyBalance = (pcr.cover(self.inflow/self.waterBodyArea, 0.0) - pcr.cover(self.waterBodyOutflow/self.waterBodyArea,0.0)) -\
-                                (pcr.cover(self.waterBodyStorage/self.waterBodyArea,0.0) - pcr.cover(preStorage/self.waterBodyArea,0.0))
+        # - for the sparse calculation, waterBodyBalance is given by updateSparseWaterBodies
+        if self.useSparseWaterBodies == False:
+            self.waterBodyBalance = (pcr.cover(self.inflow/self.waterBodyArea, 0.0) - pcr.cover(self.waterBodyOutflow/self.waterBodyArea,0.0)) -\
+                                    (pcr.cover(self.waterBodyStorage/self.waterBodyArea,0.0) - pcr.cover(preStorage/self.waterBodyArea,0.0))
                                   
 
     def moveFromChannelToWaterBody(self,\
@@ -652,3 +692,435 @@ class WaterBodies(object):
         resvOutflow = pcr.ifthen(pcr.scalar(self.waterBodyIds) > 0., resvOutflow)
         resvOutflow = pcr.ifthen(pcr.scalar(self.waterBodyTyp) == 2, resvOutflow)
         return (resvOutflow) # unit: m3  
+
+    def buildSparseWaterBodies(self):
+
+        # compact (sparse) representation of lakes and reservoirs; the calculation is done at the following cells: 
+        # - the cells of lakes and reservoirs, 
+        # - their downstream cells (needed for the average outflow of new reservoirs, see getReservoirOutflow), and 
+        # - the cells that still have water body states (e.g. lakes and/or reservoirs that were removed at the beginning of the year)
+        # At all other cells, the water body states are zero and they do not change. 
+        
+        self.sparseLandmaskGrid = pcr.pcr2numpy(pcr.cover(self.landmask, pcr.boolean(0.0)), 0).astype(bool).ravel()
+
+        waterBodyIds = pcr.pcr2numpy(pcr.cover(self.waterBodyIds, pcr.nominal(0)), 0).ravel()
+        inWaterBody  = (waterBodyIds > 0) & self.sparseLandmaskGrid
+        waterBodyCells = np.flatnonzero(inWaterBody)
+        
+        # downstream cells of lake and reservoir cells (pcr.downstream)
+        ldd = pcr.pcr2numpy(self.lddMap, 0)
+        self.sparseShape = ldd.shape
+        rows, cols = np.unravel_index(waterBodyCells, ldd.shape)
+        direction = ldd[rows, cols].astype(np.int64)
+        downRows  = rows + routing_network.ldd_row_offsets[direction]
+        downCols  = cols + routing_network.ldd_column_offsets[direction]
+        inside    = (direction > 0) & (downRows >= 0) & (downRows < ldd.shape[0]) & (downCols >= 0) & (downCols < ldd.shape[1])
+        downstreamCells = np.full(waterBodyCells.size, -1, dtype = np.int64)
+        downstreamCells[inside] = np.ravel_multi_index((downRows[inside], downCols[inside]), ldd.shape)
+        
+        # cells with remaining water body states
+        remainingCells = self.getSparseRemainingCells()
+
+        self.sparseCells = np.union1d(np.union1d(waterBodyCells, downstreamCells[downstreamCells >= 0]), remainingCells)
+        self.sparseCellGrid = np.zeros(self.sparseLandmaskGrid.size, dtype = bool)
+        self.sparseCellGrid[self.sparseCells] = True
+        
+        # gather index: calculation cell -> water body (-1 for cells outside lakes and reservoirs)
+        self.sparseInWaterBody = inWaterBody[self.sparseCells]
+        self.sparseWaterBodyIds, waterBodyIndex = np.unique(waterBodyIds[self.sparseCells][self.sparseInWaterBody], return_inverse = True)
+        self.sparseWaterBodyIndex = np.full(self.sparseCells.size, -1, dtype = np.int64)
+        self.sparseWaterBodyIndex[self.sparseInWaterBody] = waterBodyIndex
+        
+        # downstream index: calculation cell -> calculation cell of its downstream cell (-1 if not available)
+        self.sparseDownstream = np.full(self.sparseCells.size, -1, dtype = np.int64)
+        self.sparseDownstream[self.sparseInWaterBody] = np.where(downstreamCells >= 0, np.searchsorted(self.sparseCells, downstreamCells), -1)
+        
+        # outlet index: water body -> calculation cell of its outlet (-1 if not available)
+        waterBodyOut = pcr.pcr2numpy(pcr.cover(self.waterBodyOut, pcr.boolean(0.0)), 0).astype(bool).ravel()
+        outletCells  = np.flatnonzero(waterBodyOut[self.sparseCells] & self.sparseInWaterBody)
+        self.sparseOutlets = np.full(self.sparseWaterBodyIds.size, -1, dtype = np.int64)
+        self.sparseOutlets[self.sparseWaterBodyIndex[outletCells]] = outletCells
+        
+        # parameters at the calculation cells
+        self.sparseWaterBodyArea = self.getSparseValues(self.waterBodyArea)
+        self.sparseWaterBodyCap  = self.getSparseValues(self.waterBodyCap)
+        self.sparseWaterBodyTyp  = self.getSparseValues(self.waterBodyTyp)
+        self.sparseMinResvrFrac  = self.getSparseValues(self.minResvrFrac)
+        self.sparseMaxResvrFrac  = self.getSparseValues(self.maxResvrFrac)
+        
+        # the parameter maps (and their values) used; see checkSparseWaterBodies
+        self.sparseParameters = {}
+        for var in sparse_parameter_names: self.sparseParameters[var] = (vars(self)[var], self.getSparseParameterGrid(var))
+        self.sparseInputs = {}
+        self.sparseOutflowMap = None
+        self.sparseNetworkValues = None
+        
+        msg = "Sparse lakes and reservoirs: " + str(self.sparseWaterBodyIds.size) + " water bodies, " + str(waterBodyCells.size) + " water body cells and " + \
+              str(self.sparseCells.size) + " calculation cells (of " + str(self.sparseLandmaskGrid.size) + " cells)."
+        logger.debug(msg)
+
+    def checkSparseWaterBodies(self):
+
+        # synchronize the water body states (numpy) with the maps if they have been replaced outside this class (e.g. by getICs, getParameterFiles 
+        # or by the merging of the basin classes in routing.py); only the replaced states are converted again
+        if vars(self).get('sparseMaps') is None:
+            self.sparseMaps   = {}
+            self.sparseStates = {}
+        replaced = [var for var in ['waterBodyStorage', 'avgInflow', 'avgOutflow'] if vars(self)[var] is not self.sparseMaps.get(var)]
+        for var in replaced:
+            self.sparseMaps[var]   = vars(self)[var]
+            self.sparseStates[var] = pcr.pcr2numpy(pcr.spatial(pcr.scalar(vars(self)[var])), np.nan).ravel()
+        if len(replaced) > 0:
+            self.sparseMissingValuesChecked = None
+            self.sparseNetworkValues = None
+        
+        # rebuild the compact representation only if the lakes and reservoirs have been changed (compared by their values, not by the map objects)
+        # or if the replaced states have values outside the calculation cells 
+        if vars(self).get('sparseParameters') is None:
+            self.buildSparseWaterBodies()
+            return
+        for var in sparse_parameter_names:
+            if vars(self)[var] is self.sparseParameters[var][0]: continue
+            values = self.getSparseParameterGrid(var)
+            if np.array_equal(values, self.sparseParameters[var][1], equal_nan = True) == False:
+                self.buildSparseWaterBodies()
+                return
+            self.sparseParameters[var] = (vars(self)[var], values)
+        if len(replaced) > 0 and np.all(self.sparseCellGrid[self.getSparseRemainingCells()]) == False:
+            self.buildSparseWaterBodies()
+
+    def getSparseParameterGrid(self, var):
+
+        # values (of all cells) of a lake/reservoir parameter map (missing values are given as NaN)
+        return pcr.pcr2numpy(pcr.spatial(pcr.scalar(vars(self)[var])), np.nan).ravel()
+
+    def getSparseRemainingCells(self):
+
+        # cells with water body states
+        states = self.sparseStates
+        return np.flatnonzero((np.nan_to_num(states['waterBodyStorage']) != 0.0) |\
+                              (np.nan_to_num(states['avgInflow'])        != 0.0) |\
+                              (np.nan_to_num(states['avgOutflow'])       != 0.0))
+
+    def getSparseValues(self, value, name = None):
+
+        # values of a map at the calculation cells (missing values are given as NaN); constant values are returned as they are
+        if isinstance(value, (int, float)): return value
+        
+        # - maps that are inputs of every sub time step (e.g. avgChannelDischarge) are stored until they are replaced 
+        if name is not None and name in list(self.sparseInputs.keys()) and self.sparseInputs[name][0] is value:
+            return self.sparseInputs[name][1]
+        values = pcr.pcr2numpy(pcr.spatial(pcr.scalar(value)), np.nan).ravel()[self.sparseCells]
+        if name is not None: self.sparseInputs[name] = (value, values)
+        return values
+
+    def getSparseAreaValues(self, values, operation, inWaterBody = None):
+
+        # pcr.areatotal, pcr.areaaverage or pcr.areamaximum at the calculation cells, using the gather index (missing values are ignored) 
+        if inWaterBody is None: inWaterBody = self.sparseInWaterBody
+        valid   = inWaterBody & (np.isnan(values) == False)
+        index   = self.sparseWaterBodyIndex[valid]
+        number  = self.sparseWaterBodyIds.size
+        count   = np.bincount(index, minlength = number)
+        if operation == "maximum":
+            result = np.full(number, -np.inf, dtype = np.float32)
+            np.maximum.at(result, index, values[valid].astype(np.float32))
+        else:
+            # - summed in float32 and in the order of the cells (as the maps)
+            result = np.zeros(number, dtype = np.float32)
+            np.add.at(result, index, values[valid].astype(np.float32))
+            if operation == "average": result = result / np.maximum(1, count).astype(np.float32)
+        result[count == 0] = np.nan
+        
+        areaValues = np.full(values.size, np.nan, dtype = np.float32)
+        areaValues[inWaterBody] = result[self.sparseWaterBodyIndex[inWaterBody]]
+        return areaValues
+
+    def sparseValuesToMap(self, values, grid):
+
+        # map of values given at the calculation cells; the other cells are taken from grid
+        grid = grid.astype(np.float64)
+        grid[self.sparseCells] = values
+        grid[np.isnan(grid)] = vos.MV
+        return pcr.numpy2pcr(pcr.Scalar, grid.reshape(self.sparseShape), vos.MV)
+
+    def getSparseLandmask(self, landmask):
+
+        # boolean values (of all cells) of a landmask map 
+        if 'landmask' in list(self.sparseInputs.keys()) and self.sparseInputs['landmask'][0] is landmask:
+            return self.sparseInputs['landmask'][1]
+        landmaskGrid = pcr.pcr2numpy(pcr.cover(landmask, pcr.boolean(0.0)), 0).astype(bool).ravel()
+        self.sparseInputs['landmask'] = (landmask, landmaskGrid)
+        return landmaskGrid
+
+    def updateSparseWaterBodies(self,newStorageAtCells,\
+                                     maxTimestepsToAvgDischargeShort,\
+                                     maxTimestepsToAvgDischargeLong,\
+                                     avgChannelDischarge,\
+                                     length_of_time_step = vos.secondsPerDay(),\
+                                     downstreamDemand = None):
+
+        # inflow, outflow and storage of lakes and reservoirs, calculated at the calculation cells (see buildSparseWaterBodies) 
+        # - following moveFromChannelToWaterBody and getWaterBodyOutflow (including the order of the operations) 
+        # - newStorageAtCells: the storage moved to lakes and reservoirs at the calculation cells (after checkSparseWaterBodies)
+        # - the states and fluxes are kept as vectors; their maps are only made by synchronizeSparseMaps 
+        
+        length_of_time_step = float(length_of_time_step)
+        if downstreamDemand is None: downstreamDemand = 0.0
+        
+        cells  = self.sparseCells
+        states = self.sparseStates
+        
+        waterBodyStorage = states['waterBodyStorage'][cells]
+        avgInflow        = states['avgInflow'][cells]
+        avgOutflow       = states['avgOutflow'][cells]
+        preStorage       = waterBodyStorage
+        waterBodyArea    = self.sparseWaterBodyArea
+        
+        timestepsToAvgDischarge = self.getSparseValues(self.timestepsToAvgDischarge, 'timestepsToAvgDischarge')
+        avgChannelDischarge     = self.getSparseValues(avgChannelDischarge, 'avgChannelDischarge')
+        downstreamDemand        = self.getSparseValues(downstreamDemand, 'downstreamDemand')
+        
+        with np.errstate(invalid = 'ignore', divide = 'ignore', over = 'ignore'):
+        
+            # new lake and/or reservoir storages (m3) and incoming volume (m3)
+            newStorageAtLakeAndReservoirs = numpy_cover(self.getSparseAreaValues(newStorageAtCells, "total"), 0.0)
+            inflow = newStorageAtLakeAndReservoirs - waterBodyStorage
+            inflowInM3PerSec = inflow / length_of_time_step
+            
+            # updating (short term) average inflow (m3/s)
+            temp = np.maximum(1.0, np.minimum(maxTimestepsToAvgDischargeShort, timestepsToAvgDischarge - 1.0 + length_of_time_step / vos.secondsPerDay())).astype(np.float32)
+            deltaInflow = inflowInM3PerSec - avgInflow  
+            R = deltaInflow * ( length_of_time_step / vos.secondsPerDay() ) / temp
+            avgInflow = np.maximum(0.0, avgInflow + R)
+            
+            waterBodyStorage = newStorageAtLakeAndReservoirs
+            
+            # outgoing/release volume from lakes and/or reservoirs
+            lakeOutflow      = self.getSparseLakeOutflow(waterBodyStorage, avgInflow, avgOutflow, avgChannelDischarge, length_of_time_step)
+            reservoirOutflow = self.getSparseReservoirOutflow(waterBodyStorage, avgInflow, avgOutflow, avgChannelDischarge, length_of_time_step, downstreamDemand)
+            waterBodyOutflow = numpy_cover(reservoirOutflow, lakeOutflow)
+            waterBodyOutflow = np.maximum(0., numpy_cover(waterBodyOutflow, 0.0))
+            
+            # limit outflow to available storage and use round values
+            factor = 0.25  # to avoid flip flop 
+            waterBodyOutflow = np.minimum(waterBodyStorage * factor, waterBodyOutflow)
+            waterBodyOutflow = np.floor(waterBodyOutflow/1.)*1.
+            waterBodyOutflowInM3PerSec = waterBodyOutflow / length_of_time_step
+            
+            # updating (long term) average outflow (m3/s)
+            temp = np.maximum(1.0, np.minimum(maxTimestepsToAvgDischargeLong, timestepsToAvgDischarge - 1.0 + length_of_time_step / vos.secondsPerDay())).astype(np.float32)
+            deltaOutflow = waterBodyOutflowInM3PerSec - avgOutflow
+            R = deltaOutflow * ( length_of_time_step / vos.secondsPerDay() ) / temp
+            avgOutflow = np.maximum(0.0, avgOutflow + R)
+            
+            # update waterBodyStorage (after outflow)
+            waterBodyStorage = np.maximum(0.0, waterBodyStorage - waterBodyOutflow)
+            
+            waterBodyBalance = (numpy_cover(inflow/waterBodyArea, 0.0) - numpy_cover(waterBodyOutflow/waterBodyArea, 0.0)) -\
+                               (numpy_cover(waterBodyStorage/waterBodyArea, 0.0) - numpy_cover(preStorage/waterBodyArea, 0.0))
+        
+        # at the other cells: zero fluxes and unchanged states, but with missing values as in the map-based calculation 
+        # - checked (on the entire clone) after a synchronization of the states and for a new timestepsToAvgDischarge map (once a day)
+        self.sparseMissingInflow = None
+        if self.sparseMissingValuesChecked is not self.timestepsToAvgDischarge:
+            missingStorage   = np.isnan(states['waterBodyStorage'])
+            missingTimesteps = np.isnan(pcr.pcr2numpy(pcr.spatial(pcr.scalar(self.timestepsToAvgDischarge)), np.nan).ravel())
+            self.sparseMissingInflow = missingStorage
+            states['avgInflow'][missingStorage | missingTimesteps] = np.nan
+            states['avgOutflow'][missingTimesteps] = np.nan
+            states['waterBodyStorage'][missingStorage] = 0.0
+            self.sparseMissingValuesChecked = self.timestepsToAvgDischarge
+            self.sparseNetworkValues = None
+        
+        states['waterBodyStorage'][cells] = waterBodyStorage
+        states['avgInflow'][cells]        = avgInflow
+        states['avgOutflow'][cells]       = avgOutflow
+        
+        self.sparseFluxes = {'inflow': inflow, 'inflowInM3PerSec': inflowInM3PerSec, 'waterBodyOutflow': waterBodyOutflow, 'waterBodyBalance': waterBodyBalance}
+        self.sparseWaterBodyOutflow = waterBodyOutflow
+        self.sparseMapsOutdated = True
+
+    def synchronizeSparseMaps(self):
+
+        # maps of the states and fluxes of the last updateSparseWaterBodies (only if they have not been made yet)
+        if vars(self).get('sparseMapsOutdated') != True: return
+        
+        cells  = self.sparseCells
+        states = self.sparseStates
+        
+        zeros = np.zeros(states['waterBodyStorage'].size, dtype = np.float32)
+        inflowGrid = zeros
+        if self.sparseMissingInflow is not None: inflowGrid = np.where(self.sparseMissingInflow, np.nan, zeros)
+        
+        self.inflow           = self.sparseValuesToMap(self.sparseFluxes['inflow'], inflowGrid)
+        self.inflowInM3PerSec = self.sparseValuesToMap(self.sparseFluxes['inflowInM3PerSec'], inflowGrid)
+        self.waterBodyOutflow = self.sparseValuesToMap(self.sparseFluxes['waterBodyOutflow'], zeros)
+        self.waterBodyBalance = self.sparseValuesToMap(self.sparseFluxes['waterBodyBalance'], zeros)
+        for var in ['waterBodyStorage', 'avgInflow', 'avgOutflow']:
+            vars(self)[var] = self.sparseValuesToMap(states[var][cells], states[var])
+            self.sparseMaps[var] = vars(self)[var]
+        
+        self.sparseOutflowMap = self.waterBodyOutflow
+        self.sparseMapsOutdated = False
+
+    def updateSparseWaterBodiesOnNetwork(self,newStorageOnNetwork,\
+                                              networkCells,\
+                                              timestepsToAvgDischarge,\
+                                              maxTimestepsToAvgDischargeShort,\
+                                              maxTimestepsToAvgDischargeLong,\
+                                              avgChannelDischarge,\
+                                              length_of_time_step = vos.secondsPerDay(),\
+                                              downstreamDemand = None):
+
+        # the same as update (with sparseWaterBodies), but with the storage moved to lakes and reservoirs given at the cells of a routing network 
+        # (networkCells: their flat indices in the clone), e.g. for the fused kernel of routing.py; without any map conversion (the maps are made by synchronizeSparseMaps)
+        # - returned: the outflow (m3) at the outlets and the storage (m3), at the cells of the routing network (kept between the sub time steps and only updated at the calculation cells)
+        
+        self.timestepsToAvgDischarge = timestepsToAvgDischarge
+        self.checkSparseWaterBodies()
+        
+        networkIndex = self.getSparseNetworkIndex(networkCells)
+        inNetwork = networkIndex >= 0
+        newStorageAtCells = np.zeros(self.sparseCells.size, dtype = np.float32)
+        newStorageAtCells[inNetwork] = newStorageOnNetwork[networkIndex[inNetwork]]
+        
+        self.updateSparseWaterBodies(newStorageAtCells,\
+                                     maxTimestepsToAvgDischargeShort,\
+                                     maxTimestepsToAvgDischargeLong,\
+                                     avgChannelDischarge,\
+                                     length_of_time_step,\
+                                     downstreamDemand)
+        
+        # outflow and storage at the cells of the routing network; taken from all cells only for new calculation cells 
+        # or if the states outside the calculation cells may have been changed (see checkSparseWaterBodies and updateSparseWaterBodies)
+        if self.sparseNetworkValues is None or self.sparseNetworkValues[0] is not networkIndex:
+            self.sparseNetworkValues = (networkIndex, np.zeros(networkCells.size, dtype = np.float64), \
+                                                      self.sparseStates['waterBodyStorage'][networkCells].astype(np.float64))
+        networkIndex, networkOutflow, networkStorage = self.sparseNetworkValues
+        
+        outlets = self.sparseOutlets[self.sparseOutlets >= 0]
+        outlets = outlets[inNetwork[outlets]]
+        networkOutflow[networkIndex[outlets]] = self.sparseWaterBodyOutflow[outlets]
+        networkStorage[networkIndex[inNetwork]] = self.sparseStates['waterBodyStorage'][self.sparseCells[inNetwork]]
+        return networkOutflow, networkStorage
+
+    def getSparseNetworkIndex(self, networkCells):
+
+        # position of the calculation cells in a routing network (-1 outside the network); networkCells: the flat indices of its cells in the clone
+        if vars(self).get('sparseNetworkIndex') is not None and self.sparseNetworkIndex[0] is networkCells and self.sparseNetworkIndex[1] is self.sparseCells:
+            return self.sparseNetworkIndex[2]
+        networkIndexGrid = np.full(self.sparseLandmaskGrid.size, -1, dtype = np.int64)
+        networkIndexGrid[networkCells] = np.arange(networkCells.size)
+        self.sparseNetworkIndex = (networkCells, self.sparseCells, networkIndexGrid[self.sparseCells])
+        return self.sparseNetworkIndex[2]
+
+    def getSparseLakeOutflow(self, waterBodyStorage, avgInflow, avgOutflow, avgChannelDischarge, length_of_time_step):
+
+        # see getLakeOutflow 
+        inWaterBody = self.sparseInWaterBody
+        
+        minWaterHeight = 0.001
+        waterHeight = numpy_cover(np.maximum(minWaterHeight, (waterBodyStorage - numpy_cover(self.sparseWaterBodyCap, 0.0))/self.sparseWaterBodyArea), 0.)
+
+        # weirWidth (m) : 
+        avgOutflow = numpy_ifthenelse(avgOutflow > 0., np.isnan(avgOutflow) == False, avgOutflow, np.maximum(np.maximum(avgChannelDischarge, avgInflow), 0.001))
+        avgOutflow = self.getSparseAreaValues(avgOutflow, "maximum")
+        bankfullWidth = numpy_cover(4.8 * ((avgOutflow)**(0.5)), 0.)
+        weirWidthUsed = np.maximum(bankfullWidth, self.minWeirWidth)
+        weirWidthUsed = numpy_cover(numpy_ifthen(inWaterBody, weirWidthUsed), 0.0)
+
+        # avgInflow <= lakeOutflow (weirFormula) <= waterBodyStorage
+        weirFormula = (1.7 * 1.0 * np.maximum(0, waterHeight - 0.0)**1.5) * weirWidthUsed
+        lakeOutflowInM3PerSec = np.maximum(weirFormula, avgInflow)
+        lakeOutflow = lakeOutflowInM3PerSec * length_of_time_step
+        lakeOutflow = np.minimum(waterBodyStorage, lakeOutflow)
+        lakeOutflow = numpy_ifthen(inWaterBody, lakeOutflow)
+        lakeOutflow = numpy_ifthen(self.sparseWaterBodyTyp == 1, lakeOutflow)
+        return lakeOutflow
+
+    def getSparseReservoirOutflow(self, waterBodyStorage, avgInflow, avgOutflow, avgChannelDischarge, length_of_time_step, downstreamDemand):
+
+        # see getReservoirOutflow 
+        waterBodyCap = self.sparseWaterBodyCap
+        minResvrFrac = self.sparseMinResvrFrac
+        maxResvrFrac = self.sparseMaxResvrFrac
+        
+        # avgOutflow (m3/s) ; for new reservoirs, from the downstream cells
+        avgOutflow = numpy_ifthenelse(avgOutflow > 0., np.isnan(avgOutflow) == False, avgOutflow, np.maximum(avgChannelDischarge, avgInflow))
+        downstreamAvgOutflow = np.where(self.sparseDownstream >= 0, avgOutflow[self.sparseDownstream], np.nan)
+        avgOutflow = numpy_ifthenelse(avgOutflow > 0., np.isnan(avgOutflow) == False, avgOutflow, downstreamAvgOutflow)
+        avgOutflow = self.getSparseAreaValues(avgOutflow, "maximum")
+
+        # resvOutflow (m3) based on reservoir storage and avgOutflow
+        reductionFactor = numpy_cover(np.minimum(1., numpy_divide(np.maximum(0., waterBodyStorage - minResvrFrac*waterBodyCap), (maxResvrFrac - minResvrFrac))*waterBodyCap), 0.0)
+        resvOutflow = reductionFactor * avgOutflow * length_of_time_step
+        resvOutflow = np.maximum(0, np.minimum(resvOutflow, avgInflow * length_of_time_step))
+
+        # downstream demand (m3/s) ; reduced if storage < lower limit (see vos.getValDivZero) 
+        lowerLimit = minResvrFrac*waterBodyCap
+        reductionFactor = numpy_ifthenelse(lowerLimit > vos.smallNumber, np.isnan(lowerLimit) == False, downstreamDemand/np.maximum(vos.smallNumber, lowerLimit), 0.)
+        reductionFactor = numpy_cover(reductionFactor, 0.0)
+        downstreamDemand = np.minimum(downstreamDemand, downstreamDemand*reductionFactor)
+        resvOutflow = np.maximum(resvOutflow, downstreamDemand * length_of_time_step)
+
+        # floodOutflow: additional release if storage > upper limit
+        ratioQBankfull = 2.3
+        estmStorage  = np.maximum(0., waterBodyStorage - resvOutflow)
+        floodOutflow = np.maximum(0.0, estmStorage - waterBodyCap) +\
+                       numpy_cover(numpy_divide(np.maximum(0.0, estmStorage - maxResvrFrac*waterBodyCap), ((1.-maxResvrFrac)*waterBodyCap)), 0.0)*\
+                       np.maximum(0.0, ratioQBankfull*avgOutflow* vos.secondsPerDay() - resvOutflow)
+        floodOutflow = np.maximum(0.0, np.minimum(floodOutflow, estmStorage - maxResvrFrac*waterBodyCap*0.75))
+        resvOutflow  = numpy_cover(resvOutflow, 0.0) + numpy_cover(floodOutflow, 0.0)
+
+        # if storage > upper limit : bring the reservoir storages only to 3/4 of upper limit capacities, but resvOutflow > avgInflow
+        upperLimit = maxResvrFrac*waterBodyCap
+        aboveUpperLimit = waterBodyStorage > upperLimit
+        defined = (np.isnan(waterBodyStorage) == False) & (np.isnan(upperLimit) == False)
+        resvOutflow = numpy_ifthenelse(aboveUpperLimit, defined, np.minimum(resvOutflow, np.maximum(0, waterBodyStorage - maxResvrFrac*waterBodyCap*0.75)), resvOutflow)
+        resvOutflow = numpy_ifthenelse(aboveUpperLimit, defined, np.maximum(np.maximum(0.0, resvOutflow), avgInflow), resvOutflow)
+
+        # resvOutflow < waterBodyStorage
+        resvOutflow = np.minimum(waterBodyStorage, resvOutflow)
+        resvOutflow = numpy_ifthen(self.sparseInWaterBody, resvOutflow)
+        resvOutflow = numpy_ifthen(self.sparseWaterBodyTyp == 2, resvOutflow)
+        return resvOutflow
+
+    def getWaterBodyOutflowAtOutlets(self):
+
+        # waterBodyOutflow (m3) at lake/reservoir outlet cells (zero at the other cells)
+        if self.useSparseWaterBodies and self.waterBodyOutflow is vars(self).get('sparseOutflowMap'):
+            outlets = self.sparseOutlets[self.sparseOutlets >= 0]
+            grid = np.zeros(self.sparseLandmaskGrid.size, dtype = np.float64)
+            grid[self.sparseCells[outlets]] = self.sparseWaterBodyOutflow[outlets]
+            return pcr.numpy2pcr(pcr.Scalar, grid.reshape(self.sparseShape), vos.MV)
+        return pcr.cover(pcr.ifthen(self.waterBodyOut, self.waterBodyOutflow), 0.0)
+
+    def returnStorageToChannel(self, channelStorage, cellArea, landmask):
+
+        # return waterBodyStorage to channelStorage, calculated at the calculation cells (see routing.return_water_body_storage_to_channel)
+        self.checkSparseWaterBodies()
+        
+        cells = self.sparseCells
+        landmaskGrid     = self.getSparseLandmask(landmask)
+        landmaskAtCells  = landmaskGrid[cells]
+        inWaterBody      = self.sparseInWaterBody & landmaskAtCells
+        
+        channelStorageGrid = pcr.pcr2numpy(pcr.spatial(pcr.scalar(channelStorage)), np.nan).ravel()
+        channelStorageAtCells = channelStorageGrid[cells]
+        waterBodyStorage = self.sparseStates['waterBodyStorage'][cells]
+        cellArea = self.getSparseValues(cellArea, 'cellArea')
+        
+        with np.errstate(invalid = 'ignore', divide = 'ignore', over = 'ignore'):
+            waterBodyStorageTotal = numpy_ifthen(self.sparseInWaterBody, \
+                                    self.getSparseAreaValues(numpy_ifthen(landmaskAtCells, waterBodyStorage), "average", inWaterBody) + \
+                                    self.getSparseAreaValues(numpy_cover(numpy_ifthen(landmaskAtCells, channelStorageAtCells), 0.0), "total", inWaterBody))
+            waterBodyStoragePerCell = numpy_divide(waterBodyStorageTotal * cellArea, \
+                                      self.getSparseAreaValues(numpy_cover(cellArea, 0.0), "total", inWaterBody))
+            waterBodyStoragePerCell = numpy_ifthen(self.sparseInWaterBody, waterBodyStoragePerCell)         # unit: m3
+        
+        channelStorageGrid[cells] = numpy_cover(waterBodyStoragePerCell, channelStorageAtCells)
+        channelStorageGrid[landmaskGrid == False] = np.nan
+        channelStorageGrid = channelStorageGrid.astype(np.float64)
+        channelStorageGrid[np.isnan(channelStorageGrid)] = vos.MV
+        return pcr.numpy2pcr(pcr.Scalar, channelStorageGrid.reshape(self.sparseShape), vos.MV)
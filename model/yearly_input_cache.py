@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cache of yearly inputs (the 'yearlyIrrigationInputCache' option of the landSurfaceOptions), e.g. the historical irrigation areas
+# (historicalIrrigationArea) and the irrigation efficiencies (irrigationWaterEfficiency) that are read at the beginning of every year.
+#
+# The yearly maps of a netcdf file are read (with virtualOS.netcdf2PCRobjClone and useDoy = 'yearly') once into a year -> array 
+# (clone, float32) dictionary. As in netcdf2PCRobjClone, the years before and after the years of a file are given by the first and 
+# the last years of the file; these years are determined once per file. The maps are read when they are requested for the first
+# time; only the requested year and the year before are kept (the years before are removed from the cache), as the years are
+# requested in the order of the run.
+
+import datetime
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# caches (one per clone map) shared by the landSurface and the land cover types
+caches = {}
+
+
+def get_yearly_input_cache(cloneMapFileName):
+    """
+    Return the cache for a clone map (created at the first call).
+    """
+    if cloneMapFileName not in list(caches.keys()): caches[cloneMapFileName] = YearlyInputCache(cloneMapFileName)
+    return caches[cloneMapFileName]
+
+
+class YearlyInputCache(object):
+
+    def __init__(self, cloneMapFileName):
+        object.__init__(self)
+
+        self.cloneMapFileName = cloneMapFileName
+
+        # first and last years of every file
+        self.years = {}
+
+        # values (clone) of every file, variable and year
+        self.values = {}
+
+    def get_year(self, ncFile, year):
+        """
+        Return the year of a file that is used for a year (limited to the years of the file).
+        """
+        if ncFile not in list(self.years.keys()):
+            if ncFile not in list(vos.filecache.keys()): vos.filecache[ncFile] = vos.nc.Dataset(ncFile)
+            time = vos.filecache[ncFile].variables['time']
+            self.years[ncFile] = (vos.findFirstYearInNCTime(time), vos.findLastYearInNCTime(time))
+        first_year, last_year = self.years[ncFile]
+        return min(max(int(year), first_year), last_year)
+
+    def get_values(self, ncFile, varName, year):
+        key = (ncFile, varName, self.get_year(ncFile, year))
+        if key not in list(self.values.keys()):
+            yearly_map = vos.netcdf2PCRobjClone(ncFile, varName, datetime.datetime(key[2], 1, 1), useDoy = 'yearly', cloneMapFileName = self.cloneMapFileName)
+            self.values[key] = pcr.pcr2numpy(pcr.scalar(yearly_map), vos.MV).astype(np.float32)
+            # - only this year and the year before are kept
+            for old_key in list(self.values.keys()):
+                if old_key[0:2] == key[0:2] and old_key[2] < key[2] - 1: del self.values[old_key]
+        return self.values[key]
+
+    def read(self, ncFile, varName, year):
+        """
+        Return the map of a year from the cache (it is read from the file at the first request).
+        """
+        return pcr.numpy2pcr(pcr.Scalar, self.get_values(ncFile, varName, year), vos.MV)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PCR-GLOBWB (PCRaster Global Water Balance) Global Hydrological Model
+#
+# Copyright (C) 2016, Edwin H. Sutanudjaja, Rens van Beek, Niko Wanders, Yoshihide Wada,
+# Joyce H. C. Bosmans, Niels Drost, Ruud J. van der Ent, Inge E. M. de Graaf, Jannis M. Hoch,
+# Kor de Jong, Derek Karssenberg, Patricia López López, Stefanie Peßenteiner, Oliver Schmitz,
+# Menno W. Straatsma, Ekkamol Vannametee, Dominik Wisser, and Marc F. P. Bierkens
+# Faculty of Geosciences, Utrecht University, Utrecht, The Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Zone-indexed water abstraction and allocation (the 'zoneIndexedWaterAllocation' option of the landSurfaceOptions).
+#
+# virtualOS.waterAbstractionAndAllocation uses several pcr.areatotal operations over the allocation zones (e.g. allocSegments)
+# for every source (desalinated water, surface water, groundwater and fossil groundwater) and every time step. Here, the cells of
+# the allocation zones are indexed once (per allocation zone map) and the zone totals are calculated with numpy.bincount.
+# The zone totals are summed in the (raster) order of the cells, in float64, and given in float32, as with pcr.areatotal.
+#
+# Benchmark (PCRaster versus NumPy) on an allocation zone map, e.g. the global allocation segments:
+#   python zone_allocation.py <allocation_zone_map> [<number_of_repetitions>]
+
+import sys
+import time
+
+import numpy as np
+import pcraster as pcr
+
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# zone indices, one per (allocation_zones, landmask) map objects
+zone_indices = []
+
+
+def get_zone_index(allocation_zones, landmask = None):
+    """
+    Return the zone index of an allocation zone map (created at the first call for the map objects).
+    """
+    for zones, mask, zone_index in zone_indices:
+        if zones is allocation_zones and mask is landmask: return zone_index
+    zone_index = ZoneIndex(allocation_zones, landmask)
+    zone_indices.append((allocation_zones, landmask, zone_index))
+    return zone_index
+
+
+def getValDivZero(x, y, y_lim = vos.smallNumber, z_def = 0.):
+    # see virtualOS.getValDivZero (with missing values for missing denominators)
+    return np.where(np.isnan(y), np.nan, np.where(y > y_lim, x / np.maximum(np.float32(y_lim), y), z_def)).astype(np.float32)
+
+
+class ZoneIndex(object):
+
+    def __init__(self, allocation_zones, landmask = None):
+        object.__init__(self)
+
+        # cells of the allocation zones (flat indices of the clone), within the landmask
+        defined = pcr.defined(allocation_zones)
+        if landmask is not None: defined = defined & pcr.cover(landmask, pcr.boolean(0))
+        defined = pcr.pcr2numpy(defined, 0)
+        self.shape = defined.shape
+        self.cells = np.flatnonzero(defined)
+
+        # zone of every cell (numbered 0, 1, 2, ...)
+        zone_ids = pcr.pcr2numpy(pcr.nominal(allocation_zones), 0).ravel()[self.cells]
+        unique_zone_ids, self.zone_of_cell = np.unique(zone_ids, return_inverse = True)
+        self.zone_of_cell = self.zone_of_cell.ravel()
+        self.number_of_zones = unique_zone_ids.size
+
+        msg = "Zone index of " + str(self.number_of_zones) + " allocation zones (" + str(self.cells.size) + " cells)."
+        logger.debug(msg)
+
+    def to_array(self, pcr_map):
+        """
+        Return the values of a (spatial or non-spatial) map at the cells of the zones (missing values as NaN).
+        """
+        return pcr.pcr2numpy(pcr.spatial(pcr.scalar(pcr_map)), np.nan).ravel()[self.cells]
+
+    def to_map(self, values):
+        """
+        Return a scalar map of values at the cells of the zones (NaN and cells outside the zones as missing values).
+        """
+        grid = np.full(self.shape, vos.MV, dtype = np.float32)
+        grid.ravel()[self.cells] = np.where(np.isnan(values), vos.MV, values)
+        return pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
+
+    def zone_total(self, values):
+        """
+        Return the zone totals of values at the cells of the zones (see pcr.areatotal: missing values are ignored; 
+        zones without any value get missing values).
+        """
+        missing = np.isnan(values)
+        totals = np.bincount(self.zone_of_cell, weights = np.where(missing, 0.0, values).astype(np.float64), minlength = self.number_of_zones)
+        if missing.any():
+            counts = np.bincount(self.zone_of_cell, weights = (~missing).astype(np.float64), minlength = self.number_of_zones)
+            totals[counts == 0] = np.nan
+        return totals.astype(np.float32)[self.zone_of_cell]
+
+
+def waterAbstractionAndAllocation(water_demand_volume,
+                                  available_water_volume, 
+                                  allocation_zones,
+                                  zone_area = None,
+                                  high_volume_treshold = None,
+                                  debug_water_balance = True,\
+                                  extra_info_for_water_balance_reporting = "",
+                                  landmask = None,
+                                  ignore_small_values = False,
+                                  prioritizing_local_source = True):
+    """
+    Zone-indexed version of virtualOS.waterAbstractionAndAllocation (with the same arguments and the same results).
+    """
+
+    logger.debug("Allocation of abstraction (zone indexed).")
+
+    zone_index = get_zone_index(allocation_zones, landmask)
+
+    cellVolDemand = zone_index.to_array(water_demand_volume)
+    cellAvlWater  = zone_index.to_array(available_water_volume)
+    if landmask is not None:
+        cellVolDemand = np.where(np.isnan(cellVolDemand), np.float32(0.0), cellVolDemand)
+        cellAvlWater  = np.where(np.isnan(cellAvlWater) , np.float32(0.0), cellAvlWater)
+
+    # satistify demand with local sources:
+    localAllocation  = np.float32(0.0)
+    localAbstraction = np.float32(0.0)
+    cellVolDemand = np.maximum(np.float32(0.0), cellVolDemand)
+    cellAvlWater  = np.maximum(np.float32(0.0), cellAvlWater)
+    if prioritizing_local_source:
+        localAllocation  = np.maximum(np.float32(0.0), np.minimum(cellVolDemand, cellAvlWater))
+        localAbstraction = localAllocation
+
+    # the remaining demand and available water
+    cellVolDemand = np.maximum(np.float32(0.0), cellVolDemand - localAllocation)
+    cellAvlWater  = np.maximum(np.float32(0.0), cellAvlWater  - localAbstraction)
+
+    # total demand volume in each zone/segment (unit: m3)
+    zoneVolDemand = zone_index.zone_total(cellVolDemand)
+    
+    # avoid very high values of available water
+    cellAvlWater  = np.maximum(np.float32(0.0), np.minimum(cellAvlWater, zoneVolDemand))
+    
+    # total available water volume in each zone/segment (unit: m3)
+    zoneAvlWater  = zone_index.zone_total(cellAvlWater)
+    
+    # total actual water abstraction volume in each zone/segment (unit: m3)
+    zoneAbstraction = np.minimum(zoneAvlWater, zoneVolDemand)
+    
+    # actual water abstraction volume in each cell (unit: m3)
+    cellAbstraction = getValDivZero(cellAvlWater, zoneAvlWater, vos.smallNumber) * zoneAbstraction
+    cellAbstraction = np.minimum(cellAbstraction, cellAvlWater)
+    
+    # to minimize numerical errors
+    if high_volume_treshold is not None:
+        # mask: False for small volumes ; True for large volumes (e.g. lakes and reservoirs)
+        mask = cellAbstraction > high_volume_treshold
+        zoneAbstraction  = zone_index.zone_total(np.where(mask, np.float32(0.0), cellAbstraction))
+        zoneAbstraction += zone_index.zone_total(np.where(mask, cellAbstraction, np.float32(0.0)))
+
+    # allocation water to meet water demand (unit: m3)
+    cellAllocation  = getValDivZero(cellVolDemand, zoneVolDemand, vos.smallNumber) * zoneAbstraction
+    cellAllocation  = np.minimum(cellAllocation, cellVolDemand)
+    
+    # adding local abstraction and local allocation
+    cellAbstraction = cellAbstraction + localAbstraction
+    cellAllocation  = cellAllocation  + localAllocation
+    
+    if debug_water_balance and zone_area is not None:
+
+        zoneArea = zone_index.to_array(zone_area)
+        vos.waterBalanceCheck([pcr.cover(zone_index.to_map(zone_index.zone_total(cellAbstraction)/zoneArea), 0.0)],\
+                              [pcr.cover(zone_index.to_map(zone_index.zone_total(cellAllocation )/zoneArea), 0.0)],\
+                              [pcr.scalar(0.0)],\
+                              [pcr.scalar(0.0)],\
+                              'abstraction - allocation per zone/segment (PS: Error here may be caused by rounding error.)' ,\
+                               True,\
+                               extra_info_for_water_balance_reporting,threshold=1e-4)
+    
+    return zone_index.to_map(cellAbstraction), zone_index.to_map(cellAllocation)
+
+
+def benchmark(allocation_zones, number_of_repetitions = 10):
+    """
+    Compare the calculation times and the results of virtualOS.waterAbstractionAndAllocation and the zone-indexed version 
+    (with random demand and available water volumes).
+    """
+
+    landmask = pcr.defined(allocation_zones)
+    zone_index = get_zone_index(allocation_zones, landmask)
+
+    random = np.random.RandomState(0)
+    grid = np.full(zone_index.shape, vos.MV, dtype = np.float32)
+    grid.ravel()[zone_index.cells] = random.lognormal(10.0, 3.0, zone_index.cells.size)
+    water_demand_volume = pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
+    grid.ravel()[zone_index.cells] = random.lognormal(10.0, 3.0, zone_index.cells.size) * random.randint(0, 2, zone_index.cells.size)
+    available_water_volume = pcr.numpy2pcr(pcr.Scalar, grid, vos.MV)
+
+    results = {}
+    for name, function in [('PCRaster', vos.waterAbstractionAndAllocation), ('NumPy', waterAbstractionAndAllocation)]:
+        start = time.time()
+        for i in range(number_of_repetitions):
+            results[name] = function(water_demand_volume = water_demand_volume,\
+                                     available_water_volume = available_water_volume,\
+                                     allocation_zones = allocation_zones,\
+                                     debug_water_balance = False,\
+                                     landmask = landmask)
+        msg = name + ": " + str((time.time() - start) / number_of_repetitions) + " seconds per allocation."
+        logger.info(msg)
+
+    for i_var, var in enumerate(['abstraction', 'allocation']):
+        pcraster_values = zone_index.to_array(results['PCRaster'][i_var])
+        numpy_values    = zone_index.to_array(results['NumPy'][i_var])
+        relative_difference = np.abs(numpy_values - pcraster_values) / np.maximum(1.0, np.abs(pcraster_values))
+        msg = "Maximum relative difference of the " + var + ": " + str(np.nanmax(relative_difference))
+        logger.info(msg)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    pcr.setclone(sys.argv[1])
+    number_of_repetitions = 10
+    if len(sys.argv) > 2: number_of_repetitions = int(sys.argv[2])
+    benchmark(pcr.nominal(pcr.readmap(sys.argv[1])), number_of_repetitions)
@@ -0,0 +1,89 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+pcr = pytest.importorskip("pcraster")
+pytest.importorskip("netCDF4")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+import landCover
+
+
+def make_land_cover(nrRows = 4, nrCols = 5):
+
+    pcr.setclone(nrRows, nrCols, 1.0, 0.0, float(nrRows))
+
+    rng = np.random.default_rng(0)
+    def random_map(low, high):
+        return pcr.numpy2pcr(pcr.Scalar, rng.uniform(low, high, (nrRows, nrCols)).astype(np.float32), -9999.)
+
+    # a two layer land cover with the memo attributes as set in LandCover.__init__
+    land_cover = landCover.LandCover.__new__(landCover.LandCover)
+    land_cover.transpirationFractionsMemo = None
+    land_cover.totalEvapotranspirationEstimateMemo = None
+
+    land_cover.name = 'forest'
+    land_cover.includeIrrigation = False
+    land_cover.numberOfLayers = 2
+    land_cover.storUpp          = random_map(0.0, 0.2)
+    land_cover.storLow          = random_map(0.0, 0.5)
+    land_cover.adjRootFrUpp     = random_map(0.2, 0.8)
+    land_cover.adjRootFrLow     = 1.0 - land_cover.adjRootFrUpp
+    land_cover.potTranspiration = random_map(0.0, 0.005)
+    land_cover.potBareSoilEvap  = random_map(0.0, 0.002)
+    land_cover.topWaterLayer    = random_map(0.0, 0.01)
+
+    land_cover.parameters = types.SimpleNamespace(rootZoneWaterStorageCap = random_map(0.2, 0.5), kSatUpp = random_map(0.01, 0.1))
+    land_cover.rootZoneWaterStorageRange = random_map(0.05, 0.1)
+    land_cover.arnoBeta             = random_map(0.2, 0.5)
+    land_cover.WFRACB               = random_map(0.1, 0.9)
+    land_cover.satAreaFrac          = random_map(0.0, 0.5)
+    land_cover.effSatAt50           = random_map(0.3, 0.6)
+    land_cover.effPoreSizeBetaAt50  = random_map(4.0, 8.0)
+    land_cover.kUnsatUpp            = random_map(0.001, 0.01)
+
+    return land_cover
+
+
+def to_numpy(pcr_map):
+    return pcr.pcr2numpy(pcr_map, np.nan)
+
+
+def test_transpiration_fractions_are_memorized():
+
+    land_cover = make_land_cover()
+
+    first  = land_cover.getTranspirationFractions()
+    second = land_cover.getTranspirationFractions()
+    assert all([a is b for a, b in zip(first, second)])
+
+    # a new storage map gives new fractions
+    land_cover.storUpp = land_cover.storUpp * 0.5
+    third = land_cover.getTranspirationFractions()
+    assert third[0] is not first[0]
+
+
+def test_total_estimates_are_memorized():
+
+    land_cover = make_land_cover()
+
+    totalEvapotranspiration = land_cover.estimateTranspirationAndBareSoilEvap(returnTotalEstimation = True)
+    totalTranspiration      = land_cover.estimateTranspirationAndBareSoilEvap(returnTotalEstimation = True, returnTotalTranspirationOnly = True)
+    assert land_cover.estimateTranspirationAndBareSoilEvap(returnTotalEstimation = True) is totalEvapotranspiration
+    assert land_cover.estimateTranspirationAndBareSoilEvap(returnTotalEstimation = True, returnTotalTranspirationOnly = True) is totalTranspiration
+
+    # the memorized totals are the same as the totals of a land cover without memos
+    reference = make_land_cover()
+    np.testing.assert_array_equal(to_numpy(totalEvapotranspiration), to_numpy(reference.estimateTranspirationAndBareSoilEvap(returnTotalEstimation = True)))
+    reference = make_land_cover()
+    np.testing.assert_array_equal(to_numpy(totalTranspiration), \
+                                  to_numpy(reference.estimateTranspirationAndBareSoilEvap(returnTotalEstimation = True, returnTotalTranspirationOnly = True)))
+
+    # the actual fluxes (without returnTotalEstimation) can also be calculated twice
+    first  = land_cover.estimateTranspirationAndBareSoilEvap()
+    second = land_cover.estimateTranspirationAndBareSoilEvap()
+    for a, b in zip(first, second): np.testing.assert_array_equal(to_numpy(a), to_numpy(b))
@@ -0,0 +1,99 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pcr = pytest.importorskip("pcraster")
+pytest.importorskip("netCDF4")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+import routing
+import routing_network
+import routing_statistics
+
+
+def make_routing(nrRows = 5, nrCols = 6):
+
+    pcr.setclone(nrRows, nrCols, 1.0, 0.0, float(nrRows))
+
+    # all cells drain to the south; the last row has pits (one basin per column)
+    ldd = np.full((nrRows, nrCols), 2.)
+    ldd[-1, :] = 5.
+
+    routing_object = routing.Routing.__new__(routing.Routing)
+    routing_object.routingEngine = "numpy"
+    routing_object.lddMap = pcr.numpy2pcr(pcr.Ldd, ldd, -9999.)
+    routing_object.routingNetwork = routing_network.RoutingNetwork(ldd)
+    routing_object.routingNetworkLdd = ldd[routing_object.routingNetwork.rows, routing_object.routingNetwork.cols]
+    return routing_object
+
+
+def test_upstream_is_limited_to_the_cells_of_the_ldd():
+
+    routing_object = make_routing()
+    values = pcr.numpy2pcr(pcr.Scalar, np.arange(30.).reshape(5, 6), -9999.)
+
+    result = pcr.pcr2numpy(routing_object.upstream(routing_object.lddMap, values), np.nan)
+    np.testing.assert_array_equal(result[1:], np.arange(24.).reshape(4, 6))
+    np.testing.assert_array_equal(result[0], 0.0)
+
+    # complete basins (the first two columns)
+    mask = np.zeros((5, 6))
+    mask[:, :2] = 1.
+    ldd = pcr.lddmask(routing_object.lddMap, pcr.boolean(pcr.numpy2pcr(pcr.Scalar, mask, 0.)))
+    result = pcr.pcr2numpy(routing_object.upstream(ldd, values), np.nan)
+    np.testing.assert_array_equal(result[1:, :2], np.arange(24.).reshape(4, 6)[:, :2])
+    assert np.all(np.isnan(result[:, 2:]))
+
+
+def test_ldd_with_incomplete_basins_is_not_used():
+
+    routing_object = make_routing()
+    values = pcr.numpy2pcr(pcr.Scalar, np.ones((5, 6)), -9999.)
+
+    mask = np.ones((5, 6))
+    mask[:2, 0] = 0.
+    ldd = pcr.lddmask(routing_object.lddMap, pcr.boolean(pcr.numpy2pcr(pcr.Scalar, mask, -9999.)))
+    with pytest.raises(Exception):
+        routing_object.upstream(ldd, values)
+
+
+def test_accutraveltime_state_from_the_mass_balance_is_equal_to_accutraveltimestate():
+
+    pcr.setclone(6, 5, 1.0, 0.0, 6.0)
+
+    # random directions to the south-west, south and south-east (within the clone); the last row has pits
+    random = np.random.RandomState(0)
+    ldd_values = random.choice([1., 2., 3.], (6, 5))
+    ldd_values[:, 0][ldd_values[:, 0] == 1.] = 2.
+    ldd_values[:, -1][ldd_values[:, -1] == 3.] = 2.
+    ldd_values[-1, :] = 5.
+
+    routing_object = routing.Routing.__new__(routing.Routing)
+    routing_object.lddMap   = pcr.numpy2pcr(pcr.Ldd, ldd_values, -9999.)
+    routing_object.landmask = pcr.defined(routing_object.lddMap)
+
+    storage  = pcr.numpy2pcr(pcr.Scalar, random.uniform(0., 1e6, (6, 5)), -9999.)
+    distance = pcr.numpy2pcr(pcr.Scalar, random.uniform(0.5, 3.0, (6, 5)), -9999.)
+
+    flux     = pcr.accutraveltimeflux(routing_object.lddMap, storage, distance)
+    expected = pcr.pcr2numpy(pcr.accutraveltimestate(routing_object.lddMap, storage, distance), np.nan)
+    result   = pcr.pcr2numpy(routing_object.getAccuTravelTimeStateFromFlux(storage, flux), np.nan)
+
+    # the same storage (also at the pits), up to the float32 rounding of the sums
+    np.testing.assert_allclose(result, expected, rtol = 1e-5, atol = 10.)
+
+
+def test_rolling_statistics_are_equal_to_the_statistics_of_the_maps():
+
+    routing_objects = [routing_statistics.synthetic_routing(6, 7, vectorized) for vectorized in [False, True]]
+    for day in range(1, 40):
+        for routing_object, groundwater in routing_objects:
+            routing_statistics.set_synthetic_daily_values(routing_object, groundwater, day)
+            routing_object.calculate_statistics(groundwater)
+
+    for var in routing_statistics.updated_statistic_names:
+        np.testing.assert_array_equal(pcr.pcr2numpy(vars(routing_objects[1][0])[var], np.nan), \
+                                      pcr.pcr2numpy(vars(routing_objects[0][0])[var], np.nan), err_msg = var)
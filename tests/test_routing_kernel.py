@@ -0,0 +1,28 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+import routing_kernel
+
+
+def test_basin_class_on_its_subnetwork_is_equal_to_the_region():
+
+    network, daily_values, initial_values, no_water_bodies = routing_kernel.synthetic_network_and_values(15, 20)
+
+    # a class with every third basin
+    basins = network.basins()
+    in_class = (basins % 3) == 0
+    cells = np.nonzero(in_class)[0]
+
+    region_kernel = routing_kernel.SubStepKernel(network, 0.6, 0.001, False)
+    subset_kernel = routing_kernel.SubsetSubStepKernel(network, cells, routing_kernel.SubStepKernel(network.subnetwork(cells), 0.6, 0.001, False))
+    for kernel in [region_kernel, subset_kernel]:
+        kernel.set_daily_values(dict(daily_values, region = in_class))
+        kernel.run(6, 86400. / 6, 86400., initial_values, no_water_bodies)
+
+    for name in routing_kernel.result_names:
+        assert np.all(np.isnan(vars(subset_kernel)[name][in_class == False])), name
+        np.testing.assert_array_equal(vars(subset_kernel)[name], vars(region_kernel)[name], err_msg = name)
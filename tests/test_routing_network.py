@@ -0,0 +1,102 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+import routing_network
+
+
+def make_ldd(nrRows = 12, nrCols = 9, seed = 0):
+
+    # random directions to the south-west, south and south-east; pits at the last row
+    rng = np.random.default_rng(seed)
+    ldd = rng.choice([1, 2, 3], size = (nrRows, nrCols))
+    ldd[:, 0]  = np.where(ldd[:, 0]  == 1, 2, ldd[:, 0])
+    ldd[:, -1] = np.where(ldd[:, -1] == 3, 2, ldd[:, -1])
+    ldd[-1, :] = 5
+    return ldd
+
+
+def reference_iteration(q_in, q_old, q, alpha, beta, delta_t, delta_x):
+
+    # the Newton-Raphson scheme of the PCRaster kinematic operator for one cell: in long double, with the absolute tolerance 1e-12
+    q_in, q_old, q, alpha, beta, delta_t, delta_x = [np.longdouble(value) for value in [q_in, q_old, q, alpha, beta, delta_t, delta_x]]
+    if q_in + q_old + q == 0.0: return 0.0
+    ab_pq    = alpha * beta * ((q_old + q_in) / 2)**(beta - 1)
+    delta_tx = delta_t / delta_x
+    c        = delta_tx * q_in + alpha * q_old**beta + delta_t * q
+    q_k1     = max((delta_tx * q_in + q_old * ab_pq + delta_t * q) / (delta_tx + ab_pq), np.longdouble(1e-30))
+    count = 0
+    while True:
+        f_qkx  = delta_tx * q_k1 + alpha * q_k1**beta - c
+        df_qkx = delta_tx + alpha * beta * q_k1**(beta - 1)
+        q_k1   = max(q_k1 - f_qkx / df_qkx, np.longdouble(1e-30))
+        count += 1
+        if abs(f_qkx) <= 1e-12 or count >= 3000: return float(q_k1)
+
+
+def reference_kinematic(ldd, discharge, alpha, beta, delta_t, delta_x):
+
+    # cell by cell, following the upstream cells recursively
+    result = {}
+    def new_discharge(row, col):
+        if (row, col) not in result:
+            q_in = 0.0
+            for direction in range(1, 10):
+                up_row = row - routing_network.ldd_row_offsets[direction]
+                up_col = col - routing_network.ldd_column_offsets[direction]
+                if direction != 5 and 0 <= up_row < ldd.shape[0] and 0 <= up_col < ldd.shape[1] and ldd[up_row, up_col] == direction:
+                    q_in += new_discharge(up_row, up_col)
+            result[(row, col)] = reference_iteration(q_in, discharge[row, col], 0.0, alpha[row, col], beta, delta_t, delta_x)
+        return result[(row, col)]
+    grid = np.zeros(ldd.shape)
+    for row in range(ldd.shape[0] - 1, -1, -1):
+        for col in range(ldd.shape[1]): grid[row, col] = new_discharge(row, col)
+    return grid
+
+
+def test_upstream():
+
+    ldd = make_ldd()
+    network = routing_network.RoutingNetwork(ldd)
+    values = np.random.default_rng(1).uniform(0.0, 10.0, ldd.shape)
+
+    expected = np.zeros(ldd.shape)
+    for row in range(ldd.shape[0]):
+        for col in range(ldd.shape[1]):
+            if ldd[row, col] != 5:
+                expected[row + routing_network.ldd_row_offsets[ldd[row, col]], col + routing_network.ldd_column_offsets[ldd[row, col]]] += values[row, col]
+
+    np.testing.assert_allclose(network.to_grid(network.upstream(network.to_flat(values))), expected, rtol = 1e-12)
+
+
+def test_kinematic_is_equal_to_the_pcraster_scheme():
+
+    ldd = make_ldd()
+    network = routing_network.RoutingNetwork(ldd)
+    rng = np.random.default_rng(2)
+    alpha = rng.uniform(1.0, 10.0, ldd.shape)
+
+    # small and large discharge values: the float64 iteration uses a relative tolerance for large values (see routing_network.kinematic_epsilon)
+    for scale in [1.0, 1.0e4, 1.0e6]:
+        discharge = rng.gamma(0.5, scale, ldd.shape)
+        discharge[0, :3] = 0.0
+        result = network.kinematic(network.to_flat(discharge), 0.0, network.to_flat(alpha), 0.6, 1, 3600., 5000.)
+        np.testing.assert_allclose(network.to_grid(result), reference_kinematic(ldd, discharge, alpha, 0.6, 3600., 5000.), rtol = 1e-12)
+
+
+def test_kinematic_iterations_converge_for_large_values():
+
+    # with an absolute tolerance of 1e-12, the float64 iteration would not converge for these values (3000 iterations)
+    q_in, q_old, alpha = np.array([2.0e5, 1.0e6]), np.array([1.0e5, 3.0e6]), np.array([5.0, 8.0])
+    delta_tx = np.full(2, 3600. / 5000.)
+    c = delta_tx * q_in + alpha * q_old**0.6
+    assert np.all(np.spacing(c) > 1e-12)
+
+    result = routing_network.newton_raphson(q_in, q_old, np.zeros(2), alpha, 0.6, 3600., delta_tx)
+    f = delta_tx * result + alpha * result**0.6 - c
+    assert np.all(np.abs(f) <= 1e-12 * c)
+    np.testing.assert_allclose(result, [reference_iteration(*values, 0.0, alpha_value, 0.6, 3600., 5000.) \
+                                        for values, alpha_value in zip(zip(q_in, q_old), alpha)], rtol = 1e-12)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+import routing_statistics
+
+
+def test_update_is_equal_to_the_formula_of_calculate_statistics():
+
+    number_of_cells = 1000
+    random_state = np.random.RandomState(0)
+
+    statistics = routing_statistics.RollingStatistics(number_of_cells)
+    expected = {}
+    for name in routing_statistics.updated_statistic_names:
+        expected[name] = (100. * random_state.random_sample(number_of_cells)).astype(np.float32)
+        statistics.set(name, expected[name])
+
+    for day in range(1, 100):
+        discharge = (100. * random_state.random_sample(number_of_cells)).astype(np.float32)
+        baseflow  = (0.1  * random_state.random_sample(number_of_cells)).astype(np.float32)
+        number_of_time_steps_long, number_of_time_steps_short = np.float32(min(1825., day)), np.float32(min(30., day))
+        statistics.update(discharge, baseflow, number_of_time_steps_long, number_of_time_steps_short)
+
+        # the (float32) PCRaster expressions of routing.Routing.calculate_statistics
+        deltaAnoDischarge = discharge - expected['avgDischarge']
+        expected['avgDischarge'] = np.maximum(np.float32(0.0), expected['avgDischarge'] + deltaAnoDischarge / number_of_time_steps_long)
+        expected['m2tDischarge'] = expected['m2tDischarge'] + np.abs(deltaAnoDischarge * (discharge - expected['avgDischarge']))
+        deltaAnoDischargeShort = discharge - expected['avgDischargeShort']
+        expected['avgDischargeShort'] = np.maximum(np.float32(0.0), expected['avgDischargeShort'] + deltaAnoDischargeShort / number_of_time_steps_short)
+        deltaAnoBaseflow = baseflow - expected['avgBaseflow']
+        expected['avgBaseflow'] = np.maximum(np.float32(0.0), expected['avgBaseflow'] + deltaAnoBaseflow / number_of_time_steps_long)
+
+        for name in routing_statistics.updated_statistic_names:
+            assert expected[name].dtype == np.float32
+            np.testing.assert_array_equal(statistics.get(name), expected[name], err_msg = name + " (day " + str(day) + ")")
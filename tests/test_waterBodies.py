@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pcr = pytest.importorskip("pcraster")
+pytest.importorskip("netCDF4")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "model"))
+
+import waterBodies
+import routing
+
+nrRows, nrCols = 6, 7
+
+
+def make_map(values, kind = None):
+    if kind is None: kind = pcr.Scalar
+    return pcr.numpy2pcr(kind, np.asarray(values, dtype = np.float32), -9999.)
+
+
+def make_water_bodies(useSparseWaterBodies):
+
+    pcr.setclone(nrRows, nrCols, 1.0, 0.0, float(nrRows))
+
+    rng = np.random.default_rng(1)
+    landmask = np.ones((nrRows, nrCols))
+    landmask[5, 0] = -9999.
+
+    # all cells drain to the east; the last column has pits
+    ldd = np.full((nrRows, nrCols), 6.)
+    ldd[:, -1] = 5.
+    ldd[landmask < 0] = -9999.
+
+    # a lake (id 3) and a reservoir (id 7, also with a cell in another row)
+    ids = np.zeros((nrRows, nrCols))
+    ids[1, 1:3] = 3
+    ids[3, 2:5] = 7
+    ids[4, 4]   = 7
+    outlets = np.zeros((nrRows, nrCols))
+    outlets[1, 2] = 1
+    outlets[3, 4] = 1
+    types = np.where(ids == 3, 1, np.where(ids == 7, 2, 0))
+
+    water_bodies = waterBodies.WaterBodies.__new__(waterBodies.WaterBodies)
+    water_bodies.useSparseWaterBodies = useSparseWaterBodies
+    water_bodies.debugWaterBalance = False
+    water_bodies.landmask = pcr.boolean(make_map(landmask))
+    water_bodies.lddMap   = make_map(ldd, pcr.Ldd)
+    water_bodies.minWeirWidth = 10.0
+    water_bodies.minResvrFrac = 0.10
+    water_bodies.maxResvrFrac = 0.75
+
+    in_landmask = lambda pcr_map: pcr.ifthen(water_bodies.landmask, pcr_map)
+    water_bodies.waterBodyIds  = in_landmask(make_map(ids, pcr.Nominal))
+    water_bodies.waterBodyOut  = in_landmask(pcr.boolean(make_map(outlets)))
+    water_bodies.waterBodyTyp  = in_landmask(make_map(types, pcr.Nominal))
+    water_bodies.waterBodyArea = in_landmask(make_map(np.where(ids == 3, 2.0e6, np.where(ids == 7, 4.0e6, 0.0))))
+    water_bodies.waterBodyCap  = in_landmask(make_map(np.where(ids == 7, 5.0e5, 0.0)))
+
+    # states: values at the lakes/reservoirs and some remaining states (e.g. of a removed reservoir)
+    storage = np.where(ids == 3, 3.0e5, np.where(ids == 7, 2.0e5, 0.0))
+    storage[5, 5] = 1234.
+    water_bodies.waterBodyStorage = in_landmask(make_map(storage))
+    water_bodies.avgInflow        = in_landmask(make_map(np.where(ids > 0, rng.uniform(0.5, 2.0, (nrRows, nrCols)), 0.0)))
+    water_bodies.avgOutflow       = in_landmask(make_map(np.where(ids == 3, 1.5, 0.0)))
+
+    return water_bodies
+
+
+def inputs(water_bodies, step):
+
+    rng = np.random.default_rng(10 + step)
+    new_storage = pcr.ifthen(water_bodies.landmask, make_map(np.floor(rng.uniform(0.0, 5.0e4, (nrRows, nrCols)))))
+    new_storage = pcr.cover(pcr.ifthen(pcr.scalar(water_bodies.waterBodyIds) > 0., new_storage), 0.0)
+    avg_channel_discharge = pcr.ifthen(water_bodies.landmask, make_map(rng.uniform(0.0, 3.0, (nrRows, nrCols))))
+    downstream_demand     = pcr.ifthen(water_bodies.landmask, make_map(rng.uniform(0.0, 0.5, (nrRows, nrCols))))
+    return new_storage, pcr.ifthen(water_bodies.landmask, pcr.scalar(5.0 + step)), avg_channel_discharge, downstream_demand
+
+
+def update(water_bodies, step):
+
+    new_storage, timesteps, avg_channel_discharge, downstream_demand = inputs(water_bodies, step)
+    water_bodies.update(new_storage, timesteps, 30., 365., None, avg_channel_discharge, 3600., downstream_demand)
+
+
+def to_numpy(pcr_map):
+    return pcr.pcr2numpy(pcr_map, np.nan)
+
+
+def test_sparse_water_bodies_are_equal_to_the_maps():
+
+    sparse, maps = make_water_bodies(True), make_water_bodies(False)
+
+    for step in range(4):
+        update(sparse, step)
+        update(maps, step)
+        for var in ['inflow', 'inflowInM3PerSec', 'waterBodyOutflow', 'waterBodyStorage', 'avgInflow', 'avgOutflow']:
+            np.testing.assert_array_equal(to_numpy(vars(sparse)[var]), to_numpy(vars(maps)[var]), err_msg = var)
+        np.testing.assert_array_equal(to_numpy(sparse.getWaterBodyOutflowAtOutlets()), to_numpy(maps.getWaterBodyOutflowAtOutlets()))
+
+
+def test_sparse_water_bodies_on_a_network_are_equal_to_the_maps():
+
+    sparse, maps = make_water_bodies(True), make_water_bodies(False)
+
+    # the land cells in another order than the clone (as a routing network)
+    network_cells = np.flatnonzero(to_numpy(pcr.scalar(maps.landmask)).ravel() == 1)[::-1].copy()
+
+    for step in range(4):
+        new_storage, timesteps, avg_channel_discharge, downstream_demand = inputs(maps, step)
+        outflow, storage = sparse.updateSparseWaterBodiesOnNetwork(to_numpy(new_storage).ravel()[network_cells], network_cells, \
+                                                                   timesteps, 30., 365., avg_channel_discharge, 3600., downstream_demand)
+        update(maps, step)
+        np.testing.assert_array_equal(outflow, to_numpy(maps.getWaterBodyOutflowAtOutlets()).ravel()[network_cells])
+        np.testing.assert_array_equal(storage, to_numpy(maps.waterBodyStorage).ravel()[network_cells])
+
+    # the maps are only made after the sub time steps
+    sparse.synchronizeSparseMaps()
+    for var in ['inflow', 'inflowInM3PerSec', 'waterBodyOutflow', 'waterBodyStorage', 'avgInflow', 'avgOutflow']:
+        np.testing.assert_array_equal(to_numpy(vars(sparse)[var]), to_numpy(vars(maps)[var]), err_msg = var)
+
+
+def test_sparse_storage_returned_to_channel_is_equal_to_the_maps():
+
+    results = []
+    for useSparseWaterBodies in [True, False]:
+        water_bodies = make_water_bodies(useSparseWaterBodies)
+        update(water_bodies, 0)
+        routing_object = routing.Routing.__new__(routing.Routing)
+        routing_object.WaterBodies = water_bodies
+        routing_object.landmask = water_bodies.landmask
+        routing_object.cellArea = pcr.ifthen(water_bodies.landmask, make_map(np.random.default_rng(2).uniform(0.9e6, 1.1e6, (nrRows, nrCols))))
+        channel_storage = pcr.ifthen(water_bodies.landmask, make_map(np.random.default_rng(3).uniform(0.0, 1.0e4, (nrRows, nrCols))))
+        results.append(to_numpy(routing_object.return_water_body_storage_to_channel(channel_storage)))
+
+    np.testing.assert_array_equal(results[0], results[1])
+
+
+def test_sparse_water_bodies_are_rebuilt_only_for_new_values():
+
+    water_bodies = make_water_bodies(True)
+    update(water_bodies, 0)
+    cells = water_bodies.sparseCells
+
+    # states and lakes/reservoirs replaced by maps with the same values (e.g. the merging of basin classes)
+    for var in ['waterBodyStorage', 'avgInflow', 'avgOutflow', 'waterBodyIds', 'waterBodyCap']:
+        vars(water_bodies)[var] = pcr.ifthen(water_bodies.landmask, vars(water_bodies)[var])
+    water_bodies.checkSparseWaterBodies()
+    assert water_bodies.sparseCells is cells
+
+    # a storage outside the calculation cells and a new reservoir capacity
+    water_bodies.waterBodyStorage = pcr.ifthenelse(water_bodies.waterBodyOut, water_bodies.waterBodyStorage, pcr.scalar(1.0))
+    water_bodies.checkSparseWaterBodies()
+    assert water_bodies.sparseCells is not cells and water_bodies.sparseCells.size > cells.size
+    cells = water_bodies.sparseCells
+    water_bodies.waterBodyCap = water_bodies.waterBodyCap * 2.0
+    water_bodies.checkSparseWaterBodies()
+    assert water_bodies.sparseCells is not cells
+    np.testing.assert_array_equal(water_bodies.sparseWaterBodyCap, to_numpy(water_bodies.waterBodyCap).ravel()[water_bodies.sparseCells])